@@ -275,7 +275,50 @@ Now process the extracted text (between the demarcation markers) and the origina
 ---EXTRACTED TEXT ENDS HERE---
 """
 
+flashcard_tile_note = """
+The attached image is one region of a larger textbook page, cut with a small overlap to the neighbouring regions, and the extracted text above is the part of the page's text that lies in or near this region. Only generate flashcards for vocabulary that is visible in the attached image. Skip any word that is cut off at the edge of the image: the neighbouring region contains it in full.
+"""
+
+flashcard_json_note = """
+Return the flashcards as a JSON array with one object per flashcard, using the fields "kanji", "furigana" and "english_translation_and_notes" instead of CSV columns. The CSV examples above show what belongs in each field.
+"""
 
+flashcard_repair_prompt = """
+Some entries of a JSON array of Japanese vocabulary flashcards were malformed or cut off. Each flashcard must be a JSON object with the string fields "kanji", "furigana" and "english_translation_and_notes", where "kanji" is the word in Kanji (or Hiragana/Katakana if it has no Kanji) and "furigana" is its reading in Hiragana.
 
+Rewrite only the malformed entries below as valid flashcards, using the extracted text of the textbook page to complete any entry that was cut off. Return a JSON array with one object per flashcard and nothing else.
 
+---MALFORMED ENTRIES START HERE---
 
+{rows}
+
+---MALFORMED ENTRIES END HERE---
+
+---EXTRACTED TEXT STARTS HERE---
+
+{extracted_text}
+
+---EXTRACTED TEXT ENDS HERE---
+"""
+
+suitability_repair_prompt = """
+The following answer to the question whether an image is suitable for generating Japanese vocabulary flashcards is not valid JSON of the expected form. Rewrite it as a JSON object with the fields "is_suitable" ("Yes" or "No") and "reason" (a short explanation), keeping its verdict and reason. Return only the JSON object.
+
+---ANSWER STARTS HERE---
+
+{answer}
+
+---ANSWER ENDS HERE---
+"""
+
+
+single_pass_note = """
+Before writing any flashcard, assess whether the attached image is suitable for generating Japanese/English flashcards. It is suitable only if it contains Japanese text (Kanji, Hiragana, Katakana), ideally with English translations or notes, and the text is clear and legible.
+
+Return a single JSON object instead of CSV, with the fields:
+- "is_suitable": "Yes" or "No"
+- "reason": A brief explanation for your decision (max 1-2 sentences)
+- "vocabulary": The flashcards as a JSON array with one object per flashcard, using the fields "kanji", "furigana" and "english_translation_and_notes" instead of CSV columns (the CSV examples above show what belongs in each field). Leave the array empty if the image is not suitable.
+
+Do not output any text outside of the JSON object. Do not wrap the JSON output in backticks or code blocks.
+"""
@@ -1,25 +1,1533 @@
 # Building a Streamlit UI for code in 'Flashcard_Generation_LLM.ipynb'
 # Importing the required libraries
+import time
+# Taken before the other imports, so the startup measurement includes them
+_script_start = time.perf_counter()
 import streamlit as st
-import google.generativeai as genai
 import PIL.Image
+import PIL.ImageOps
 import json
-from unstract.llmwhisperer import LLMWhispererClientV2
 import os
-from io import BytesIO
-from dotenv import load_dotenv
-import base64
+import threading
+import queue
+import uuid
+import contextvars
+from io import BytesIO, StringIO
+from collections import deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from pipeline_resources import get_pipeline_resources
+from image_preprocessing import describe_preprocessing, get_shared_preprocess_executor, preprocess_page
+from rate_limiter import GEMINI_API, LLMWHISPERER_API, get_shared_rate_limiter, is_retryable
+from flashcard_deck import (
+    FlashcardDeck,
+    FlashcardJsonStreamParser,
+    FlashcardStreamParser,
+    parse_flashcards,
+    parse_flashcards_json,
+    write_flashcards,
+)
+from known_vocabulary import estimate_tokens, load_known_vocabulary
+from duplicate_pages import DEFAULT_PAGE_INDEX_PATH, SKIP_DUPLICATES, PageIndex, fingerprint_upload
+from model_router import ESCALATE_ERROR, ESCALATE_INVALID, short_model_name, token_cost
+from fair_scheduler import PRIORITY_BATCH, get_shared_scheduler, priority_for_pages
+from document_pages import DEFAULT_DPI, MAX_DPI, MIN_DPI, count_pages, expand_uploads
+from job_store import DEFAULT_JOB_STORE_PATH, DEFAULT_JOB_WORKERS, JOB_QUEUED, JobStore
+from ocr_poller import get_shared_poller
+from token_budget import estimate_gemini_tokens, get_shared_token_planner, plan_key, scale_image, text_tokens
+from page_tiling import merge_tile_cards, plan_tiles, tile_count, tile_text
+from pipeline_metrics import ENCODED_BYTES_INFO_KEY, get_shared_metrics, read_usage, request_bytes
+from upload_spool import SPILL_THRESHOLD_BYTES, backing_path, release_upload, upload_size
+from structured_output import (
+    FLASHCARD_SCHEMA,
+    MAX_REPAIR_ROW_CHARACTERS,
+    SINGLE_PASS_SCHEMA,
+    STRUCTURED_OUTPUT,
+    SUITABILITY_SCHEMA,
+    SinglePassStreamParser,
+    StructuredOutputError,
+    format_repair_rows,
+    json_generation_config,
+    parse_single_pass,
+    parse_suitability,
+    repair_report,
+    strip_fences,
+)
+from result_cache import (
+    FLASHCARD_STAGE,
+    OCR_STAGE,
+    SUITABILITY_STAGE,
+    ResultCache,
+    hash_strings,
+    hash_stream,
+)
 
 # Importing all variables from LLM_Prompts.py
 from LLM_Prompts import *
 
+# -----------------------------
+# Speculative OCR
+# -----------------------------
+# With speculative OCR the LLMWhisperer extraction starts at the same time as the
+# suitability check instead of after it. The shared executor bounds how many
+# speculative uploads are in flight across all runs in this process; once a page
+# is uploaded its extraction is tracked by the shared WhisperPoller.
+SPECULATIVE_OCR_WORKERS = int(os.getenv("FLASHCARD_SPECULATIVE_OCR_WORKERS", "8"))
+_speculative_ocr_executor = ThreadPoolExecutor(
+    max_workers=SPECULATIVE_OCR_WORKERS,
+    thread_name_prefix="speculative-ocr"
+)
+_speculative_ocr_lock = threading.Lock()
+_speculative_ocr_stats = {"started": 0, "used": 0, "wasted": 0, "cancelled": 0}
+
+# Function to count a speculative OCR outcome
+# outcome: "started", "used", "wasted" (extraction ran for a rejected page) or "cancelled" (never sent)
+# Returns: None
+def record_speculative_ocr(outcome):
+    with _speculative_ocr_lock:
+        _speculative_ocr_stats[outcome] += 1
+
+# Function to report how often speculative OCR paid off in this process
+# Returns: Dictionary of counters plus the share of started extractions that were wasted
+def get_speculative_ocr_stats():
+    with _speculative_ocr_lock:
+        stats = dict(_speculative_ocr_stats)
+    stats["waste_rate"] = stats["wasted"] / stats["started"] if stats["started"] else 0.0
+    return stats
+
+# -----------------------------
+# Dense-page tiling
+# -----------------------------
+# With tiling, a page with a lot of vocabulary is cut into overlapping regions (see
+# page_tiling.py) and each region's flashcards are written by a call of its own. The
+# calls run at the same time on this shared executor, so a dense page takes about as
+# long as its largest region instead of as long as one very long answer.
+TILE_WORKERS = int(os.getenv("FLASHCARD_TILE_WORKERS", "8"))
+_tile_executor = ThreadPoolExecutor(
+    max_workers=TILE_WORKERS,
+    thread_name_prefix="flashcard-tile"
+)
+
+# -----------------------------
+# Single-pass mode
+# -----------------------------
+# In two-pass mode (the default) a page gets a suitability call and, if it is suitable, a
+# flashcard call, each uploading the image. In single-pass mode OCR runs first and one call
+# with a combined prompt returns the verdict and the flashcards together (SINGLE_PASS_SCHEMA):
+# suitable pages save a round-trip and an upload, rejected ones cost an OCR call and a longer
+# prompt. benchmarks/ab_single_pass.py compares the two on a fixed page set.
+TWO_PASS = "two_pass"
+SINGLE_PASS = "single_pass"
+PIPELINE_MODES = (TWO_PASS, SINGLE_PASS)
+
+# -----------------------------
+# Run options
+# -----------------------------
+# How a run processes its pages, passed down to every stage
+# max_workers: Number of pages processed concurrently (1 keeps the sequential behaviour)
+# cache: Optional ResultCache; pages seen before skip the stages whose inputs are unchanged
+# preprocess_images: If True, re-encode each page into smaller LLM and OCR inputs before uploading
+# speculative_ocr: If True, start OCR alongside the suitability check and discard it if the page is rejected
+# on_event: Optional callback receiving per-page progress events (see generate_japanese_flashcards_stream)
+# rate_limiter: Optional RateLimitScheduler applying quotas and retries to every API call; process_pages
+#               defaults it to the process-wide one shared by all runs
+# known_vocabulary: Optional KnownVocabulary; entries for known words are dropped from the OCR text and the cards
+# metrics: Optional PipelineMetrics that each page's timings, bytes, tokens and retries are added to
+#          (every page is also counted in the process-wide get_shared_metrics())
+# scheduler: Optional FairScheduler shared by all sessions; pages are then queued on it instead of a pool of the
+#            run's own, and max_workers only bounds how many of the run's pages are queued ahead
+# user_id: Whose share of the scheduler the pages count against (e.g. the session)
+# priority: PRIORITY_INTERACTIVE or PRIORITY_BATCH (see fair_scheduler.priority_for_pages)
+# page_range: Optional pages of each PDF/TIFF to process, e.g. "1-20, 25" (see document_pages.parse_page_range)
+# dpi: Resolution PDF pages are rendered at (higher-resolution TIFF scans are scaled down to it)
+# tile_pages: If True, a page with a lot of OCR text gets its flashcards from concurrent calls over overlapping
+#             regions of the page, merged and de-duplicated (see page_tiling.py)
+# pipeline_mode: TWO_PASS (a suitability call, then OCR and a flashcard call for suitable pages) or SINGLE_PASS
+#                (OCR, then one call returning the verdict and the flashcards together; pages are then not tiled
+#                and OCR is never speculative, as every page is read)
+# skip_duplicates: If True, a page that is a near-duplicate of an earlier page of the run (a retake, re-scan or
+#                  re-crop) gets no API calls; its cards are already in the deck (see duplicate_pages.py)
+# page_index: Optional PageIndex of the pages of earlier runs; with a cache, a near-duplicate of one of them reuses
+#             that page's cached stages, and new pages are added to it
+# token_planner: Optional TokenBudgetPlanner fitting each Gemini call to its input-token budget by scaling the
+#                images down and leaving examples out (defaults to the process-wide one, see token_budget.py)
+PipelineConfig = namedtuple(
+    "PipelineConfig",
+    [
+        "max_workers", "cache", "preprocess_images", "speculative_ocr", "on_event", "rate_limiter",
+        "known_vocabulary", "metrics", "scheduler", "user_id", "priority", "page_range", "dpi",
+        "tile_pages", "pipeline_mode", "skip_duplicates", "page_index", "token_planner",
+    ],
+    defaults=(
+        1, None, False, False, None, None,
+        None, None, None, None, PRIORITY_BATCH, None, DEFAULT_DPI,
+        False, TWO_PASS, False, None, None,
+    ),
+)
+
+# Function to return a cached stage output, or compute it and store it in the cache
+# cache: A ResultCache, or None to always compute
+# stage: The cache namespace of the stage (SUITABILITY_STAGE, OCR_STAGE or FLASHCARD_STAGE)
+# key: The cache key for this page and stage
+# compute: Callable producing the stage output as a string; exceptions are not cached
+# hits: Optional list the stage name is appended to when the output came from the cache
+# Returns: The stage output string
+def run_cached_stage(cache, stage, key, compute, hits=None):
+    if cache is None:
+        return compute()
+    value = cache.get(stage, key)
+    if value is None:
+        value = compute()
+        cache.put(stage, key, value)
+    elif hits is not None:
+        hits.append(stage)
+    return value
+
+# Function to create the result of a page before any stage has run
+# idx: 1-based position of the page in the upload
+# Returns: Page result dictionary (see process_single_image)
+def empty_page_result(idx):
+    return {
+        "index": idx,
+        "flashcards": "",
+        "notes": [],
+        "cards": [],
+        "speculative_ocr": None,
+        "suitability": None,
+        "ocr_text": None,
+        "timings": {},
+        "retries": {},
+        "bytes_uploaded": {},
+        "tokens": {},
+        "api_calls": {},
+        "cached_stages": [],
+        "cache_hashes": None,
+        "known_vocabulary": None,
+        "tiles": None,
+        "repairs": {},
+        "prefix_cache": None,
+        "models": [],
+        "token_plans": [],
+        "duplicate": None,
+        "error": None,
+        "error_stage": None,
+    }
+
+class PageRun:
+    """
+    One page on its way through the stages: its result dictionary, the decoded page
+    and the bookkeeping every stage shares.
+
+    Progress events, API calls through the rate limiter, uploaded bytes, token usage,
+    token plans, repairs and model attempts are all recorded here, under one lock, as
+    the tiles of a dense page report from several threads. stage_models holds the model
+    each stage calls; with a router it starts on the cheapest one and run_tiers moves
+    it up as the page escalates.
+    """
+
+    def __init__(self, idx, resources, config):
+        self.idx = idx
+        self.resources = resources
+        self.config = config
+        self.token_planner = config.token_planner or get_shared_token_planner()
+        self.result = empty_page_result(idx)
+        self.notes = self.result["notes"]
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.stage_models = {SUITABILITY_STAGE: resources.model, FLASHCARD_STAGE: resources.model}
+        if resources.router is not None:
+            self.stage_models = {stage: resources.router.models(stage)[0] for stage in self.stage_models}
+        # Whether the current model of a stage has a stronger one behind it
+        self.can_escalate = {SUITABILITY_STAGE: False, FLASHCARD_STAGE: False}
+        # One entry per streamed flashcard answer, so a retried stream tells the caller to drop its cards
+        self.streamed_attempts = []
+        # Set by open_page
+        self.image = None
+        self.page_bytes = 0
+        self.ocr_file = None
+        self.ocr_request_start = self.start  # When the page was sent to OCR, set by submit_ocr
+        self._scaled_pages = {}
+
+    # Function to finish the page
+    # Returns: The page result, with its total time
+    def finish(self):
+        self.result["timings"]["total"] = time.perf_counter() - self.start
+        return self.result
+
+    # Function to record a failed stage
+    # Returns: The page result
+    def fail(self, msg, stage):
+        self.notes.append(msg)
+        self.result["error"] = msg
+        self.result["error_stage"] = stage
+        return self.finish()
+
+    # Function to report a progress event for this page to the caller, if it asked for them
+    def emit(self, event_type, **fields):
+        if self.config.on_event is not None:
+            self.config.on_event({"type": event_type, "index": self.idx, **fields})
+
+    # Function to report cards to the caller as CSV rows, like the streamed text of free-text answers
+    def emit_cards(self, cards):
+        if cards:
+            cards_text = StringIO()
+            write_flashcards(cards, cards_text)
+            self.emit("cards", text=cards_text.getvalue())
+
+    # Function to make an API call through the rate limiter, counting this page's retries per stage
+    def call_api(self, api, stage, fn, estimated_tokens=0):
+        with self.lock:
+            self.result["api_calls"][api] = self.result["api_calls"].get(api, 0) + 1
+        if self.config.rate_limiter is None:
+            return fn()
+
+        def on_retry(attempt, delay, error):
+            with self.lock:
+                self.result["retries"][stage] = self.result["retries"].get(stage, 0) + 1
+
+        return self.config.rate_limiter.call(api, fn, estimated_tokens=estimated_tokens, on_retry=on_retry)
+
+    # Function to count the bytes of one request attempt (retries put the payload on the wire again)
+    def record_upload(self, stage, size):
+        with self.lock:
+            self.result["bytes_uploaded"][stage] = self.result["bytes_uploaded"].get(stage, 0) + size
+
+    # Function to add up the token usage Gemini reported for a stage's calls
+    def record_usage(self, stage, response):
+        usage = read_usage(response)
+        if usage is not None:
+            with self.lock:
+                totals = self.result["tokens"].setdefault(stage, {})
+                for field, count in usage.items():
+                    totals[field] = totals.get(field, 0) + count
+
+    # Function to keep a planned call's predicted and reported input tokens
+    def record_plan(self, stage, plan, response):
+        entry = self.token_planner.record(stage, plan, read_usage(response))
+        with self.lock:
+            self.result["token_plans"].append(entry)
+
+    # Function to add up the targeted repairs of a stage's malformed answers
+    def record_repair(self, stage, report):
+        with self.lock:
+            totals = self.result["repairs"].setdefault(stage, {})
+            for field, count in report.items():
+                totals[field] = totals.get(field, 0) + count
+
+    # Function to record one model's attempt at a stage
+    # usage_before: The stage's token totals before the attempt, to take this attempt's share
+    # escalation: Why the answer was passed to the next model, or None if it was kept
+    def record_attempt(self, stage, stage_model, seconds, usage_before, escalation):
+        usage = self.result["tokens"].get(stage, {})
+        tokens = {kind: usage.get(kind, 0) - usage_before.get(kind, 0) for kind in ("prompt", "candidates")}
+        self.result["models"].append({
+            "stage": stage,
+            "model": short_model_name(stage_model.model_name),
+            "seconds": seconds,
+            "tokens": tokens,
+            "cost": token_cost(stage_model.model_name, tokens),
+            "escalation": escalation,
+        })
+
+    # Function to add up what the cached prefix saved this page
+    # cached: Whether the call referenced the cached prefix
+    # seconds: How long the call took
+    # response: The resolved answer
+    # prefix: The prefix the call referenced (or sent)
+    def record_prefix_call(self, cached, seconds, response, prefix):
+        seconds_saved = self.resources.prefix_cache.record_call(cached, seconds)
+        cached_tokens = (read_usage(response) or {}).get("cached") or estimate_gemini_tokens(prefix)
+        with self.lock:
+            report = self.result["prefix_cache"]
+            if report is None:
+                report = self.result["prefix_cache"] = {
+                    "cached_calls": 0, "inline_calls": 0, "tokens_saved": 0, "bytes_saved": 0, "seconds_saved": None,
+                }
+            if not cached:
+                report["inline_calls"] += 1
+                return
+            report["cached_calls"] += 1
+            report["tokens_saved"] += cached_tokens
+            report["bytes_saved"] += request_bytes(prefix)
+            if seconds_saved is not None:
+                report["seconds_saved"] = (report["seconds_saved"] or 0.0) + seconds_saved
+
+    # Function to identify the models a stage's answer can come from, for its cache key
+    def stage_fingerprint(self, stage):
+        if self.resources.router is not None:
+            return self.resources.router.fingerprint(stage)
+        return self.resources.model.model_name
+
+    # Function to give the page image at a plan's size
+    # side: TokenPlan.page_side
+    # Returns: The page, or a scaled copy (made once per size) counted as its share of the page's bytes
+    def page_image_at(self, side):
+        if side is None:
+            return self.image
+        if side not in self._scaled_pages:
+            scaled = scale_image(self.image, side)
+            scaled.info[ENCODED_BYTES_INFO_KEY] = self.page_bytes * scaled.width * scaled.height // max(1, self.image.width * self.image.height)
+            self._scaled_pages[side] = scaled
+        return self._scaled_pages[side]
+
+    # Function to run a stage on the router's models, cheapest first, until an answer is trusted
+    # (without a router, on the configured model alone; its attempt is recorded all the same)
+    # stage: SUITABILITY_STAGE or FLASHCARD_STAGE
+    # compute: Callable producing the stage output with stage_models[stage]
+    # signal: Callable (output) returning why the output is not to be trusted (see model_router.py), or None
+    # start: Position of the first model to try
+    # Returns: The output of the first trusted answer, or of the last model whatever its signal
+    def run_tiers(self, stage, compute, signal, start=0):
+        router = self.resources.router
+        tier_models = router.models(stage) if router is not None else [self.resources.model]
+        for position in range(start, len(tier_models)):
+            stage_model = self.stage_models[stage] = tier_models[position]
+            self.can_escalate[stage] = position < len(tier_models) - 1
+            usage_before = dict(self.result["tokens"].get(stage, {}))
+            repairs_before = dict(self.result["repairs"].get(stage, {}))
+            attempt_start = time.perf_counter()
+            try:
+                output = compute()
+            except Exception as e:
+                if not self.can_escalate[stage]:
+                    self.record_attempt(stage, stage_model, time.perf_counter() - attempt_start, usage_before, None)
+                    raise
+                escalation = ESCALATE_INVALID if isinstance(e, StructuredOutputError) else ESCALATE_ERROR
+            else:
+                escalation = None
+                if self.can_escalate[stage]:
+                    # Malformed rows the repair could not fix count as a failed validation
+                    repairs = self.result["repairs"].get(stage, {})
+                    unrepaired = (
+                        repairs.get("rows", 0) - repairs_before.get("rows", 0)
+                        - (repairs.get("repaired", 0) - repairs_before.get("repaired", 0))
+                    )
+                    escalation = ESCALATE_INVALID if unrepaired > 0 else signal(output)
+            self.record_attempt(stage, stage_model, time.perf_counter() - attempt_start, usage_before, escalation)
+            if escalation is None:
+                return output
+            self.notes.append(
+                f"Image #{self.idx}: {stage} answer of {short_model_name(stage_model.model_name)} not trusted ({escalation}); "
+                f"asking {short_model_name(tier_models[position + 1].model_name)}."
+            )
+            if stage == FLASHCARD_STAGE:
+                # The cards streamed from the cheaper model are replaced; the next stream starts afresh
+                self.emit("cards_reset")
+                self.streamed_attempts.clear()
+
+# Function to give the options of a Gemini call: in JSON mode the answer is constrained to a schema
+# schema: The response schema
+# Returns: Keyword arguments for generate_content
+def generation_options(schema):
+    if STRUCTURED_OUTPUT:
+        return {"generation_config": json_generation_config(schema)}
+    return {}
+
+# -----------------------------
+# Input
+# -----------------------------
+
+# Function to hash the page and open it as an image
+# page_run: PageRun of the page
+# uploaded_file: The page file
+# ocr_file: Separate file sent to OCR, or None to send uploaded_file
+# cache_hashes: Optional (image hash, OCR image hash) of an earlier near-duplicate page, used instead of its own
+# Returns: Tuple (image hash, OCR image hash) the cache keys are built from (both None without a cache);
+#          raises if the file cannot be read
+def open_page(page_run, uploaded_file, ocr_file=None, cache_hashes=None):
+    page_run.ocr_file = uploaded_file if ocr_file is None else ocr_file
+
+    # Hash the image bytes once; every stage's cache key starts from it
+    image_hash = None
+    ocr_image_hash = None
+    if page_run.config.cache is not None:
+        image_hash = hash_stream(uploaded_file)
+        ocr_image_hash = image_hash
+        if page_run.ocr_file is not uploaded_file:
+            ocr_image_hash = hash_stream(page_run.ocr_file)
+        page_run.result["cache_hashes"] = [image_hash, ocr_image_hash]
+        # A near-duplicate of an earlier page reads (and fills) that page's cache entries
+        if cache_hashes is not None:
+            image_hash, ocr_image_hash = cache_hashes
+
+    # Convert uploaded file to a PIL image. A page backed by a file on disk (batch mode,
+    # spooled uploads) is opened by path: Gemini's SDK then uploads the file's bytes as they
+    # are, so the page is never decoded, instead of re-encoding the pixels as lossless WebP.
+    page_run.page_bytes = upload_size(uploaded_file)
+    page_path = backing_path(uploaded_file)
+    page_run.image = PIL.Image.open(page_path if page_path else uploaded_file)
+    return image_hash, ocr_image_hash
+
+# -----------------------------
+# OCR stage
+# -----------------------------
+
+# Function to prepare the OCR input without copying it: a file on disk is streamed from a
+# handle of its own, an in-memory buffer is shared (getvalue() of a BytesIO built from
+# bytes, like Streamlit's uploads, returns that same bytes object)
+# ocr_file: The file sent to OCR
+# Returns: Tuple (size in bytes, callable returning a fresh stream positioned at the start)
+def ocr_input(ocr_file):
+    ocr_path = backing_path(ocr_file)
+    if ocr_path:
+        return os.path.getsize(ocr_path), lambda: open(ocr_path, "rb")
+    if hasattr(ocr_file, "getvalue"):
+        ocr_bytes = ocr_file.getvalue()
+    else:
+        ocr_file.seek(0)  # Reset file pointer
+        ocr_bytes = ocr_file.read()
+    return len(ocr_bytes), lambda: BytesIO(ocr_bytes)
+
+# Function to send the page to LLMWhisperer without waiting for the extraction
+# prepared_input: Output of ocr_input (computed here if not given)
+# Returns: Future from the shared WhisperPoller, resolved once the text can be retrieved
+def submit_ocr(page_run, prepared_input=None):
+    ocr_size, open_ocr_stream = prepared_input or ocr_input(page_run.ocr_file)
+    client = page_run.resources.client
+
+    def request_ocr():
+        page_run.record_upload(OCR_STAGE, ocr_size)
+        with open_ocr_stream() as image_stream:
+            return client.whisper(stream=image_stream, wait_for_completion=False)
+
+    page_run.ocr_request_start = time.perf_counter()
+    return get_shared_poller().submit(
+        client,
+        lambda: page_run.call_api(LLMWHISPERER_API, OCR_STAGE, request_ocr),
+        rate_limiter=page_run.config.rate_limiter,
+    )
+
+# Function to wait for a submitted extraction; the page's thread blocks here while the shared
+# poller checks the status (this page sends no status requests of its own)
+# Returns: The extracted text
+def read_ocr_text(page_run, future):
+    try:
+        result = future.result()
+    except BaseException:
+        page_run.result["timings"]["ocr_request"] = time.perf_counter() - page_run.ocr_request_start
+        raise
+    page_run.result["timings"]["ocr_request"] = result["finished_at"] - page_run.ocr_request_start
+    return result["extraction"]["result_text"]
+
+# Function to speculatively start OCR so it overlaps the suitability round-trip. The input is
+# prepared in this thread, so the OCR worker never shares the file object (or its position)
+# with the suitability call.
+# ocr_key: Cache key of the page's OCR text (None without a cache)
+# Returns: Tuple (future of the submitted extraction or None, cached OCR text or None)
+def start_speculative_ocr(page_run, ocr_key):
+    if page_run.config.cache is not None:
+        cached_ocr_text = page_run.config.cache.get(OCR_STAGE, ocr_key)
+        if cached_ocr_text is not None:
+            return None, cached_ocr_text
+    try:
+        prepared_input = ocr_input(page_run.ocr_file)
+        # The copied context carries the page's user and priority to the OCR worker, which
+        # only uploads the page; the extraction is then tracked by the shared poller
+        ocr_future = _speculative_ocr_executor.submit(contextvars.copy_context().run, submit_ocr, page_run, prepared_input)
+        record_speculative_ocr("started")
+    except Exception:
+        return None, None  # Fall back to OCR after the suitability check
+    return ocr_future, None
+
+# Function to drop the speculative OCR of a page that will not get flashcards
+# ocr_future: Future from start_speculative_ocr, or None
+def discard_speculative_ocr(page_run, ocr_future):
+    if ocr_future is None:
+        return
+    if ocr_future.cancel():
+        record_speculative_ocr("cancelled")
+        page_run.result["speculative_ocr"] = "cancelled"
+    else:
+        record_speculative_ocr("wasted")
+        page_run.result["speculative_ocr"] = "wasted"
+        ocr_future.add_done_callback(_stop_polling)
+
+# Function to stop polling for a speculative extraction nobody will read
+def _stop_polling(submitted):
+    if not submitted.cancelled() and submitted.exception() is None:
+        submitted.result().cancel()
+
+# Function to get the page's OCR text: from the speculative extraction, the cache or a new extraction
+# ocr_key: Cache key of the page's OCR text (None without a cache)
+# ocr_future, cached_ocr_text: Output of start_speculative_ocr (both None without speculative OCR)
+# Returns: The extracted text
+def run_ocr_stage(page_run, ocr_key, ocr_future=None, cached_ocr_text=None):
+    cache = page_run.config.cache
+    if ocr_future is not None:
+        extracted_text = read_ocr_text(page_run, ocr_future.result())
+        record_speculative_ocr("used")
+        page_run.result["speculative_ocr"] = "used"
+        if cache is not None:
+            cache.put(OCR_STAGE, ocr_key, extracted_text)
+        return extracted_text
+    if cached_ocr_text is not None:
+        page_run.result["cached_stages"].append(OCR_STAGE)
+        return cached_ocr_text
+    return run_cached_stage(
+        cache,
+        OCR_STAGE,
+        ocr_key,
+        lambda: read_ocr_text(page_run, submit_ocr(page_run)),
+        hits=page_run.result["cached_stages"],
+    )
+
+# Function to drop the vocabulary entries the learner already knows before they cost prompt and answer tokens
+# extracted_text: The OCR text
+# Returns: The OCR text without the known entries (unchanged without a known vocabulary)
+def filter_known_ocr_text(page_run, extracted_text):
+    known_vocabulary = page_run.config.known_vocabulary
+    if known_vocabulary is None:
+        return extracted_text
+    extracted_text, removed_entries = known_vocabulary.filter_ocr_text(extracted_text)
+    page_run.result["known_vocabulary"] = {
+        "ocr_entries_removed": len(removed_entries),
+        "input_tokens_saved": estimate_tokens("\n".join(removed_entries)),
+        "cards_removed": 0,
+    }
+    return extracted_text
+
+# -----------------------------
+# Suitability stage
+# -----------------------------
+
+# Function to plan a suitability call within its token budget; the prompts are counted for the
+# model the call goes to, which with a router is not the configured model
+# stage_model: The GenerativeModel making the call
+# Returns: TokenPlan, which scales the page down if the call is over its budget
+def plan_suitability_call(page_run, stage_model):
+    token_planner = page_run.token_planner
+    return token_planner.plan(
+        SUITABILITY_STAGE,
+        token_planner.fixed_text_tokens(suitability_system_prompt, stage_model)
+        + token_planner.fixed_text_tokens(suitability_user_prompt, stage_model),
+        page_size=page_run.image.size,
+    )
+
+# Function to make one suitability call
+# plan: TokenPlan of the call
+# Returns: The resolved answer
+def request_suitability(page_run, plan):
+    content_suitability = [
+        suitability_system_prompt,
+        page_run.page_image_at(plan.page_side),
+        suitability_user_prompt,
+    ]
+    page_run.record_upload(SUITABILITY_STAGE, request_bytes(content_suitability, page_run.page_bytes, page_run.image))
+    response_suitability = page_run.stage_models[SUITABILITY_STAGE].generate_content(
+        content_suitability, **generation_options(SUITABILITY_SCHEMA)
+    )
+    response_suitability.resolve()  # Raises an exception on error
+    page_run.record_usage(SUITABILITY_STAGE, response_suitability)
+    page_run.record_plan(SUITABILITY_STAGE, plan, response_suitability)
+    return response_suitability
+
+# Function to have a malformed verdict rewritten in the expected form, without sending the page again
+# answer: The malformed answer text
+# full_usage: Token usage of the call that wrote it
+# Returns: Validated verdict dictionary
+def repair_suitability(page_run, answer, full_usage):
+    content_repair = [suitability_repair_prompt.format(answer=answer[:MAX_REPAIR_ROW_CHARACTERS])]
+
+    def request_repair():
+        page_run.record_upload(SUITABILITY_STAGE, request_bytes(content_repair))
+        response_repair = page_run.stage_models[SUITABILITY_STAGE].generate_content(
+            content_repair, **generation_options(SUITABILITY_SCHEMA)
+        )
+        response_repair.resolve()  # Raises an exception on error
+        page_run.record_usage(SUITABILITY_STAGE, response_repair)
+        return response_repair
+
+    response_repair = page_run.call_api(
+        GEMINI_API,
+        SUITABILITY_STAGE,
+        request_repair,
+        estimated_tokens=estimate_gemini_tokens(content_repair),
+    )
+    try:
+        verdict = parse_suitability(response_repair.text)
+    except StructuredOutputError:
+        page_run.record_repair(SUITABILITY_STAGE, repair_report(1, 0, read_usage(response_repair), None))
+        raise
+    page_run.record_repair(SUITABILITY_STAGE, repair_report(1, 1, read_usage(response_repair), full_usage))
+    return verdict
+
+# Function to ask the stage's current model whether the page is suitable
+# Returns: JSON text of the validated verdict
+def assess_suitability(page_run):
+    suitability_plan = plan_suitability_call(page_run, page_run.stage_models[SUITABILITY_STAGE])
+    response_suitability = page_run.call_api(
+        GEMINI_API,
+        SUITABILITY_STAGE,
+        lambda: request_suitability(page_run, suitability_plan),
+        estimated_tokens=suitability_plan.calibrated,
+    )
+    # Validate before the response can be cached; a malformed verdict is repaired on its own
+    try:
+        verdict = parse_suitability(response_suitability.text)
+    except StructuredOutputError:
+        verdict = repair_suitability(page_run, response_suitability.text, read_usage(response_suitability))
+    return json.dumps(verdict, ensure_ascii=False)
+
+# Function to build the cache key of the page's verdict
+# image_hash: Hash the page's cache keys are built from
+# Returns: Cache key
+def suitability_cache_key(page_run, image_hash):
+    key_parts = [
+        image_hash,
+        page_run.stage_fingerprint(SUITABILITY_STAGE),
+        suitability_system_prompt,
+        suitability_user_prompt,
+    ]
+    if STRUCTURED_OUTPUT:
+        key_parts.append(json.dumps(SUITABILITY_SCHEMA, sort_keys=True))
+    # A page that may be sent smaller to fit the token budget
+    if page_run.token_planner.cache_key(SUITABILITY_STAGE):
+        key_parts.append(page_run.token_planner.cache_key(SUITABILITY_STAGE))
+    return hash_strings(*key_parts)
+
+# Function to check if the image is suitable for flashcard generation, from the cache or the router's models
+# image_hash: Hash the page's cache keys are built from (None without a cache)
+# Returns: Dictionary with "is_suitable" and "reason", also kept in the page result
+def run_suitability_stage(page_run, image_hash):
+    cache = page_run.config.cache
+    router = page_run.resources.router
+    suitability_key = suitability_cache_key(page_run, image_hash) if cache is not None else None
+    json_string = run_cached_stage(
+        cache,
+        SUITABILITY_STAGE,
+        suitability_key,
+        lambda: page_run.run_tiers(
+            SUITABILITY_STAGE,
+            lambda: assess_suitability(page_run),
+            lambda output: router.suitability_signal(json.loads(output)),
+        ),
+        hits=page_run.result["cached_stages"],
+    )
+    suitability_data = json.loads(json_string)
+    is_suitable = suitability_data.get("is_suitable")
+    reason = suitability_data.get("reason")
+    page_run.result["suitability"] = {"is_suitable": is_suitable, "reason": reason}
+    page_run.emit("suitability", is_suitable=is_suitable, reason=reason)
+    return page_run.result["suitability"]
+
+# -----------------------------
+# Flashcard stage
+# -----------------------------
+
+# Function to list the few-shot examples shared by the whole-page call and every tile's call
+# resources: PipelineResources with the example images
+# Returns: List of (image, prompt, answer); empty if an example image is missing
+def flashcard_examples(resources):
+    if not (resources.image_example_1 and resources.image_example_2):
+        return []
+    return [
+        (resources.image_example_1, flashcard_user_prompt_example_1, flashcard_answer_example_1),
+        (resources.image_example_2, flashcard_user_prompt_example_2, flashcard_answer_example_2),
+    ]
+
+# Function to build the few-shot prefix of a token plan: all examples at full size unless the
+# call was over its budget
+# plan: TokenPlan of the call
+# Returns: List of prompt parts
+def flashcard_prefix_for(page_run, plan):
+    prefix = [flashcard_system_prompt]
+    for image, prompt, answer in flashcard_examples(page_run.resources)[:plan.examples]:
+        prefix += [page_run.token_planner.example_image(image, plan.example_side), prompt, answer]
+    return prefix
+
+# Function to plan a flashcard call within its token budget; the fixed prompts are counted for the
+# model the call goes to (stage_models moves up the router's models as a page escalates)
+# image_size: Size of the page (or tile) image
+# prompt: The call's own prompt
+# Returns: TokenPlan
+def plan_flashcard_call(page_run, image_size, prompt):
+    token_planner = page_run.token_planner
+    flashcard_model = page_run.stage_models[FLASHCARD_STAGE]
+    example_sizes = [
+        (
+            image.size,
+            token_planner.fixed_text_tokens(example_prompt, flashcard_model)
+            + token_planner.fixed_text_tokens(answer, flashcard_model),
+        )
+        for image, example_prompt, answer in flashcard_examples(page_run.resources)
+    ]
+    fixed_tokens = token_planner.fixed_text_tokens(flashcard_system_prompt, flashcard_model) + text_tokens(prompt)
+    return token_planner.plan(FLASHCARD_STAGE, fixed_tokens, example_sizes, image_size)
+
+# Function to make a flashcard call with the few-shot prefix: referenced from Gemini's context
+# cache when it is registered there, sent inline otherwise. The prefix is the same for every page,
+# so it is registered once per model (and per reduced prefix of the token plans).
+# plan: TokenPlan of the call, which decides the prefix and the size of the image
+# image: The page or tile image
+# prompt: The call's own prompt
+# send: Callable (model, contents) making the call and returning the resolved answer
+# Returns: The resolved answer
+def send_with_prefix(page_run, plan, image, prompt, send):
+    resources = page_run.resources
+    prefix_cache = resources.prefix_cache
+    flashcard_model = page_run.stage_models[FLASHCARD_STAGE]
+    prefix = flashcard_prefix_for(page_run, plan)
+    suffix = [page_run.page_image_at(plan.page_side) if image is page_run.image else scale_image(image, plan.page_side), prompt]
+    cached_model = None
+    if prefix_cache is not None:
+        prefix_fingerprint = hash_strings(
+            flashcard_system_prompt,
+            *[text for _, example_prompt, answer in flashcard_examples(resources) for text in (example_prompt, answer)],
+            resources.examples_fingerprint if resources.image_example_1 and resources.image_example_2 else "",
+        )
+        prefix_key = hash_strings(flashcard_model.model_name, prefix_fingerprint, plan_key(plan._replace(page_side=None)))
+        cached_model = prefix_cache.model_for(flashcard_model, prefix_key, prefix)
+    if cached_model is not None:
+        page_run.record_upload(FLASHCARD_STAGE, request_bytes(suffix, page_run.page_bytes, page_run.image))
+        call_start = time.perf_counter()
+        try:
+            response = send(cached_model, suffix)
+        except Exception as e:
+            if is_retryable(e):
+                raise
+            # The cached prefix expired or was deleted early: this call and the next ones send it inline
+            prefix_cache.invalidate(prefix_key, e)
+        else:
+            page_run.record_prefix_call(True, time.perf_counter() - call_start, response, prefix)
+            page_run.record_plan(FLASHCARD_STAGE, plan, response)
+            return response
+    contents = prefix + suffix
+    page_run.record_upload(FLASHCARD_STAGE, request_bytes(contents, page_run.page_bytes, page_run.image))
+    call_start = time.perf_counter()
+    response = send(flashcard_model, contents)
+    if prefix_cache is not None:
+        page_run.record_prefix_call(False, time.perf_counter() - call_start, response, prefix)
+    page_run.record_plan(FLASHCARD_STAGE, plan, response)
+    return response
+
+# Function to have only the malformed rows of an answer rewritten, instead of regenerating the page
+# rows: Raw rows that failed validation (including an object cut off by a truncated answer)
+# extracted_text: The OCR text the answer was written from, to complete cut-off rows
+# full_usage: Token usage of the call that wrote the answer
+# Returns: List of the valid Flashcards the repair produced (empty if it failed)
+def repair_flashcards(page_run, rows, extracted_text, full_usage):
+    content_repair = [
+        flashcard_repair_prompt.format(rows=format_repair_rows(rows), extracted_text=extracted_text)
+    ]
+
+    def request_repair():
+        page_run.record_upload(FLASHCARD_STAGE, request_bytes(content_repair))
+        response_repair = page_run.stage_models[FLASHCARD_STAGE].generate_content(
+            content_repair, **generation_options(FLASHCARD_SCHEMA)
+        )
+        response_repair.resolve()  # Raises an exception on error
+        page_run.record_usage(FLASHCARD_STAGE, response_repair)
+        return response_repair
+
+    try:
+        response_repair = page_run.call_api(
+            GEMINI_API,
+            FLASHCARD_STAGE,
+            request_repair,
+            estimated_tokens=estimate_gemini_tokens(content_repair),
+        )
+        repaired_cards, _, _ = parse_flashcards_json(response_repair.text)
+    except Exception as e:
+        # The valid rows are kept; only the malformed ones are lost
+        page_run.record_repair(FLASHCARD_STAGE, repair_report(len(rows), 0, None, None))
+        page_run.notes.append(f"Image #{page_run.idx}: {len(rows)} malformed flashcard row(s) could not be repaired - {e}")
+        return []
+    page_run.record_repair(FLASHCARD_STAGE, repair_report(len(rows), len(repaired_cards), read_usage(response_repair), full_usage))
+    return repaired_cards
+
+# Function to read the cards of a flashcard answer
+# response: The resolved answer
+# extracted_text: The OCR text the answer was written from
+# Returns: Tuple (valid Flashcards of the JSON answer, Flashcards recovered otherwise: from the repair of
+#          its malformed rows, or from the CSV of a model that ignored JSON mode)
+def read_flashcards(page_run, response, extracted_text):
+    if not STRUCTURED_OUTPUT:
+        return parse_flashcards(strip_fences(response.text)), []
+    cards, rejected, objects = parse_flashcards_json(response.text)
+    if not objects:
+        # No JSON object at all: a model that ignored JSON mode and wrote the CSV of the examples
+        csv_cards = parse_flashcards(strip_fences(response.text))
+        if csv_cards:
+            return [], csv_cards
+    if not rejected:
+        return cards, []
+    return cards, repair_flashcards(page_run, rejected, extracted_text, read_usage(response))
+
+# Function to make a whole-page flashcard call, streaming its cards to the caller if it asked for events
+# Returns: The resolved answer
+def send_flashcards(page_run, request_model, request_contents):
+    flashcard_options = generation_options(FLASHCARD_SCHEMA)
+    if page_run.config.on_event is None:
+        response_flashcards = request_model.generate_content(request_contents, **flashcard_options)
+    else:
+        # A retried stream starts over, so tell the caller to drop the partial cards
+        if page_run.streamed_attempts:
+            page_run.emit("cards_reset")
+        page_run.streamed_attempts.append(True)
+
+        # Stream the answer so callers can show the cards as they are written; JSON answers
+        # are passed on as CSV rows once each card's object has closed and validated
+        stream_parser = FlashcardJsonStreamParser() if STRUCTURED_OUTPUT else None
+        response_flashcards = request_model.generate_content(request_contents, stream=True, **flashcard_options)
+        for chunk in response_flashcards:
+            try:
+                chunk_text = chunk.text
+            except ValueError:
+                continue  # Chunks without text parts (e.g. the finish reason)
+            if stream_parser is None:
+                page_run.emit("cards", text=chunk_text)
+            else:
+                page_run.emit_cards(stream_parser.feed(chunk_text))
+    response_flashcards.resolve()  # Raises an exception on error
+    page_run.record_usage(FLASHCARD_STAGE, response_flashcards)
+    return response_flashcards
+
+# Function to write the page's flashcards with one whole-page call
+# extracted_text: The page's OCR text
+# Returns: CSV text of the cards
+def generate_flashcards(page_run, extracted_text):
+    # Add the user prompt for the actual image's extracted text; in JSON mode the prompt asks for
+    # the fields of the schema instead of the CSV columns the examples show
+    flashcard_prompt = flashcard_user_prompt_actual.format(extracted_text=extracted_text)
+    if STRUCTURED_OUTPUT:
+        flashcard_prompt += flashcard_json_note
+    flashcard_plan = plan_flashcard_call(page_run, page_run.image.size, flashcard_prompt)
+    response_flashcards = page_run.call_api(
+        GEMINI_API,
+        FLASHCARD_STAGE,
+        lambda: send_with_prefix(
+            page_run,
+            flashcard_plan,
+            page_run.image,
+            flashcard_prompt,
+            lambda request_model, request_contents: send_flashcards(page_run, request_model, request_contents),
+        ),
+        estimated_tokens=flashcard_plan.calibrated,
+    )
+    if not STRUCTURED_OUTPUT:
+        return strip_fences(response_flashcards.text)
+    cards, recovered_cards = read_flashcards(page_run, response_flashcards, extracted_text)
+    page_run.emit_cards(recovered_cards)  # The stream only passed on the valid JSON cards
+    flashcards_csv = StringIO()
+    write_flashcards(cards + recovered_cards, flashcards_csv)
+    return flashcards_csv.getvalue()
+
+# Function to split a dense page into tiles; other pages keep the single whole-page call
+# extracted_text: The page's OCR text
+# Returns: Tuple (tile layout or None, list of Tiles; empty unless the page is split)
+def plan_page_tiles(page_run, extracted_text):
+    tile_layout, tiles = None, []
+    try:
+        count = tile_count(extracted_text)
+        if count > 1:
+            tile_layout, tiles = plan_tiles(page_run.image, count)
+    except Exception:
+        tiles = []  # Unreadable layout: the page is sent whole
+    if len(tiles) <= 1:
+        return tile_layout, []
+    page_run.result["tiles"] = {
+        "count": len(tiles),
+        "layout": tile_layout,
+        "boxes": [tile.box for tile in tiles],
+        "duplicates": 0,
+        "seconds": [],
+    }
+    return tile_layout, tiles
+
+# Function to write one tile's flashcards
+# tile: Tile from plan_tiles
+# tile_layout: Layout the tiles were cut along
+# extracted_text: The page's OCR text
+# Returns: Tuple (list of Flashcards, seconds the call took)
+def generate_tile_flashcards(page_run, tile, tile_layout, extracted_text):
+    tile_start = time.perf_counter()
+    page_image = page_run.image
+    tile_image = page_image.crop(tile.box)
+    left, top, right, bottom = tile.box
+    # The SDK encodes the crop itself; count its share of the page's bytes as uploaded
+    tile_image.info[ENCODED_BYTES_INFO_KEY] = page_run.page_bytes * (right - left) * (bottom - top) // max(1, page_image.width * page_image.height)
+    extracted_tile_text = tile_text(extracted_text, tile_layout, tile)
+    tile_prompt = flashcard_user_prompt_actual.format(extracted_text=extracted_tile_text)
+    if STRUCTURED_OUTPUT:
+        tile_prompt += flashcard_json_note
+    tile_prompt += flashcard_tile_note
+    tile_plan = plan_flashcard_call(page_run, tile_image.size, tile_prompt)
+
+    def send_tile_flashcards(request_model, request_contents):
+        response_tile = request_model.generate_content(request_contents, **generation_options(FLASHCARD_SCHEMA))
+        response_tile.resolve()  # Raises an exception on error
+        page_run.record_usage(FLASHCARD_STAGE, response_tile)
+        return response_tile
+
+    response_tile = page_run.call_api(
+        GEMINI_API,
+        FLASHCARD_STAGE,
+        lambda: send_with_prefix(page_run, tile_plan, tile_image, tile_prompt, send_tile_flashcards),
+        estimated_tokens=tile_plan.calibrated,
+    )
+    cards, recovered_cards = read_flashcards(page_run, response_tile, extracted_tile_text)
+    return cards + recovered_cards, time.perf_counter() - tile_start
+
+# Function to write a dense page's flashcards with one concurrent call per tile
+# tile_layout, tiles: Output of plan_page_tiles
+# extracted_text: The page's OCR text
+# Returns: CSV text of the merged cards, in reading order
+def generate_tiled_flashcards(page_run, tile_layout, tiles, extracted_text):
+    # Each tile's cards are streamed once its call is done, less those an earlier tile already streamed
+    streamed_deck = FlashcardDeck()
+    streamed_lock = threading.Lock()
+
+    def run_tile(tile):
+        cards, seconds = generate_tile_flashcards(page_run, tile, tile_layout, extracted_text)
+        if page_run.config.on_event is not None:
+            with streamed_lock:
+                page_run.emit_cards([card for card in cards if streamed_deck.add(card)])
+        return cards, seconds
+
+    # The copied context carries the page's user and priority to the tile workers
+    tile_futures = [
+        _tile_executor.submit(contextvars.copy_context().run, run_tile, tile)
+        for tile in tiles
+    ]
+    try:
+        tile_outputs = [future.result() for future in tile_futures]
+    finally:
+        for future in tile_futures:
+            future.cancel()  # A tile failed: the ones not started yet are dropped
+    merged_cards, duplicates = merge_tile_cards([cards for cards, seconds in tile_outputs])
+    page_run.result["tiles"]["duplicates"] = duplicates
+    page_run.result["tiles"]["seconds"] = [seconds for cards, seconds in tile_outputs]
+    merged_text = StringIO()
+    write_flashcards(merged_cards, merged_text)
+    return merged_text.getvalue()
+
+# -----------------------------
+# Single-pass stage
+# -----------------------------
+
+# Function to make a single-pass call, streaming the cards of a suitable page to the caller if it asked for events
+# Returns: The resolved answer
+def send_single_pass(page_run, request_model, request_contents):
+    single_pass_options = generation_options(SINGLE_PASS_SCHEMA)
+    if page_run.config.on_event is None:
+        response_single_pass = request_model.generate_content(request_contents, **single_pass_options)
+    else:
+        if page_run.streamed_attempts:
+            page_run.emit("cards_reset")
+        page_run.streamed_attempts.append(True)
+
+        # The cards are passed on as CSV rows as their objects close, like the flashcard stream
+        stream_parser = SinglePassStreamParser()
+        response_single_pass = request_model.generate_content(request_contents, stream=True, **single_pass_options)
+        for chunk in response_single_pass:
+            try:
+                chunk_text = chunk.text
+            except ValueError:
+                continue  # Chunks without text parts (e.g. the finish reason)
+            cards = stream_parser.feed(chunk_text)
+            if stream_parser.verdict is None or stream_parser.verdict["is_suitable"] == "Yes":
+                page_run.emit_cards(cards)
+    response_single_pass.resolve()  # Raises an exception on error
+    page_run.record_usage(FLASHCARD_STAGE, response_single_pass)
+    return response_single_pass
+
+# Function to check suitability and write the flashcards with one call
+# extracted_text: The page's OCR text
+# Returns: JSON text with "is_suitable", "reason" and "flashcards" (CSV text, empty for rejected pages)
+def generate_single_pass(page_run, extracted_text):
+    # The combined prompt of single-pass mode: the flashcard prompt, plus the suitability criteria
+    # and the answer shape that carries the verdict
+    single_pass_prompt = flashcard_user_prompt_actual.format(extracted_text=extracted_text) + single_pass_note
+    single_pass_plan = plan_flashcard_call(page_run, page_run.image.size, single_pass_prompt)
+    response_single_pass = page_run.call_api(
+        GEMINI_API,
+        FLASHCARD_STAGE,
+        lambda: send_with_prefix(
+            page_run,
+            single_pass_plan,
+            page_run.image,
+            single_pass_prompt,
+            lambda request_model, request_contents: send_single_pass(page_run, request_model, request_contents),
+        ),
+        estimated_tokens=single_pass_plan.calibrated,
+    )
+    verdict, cards, rejected, objects = parse_single_pass(response_single_pass.text)
+    if verdict is None and not objects:
+        if page_run.can_escalate[FLASHCARD_STAGE]:
+            raise StructuredOutputError("Neither a verdict nor a card could be read from the single-pass answer")
+        # Neither a verdict nor a card could be read: ask the two questions separately
+        page_run.notes.append(f"Image #{page_run.idx}: Unreadable single-pass answer; checked suitability separately.")
+        verdict = json.loads(assess_suitability(page_run))
+        flashcards_csv = generate_flashcards(page_run, extracted_text) if verdict["is_suitable"] == "Yes" else ""
+        return json.dumps({**verdict, "flashcards": flashcards_csv}, ensure_ascii=False)
+    if verdict is None:
+        # The model wrote cards, so it judged the page suitable; only the verdict was lost
+        verdict = {"is_suitable": "Yes", "reason": "The verdict was cut off, but flashcards were written."}
+    flashcards_csv = ""
+    if verdict["is_suitable"] == "Yes":
+        recovered_cards = []
+        if rejected:
+            recovered_cards = repair_flashcards(page_run, rejected, extracted_text, read_usage(response_single_pass))
+            page_run.emit_cards(recovered_cards)
+        flashcards_text = StringIO()
+        write_flashcards(cards + recovered_cards, flashcards_text)
+        flashcards_csv = flashcards_text.getvalue()
+    elif page_run.streamed_attempts:
+        page_run.emit("cards_reset")  # Cards streamed before the verdict are dropped with the page
+    return json.dumps({**verdict, "flashcards": flashcards_csv}, ensure_ascii=False)
+
+# -----------------------------
+# Flashcard stage: caching and routing
+# -----------------------------
+
+# Function to check a flashcard (or single-pass) answer before it is trusted
+# output: The stage output
+# extracted_text: The page's OCR text
+# Returns: Why the answer is to be passed to a stronger model, or None
+def flashcard_signal(page_run, output, extracted_text):
+    router = page_run.resources.router
+    if page_run.config.pipeline_mode == SINGLE_PASS:
+        single_pass_data = json.loads(output)
+        if single_pass_data["is_suitable"] != "Yes":
+            return router.suitability_signal(single_pass_data)
+        output = single_pass_data["flashcards"]
+    return router.flashcard_signal(len(parse_flashcards(output)), extracted_text)
+
+# Function to build the cache key of the page's flashcards (or single-pass answer)
+# image_hash: Hash the page's cache keys are built from
+# extracted_text: The OCR text the flashcards are written from
+# tile_layout, tiles: Output of plan_page_tiles
+# Returns: Cache key
+def flashcard_cache_key(page_run, image_hash, extracted_text, tile_layout, tiles):
+    resources = page_run.resources
+    key_parts = [
+        image_hash,
+        page_run.stage_fingerprint(FLASHCARD_STAGE),
+        flashcard_system_prompt,
+        flashcard_user_prompt_example_1,
+        flashcard_answer_example_1,
+        flashcard_user_prompt_example_2,
+        flashcard_answer_example_2,
+        flashcard_user_prompt_actual,
+        resources.examples_fingerprint if resources.image_example_1 and resources.image_example_2 else "",
+        extracted_text,
+    ]
+    if STRUCTURED_OUTPUT:
+        key_parts += [flashcard_json_note, json.dumps(FLASHCARD_SCHEMA, sort_keys=True)]
+    if tiles:
+        key_parts += [flashcard_tile_note, tile_layout, repr([tile.box for tile in tiles])]
+    if page_run.config.pipeline_mode == SINGLE_PASS:
+        # A different value (the verdict and the cards) under a key of its own
+        key_parts += [SINGLE_PASS, single_pass_note, json.dumps(SINGLE_PASS_SCHEMA, sort_keys=True)]
+    # A page that may be sent smaller, or with fewer examples, to fit the token budget
+    if page_run.token_planner.cache_key(FLASHCARD_STAGE):
+        key_parts.append(page_run.token_planner.cache_key(FLASHCARD_STAGE))
+    return hash_strings(*key_parts)
+
+# Function to generate the flashcards using Gemini, from the cache or the router's models; in single-pass
+# mode the verdict comes with them and is kept in the page result
+# image_hash: Hash the page's cache keys are built from (None without a cache)
+# extracted_text: The OCR text the flashcards are written from
+# tile_layout, tiles: Output of plan_page_tiles (no tiles sends the page whole)
+# Returns: CSV text of the cards (empty for a page single-pass mode rejected)
+def run_flashcard_stage(page_run, image_hash, extracted_text, tile_layout=None, tiles=()):
+    cache = page_run.config.cache
+    router = page_run.resources.router
+    single_pass = page_run.config.pipeline_mode == SINGLE_PASS
+    flashcard_key = None
+    if cache is not None:
+        flashcard_key = flashcard_cache_key(page_run, image_hash, extracted_text, tile_layout, tiles)
+    if single_pass:
+        generate = lambda: generate_single_pass(page_run, extracted_text)
+    elif tiles:
+        generate = lambda: generate_tiled_flashcards(page_run, tile_layout, tiles, extracted_text)
+    else:
+        generate = lambda: generate_flashcards(page_run, extracted_text)
+    # Dense pages go straight to the strongest model
+    start = router.start_tier(FLASHCARD_STAGE, extracted_text) if router is not None else 0
+    flashcards_text = run_cached_stage(
+        cache,
+        FLASHCARD_STAGE,
+        flashcard_key,
+        lambda: page_run.run_tiers(
+            FLASHCARD_STAGE, generate, lambda output: flashcard_signal(page_run, output, extracted_text), start
+        ),
+        hits=page_run.result["cached_stages"],
+    )
+    if single_pass:
+        single_pass_data = json.loads(flashcards_text)
+        flashcards_text = single_pass_data["flashcards"]
+        is_suitable = single_pass_data.get("is_suitable")
+        reason = single_pass_data.get("reason")
+        page_run.result["suitability"] = {"is_suitable": is_suitable, "reason": reason}
+        page_run.emit("suitability", is_suitable=is_suitable, reason=reason)
+    return flashcards_text
+
+# Function to keep the page's flashcards, less any the model still wrote for known words that were
+# not on their own line in the OCR text
+# flashcards_text: CSV text of the cards
+# Returns: None
+def keep_flashcards(page_run, flashcards_text):
+    page_result = page_run.result
+    page_result["flashcards"] = flashcards_text
+    page_result["cards"] = parse_flashcards(flashcards_text)
+
+    known_vocabulary = page_run.config.known_vocabulary
+    if known_vocabulary is None:
+        return
+    kept_cards, removed_cards = known_vocabulary.filter_cards(page_result["cards"])
+    if removed_cards:
+        filtered_text = StringIO()
+        write_flashcards(kept_cards, filtered_text)
+        page_result["flashcards"] = filtered_text.getvalue()
+        page_result["cards"] = kept_cards
+    known_report = page_result["known_vocabulary"]
+    known_report["cards_removed"] = len(removed_cards)
+    # Each entry dropped from the OCR text is roughly one card the model did not have to write
+    known_report["output_tokens_saved"] = (
+        known_report["ocr_entries_removed"] * estimate_tokens(flashcards_text) // max(1, len(kept_cards) + len(removed_cards))
+    )
+    skipped = known_report["ocr_entries_removed"] + known_report["cards_removed"]
+    if skipped:
+        page_run.notes.append(
+            f"Image #{page_run.idx}: Skipped {skipped} known word(s) "
+            f"(~{known_report['input_tokens_saved'] + known_report['output_tokens_saved']} tokens saved)."
+        )
+
+# Function to add the notes summing up a page that got its flashcards
+# Returns: None
+def add_flashcard_notes(page_run):
+    page_result = page_run.result
+    idx = page_run.idx
+    if page_result["tiles"] is not None:
+        page_run.notes.append(
+            f"Image #{idx}: Dense page split into {page_result['tiles']['count']} tiles ({page_result['tiles']['layout']}); "
+            f"{page_result['tiles']['duplicates']} duplicate card(s) from the overlaps merged."
+        )
+    prefix_report = page_result["prefix_cache"]
+    if prefix_report is not None and prefix_report["cached_calls"]:
+        seconds_saved = (
+            f", ~{prefix_report['seconds_saved']:.2f}s faster" if prefix_report["seconds_saved"] is not None else ""
+        )
+        page_run.notes.append(
+            f"Image #{idx}: Few-shot examples read from the context cache "
+            f"(~{prefix_report['tokens_saved']} input tokens and {prefix_report['bytes_saved'] // 1024} KB not re-sent{seconds_saved})."
+        )
+    repaired_rows = sum(report["rows"] for report in page_result["repairs"].values())
+    if repaired_rows:
+        page_run.notes.append(
+            f"Image #{idx}: Repaired {sum(report['repaired'] for report in page_result['repairs'].values())} record(s) "
+            f"from {repaired_rows} malformed row(s) (~{sum(report['tokens_saved'] for report in page_result['repairs'].values())} "
+            f"tokens saved versus regenerating)."
+        )
+    page_run.notes.append(f"Image #{idx}: Flashcards generated successfully.")
+
+# Function to run the suitability, OCR and flashcard stages for a single uploaded image
+# idx: 1-based position of the image in the upload, used in the status notes
+# uploaded_file: A file-like object (from Streamlit's uploader)
+# resources: PipelineResources with the model (or router), OCR client, example images and prefix cache
+# config: PipelineConfig of the run (the defaults if None); with a router, the configured model is not called
+# ocr_file: Optional separate file-like object sent to OCR (defaults to uploaded_file)
+# cache_hashes: Optional (image hash, OCR image hash) of an earlier near-duplicate page; the cache keys are then built
+#               from them instead of this page's bytes, so its cached stages are reused (see duplicate_pages.py)
+# Returns: Dictionary with the page index, its flashcards text (raw and parsed), its status notes, the output of each
+#          stage (suitability verdict, OCR text), per-stage wall times in seconds, bytes uploaded, Gemini token usage,
+#          retries and cache hits per stage, the tiles the page was split into (or None), the targeted repairs of
+#          malformed answers per stage, the savings of the cached few-shot prefix (or None), every model attempt
+#          with its seconds, tokens, cost and escalation, the token plan of every Gemini call with its reported
+#          input tokens, API calls made per API, the hashes its cache keys were built from (or None), and the
+#          error and the stage that raised it, if any
+def process_single_image(idx, uploaded_file, resources, config=None, ocr_file=None, cache_hashes=None):
+    config = config or PipelineConfig()
+    if config.pipeline_mode not in PIPELINE_MODES:
+        raise ValueError(f"Unknown pipeline mode '{config.pipeline_mode}': use one of {', '.join(PIPELINE_MODES)}")
+    page_run = PageRun(idx, resources, config)
+    page_result = page_run.result
+
+    try:
+        image_hash, ocr_image_hash = open_page(page_run, uploaded_file, ocr_file, cache_hashes)
+    except Exception as e:
+        return page_run.fail(f"Image #{idx}: Error opening file - {e}", "input")
+
+    ocr_key = None
+    if config.cache is not None:
+        ocr_key = hash_strings(ocr_image_hash, "llmwhisperer-v2")
+
+    # In single-pass mode every page is read, so OCR is never speculative
+    ocr_future, cached_ocr_text = None, None
+    if config.speculative_ocr and config.pipeline_mode == TWO_PASS:
+        ocr_future, cached_ocr_text = start_speculative_ocr(page_run, ocr_key)
+
+    # In single-pass mode the verdict comes with the flashcards, from one call after OCR
+    if config.pipeline_mode == TWO_PASS:
+        stage_start = time.perf_counter()
+        try:
+            suitability = run_suitability_stage(page_run, image_hash)
+        except Exception as e:
+            discard_speculative_ocr(page_run, ocr_future)
+            page_result["timings"]["suitability"] = time.perf_counter() - stage_start
+            return page_run.fail(f"Image #{idx}: Error generating suitability assessment - {e}", SUITABILITY_STAGE)
+        page_result["timings"]["suitability"] = time.perf_counter() - stage_start
+
+        # If not suitable, record a note and skip further processing
+        if suitability["is_suitable"] != "Yes":
+            discard_speculative_ocr(page_run, ocr_future)
+            page_run.notes.append(f"Image #{idx}: NOT suitable for flashcard generation. Reason: {suitability['reason']}")
+            return page_run.finish()
+        page_run.notes.append(f"Image #{idx}: Suitable for flashcards. Proceeding...")
+
+    # If suitable (or in single-pass mode, for every page), extract the text from the image via LLMWhisperer (OCR)
+    stage_start = time.perf_counter()
+    try:
+        extracted_text = run_ocr_stage(page_run, ocr_key, ocr_future, cached_ocr_text)
+    except Exception as e:
+        page_result["timings"]["ocr"] = time.perf_counter() - stage_start
+        return page_run.fail(f"Image #{idx}: OCR extraction error - {e}", OCR_STAGE)
+    # The time this page was blocked on OCR; "ocr_request" is the OCR call itself, which
+    # with speculative OCR mostly overlaps the suitability check
+    page_result["timings"]["ocr"] = time.perf_counter() - stage_start
+    page_result["ocr_text"] = extracted_text
+    page_run.emit("ocr", characters=len(extracted_text or ""))
+
+    extracted_text = filter_known_ocr_text(page_run, extracted_text)
+
+    tile_layout, tiles = None, []
+    if config.tile_pages and config.pipeline_mode == TWO_PASS:
+        tile_layout, tiles = plan_page_tiles(page_run, extracted_text)
+
+    stage_start = time.perf_counter()
+    try:
+        flashcards_text = run_flashcard_stage(page_run, image_hash, extracted_text, tile_layout, tiles)
+    except Exception as e:
+        page_result["timings"]["flashcards"] = time.perf_counter() - stage_start
+        return page_run.fail(f"Image #{idx}: Error generating flashcards - {e}", FLASHCARD_STAGE)
+    page_result["timings"]["flashcards"] = time.perf_counter() - stage_start
+
+    if config.pipeline_mode == SINGLE_PASS and page_result["suitability"]["is_suitable"] != "Yes":
+        page_run.notes.append(
+            f"Image #{idx}: NOT suitable for flashcard generation. Reason: {page_result['suitability']['reason']}"
+        )
+        return page_run.finish()
+
+    # If we made it here, flashcards were generated successfully
+    keep_flashcards(page_run, flashcards_text)
+    add_flashcard_notes(page_run)
+    return page_run.finish()
+
+# -----------------------------
+# Runs of pages
+# -----------------------------
+
+# Number of pages read ahead per worker when pages are processed concurrently
+READ_AHEAD_PER_WORKER = 2
+
+# Function to optionally shrink a page before it goes over the wire
+# preprocess_executor: Process pool the CPU-heavy work runs on, or None to run it in this thread
+# Returns: Tuple (file for Gemini, file for OCR, preprocessing note or None)
+def prepare_page(idx, uploaded_file, config, preprocess_executor=None):
+    if not config.preprocess_images:
+        return uploaded_file, uploaded_file, None
+    try:
+        uploaded_file.seek(0)
+        page_bytes = uploaded_file.read()
+        uploaded_file.seek(0)
+    except Exception:
+        # Unreadable files are reported by process_single_image
+        return uploaded_file, uploaded_file, None
+
+    if preprocess_executor is not None:
+        prepared = preprocess_executor.submit(preprocess_page, page_bytes).result()
+    else:
+        prepared = preprocess_page(page_bytes)
+    note = describe_preprocessing(idx, prepared)
+    if "error" in prepared:
+        return uploaded_file, uploaded_file, note
+    return BytesIO(prepared["llm"]["bytes"]), BytesIO(prepared["ocr"]["bytes"]), note
+
+# Function to answer a near-duplicate page from the page it repeats
+# original: Result of the earlier page of this run (as kept by finish_page)
+# distance: Difference-hash distance between the two pages
+# start: When the page was picked up, for its total time
+# Returns: Page result without cards of its own (the deck already has the original's)
+def duplicate_result(idx, original, distance, start, config):
+    page_result = empty_page_result(idx)
+    page_result["suitability"] = original["suitability"]
+    page_result["ocr_text"] = original["ocr_text"]
+    page_result["duplicate"] = {
+        "of": original["index"],
+        "distance": distance,
+        "calls_avoided": sum(original["api_calls"].values()),
+    }
+    page_result["notes"].append(
+        f"Image #{idx}: Near-duplicate of image #{original['index']}; its flashcards were not generated again."
+    )
+    page_result["timings"]["total"] = time.perf_counter() - start
+    if config.on_event is not None and original["suitability"] is not None:
+        config.on_event({"type": "suitability", "index": idx, **original["suitability"]})
+    return page_result
+
+# Function to record a finished page and hand it to its copies
+# run_results: The run's futures of page results by index, awaited by near-duplicates of the page
+# Returns: The page result
+def finish_page(page_result, config, run_results):
+    get_shared_metrics().add_page(page_result)
+    if config.metrics is not None:
+        config.metrics.add_page(page_result)
+    if page_result["index"] in run_results:
+        # Only what duplicate_result reads is kept for the rest of the run
+        run_results[page_result["index"]].set_result({
+            key: page_result[key] for key in ("index", "suitability", "ocr_text", "api_calls", "error")
+        })
+    if config.on_event is not None:
+        config.on_event({"type": "page_done", "index": page_result["index"], "result": page_result})
+    return page_result
+
+# Function to process a page that is not a near-duplicate of an earlier page of the run
+# fingerprint: The page's PageFingerprint, or None if it was not fingerprinted
+# Returns: The page result
+def process_new_image(idx, uploaded_file, fingerprint, resources, config, preprocess_executor=None):
+    # A page like one of an earlier run reuses that page's cached stages
+    page_index = config.page_index
+    earlier = None
+    if page_index is not None and config.cache is not None and fingerprint is not None:
+        earlier = page_index.find(fingerprint)
+    llm_file, ocr_file, preprocessing_note = prepare_page(idx, uploaded_file, config, preprocess_executor)
+    page_result = process_single_image(
+        idx,
+        llm_file,
+        resources,
+        config,
+        ocr_file=ocr_file,
+        cache_hashes=earlier[0] if earlier is not None else None,
+    )
+    if preprocessing_note:
+        page_result["notes"].insert(0, preprocessing_note)
+    if earlier is not None and earlier[0] != page_result["cache_hashes"] and page_result["cached_stages"]:
+        page_result["duplicate"] = {
+            "of": None,
+            "distance": earlier[1],
+            "calls_avoided": len(page_result["cached_stages"]),
+        }
+        page_result["notes"].append(
+            f"Image #{idx}: Near-duplicate of a page of an earlier run; its cached results were reused."
+        )
+    elif earlier is None and page_index is not None and fingerprint is not None \
+            and page_result["error"] is None and page_result["cache_hashes"] is not None:
+        page_index.add(fingerprint, page_result["cache_hashes"])
+    return page_result
+
+# Function to process one page of a run: a near-duplicate of an earlier page of the run waits for that
+# page's result instead of calling the APIs again
+# indexed_image: Tuple (idx, file-like object)
+# run_pages: PageIndex of the run's pages by fingerprint, or None if near-duplicates are not skipped
+# run_results: The run's futures of page results by index (see finish_page)
+# Returns: The page result
+def process_page(indexed_image, resources, config, run_pages, run_results, preprocess_executor=None):
+    idx, uploaded_file = indexed_image
+    page_start = time.perf_counter()
+    fingerprint = None
+    if run_pages is not None or config.page_index is not None:
+        fingerprint = fingerprint_upload(uploaded_file)
+    try:
+        if run_pages is not None and fingerprint is not None:
+            # Registered before the lookup, so a later copy of this page always finds a result to wait for
+            run_results[idx] = Future()
+            match = run_pages.find_or_add(fingerprint, idx)
+            if match is not None:
+                del run_results[idx]
+                original_idx, distance = match
+                # The original is already past this point, so it is running on a worker, not queued behind this page
+                original = run_results[original_idx].result()
+                if original["error"] is None:
+                    return finish_page(duplicate_result(idx, original, distance, page_start, config), config, run_results)
+        page_result = process_new_image(idx, uploaded_file, fingerprint, resources, config, preprocess_executor)
+        return finish_page(page_result, config, run_results)
+    finally:
+        if idx in run_results and not run_results[idx].done():
+            # An unexpected error: the page's copies are processed on their own
+            run_results[idx].set_result({"error": "failed"})
+        release_upload(uploaded_file)
+
+# Function to process pages lazily and yield each page's result in input order
+# indexed_images: Iterable of (idx, file-like object) pairs; it is consumed lazily
+# resources: PipelineResources with the model, OCR client and example images
+# config: PipelineConfig of the run (the defaults if None); its page_range and dpi are not used here
+# Yields: process_single_image result dictionaries, in the order of indexed_images
+def process_pages(indexed_images, resources, config=None):
+    config = config or PipelineConfig()
+    if config.rate_limiter is None:
+        config = config._replace(rate_limiter=get_shared_rate_limiter())
+    max_workers = config.max_workers
+    sequential = max_workers is None or max_workers <= 1
+
+    # Pages of this run by fingerprint, and the result of each page as it finishes, so a
+    # near-duplicate waits for the page it repeats instead of calling the APIs again
+    run_pages = PageIndex() if config.skip_duplicates else None
+    run_results = {}
+
+    # The CPU-heavy decode/resize/encode work of the pre-encoding stage runs on the
+    # process-wide pool when pages are processed concurrently
+    preprocess_executor = None
+    if config.preprocess_images and not sequential:
+        preprocess_executor = get_shared_preprocess_executor()
+
+    page_arguments = (resources, config, run_pages, run_results, preprocess_executor)
+    executor = None
+    pending = deque()
+    try:
+        if sequential and config.scheduler is None:
+            for indexed_image in indexed_images:
+                yield process_page(indexed_image, *page_arguments)
+            return
+
+        # Pages go to the shared scheduler, which shares its workers fairly between
+        # users, or else to a pool of this run's own
+        if config.scheduler is not None:
+            def submit(indexed_image):
+                return config.scheduler.submit(
+                    config.user_id, process_page, indexed_image, *page_arguments, priority=config.priority
+                )
+        else:
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+            def submit(indexed_image):
+                return executor.submit(process_page, indexed_image, *page_arguments)
+
+        # Each page is independent, so pages are processed concurrently. Only a
+        # bounded window of pages is submitted ahead, and results are yielded in
+        # submission order, which keeps the flashcards and notes in upload order.
+        read_ahead = max(1, max_workers or 1) * READ_AHEAD_PER_WORKER
+        for indexed_image in indexed_images:
+            pending.append(submit(indexed_image))
+            if len(pending) >= read_ahead:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # Pages not started yet are dropped if the caller stops early
+        for future in pending:
+            future.cancel()
+        if executor is not None:
+            executor.shutdown()
+
 # Function to generate Japanese flashcards from uploaded images
-# uploaded_images: A list of file-like objects (from Streamlit's uploader)
-# base64_json_path: The path to a JSON file containing base64-encoded example images
+# uploaded_images: A list of file-like objects (from Streamlit's uploader); PDF and TIFF documents are
+#                  expanded into their pages, which are rasterised one at a time as the pipeline reads ahead
+# base64_json_path: The path to a JSON file containing base64-encoded example images (or a .bin example store)
+# config: PipelineConfig of the run (the defaults if None)
+# resources: Optional PipelineResources to use instead of the shared process-wide ones
+# deck: Optional FlashcardDeck that the parsed cards of each page are merged into, in upload order
+# output_file: Optional writable text file; each page's flashcards are written to it, in upload order, as soon
+#              as the page is done, instead of being collected into the returned string (which is then empty)
+# options: PipelineConfig fields overriding those of config (e.g. the on_event and metrics of a job)
 # Returns: A string containing all generated flashcards (or reasons if not suitable)
 def generate_japanese_flashcards(
     uploaded_images,
-    base64_json_path="base64_example_images.json"
+    base64_json_path="base64_example_images.json",
+    *,
+    config=None,
+    resources=None,
+    deck=None,
+    output_file=None,
+    **options
     ):
     """
     For each uploaded image file:
@@ -27,202 +1535,178 @@ def generate_japanese_flashcards(
       2) If suitable, extract text (OCR) via LLMWhisperer, then generate flashcards.
     Returns a string containing all flashcards from all suitable images.
 
+    Pages are independent of each other, so with max_workers > 1 they are processed
+    on a thread pool. The flashcards and notes are still returned in upload order.
+
     This function reads the prompt variables (suitability_system_prompt, etc.)
     from the global namespace, as imported by `from LLM_Prompts import *`.
     """
+    config = (config or PipelineConfig())._replace(**options)
 
     # -----------------------------
-    # Load environment variables
-    # -----------------------------
-    # Load environment variables from .env file if running locally
-    load_dotenv(override=True)
-
-    # Check if we're running locally by looking for a specific environment variable
-    is_local_dev = os.getenv("IS_LOCAL_DEV", "false").lower() == "true"
-
-    # Only try to access st.secrets if not in local development
-    if not is_local_dev:
-        try:
-            secrets = getattr(st, "secrets", {})
-            if "GOOGLE_GEMINI_API_KEY" in secrets:
-                os.environ["GOOGLE_GEMINI_API_KEY"] = secrets["GOOGLE_GEMINI_API_KEY"]
-            
-            if "LLMWHISPERER_BASE_URL_V2" in secrets:
-                os.environ["LLMWHISPERER_BASE_URL_V2"] = secrets["LLMWHISPERER_BASE_URL_V2"]
-
-            if "LLMWHISPERER_API_KEY" in secrets:    
-                os.environ["LLMWHISPERER_API_KEY"] = secrets["LLMWHISPERER_API_KEY"]
-        except Exception as e:
-            pass
-
-    gemini_api_key = os.getenv("GOOGLE_GEMINI_API_KEY")
-    unstract_api_url = os.getenv("LLMWHISPERER_BASE_URL_V2")
-    unstract_api_key = os.getenv("LLMWHISPERER_API_KEY")
-
-    if not gemini_api_key:
-        raise ValueError("GOOGLE_GEMINI_API_KEY not found in environment.")
-    if not unstract_api_url:
-        raise ValueError("LLMWHISPERER_BASE_URL_V2 not found in environment.")
-    if not unstract_api_key:
-        raise ValueError("LLMWHISPERER_API_KEY not found in environment.")
-
-    # -----------------------------
-    # Configure the Gemini model
-    # -----------------------------
-    genai.configure(api_key=gemini_api_key)
-    model = genai.GenerativeModel("gemini-2.0-flash")
-    # model = genai.GenerativeModel("gemini-2.0-flash-thinking-exp-01-21")
-
-    # -----------------------------
-    # Utility functions
+    # Shared resources
     # -----------------------------
-    # Function to load base64 images from a JSON file
-    # filepath: Path to the JSON file containing base64 image strings
-    # Returns: Dictionary with image names as keys and PIL Image objects as values. Empty dictionary returned on error.
-    def load_base64_images_from_json(filepath="base64_example_images.json"):
-        try:
-            with open(filepath, 'r') as f:
-                base64_images = json.load(f)
-            return base64_images
-        except FileNotFoundError:
-            print(f"Error: File not found: {filepath}")
-            return {}
-        except json.JSONDecodeError:
-            print(f"Error: Invalid JSON format in {filepath}")
-            return {}
-
-    # Function to load a base64 image string into a PIL Image object
-    # base64_string: Base64 encoded image string
-    # Returns: PIL Image object or None on error
-    def load_image_from_base64(base64_string):
-        try:
-            image_bytes = base64.b64decode(base64_string)
-            image = PIL.Image.open(BytesIO(image_bytes))
-            return image
-        except Exception as e:
-            print(f"Error loading image from base64: {e}")
-            return None
-    
-    # -----------------------------
-    # Prepare example images
-    # -----------------------------
-    base64_example_image_dict = load_base64_images_from_json()
-    if base64_example_image_dict:
-        image_example_1 = load_image_from_base64(base64_example_image_dict["flashcard_image_example_1"])
-        image_example_2 = load_image_from_base64(base64_example_image_dict["flashcard_image_example_2"])
+    # The model, OCR client and decoded example images are built once per process
+    # and reused across runs, reruns and sessions (see pipeline_resources.py)
+    if resources is None:
+        resources = get_pipeline_resources(base64_json_path)
 
-    # -----------------------------
-    # LLMWhisperer client
-    # -----------------------------
-    client = LLMWhispererClientV2(base_url=unstract_api_url, 
-                                  api_key=unstract_api_key, 
-                                  logging_level="ERROR")
-    
     # -----------------------------
     # Process each uploaded image
     # -----------------------------
-    # Initialize a string to store flashcards for all suitable images
-    combined_flashcards = ""
+    # Document pages are rendered lazily: process_pages only reads a bounded window
+    # of pages ahead, so a whole scanned book is never decoded at once
+    page_results = process_pages(
+        enumerate(expand_uploads(uploaded_images, page_range=config.page_range, dpi=config.dpi), start=1),
+        resources,
+        config,
+    )
+
+    # Initialize a list to store the flashcards of each suitable image (joined once at the end)
+    flashcard_parts = []
 
     # Initialize a list to store status notes for each image
     image_processing_notes = []
 
-     # Iterate over each uploaded image
-    for idx, uploaded_file in enumerate(uploaded_images, start=1):
-        # Convert uploaded file to a PIL image
-        try:
-            pil_image = PIL.Image.open(uploaded_file)
-        except Exception as e:
-            msg = f"Image #{idx}: Error opening file - {e}"
-            image_processing_notes.append(msg)
-            continue  # Move on to the next image
-
-        # Prepare the content for suitability check
-        content_suitability = [
-            suitability_system_prompt,
-            pil_image,
-            suitability_user_prompt,
-        ]
-
-        # Check if the image is suitable for flashcard generation
-        try:
-            response_suitability = model.generate_content(content_suitability)
-            response_suitability.resolve()  # Raises an exception on error
-            # Extract JSON-like text from the model response
-            json_string = (
-                response_suitability.text
-                    .replace("```json", "")
-                    .replace("```", "")
-            )
-            suitability_data = json.loads(json_string)
-            is_suitable = suitability_data.get("is_suitable")
-            reason = suitability_data.get("reason")
-        except Exception as e:
-            msg = f"Image #{idx}: Error generating suitability assessment - {e}"
-            image_processing_notes.append(msg)
-            continue
-
-        # If not suitable, record a note and skip further processing
-        if is_suitable != "Yes":
-            msg = f"Image #{idx}: NOT suitable for flashcard generation. Reason: {reason}"
-            image_processing_notes.append(msg)
-            continue
+    for page_result in page_results:
+        if output_file is not None:
+            output_file.write(page_result["flashcards"])
+            output_file.flush()
         else:
-            image_processing_notes.append(f"Image #{idx}: Suitable for flashcards. Proceeding...")
+            flashcard_parts.append(page_result["flashcards"])
+        image_processing_notes.extend(page_result["notes"])
+        if deck is not None:
+            deck.add_cards(page_result["cards"], page_result["index"])
 
-        # If suitable, extract the text from the image via LLMWhisperer (OCR)
-        try:
-            uploaded_file.seek(0)  # Reset file pointer
-            image_bytes = BytesIO(uploaded_file.read())
-            result = client.whisper(stream=image_bytes, wait_for_completion=True)
-            image_actual_extracted_text = result["extraction"]["result_text"]
-        except Exception as e:
-            msg = f"Image #{idx}: OCR extraction error - {e}"
-            image_processing_notes.append(msg)
-            continue
-
-        # Prepare the content for flashcard generation
-        content_flashcards = [flashcard_system_prompt]
-
-        # If example images are available, include them in the prompt
-        if image_example_1 and image_example_2:
-            content_flashcards += [
-                image_example_1,
-                flashcard_user_prompt_example_1,
-                flashcard_answer_example_1,
-                image_example_2,
-                flashcard_user_prompt_example_2,
-                flashcard_answer_example_2,
-            ]
-
-        # Add the user prompt for the actual image's extracted text
-        content_flashcards += [
-            pil_image,
-            flashcard_user_prompt_actual.format(extracted_text=image_actual_extracted_text),
-        ]
-
-        # Generate the flashcards using Gemini
+    # Return both the flashcards and the notes
+    return "".join(flashcard_parts), image_processing_notes
+
+# Function to generate Japanese flashcards while yielding progress events as they happen
+# uploaded_images: A list of file-like objects (from Streamlit's uploader)
+# kwargs: Any other generate_japanese_flashcards argument (max_workers, cache, ...)
+# Yields: Event dictionaries, each with a "type" and (except "done") the page "index":
+#   "suitability" - is_suitable and reason for the page
+#   "ocr"         - OCR finished; characters extracted
+#   "cards"       - text: the next streamed chunk of the page's raw flashcard output
+#   "cards_reset" - the flashcard call is being retried; drop the page's streamed text
+#   "page_done"   - result: the finished page dictionary (flashcards and notes)
+#   "done"        - flashcards and notes for the whole run, as returned by generate_japanese_flashcards
+def generate_japanese_flashcards_stream(uploaded_images, **kwargs):
+    events = queue.Queue()
+    outcome = {}
+
+    def run():
         try:
-            response_flashcards = model.generate_content(content_flashcards)
-            response_flashcards.resolve()  # Raises an exception on error
-            flashcards_text = (
-                response_flashcards.text
-                    .replace("```html", "")
-                    .replace("```csv", "")
-                    .replace("```", "")
+            outcome["value"] = generate_japanese_flashcards(
+                uploaded_images,
+                on_event=events.put,
+                **kwargs
             )
         except Exception as e:
-            msg = f"Image #{idx}: Error generating flashcards - {e}"
-            image_processing_notes.append(msg)
-            continue
+            outcome["error"] = e
+        finally:
+            events.put(None)  # Sentinel: the run has finished
 
-        # If we made it here, flashcards were generated successfully
-        # combined_flashcards += f"\n---\nFlashcards for Image #{idx}:\n{flashcards_text}\n---\n"
-        combined_flashcards += flashcards_text
-        image_processing_notes.append(f"Image #{idx}: Flashcards generated successfully.")
+    worker = threading.Thread(target=run, name="flashcard-stream", daemon=True)
+    worker.start()
+    while True:
+        event = events.get()
+        if event is None:
+            break
+        yield event
+    worker.join()
 
-    # Return both the flashcards and the notes
-    return combined_flashcards, image_processing_notes
+    if "error" in outcome:
+        raise outcome["error"]
+    combined_flashcards, image_processing_notes = outcome["value"]
+    yield {"type": "done", "flashcards": combined_flashcards, "notes": image_processing_notes}
+
+# Path of the banner shown above the description
+BANNER_IMAGE_PATH = "Flashcard_App_Image_2.jpeg"
+
+# Static description of the app, rendered below the banner
+APP_DESCRIPTION_MARKDOWN = """
+### Japanese Language Flashcard Generation
+
+#### Overview
+This App automates the creation of Japanese Language Anki flashcards from textbook images. It combines OCR technology with large language model processing to extract, verify, and format vocabulary into ready-to-import flashcards.
+
+#### Features
+- Extract Japanese text from textbook images using OCR API
+- Cross-reference extracted text with original images for accuracy
+- Generate structured CSV flashcards with proper formatting
+- Support for contextual vocabulary notes and usage examples
+
+#### Workflow
+1. **Image Upload**: Upload Japanese textbook page images  
+2. **Text Extraction**: Use OCR API to extract text from the images (Currently the [LLMWhisperer API](https://docs.unstract.com/llmwhisperer/) is used)  
+3. **LLM Processing**: Send both the extracted text and original image to an LLM (Currently the [Gemini API](https://ai.google.dev/gemini-api/docs?_gl=1*12oxa0f*_up*MQ..*_ga*MzA5MjA0NTQ0LjE3NDI2OTMzNzE.*_ga_P1DBVKWT6V*MTc0MjY5MzM3MC4xLjAuMTc0MjY5MzM3MC4wLjAuNDgyMDU2NTA5) is used)  
+4. **Flashcard Generation**: Generate structured CSV data using specialized prompts  
+5. **Export**: Save the resulting flashcards in Anki-compatible CSV format  
+
+#### Flashcard Format
+The generated flashcards follow a specific CSV structure:
+- **Kanji column**: Contains the word in Kanji (or Hiragana/Katakana if no Kanji exists)  
+- **Furigana column**: Contains the phonetic reading of the word in Hiragana  
+- **English_Translation_and_Notes column**: Contains both the English translation and any usage or contextual notes  
+
+Example output:
+```
+"迷う [道に～]","まよう [みちに～]","lose one's way (e.g., get lost on the road)"
+"先輩","せんぱい","senior (student, colleague, etc.)"
+```
+
+#### Benefits
+- **Accuracy**: Cross-references OCR text with the original image to fix errors  
+- **Context-Aware**: Preserves usage examples and contextual information  
+- **Time-Saving**: Automates the tedious process of manual flashcard creation  
+- **Customizable**: Prompts can be adjusted for different textbook formats  
+
+#### Applications
+- Creating comprehensive JLPT study materials  
+- Building personal vocabulary decks from textbooks  
+- Supplementing classroom learning with digital flashcards  
+- Archiving vocabulary from various Japanese learning resources
+"""
+
+# Function to draw the border around the banner once per process instead of on every rerun
+# path: Path of the banner image
+# Returns: JPEG bytes of the bordered banner, which st.image sends without re-encoding
+@st.cache_resource
+def load_banner_image(path=BANNER_IMAGE_PATH):
+    img = PIL.Image.open(path)
+    # Add a light black border (5px width)
+    bordered_img = PIL.ImageOps.expand(img.convert("RGB"), border=5, fill='#333333')
+    buffer = BytesIO()
+    bordered_img.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+# Function to open the on-disk result cache once per process
+# The cache location and size cap can be overridden with FLASHCARD_CACHE_PATH / FLASHCARD_CACHE_MAX_MB
+# Returns: A ResultCache shared by all Streamlit sessions
+@st.cache_resource
+def get_result_cache():
+    cache_path = os.getenv("FLASHCARD_CACHE_PATH", ".flashcard_cache.sqlite3")
+    max_megabytes = float(os.getenv("FLASHCARD_CACHE_MAX_MB", "256"))
+    return ResultCache(path=cache_path, max_bytes=int(max_megabytes * 1024 * 1024))
+
+# Function to open the index of the pages seen by earlier runs once per process
+# The index location can be overridden with FLASHCARD_PAGE_INDEX_PATH
+# Returns: A PageIndex shared by all Streamlit sessions
+@st.cache_resource
+def get_page_index():
+    return PageIndex(path=os.getenv("FLASHCARD_PAGE_INDEX_PATH", DEFAULT_PAGE_INDEX_PATH))
+
+# Function to open the background job store once per process
+# The store location and the number of jobs run at once can be overridden with
+# FLASHCARD_JOB_STORE_PATH / FLASHCARD_JOB_WORKERS
+# Returns: A JobStore shared by all Streamlit sessions
+@st.cache_resource
+def get_job_store():
+    return JobStore(
+        path=os.getenv("FLASHCARD_JOB_STORE_PATH", DEFAULT_JOB_STORE_PATH),
+        max_workers=int(os.getenv("FLASHCARD_JOB_WORKERS", str(DEFAULT_JOB_WORKERS))),
+    )
 
 # Function to handle the Streamlit app layout and user interaction
 # No parameters
@@ -239,105 +1723,410 @@ def main():
 
      # Displaying a banner or logo image with border
     try:
-        # Load the image
-        img = PIL.Image.open("Flashcard_App_Image_2.jpeg")
-        
-        # Add a light black border (3px width)
-        bordered_img = PIL.ImageOps.expand(img, border=5, fill='#333333')
-        
-        # Display the image with border
-        st.image(bordered_img, use_container_width=True)
+        # Display the image with border (decoded and bordered once per process)
+        st.image(load_banner_image(), use_container_width=True)
     except Exception as e:
         # Fallback to display without border if there's an error
-        st.image("Flashcard_App_Image_2.jpeg", use_container_width=True)
+        st.image(BANNER_IMAGE_PATH, use_container_width=True)
 
     # Displaying a short description of the app
-    st.markdown("""
-    ### Japanese Language Flashcard Generation
-
-    #### Overview
-    This App automates the creation of Japanese Language Anki flashcards from textbook images. It combines OCR technology with large language model processing to extract, verify, and format vocabulary into ready-to-import flashcards.
-
-    #### Features
-    - Extract Japanese text from textbook images using OCR API
-    - Cross-reference extracted text with original images for accuracy
-    - Generate structured CSV flashcards with proper formatting
-    - Support for contextual vocabulary notes and usage examples
-
-    #### Workflow
-    1. **Image Upload**: Upload Japanese textbook page images  
-    2. **Text Extraction**: Use OCR API to extract text from the images (Currently the [LLMWhisperer API](https://docs.unstract.com/llmwhisperer/) is used)  
-    3. **LLM Processing**: Send both the extracted text and original image to an LLM (Currently the [Gemini API](https://ai.google.dev/gemini-api/docs?_gl=1*12oxa0f*_up*MQ..*_ga*MzA5MjA0NTQ0LjE3NDI2OTMzNzE.*_ga_P1DBVKWT6V*MTc0MjY5MzM3MC4xLjAuMTc0MjY5MzM3MC4wLjAuNDgyMDU2NTA5) is used)  
-    4. **Flashcard Generation**: Generate structured CSV data using specialized prompts  
-    5. **Export**: Save the resulting flashcards in Anki-compatible CSV format  
-
-    #### Flashcard Format
-    The generated flashcards follow a specific CSV structure:
-    - **Kanji column**: Contains the word in Kanji (or Hiragana/Katakana if no Kanji exists)  
-    - **Furigana column**: Contains the phonetic reading of the word in Hiragana  
-    - **English_Translation_and_Notes column**: Contains both the English translation and any usage or contextual notes  
-
-    Example output:
-    ```
-    "迷う [道に～]","まよう [みちに～]","lose one's way (e.g., get lost on the road)"
-    "先輩","せんぱい","senior (student, colleague, etc.)"
-    ```
-
-    #### Benefits
-    - **Accuracy**: Cross-references OCR text with the original image to fix errors  
-    - **Context-Aware**: Preserves usage examples and contextual information  
-    - **Time-Saving**: Automates the tedious process of manual flashcard creation  
-    - **Customizable**: Prompts can be adjusted for different textbook formats  
-
-    #### Applications
-    - Creating comprehensive JLPT study materials  
-    - Building personal vocabulary decks from textbooks  
-    - Supplementing classroom learning with digital flashcards  
-    - Archiving vocabulary from various Japanese learning resources
-    """)
+    st.markdown(APP_DESCRIPTION_MARKDOWN)
+
+    # Time to first paint: everything above is what a visitor sees first
+    get_shared_metrics().record_script_run(time.perf_counter() - _script_start)
 
     st.divider()
 
     # Providing a file uploader for users to add images
     uploaded_images = st.file_uploader(
-        "Upload image(s) of textbook pages",
-        type=["jpg", "jpeg", "png"],
+        "Upload image(s) of textbook pages, or scanned PDF/TIFF documents",
+        type=["jpg", "jpeg", "png", "pdf", "tif", "tiff"],
         accept_multiple_files=True
     )
 
+    # Optional settings for the generation run
+    with st.expander("Advanced settings"):
+        max_workers = st.slider(
+            "Pages processed in parallel",
+            min_value=1,
+            max_value=8,
+            value=4,
+            help="Number of pages sent to the APIs at the same time. Use 1 to process pages one by one."
+        )
+        use_cache = st.checkbox(
+            "Reuse cached results",
+            value=True,
+            help="Skip API calls for pages (and stages) that were already processed with the same prompts."
+        )
+        skip_duplicates = st.checkbox(
+            "Skip near-duplicate pages",
+            value=SKIP_DUPLICATES,
+            help="A page that looks like one already uploaded (a retake, re-scan or re-crop) gets no API calls of "
+                 "its own and reuses that page's result. With cached results on, this also covers pages from "
+                 "earlier runs. Pages with the same layout can be mistaken for each other; skipped pages are "
+                 "listed after the run and can be reprocessed."
+        )
+        preprocess_images = st.checkbox(
+            "Shrink images before uploading",
+            value=False,
+            help="Fix the orientation, cap the resolution and re-encode large photos before sending them to the APIs."
+        )
+        speculative_ocr = st.checkbox(
+            "Start OCR during the suitability check",
+            value=False,
+            help="Lower latency per page, but pages rejected as unsuitable still use OCR quota."
+        )
+        page_range = st.text_input(
+            "Pages to process (PDF/TIFF)",
+            value="",
+            placeholder="All pages, or e.g. 1-20, 25",
+            help="Pages of each uploaded document to process. Leave empty to process every page."
+        )
+        dpi = st.slider(
+            "Document resolution (DPI)",
+            min_value=MIN_DPI,
+            max_value=MAX_DPI,
+            value=DEFAULT_DPI,
+            step=25,
+            help="Resolution PDF pages are rendered at. Higher values help with small furigana but upload more data."
+        )
+        tile_pages = st.checkbox(
+            "Split dense pages into tiles",
+            value=False,
+            help="Pages with a lot of vocabulary are cut into overlapping regions whose flashcards are written in "
+                 "parallel and merged. Faster and less likely to be cut short on dense pages, but uses more API calls."
+        )
+        single_pass = st.checkbox(
+            "Check suitability and write flashcards in one call",
+            value=False,
+            help="Every page is read by OCR first, then one Gemini call judges it and writes its flashcards. "
+                 "Faster and cheaper when most pages are suitable; rejected pages still use OCR quota."
+        )
+        low_memory = st.checkbox(
+            "Low-memory mode",
+            value=False,
+            help="Keep the uploads in temp files and write the flashcards to disk as pages finish, for long "
+                 f"documents on small servers. Uploads over {SPILL_THRESHOLD_BYTES // (1024 * 1024)} MB always use it."
+        )
+        known_deck_file = st.file_uploader(
+            "Known vocabulary deck (optional)",
+            type=["csv", "tsv", "txt", "apkg"],
+            help="Your existing deck (CSV/TSV or an Anki export). Words already in it are skipped."
+        )
+
+    # Function to start a generation job over the current uploads and settings
+    # skip_near_duplicates: Whether near-duplicate pages reuse the result of the page they repeat
+    # Returns: None; the job id is put into the URL
+    def submit_job(skip_near_duplicates):
+        # Counting the pages of documents does not render them
+        page_count = count_pages(uploaded_images, page_range)
+
+        known_vocabulary = None
+        if known_deck_file is not None:
+            known_vocabulary = load_known_vocabulary(known_deck_file, filename=known_deck_file.name)
+            st.caption(f"Skipping {len(known_vocabulary)} known word(s) from {known_deck_file.name}.")
+
+        # Run the generation as a background job. The job id goes into the URL, so
+        # reruns (e.g. clicking a download button) and browser refreshes reattach
+        # to the job instead of losing or repeating the work.
+        st.query_params["job"] = get_job_store().submit(
+            generate_japanese_flashcards,
+            uploaded_images,
+            total_pages=page_count,
+            low_memory=low_memory,
+            base64_json_path="base64_example_images.json",  # Adjust if needed
+            config=PipelineConfig(
+                max_workers=max_workers,
+                cache=get_result_cache() if use_cache else None,
+                skip_duplicates=skip_near_duplicates,
+                page_index=get_page_index() if use_cache and skip_near_duplicates else None,
+                preprocess_images=preprocess_images,
+                speculative_ocr=speculative_ocr,
+                tile_pages=tile_pages,
+                pipeline_mode=SINGLE_PASS if single_pass else TWO_PASS,
+                known_vocabulary=known_vocabulary,
+                page_range=page_range,
+                dpi=dpi,
+                # Pages from every session share one scheduler; single pages go first
+                scheduler=get_shared_scheduler(),
+                user_id=st.session_state.setdefault("user_id", uuid.uuid4().hex),
+                priority=priority_for_pages(page_count),
+            ),
+        )
+
     # Button to initiate flashcard generation
     if st.button("Generate Flashcards"):
         if not uploaded_images:
             st.warning("Please upload at least one image.")
         else:
-            with st.spinner("Processing..."):
-                try:
-                    # Generate the flashcards by calling the function
-                    flashcards_str, processing_notes = generate_japanese_flashcards(
-                        uploaded_images=uploaded_images,
-                        base64_json_path="base64_example_images.json"  # Adjust if needed
+            try:
+                submit_job(skip_duplicates)
+            except Exception as e:
+                st.error(f"An error occurred: {e}")
+
+    # Show the job of this page: just started, still running or finished
+    job_store = get_job_store()
+    job = job_store.get(st.query_params.get("job"))
+    if job is not None:
+        # Live progress: a progress bar, the status notes, a table of the cards
+        # written so far and a download of the pages finished so far
+        total_pages = job.total_pages
+        progress_bar = st.progress(0.0, text="Waiting for a free worker..." if job.status == JOB_QUEUED else "Processing...")
+        notes_container = st.container()
+        table_placeholder = st.empty()
+        download_placeholder = st.empty()
+
+        streamed_cards = {}  # Page index -> cards parsed from the streamed text so far
+        card_parsers = {}    # Page index -> FlashcardStreamParser for the streamed text
+        finished_pages = {}  # Page index -> final flashcards text
+        duplicate_notes = []  # Notes of the pages answered from a near-duplicate, shown again after the run
+        deck = job.deck
+        run_metrics = job.metrics
+        # Low-memory jobs write their flashcards to disk; the text is not kept here as well
+        low_memory_job = bool(job.options.get("low_memory"))
+        if low_memory_job and not job.finished:
+            download_placeholder.caption("Low-memory mode: the download appears when every page is done.")
+        try:
+            # Render each event of the job as it arrives; a finished job is replayed at once
+            for event in job_store.follow(job.id):
+                page_index = event.get("index")
+                if event["type"] == "cards":
+                    parser = card_parsers.setdefault(page_index, FlashcardStreamParser())
+                    streamed_cards.setdefault(page_index, []).extend(parser.feed(event["text"]))
+                elif event["type"] == "cards_reset":
+                    card_parsers[page_index] = FlashcardStreamParser()
+                    streamed_cards[page_index] = []
+                elif event["type"] == "page_done":
+                    # Low-memory jobs keep only the page index in their events; the page is read from disk
+                    page_result = event["result"] if "result" in event else job_store.page_result(job.id, page_index)
+                    finished_pages[page_index] = "" if low_memory_job else page_result["flashcards"]
+                    streamed_cards[page_index] = page_result["cards"]
+
+                    # Display the processing status for the image; a page answered from a near-duplicate
+                    # stands out, as a false match gives it another page's result
+                    for note in page_result["notes"]:
+                        if page_result.get("duplicate") and "Near-duplicate" in note:
+                            notes_container.warning(note)
+                            duplicate_notes.append(note)
+                        else:
+                            notes_container.info(note)
+
+                    progress_bar.progress(
+                        len(finished_pages) / total_pages,
+                        text=f"Processed {len(finished_pages)} of {total_pages} page(s)"
                     )
 
-                    # Display the processing status for each image
-                    for note in processing_notes:
-                        st.info(note)
-
-                    # If we have at least some flashcards, show a download button
-                    if flashcards_str.strip():
-                        st.download_button(
-                            label="Download Flashcards",
-                            data=flashcards_str,
-                            file_name="generated_flashcards.txt",
-                            mime="text/plain"
+                    # Offer the pages finished so far, in upload order
+                    partial_flashcards = "".join(finished_pages[i] for i in sorted(finished_pages))
+                    if not low_memory_job and partial_flashcards.strip() and len(finished_pages) < total_pages:
+                        download_placeholder.download_button(
+                            label="Download Flashcards So Far",
+                            data=partial_flashcards,
+                            file_name="generated_flashcards_partial.txt",
+                            mime="text/plain",
+                            key=f"partial_download_{len(finished_pages)}"
                         )
+                elif event["type"] == "done":
+                    flashcards_str = event["flashcards"]
+                    output_path = event.get("output_path")
+                    if output_path is not None:
+                        has_flashcards = os.path.exists(output_path) and os.path.getsize(output_path) > 0
+                    else:
+                        has_flashcards = bool(flashcards_str.strip())
+
+                    # If we have at least some flashcards, show the download buttons
+                    if has_flashcards:
+                        with download_placeholder.container():
+                            if output_path is not None:
+                                with open(output_path, "rb") as output_file:
+                                    st.download_button(
+                                        label="Download Flashcards",
+                                        data=output_file,
+                                        file_name="generated_flashcards.txt",
+                                        mime="text/plain"
+                                    )
+                            else:
+                                st.download_button(
+                                    label="Download Flashcards",
+                                    data=flashcards_str,
+                                    file_name="generated_flashcards.txt",
+                                    mime="text/plain"
+                                )
+                            if len(deck):
+                                st.caption(
+                                    f"{len(deck)} unique card(s); {deck.duplicates} duplicate(s) "
+                                    "across pages merged in the exports below."
+                                )
+                                csv_column, tsv_column, apkg_column = st.columns(3)
+                                csv_column.download_button(
+                                    label="De-duplicated CSV",
+                                    data=deck.to_csv(),
+                                    file_name="generated_flashcards.csv",
+                                    mime="text/csv"
+                                )
+                                tsv_column.download_button(
+                                    label="De-duplicated TSV",
+                                    data=deck.to_tsv(),
+                                    file_name="generated_flashcards.tsv",
+                                    mime="text/tab-separated-values"
+                                )
+                                try:
+                                    apkg_column.download_button(
+                                        label="Anki package (.apkg)",
+                                        data=deck.to_apkg_bytes(),
+                                        file_name="generated_flashcards.apkg",
+                                        mime="application/octet-stream"
+                                    )
+                                except ImportError as e:
+                                    apkg_column.caption(str(e))
                         st.success("Flashcards generated successfully!")
                     else:
+                        download_placeholder.empty()
                         st.warning("No flashcards were generated from the uploaded images.")
-                except Exception as e:
-                    st.error(f"An error occurred: {e}")
-                # Example of writing to disk with UTF-8 (if needed):
-                # with open("generated_flashcards.txt", "w", encoding="utf-8") as f:
-                #     f.write(flashcards_str)
+
+                if event["type"] in ("cards", "cards_reset", "page_done"):
+                    card_rows = [
+                        {
+                            "Kanji": card.kanji,
+                            "Furigana": card.furigana,
+                            "English_Translation_and_Notes": card.english_translation_and_notes,
+                        }
+                        for page in sorted(streamed_cards)
+                        for card in streamed_cards[page]
+                    ]
+                    table_placeholder.dataframe(card_rows, use_container_width=True)
+        except Exception as e:
+            st.error(f"An error occurred: {e}")
+
+        # Near-duplicate matches are listed together, with a way to process those pages after all
+        if job.finished and duplicate_notes:
+            st.warning(
+                f"{len(duplicate_notes)} page(s) were treated as near-duplicates and reused another page's result:\n\n"
+                + "\n\n".join(f"- {note}" for note in duplicate_notes)
+            )
+            if st.button(
+                "Reprocess near-duplicate pages",
+                help="Run the same uploads again without skipping near-duplicates. With cached results on, "
+                     "the other pages are answered from the cache."
+            ):
+                if not uploaded_images:
+                    st.warning("Upload the same files again to reprocess them.")
+                else:
+                    try:
+                        submit_job(False)
+                        st.rerun()
+                    except Exception as e:
+                        st.error(f"An error occurred: {e}")
+
+        if job.options.get("speculative_ocr"):
+            ocr_stats = get_speculative_ocr_stats()
+            st.caption(
+                f"Speculative OCR: {ocr_stats['used']} used, {ocr_stats['wasted']} wasted, "
+                f"{ocr_stats['cancelled']} cancelled ({ocr_stats['waste_rate']:.0%} waste rate)"
+            )
+
+        poller_stats = get_shared_poller().stats()
+        if poller_stats["submitted"]:
+            st.caption(
+                f"OCR poller: {poller_stats['in_flight']} extraction(s) in flight (peak {poller_stats['peak_in_flight']}), "
+                f"{poller_stats['checks_per_extraction']:.1f} status checks per page"
+            )
+
+        api_stats = get_shared_rate_limiter().stats()
+        st.caption(
+            " | ".join(
+                f"{api}: {stats['retries']} retries, {stats['throttled']} throttled, "
+                f"concurrency {stats['concurrency_limit']}/{stats['max_concurrency']}"
+                for api, stats in api_stats.items()
+            )
+        )
+
+        scheduler_stats = get_shared_scheduler().stats()
+        st.caption(
+            f"Scheduler: {scheduler_stats['running']}/{scheduler_stats['max_workers']} page(s) running, "
+            f"{scheduler_stats['batch']['queued'] + scheduler_stats['interactive']['queued']} queued, "
+            f"p95 wait {scheduler_stats['batch']['delay_p95']:.1f}s (batch), "
+            f"{scheduler_stats['interactive']['delay_p95']:.1f}s (single page)"
+        )
+
+        if use_cache:
+            cache_stats = get_result_cache().stats()
+            st.caption(
+                f"Cache hits: {sum(cache_stats['hits'].values())}, "
+                f"misses: {sum(cache_stats['misses'].values())}, "
+                f"stored: {cache_stats['bytes'] / (1024 * 1024):.1f} MB"
+            )
+
+        # Where the time, bytes and tokens of this run went, per page and stage
+        metric_rows = run_metrics.summary_rows()
+        if metric_rows:
+            with st.expander("Run metrics"):
+                totals = run_metrics.totals()
+                prompt_tokens = sum(usage.get("prompt", 0) for usage in totals["tokens"].values())
+                output_tokens = sum(usage.get("candidates", 0) for usage in totals["tokens"].values())
+                peak_memory = (
+                    f", peak server memory {totals['peak_rss_mb']:.0f} MB" if totals["peak_rss_mb"] is not None else ""
+                )
+                repaired_rows = sum(report.get("rows", 0) for report in totals["repairs"].values())
+                repairs = (
+                    f", {repaired_rows} malformed row(s) repaired "
+                    f"(~{sum(report.get('tokens_saved', 0) for report in totals['repairs'].values())} tokens saved)"
+                    if repaired_rows else ""
+                )
+                prefix_cache = (
+                    f", ~{totals['prefix_cache']['tokens_saved']} prompt token(s) read from the context cache"
+                    if totals["prefix_cache"].get("cached_calls") else ""
+                )
+                st.caption(
+                    f"{totals['pages']} page(s): {sum(totals['bytes_uploaded'].values()) / (1024 * 1024):.2f} MB "
+                    f"uploaded, {prompt_tokens} prompt and {output_tokens} output token(s), "
+                    f"{sum(totals['retries'].values())} retries{repairs}{prefix_cache}{peak_memory}"
+                )
+                # Which models answered, how often their answers were passed to a stronger one, and what they cost
+                model_lines = [
+                    f"{stage} {model}: {model_totals['attempts']} answer(s), "
+                    f"{sum(model_totals['escalations'].values())} escalated, "
+                    f"{model_totals['seconds'] / model_totals['attempts']:.2f}s each, ~${model_totals['cost']:.4f}"
+                    for stage, models in totals["models"].items()
+                    for model, model_totals in models.items()
+                ]
+                if model_lines:
+                    st.caption("Models — " + "; ".join(model_lines))
+                # How close the token planner's predictions were, and how many requests it cut down to fit the budget
+                token_lines = [
+                    f"{stage}: ~{plan_totals['predicted']} predicted vs {plan_totals['reported']} reported, "
+                    f"{plan_totals['reduced']} of {plan_totals['calls']} call(s) reduced"
+                    + (f", {plan_totals['over_budget']} over budget" if plan_totals["over_budget"] else "")
+                    for stage, plan_totals in totals["token_plans"].items()
+                ]
+                if token_lines:
+                    st.caption("Input tokens — " + "; ".join(token_lines))
+                if totals["duplicates"]["pages"]:
+                    st.caption(
+                        f"{totals['duplicates']['pages']} near-duplicate page(s) skipped, "
+                        f"~{totals['duplicates']['calls_avoided']} API call(s) avoided"
+                    )
+                st.dataframe(metric_rows, use_container_width=True, hide_index=True)
+                json_column, prometheus_column, process_column = st.columns(3)
+                json_column.download_button(
+                    label="Metrics (JSON)",
+                    data=run_metrics.to_json(),
+                    file_name="flashcard_metrics.json",
+                    mime="application/json"
+                )
+                prometheus_column.download_button(
+                    label="Metrics (Prometheus)",
+                    data=run_metrics.to_prometheus(),
+                    file_name="flashcard_metrics.prom",
+                    mime="text/plain"
+                )
+                # Every run of this server process, plus its startup and rerun times
+                process_column.download_button(
+                    label="Process metrics (Prometheus)",
+                    data=get_shared_metrics().to_prometheus(),
+                    file_name="flashcard_process_metrics.prom",
+                    mime="text/plain"
+                )
 
 
 # This condition ensures the script is run directly through Streamlit
@@ -0,0 +1,403 @@
+# Headless batch mode: runs the flashcard pipeline over a directory or glob of page images
+# or scanned PDF/TIFF documents
+#
+# Usage:
+#   python batch_cli.py scans/chapter_01 --output chapter_01.csv
+#   python batch_cli.py "scans/**/*.jpg" --manifest book.jsonl --output book.csv --workers 4
+#   python batch_cli.py book.pdf --pages 10-40 --dpi 250 --output chapter_02.csv
+#
+# Every finished page is appended to a JSONL manifest (stage outputs, metrics, error).
+# Re-running the same command resumes from the manifest: pages already processed are
+# skipped and only failed or new pages are sent to the APIs again.
+# Importing the required libraries
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+
+from app import PIPELINE_MODES, TWO_PASS, PipelineConfig, process_pages
+from document_pages import DEFAULT_DPI, DOCUMENT_EXTENSIONS, DocumentReader, is_document_path, parse_page_range
+from duplicate_pages import DEFAULT_PAGE_INDEX_PATH, SKIP_DUPLICATES, PageIndex
+from flashcard_deck import FlashcardDeck, parse_flashcards
+from known_vocabulary import load_known_vocabulary
+from pipeline_metrics import PipelineMetrics, page_metrics, page_status
+from pipeline_resources import get_pipeline_resources
+from result_cache import DEFAULT_CACHE_PATH, ResultCache
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+INPUT_EXTENSIONS = IMAGE_EXTENSIONS + DOCUMENT_EXTENSIONS
+
+# Manifest statuses that count as finished on resume; "error" pages are retried
+COMPLETED_STATUSES = ("done", "not_suitable")
+
+
+# Function to expand the command-line inputs into an ordered list of image and document paths
+# inputs: Directories, files or glob patterns
+# Returns: List of image, PDF and TIFF paths, sorted within each input, without duplicates
+def collect_image_paths(inputs):
+    paths = []
+    seen = set()
+    for entry in inputs:
+        if os.path.isdir(entry):
+            matches = [
+                os.path.join(entry, name)
+                for name in os.listdir(entry)
+                if name.lower().endswith(INPUT_EXTENSIONS)
+            ]
+        elif os.path.isfile(entry):
+            matches = [entry]
+        else:
+            matches = [
+                path for path in glob.glob(entry, recursive=True)
+                if path.lower().endswith(INPUT_EXTENSIONS)
+            ]
+        for path in sorted(matches):
+            absolute_path = os.path.abspath(path)
+            if absolute_path not in seen:
+                seen.add(absolute_path)
+                paths.append(path)
+    return paths
+
+
+# Function to hash a file without reading it into memory at once
+# path: File to hash
+# Returns: Hex SHA-256 digest of the file contents
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Function to list the pages of the inputs without rendering any document page
+# paths: Image and document paths (from collect_image_paths)
+# page_range: Pages of each document to process (see document_pages.parse_page_range)
+# dpi: Resolution document pages are rendered at
+# Returns: List of (page path, page sha256, document position or None) tuples; a document page's path
+#          is "<document>#page=<n>" and its hash covers the document contents, page number and DPI
+def collect_pages(paths, page_range=None, dpi=DEFAULT_DPI):
+    pages = []
+    for path in paths:
+        file_hash = hash_file(path)
+        if not is_document_path(path):
+            pages.append((path, file_hash, None))
+            continue
+        with open(path, "rb") as document:
+            reader = DocumentReader(document, dpi=dpi)
+            page_count = reader.page_count
+            reader.close()
+        for position in parse_page_range(page_range, page_count):
+            page_key = f"{file_hash}#page={position + 1}@{dpi}dpi"
+            pages.append((f"{path}#page={position + 1}", hashlib.sha256(page_key.encode("utf-8")).hexdigest(), position))
+    return pages
+
+
+# Function to index the manifest by page hash
+# manifest_path: JSONL manifest written by a previous run
+# Returns: Dictionary of page sha256 -> (byte offset of its latest record, status)
+def read_manifest_index(manifest_path):
+    index = {}
+    if not os.path.exists(manifest_path):
+        return index
+    with open(manifest_path, "rb") as f:
+        offset = 0
+        for line in f:
+            try:
+                record = json.loads(line)
+                index[record["sha256"]] = (offset, record["status"])
+            except (ValueError, KeyError):
+                pass  # A torn last line from a crash; the page is simply re-run
+            offset += len(line)
+    return index
+
+
+# Function to turn a page result into a manifest record
+# path: Image path, or "<document>#page=<n>" for a document page
+# sha256: Hash of the image contents (see collect_pages for document pages)
+# page_result: Dictionary returned by process_single_image
+# Returns: JSON-serialisable dictionary
+def build_manifest_record(path, sha256, page_result):
+    return {
+        "path": path,
+        "sha256": sha256,
+        "index": page_result["index"],
+        "status": page_status(page_result),
+        "suitability": page_result["suitability"],
+        "ocr_text": page_result["ocr_text"],
+        "flashcards": page_result["flashcards"],
+        "notes": page_result["notes"],
+        "timings": page_result["timings"],
+        "tiles": page_result["tiles"],
+        "metrics": page_metrics(page_result),
+        "error": page_result["error"],
+        "error_stage": page_result["error_stage"],
+        "finished_at": time.time(),
+    }
+
+
+# Function to iterate over the flashcards text of each finished page, read one record at a time
+# page_hashes: Page hashes in input order
+# manifest_path: JSONL manifest
+# Yields: The flashcards text of every page whose latest record is "done", in input order
+def iter_manifest_flashcards(page_hashes, manifest_path):
+    index = read_manifest_index(manifest_path)
+    with open(manifest_path, "rb") as manifest:
+        for sha256 in page_hashes:
+            if sha256 not in index:
+                continue
+            offset, status = index[sha256]
+            if status != "done":
+                continue
+            manifest.seek(offset)
+            yield json.loads(manifest.readline())["flashcards"]
+
+
+# Function to write a de-duplicated deck built from the manifest
+# page_hashes: Page hashes in input order
+# manifest_path: JSONL manifest
+# output_path: Destination; .tsv and .apkg select those formats, anything else is CSV
+# Returns: Tuple (unique cards written, duplicates merged)
+def write_deck_from_manifest(page_hashes, manifest_path, output_path):
+    deck = FlashcardDeck(name=os.path.splitext(os.path.basename(output_path))[0])
+    for page_index, flashcards_text in enumerate(iter_manifest_flashcards(page_hashes, manifest_path), start=1):
+        deck.add_cards(parse_flashcards(flashcards_text), page_index)
+
+    if output_path.lower().endswith(".apkg"):
+        deck.write_apkg(output_path)
+    else:
+        delimiter = "\t" if output_path.lower().endswith(".tsv") else ","
+        with open(output_path, "w", encoding="utf-8") as output:
+            output.write(deck.to_csv(delimiter=delimiter))
+    return len(deck), deck.duplicates
+
+
+# Function to write the final CSV by streaming each page's record from the manifest
+# page_hashes: Page hashes in input order
+# manifest_path: JSONL manifest
+# output_path: Destination CSV path
+# Returns: Number of pages whose flashcards were written
+def write_csv_from_manifest(page_hashes, manifest_path, output_path):
+    written = 0
+    temporary_path = output_path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as output:
+        for flashcards_text in iter_manifest_flashcards(page_hashes, manifest_path):
+            flashcards_text = flashcards_text.strip("\n")
+            if flashcards_text:
+                output.write(flashcards_text + "\n")
+                written += 1
+    os.replace(temporary_path, output_path)
+    return written
+
+
+# Function to run the batch, resuming from the manifest
+# args: Parsed command-line arguments
+# Returns: Process exit code
+def run_batch(args):
+    paths = collect_image_paths(args.inputs)
+    if not paths:
+        print("No images found.", file=sys.stderr)
+        return 1
+    try:
+        pages = collect_pages(paths, page_range=args.pages, dpi=args.dpi)
+    except (ImportError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    if args.restart and os.path.exists(args.manifest):
+        os.remove(args.manifest)
+
+    metrics = PipelineMetrics(keep_pages=False)
+    page_hashes = [sha256 for _, sha256, _ in pages]
+    manifest_index = read_manifest_index(args.manifest)
+    pending = [
+        (position, path, sha256, document_position)
+        for position, (path, sha256, document_position) in enumerate(pages, start=1)
+        if manifest_index.get(sha256, (None, None))[1] not in COMPLETED_STATUSES
+    ]
+    print(f"{len(pages)} page(s) found, {len(pages) - len(pending)} already done, {len(pending)} to process.")
+
+    if pending:
+        resources = get_pipeline_resources(args.examples)
+        cache = None if args.no_cache else ResultCache(path=args.cache)
+        # Near-duplicates of pages from earlier runs are looked up next to the cache they reuse
+        page_index = PageIndex(path=args.page_index) if cache is not None and args.skip_duplicates else None
+        known_vocabulary = load_known_vocabulary(args.known_deck) if args.known_deck else None
+
+        # Files are opened, and document pages rendered, lazily as process_pages reads
+        # ahead; each is closed once its page is written
+        open_files = {}
+
+        def indexed_images():
+            document_path, document, reader = None, None, None
+            try:
+                for position, path, _, document_position in pending:
+                    if document_position is None:
+                        open_files[position] = open(path, "rb")
+                    else:
+                        # One reader per document, kept open while its pages are consumed
+                        page_document_path = path.rsplit("#page=", 1)[0]
+                        if page_document_path != document_path:
+                            if reader is not None:
+                                reader.close()
+                                document.close()
+                            document_path = page_document_path
+                            document = open(document_path, "rb")
+                            reader = DocumentReader(document, dpi=args.dpi)
+                        open_files[position] = reader.render(document_position)
+                    yield position, open_files[position]
+            finally:
+                if reader is not None:
+                    reader.close()
+                    document.close()
+
+        page_info = {position: (path, sha256) for position, path, sha256, _ in pending}
+        with open(args.manifest, "a", encoding="utf-8") as manifest:
+            for page_result in process_pages(
+                indexed_images(),
+                resources,
+                PipelineConfig(
+                    max_workers=args.workers,
+                    cache=cache,
+                    preprocess_images=args.preprocess,
+                    speculative_ocr=args.speculative_ocr,
+                    known_vocabulary=known_vocabulary,
+                    metrics=metrics,
+                    tile_pages=args.tile_pages,
+                    pipeline_mode=args.mode,
+                    skip_duplicates=args.skip_duplicates,
+                    page_index=page_index,
+                ),
+            ):
+                position = page_result["index"]
+                open_files.pop(position).close()
+                path, sha256 = page_info[position]
+                record = build_manifest_record(path, sha256, page_result)
+
+                # Checkpoint: the record is on disk before the next page is reported
+                manifest.write(json.dumps(record, ensure_ascii=False) + "\n")
+                manifest.flush()
+                os.fsync(manifest.fileno())
+
+                for note in page_result["notes"]:
+                    print(note)
+
+    if args.dedupe:
+        unique_cards, duplicates = write_deck_from_manifest(page_hashes, args.manifest, args.output)
+        print(f"Merged {duplicates} duplicate card(s); {unique_cards} unique card(s).")
+    written = None if args.dedupe else write_csv_from_manifest(page_hashes, args.manifest, args.output)
+    manifest_index = read_manifest_index(args.manifest)
+    failed = sum(
+        1 for sha256 in page_hashes
+        if manifest_index.get(sha256, (None, "error"))[1] == "error"
+    )
+    if written is not None:
+        print(f"Wrote flashcards for {written} page(s) to {args.output}.")
+    else:
+        print(f"Wrote the de-duplicated deck to {args.output}.")
+    totals = metrics.totals()
+    if totals["peak_rss_mb"] is not None:
+        print(f"Peak memory while processing: {totals['peak_rss_mb']:.0f} MB.")
+    if totals["prefix_cache"].get("cached_calls"):
+        print(
+            f"{totals['prefix_cache']['cached_calls']} flashcard call(s) read the few-shot examples from the context cache "
+            f"(~{totals['prefix_cache']['tokens_saved']} input tokens not re-sent)."
+        )
+    repaired_rows = sum(report["rows"] for report in totals["repairs"].values())
+    if repaired_rows:
+        print(
+            f"Sent {repaired_rows} malformed row(s) back for repair instead of regenerating their pages "
+            f"(~{sum(report['tokens_saved'] for report in totals['repairs'].values())} tokens saved)."
+        )
+    for stage, plan_totals in totals["token_plans"].items():
+        if plan_totals["reduced"] or plan_totals["over_budget"]:
+            print(
+                f"{stage}: {plan_totals['reduced']} of {plan_totals['calls']} call(s) reduced to fit the token budget"
+                + (f", {plan_totals['over_budget']} still over it" if plan_totals["over_budget"] else "")
+                + f" (~{plan_totals['predicted']} input tokens predicted, {plan_totals['reported']} reported)."
+            )
+    if totals["duplicates"]["pages"]:
+        print(
+            f"{totals['duplicates']['pages']} near-duplicate page(s) answered from an earlier page "
+            f"(~{totals['duplicates']['calls_avoided']} API call(s) avoided)."
+        )
+    for stage, models in totals["models"].items():
+        for model, model_totals in models.items():
+            escalated = sum(model_totals["escalations"].values())
+            print(
+                f"{stage} on {model}: {model_totals['attempts']} answer(s), {escalated} escalated "
+                f"({escalated / model_totals['attempts']:.0%}), {model_totals['seconds'] / model_totals['attempts']:.2f}s "
+                f"each, ~${model_totals['cost']:.4f}."
+            )
+    if args.metrics:
+        with open(args.metrics, "w", encoding="utf-8") as f:
+            f.write(metrics.to_prometheus() if args.metrics.lower().endswith(".prom") else metrics.to_json())
+        print(f"Wrote the metrics of this run to {args.metrics}.")
+    if failed:
+        print(f"{failed} page(s) failed; re-run the same command to retry them.", file=sys.stderr)
+        return 2
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate Japanese flashcards from a directory or glob of textbook page images or scanned documents."
+    )
+    parser.add_argument("inputs", nargs="+", help="Image, PDF or TIFF files, directories or glob patterns (quote globs)")
+    parser.add_argument("--output", default="generated_flashcards.csv", help="CSV file to write")
+    parser.add_argument("--manifest", default="flashcards_manifest.jsonl", help="JSONL checkpoint manifest")
+    parser.add_argument("--examples", default="base64_example_images.json", help="Few-shot example images (.json or .bin)")
+    parser.add_argument("--workers", type=int, default=4, help="Pages processed in parallel")
+    parser.add_argument("--pages", help='Pages of each PDF/TIFF to process, e.g. "1-20,25" (default: all)')
+    parser.add_argument("--dpi", type=int, default=DEFAULT_DPI, help="Resolution PDF pages are rendered at")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH, help="Result cache path")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the result cache")
+    duplicates = parser.add_mutually_exclusive_group()
+    duplicates.add_argument(
+        "--skip-duplicates",
+        dest="skip_duplicates",
+        action="store_true",
+        default=SKIP_DUPLICATES,
+        help="Answer near-duplicate pages (retakes, re-scans, re-crops) from the page they repeat instead of the APIs",
+    )
+    duplicates.add_argument(
+        "--keep-duplicates",
+        dest="skip_duplicates",
+        action="store_false",
+        help="Send near-duplicate pages to the APIs like any other page (the default unless FLASHCARD_SKIP_DUPLICATES=1)",
+    )
+    parser.add_argument(
+        "--page-index",
+        default=DEFAULT_PAGE_INDEX_PATH,
+        help="Fingerprints of the pages of earlier runs, for near-duplicates of them (used with the cache)",
+    )
+    parser.add_argument("--preprocess", action="store_true", help="Shrink images before uploading")
+    parser.add_argument("--speculative-ocr", action="store_true", help="Start OCR during the suitability check")
+    parser.add_argument("--tile-pages", action="store_true", help="Split dense pages into tiles generated in parallel")
+    parser.add_argument(
+        "--mode",
+        choices=PIPELINE_MODES,
+        default=TWO_PASS,
+        help="two_pass checks suitability before OCR; single_pass runs OCR first and gets the verdict and "
+             "flashcards from one call",
+    )
+    parser.add_argument("--known-deck", help="Existing deck (CSV/TSV, Anki text export or .apkg) whose words are skipped")
+    parser.add_argument(
+        "--dedupe",
+        action="store_true",
+        help="Merge duplicate cards across pages; an --output ending in .tsv or .apkg selects that format",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="Write this run's timings, bytes, tokens and retries here; a path ending in .prom selects "
+             "the Prometheus text format, anything else JSON",
+    )
+    parser.add_argument("--restart", action="store_true", help="Ignore and replace an existing manifest")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(run_batch(parse_args()))
@@ -0,0 +1,5 @@
+# The fake LLMWhisperer answers in milliseconds and has no request quota, so the benchmarks poll
+# it faster than the floor the app uses against the real API (see ocr_poller.MIN_POLL_INTERVAL)
+import os
+
+os.environ.setdefault("LLMWHISPERER_MIN_POLL_INTERVAL", "0.01")
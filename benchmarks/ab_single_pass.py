@@ -0,0 +1,207 @@
+# A/B comparison of the two-pass and single-pass pipeline modes
+#
+# Usage (from the repository root):
+#   python -m benchmarks.ab_single_pass                                  # 100 synthetic pages, fake backends
+#   python -m benchmarks.ab_single_pass --page-count 200 --suitable-rate 0.6 --verdict-flip-rate 0.02
+#   python -m benchmarks.ab_single_pass --live scans/*.jpg                # real APIs on a fixed page set (uses quota)
+#
+# Runs the same page set through generate_japanese_flashcards once per mode, without the
+# result cache, and reports end-to-end latency, Gemini token spend, bytes uploaded and API
+# calls per mode, then how often the two modes agree on which pages to reject.
+# Importing the required libraries
+import argparse
+import glob
+import sys
+import time
+
+from app import PIPELINE_MODES, SINGLE_PASS, TWO_PASS, generate_japanese_flashcards
+from benchmarks.fake_backends import (
+    FakeGenerativeModel,
+    FakeWhispererClient,
+    make_fake_resources,
+    make_synthetic_pages,
+)
+from benchmarks.run_benchmarks import make_unthrottled_limiter, percentile
+from rate_limiter import GEMINI_API, LLMWHISPERER_API
+
+
+# Function to open the page set of one run
+# args: Parsed command-line arguments
+# Returns: List of file-like objects (the caller closes real files)
+def open_pages(args):
+    if not args.live:
+        return make_synthetic_pages(args.page_count)
+    paths = sorted(path for pattern in args.paths for path in glob.glob(pattern))
+    return [open(path, "rb") for path in paths]
+
+
+# Function to build the resources of one run
+# args: Parsed command-line arguments
+# Returns: PipelineResources (fresh fakes with the same seed, so both modes see the same pages)
+def make_resources(args):
+    if args.live:
+        from pipeline_resources import get_pipeline_resources
+
+        return get_pipeline_resources(args.examples)
+    return make_fake_resources(
+        model=FakeGenerativeModel(
+            suitability_latency=args.suitability_latency,
+            flashcard_latency=args.flashcard_latency,
+            suitable_rate=args.suitable_rate,
+            verdict_flip_rate=args.verdict_flip_rate,
+            prompt_latency_per_1k_tokens=args.prompt_latency_per_1k,
+            seed=args.seed,
+        ),
+        client=FakeWhispererClient(ocr_latency=args.ocr_latency, seed=args.seed),
+    )
+
+
+# Function to run the page set in one mode
+# mode: TWO_PASS or SINGLE_PASS
+# args: Parsed command-line arguments
+# Returns: Summary dictionary, with the verdict of every page under "verdicts"
+def run_mode(mode, args):
+    resources = make_resources(args)
+    rate_limiter = make_unthrottled_limiter(args.workers)
+    pages = open_pages(args)
+    page_results = []
+    start = time.perf_counter()
+    try:
+        generate_japanese_flashcards(
+            pages,
+            resources=resources,
+            max_workers=args.workers,
+            rate_limiter=rate_limiter,
+            pipeline_mode=mode,
+            on_event=lambda event: page_results.append(event["result"]) if event["type"] == "page_done" else None,
+        )
+    finally:
+        if args.live:
+            for page in pages:
+                page.close()
+    elapsed = time.perf_counter() - start
+
+    api_stats = rate_limiter.stats()
+    totals = [page_result["timings"]["total"] for page_result in page_results if "total" in page_result["timings"]]
+    return {
+        "pages": len(page_results),
+        "elapsed_seconds": elapsed,
+        "total_p50": percentile(totals, 50),
+        "total_p95": percentile(totals, 95),
+        "prompt_tokens": sum(
+            usage.get("prompt", 0) for page_result in page_results for usage in page_result["tokens"].values()
+        ),
+        "output_tokens": sum(
+            usage.get("candidates", 0) for page_result in page_results for usage in page_result["tokens"].values()
+        ),
+        "bytes_uploaded": sum(sum(page_result["bytes_uploaded"].values()) for page_result in page_results),
+        "gemini_calls": api_stats[GEMINI_API]["succeeded"],
+        "ocr_calls": api_stats[LLMWHISPERER_API]["succeeded"],
+        "cards": sum(len(page_result["cards"]) for page_result in page_results),
+        "errors": sum(1 for page_result in page_results if page_result["error"]),
+        "verdicts": {
+            page_result["index"]: (page_result["suitability"] or {}).get("is_suitable")
+            for page_result in page_results
+        },
+    }
+
+
+# Function to compare the verdicts of the two modes
+# two_pass, single_pass: Summaries from run_mode
+# Returns: Dictionary with the pages both modes judged, how many they agree on, and the pages
+#          rejected by only one of them
+def compare_verdicts(two_pass, single_pass):
+    pages = sorted(
+        index for index in two_pass["verdicts"]
+        if two_pass["verdicts"][index] and single_pass["verdicts"].get(index)
+    )
+    agree = [index for index in pages if two_pass["verdicts"][index] == single_pass["verdicts"][index]]
+    return {
+        "pages": len(pages),
+        "agree": len(agree),
+        "rejected_by_two_pass_only": [
+            index for index in pages if two_pass["verdicts"][index] != "Yes" and single_pass["verdicts"][index] == "Yes"
+        ],
+        "rejected_by_single_pass_only": [
+            index for index in pages if two_pass["verdicts"][index] == "Yes" and single_pass["verdicts"][index] != "Yes"
+        ],
+    }
+
+
+# Function to print the comparison
+# results: Dictionary of mode -> summary
+# Returns: None
+def print_report(results):
+    print(
+        f"{'mode':<13}{'pages':>7}{'wall s':>9}{'p50 ms':>9}{'p95 ms':>9}{'Gemini calls':>14}{'OCR calls':>11}"
+        f"{'prompt tok':>12}{'output tok':>12}{'uploaded MB':>13}{'cards':>8}{'errors':>8}"
+    )
+    for mode, summary in results.items():
+        def ms(value):
+            return f"{value * 1000:.0f}" if value is not None else "-"
+        print(
+            f"{mode:<13}{summary['pages']:>7}{summary['elapsed_seconds']:>9.2f}{ms(summary['total_p50']):>9}"
+            f"{ms(summary['total_p95']):>9}{summary['gemini_calls']:>14}{summary['ocr_calls']:>11}"
+            f"{summary['prompt_tokens']:>12}{summary['output_tokens']:>12}"
+            f"{summary['bytes_uploaded'] / (1024 * 1024):>13.2f}{summary['cards']:>8}{summary['errors']:>8}"
+        )
+    if TWO_PASS not in results or SINGLE_PASS not in results:
+        return
+    two_pass, single_pass = results[TWO_PASS], results[SINGLE_PASS]
+
+    def change(key):
+        if not two_pass[key]:
+            return "-"
+        return f"{(single_pass[key] - two_pass[key]) / two_pass[key]:+.0%}"
+
+    print(
+        f"single_pass vs two_pass: wall time {change('elapsed_seconds')}, p50 {change('total_p50')}, "
+        f"p95 {change('total_p95')}, prompt tokens {change('prompt_tokens')}, output tokens {change('output_tokens')}, "
+        f"bytes uploaded {change('bytes_uploaded')}"
+    )
+    agreement = compare_verdicts(two_pass, single_pass)
+    if agreement["pages"]:
+        print(
+            f"Rejection agreement: {agreement['agree']}/{agreement['pages']} pages "
+            f"({agreement['agree'] / agreement['pages']:.1%}); rejected only by two_pass: "
+            f"{agreement['rejected_by_two_pass_only'] or 'none'}; rejected only by single_pass: "
+            f"{agreement['rejected_by_single_pass_only'] or 'none'}"
+        )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the two-pass and single-pass pipeline modes on one page set.")
+    parser.add_argument("paths", nargs="*", help="Page images (or quoted globs) for --live runs")
+    parser.add_argument("--live", action="store_true", help="Call the real APIs on the given pages (uses quota)")
+    parser.add_argument("--examples", default="base64_example_images.json", help="Example images for --live runs")
+    parser.add_argument("--modes", nargs="+", default=list(PIPELINE_MODES), choices=PIPELINE_MODES)
+    parser.add_argument("--page-count", type=int, default=100, help="Synthetic pages (without --live)")
+    parser.add_argument("--workers", type=int, default=8, help="Pages processed in parallel")
+    parser.add_argument("--suitable-rate", type=float, default=0.8, help="Share of synthetic pages that are suitable")
+    parser.add_argument(
+        "--verdict-flip-rate", type=float, default=0.0,
+        help="Share of synthetic pages whose single-pass verdict differs from the suitability call's"
+    )
+    parser.add_argument("--suitability-latency", type=float, default=0.02, help="Seconds per suitability call")
+    parser.add_argument("--ocr-latency", type=float, default=0.06, help="Seconds per OCR call")
+    parser.add_argument("--flashcard-latency", type=float, default=0.04, help="Seconds per flashcard call")
+    parser.add_argument(
+        "--prompt-latency-per-1k", type=float, default=0.01,
+        help="Extra seconds per flashcard call for every thousand prompt tokens"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    if args.live and not args.paths:
+        parser.error("--live needs the page images to run on")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = {mode: run_mode(mode, args) for mode in args.modes}
+    print_report(results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,458 @@
+# Local stand-ins for the Gemini and LLMWhisperer clients, for offline benchmarks
+# The fakes implement only the parts of the SDK surface the pipeline uses, with
+# configurable latency, error injection and output sizes, and are deterministic for a seed.
+# Importing the required libraries
+import copy
+import json
+import random
+import re
+import threading
+import time
+from io import BytesIO
+
+import PIL.Image
+import PIL.ImageDraw
+import PIL.ImageEnhance
+
+from LLM_Prompts import flashcard_repair_prompt, single_pass_note, suitability_repair_prompt, suitability_user_prompt
+from model_router import ModelRouter
+from pipeline_resources import PipelineResources
+from result_cache import FLASHCARD_STAGE, SUITABILITY_STAGE
+from token_budget import estimate_gemini_tokens
+
+# Kana and kanji, counted at their own rate by FakeGenerativeModel.count_tokens
+_JAPANESE_PATTERN = re.compile("[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff]")
+
+
+class FakeApiError(Exception):
+    """Error carrying an HTTP-like status code, classified like the real SDK errors."""
+
+    def __init__(self, code, message="Injected fake API error"):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+class FakeUsageMetadata:
+    def __init__(self, prompt_token_count, candidates_token_count, cached_content_token_count=0):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.cached_content_token_count = cached_content_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+class FakeResponse:
+    """Mimics GenerateContentResponse: .text, .resolve(), .usage_metadata and chunk iteration."""
+
+    def __init__(self, text, usage_metadata, chunk_count=1, chunk_delay=0.0):
+        self.text = text
+        self.usage_metadata = usage_metadata
+        self._chunk_count = max(1, chunk_count)
+        self._chunk_delay = chunk_delay
+
+    def resolve(self):
+        pass
+
+    def __iter__(self):
+        chunk_size = max(1, len(self.text) // self._chunk_count + 1)
+        for start in range(0, len(self.text), chunk_size):
+            if self._chunk_delay:
+                time.sleep(self._chunk_delay)
+            yield FakeResponse(self.text[start:start + chunk_size], self.usage_metadata)
+
+
+# Function to sleep for a latency drawn around a mean
+# rng: random.Random to draw from
+# mean: Mean latency in seconds
+# jitter: Relative jitter (0.2 means +/-20%)
+# Returns: None
+def _sleep(rng, mean, jitter):
+    if mean > 0:
+        time.sleep(max(0.0, rng.uniform(mean * (1 - jitter), mean * (1 + jitter))))
+
+
+class FakeGenerativeModel:
+    """
+    Stand-in for genai.GenerativeModel.
+
+    Suitability prompts get a JSON verdict (a page is unsuitable with probability
+    1 - suitable_rate), everything else gets cards_per_page CSV rows, or a JSON array
+    of card objects when the call asks for JSON mode. malformed_rate of the JSON rows
+    lose a field, and repair prompts get one valid card per malformed entry.
+    error_rate of calls raise FakeApiError(error_code), which the rate limiter
+    retries like a 429. Flashcard calls take prompt_latency_per_1k_tokens longer per
+    thousand prompt tokens that are not read from a FakeContextCache prefix.
+    Single-pass prompts get the page's verdict and cards in one JSON object; the
+    verdict differs from the suitability call's for verdict_flip_rate of the pages.
+    short_answer_rate of the flashcard answers stop after a fifth of the cards, like a
+    weaker model skipping most of a page (used to exercise model escalation).
+    Kana and kanji are billed at text_tokens_per_character tokens each when it is
+    set, so the token planner's estimates have something to calibrate against.
+    """
+
+    def __init__(
+        self,
+        model_name="models/fake-gemini",
+        suitability_latency=0.02,
+        flashcard_latency=0.05,
+        jitter=0.2,
+        error_rate=0.0,
+        error_code=429,
+        suitable_rate=0.9,
+        cards_per_page=20,
+        malformed_rate=0.0,
+        prompt_latency_per_1k_tokens=0.0,
+        verdict_flip_rate=0.0,
+        short_answer_rate=0.0,
+        text_tokens_per_character=None,
+        seed=0
+        ):
+        self.model_name = model_name
+        self.suitability_latency = suitability_latency
+        self.flashcard_latency = flashcard_latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.suitable_rate = suitable_rate
+        self.cards_per_page = cards_per_page
+        self.malformed_rate = malformed_rate
+        self.prompt_latency_per_1k_tokens = prompt_latency_per_1k_tokens
+        self.verdict_flip_rate = verdict_flip_rate
+        self.short_answer_rate = short_answer_rate
+        self.text_tokens_per_character = text_tokens_per_character
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._context_cache = None
+        self._cached_name = None
+        self._cached_prefix = []
+        self.calls = 0
+
+    def _draw(self):
+        with self._lock:
+            self.calls += 1
+            return random.Random(self._rng.random())
+
+    # Function to give every page a stable identity, so verdicts do not depend on call order
+    # contents: The prompt parts
+    # Returns: Integer derived from the first image's size
+    @staticmethod
+    def _page_seed(contents):
+        images = [part for part in contents if hasattr(part, "size")]
+        return images[-1].size[0] * 7919 + images[-1].size[1] if images else 0
+
+    # Function to count a request's tokens, like GenerativeModel.count_tokens: text and image tiles
+    # are counted as token_budget estimates them, Japanese text at text_tokens_per_character
+    def count_tokens(self, contents):
+        tokens = estimate_gemini_tokens(contents)
+        if self.text_tokens_per_character is not None:
+            for part in contents:
+                if isinstance(part, str):
+                    japanese = len(_JAPANESE_PATTERN.findall(part))
+                    tokens += round(japanese * self.text_tokens_per_character) - japanese // 3
+        usage = FakeUsageMetadata(tokens, 0)
+        usage.total_tokens = tokens
+        return usage
+
+    # Function to bind a copy of the model to a cached prefix, like GenerativeModel.from_cached_content
+    # context_cache: FakeContextCache holding the prefix
+    # name: Name of the cached prefix
+    # prefix: The cached prefix parts
+    # Returns: FakeGenerativeModel sharing this one's random state and call count
+    def with_cached_prefix(self, context_cache, name, prefix):
+        cached_model = copy.copy(self)
+        cached_model._context_cache = context_cache
+        cached_model._cached_name = name
+        cached_model._cached_prefix = list(prefix)
+        return cached_model
+
+    # Function to write a page's cards as a JSON array, malformed_rate of them without their reading
+    # page_rng: random.Random seeded with the page identity
+    # card_count: Number of cards
+    # Returns: JSON text
+    def _json_cards(self, page_rng, card_count):
+        rows = []
+        for row in range(card_count):
+            card = {
+                "kanji": f"語{page_rng.randrange(100000)}",
+                "furigana": f"ご{row}",
+                "english_translation_and_notes": f"synthetic word {row}, with a note",
+            }
+            if page_rng.random() < self.malformed_rate:
+                del card["furigana"]
+            rows.append(json.dumps(card, ensure_ascii=False))
+        return "[" + ",\n".join(rows) + "]"
+
+    def generate_content(self, contents, stream=False, generation_config=None, **kwargs):
+        if self._context_cache is not None and not self._context_cache.is_live(self._cached_name):
+            raise FakeApiError(404, f"CachedContent not found (or permission denied): {self._cached_name}")
+        uncached_tokens = self.count_tokens(contents).prompt_token_count
+        cached_tokens = self.count_tokens(self._cached_prefix).prompt_token_count if self._cached_prefix else 0
+        contents = self._cached_prefix + list(contents)
+        rng = self._draw()
+        is_suitability = any(isinstance(part, str) and part == suitability_user_prompt for part in contents)
+        prompt = contents[-1] if contents and isinstance(contents[-1], str) else ""
+        is_suitability_repair = prompt.startswith(suitability_repair_prompt.split("{")[0])
+        is_flashcard_repair = prompt.startswith(flashcard_repair_prompt.split("{")[0])
+        is_single_pass = prompt.endswith(single_pass_note)
+        # Repairs are short text-only calls
+        is_short = is_suitability or is_suitability_repair or is_flashcard_repair
+        latency = self.suitability_latency if is_short else self.flashcard_latency
+        if not is_short:
+            latency += self.prompt_latency_per_1k_tokens * uncached_tokens / 1000
+        _sleep(rng, latency, self.jitter)
+        if rng.random() < self.error_rate:
+            raise FakeApiError(self.error_code)
+
+        card_count = self.cards_per_page
+        if rng.random() < self.short_answer_rate:
+            card_count = max(1, self.cards_per_page // 5)
+        json_mode = (generation_config or {}).get("response_mime_type") == "application/json"
+        page_rng = random.Random(self._page_seed(contents))
+        if is_suitability or is_suitability_repair:
+            suitable = page_rng.random() < self.suitable_rate
+            text = json.dumps({
+                "is_suitable": "Yes" if suitable else "No",
+                "reason": "Synthetic verdict from the fake backend.",
+            })
+        elif is_flashcard_repair:
+            entries = prompt.split("---MALFORMED ENTRIES START HERE---")[1].split("---MALFORMED ENTRIES END HERE---")[0]
+            text = json.dumps([
+                {"kanji": f"語{row}", "furigana": f"ご{row}", "english_translation_and_notes": f"repaired word {row}"}
+                for row, entry in enumerate(line for line in entries.splitlines() if line.strip())
+            ], ensure_ascii=False)
+        elif is_single_pass:
+            suitable = page_rng.random() < self.suitable_rate
+            if page_rng.random() < self.verdict_flip_rate:
+                suitable = not suitable
+            verdict = json.dumps({
+                "is_suitable": "Yes" if suitable else "No",
+                "reason": "Synthetic verdict from the fake backend.",
+            })
+            cards = self._json_cards(page_rng, card_count) if suitable else "[]"
+            text = verdict[:-1] + ', "vocabulary": ' + cards + "}"
+        elif json_mode:
+            text = self._json_cards(page_rng, card_count)
+        else:
+            rows = [
+                f'"語{page_rng.randrange(100000)}","ご{row}","synthetic word {row}, with a note"'
+                for row in range(card_count)
+            ]
+            text = "```csv\n" + "\n".join(rows) + "\n```"
+
+        usage = FakeUsageMetadata(uncached_tokens + cached_tokens, len(text) // 3 + 1, cached_tokens)
+        chunk_count = self.cards_per_page // 4 + 1 if stream else 1
+        return FakeResponse(text, usage, chunk_count=chunk_count)
+
+
+class FakeContextCache:
+    """
+    Stand-in for Gemini's context caching API, as a PrefixCache backend.
+
+    Prefixes of fewer than min_tokens are refused, as the real API refuses small
+    ones. A cached prefix expires after its TTL (times ttl_scale, to exercise
+    expiry and refresh in short runs), after which calls against it fail with a 404.
+    """
+
+    def __init__(self, min_tokens=0, ttl_scale=1.0):
+        self.min_tokens = min_tokens
+        self.ttl_scale = ttl_scale
+        self._lock = threading.Lock()
+        self._expires_at = {}
+        self.created = 0
+        self.refreshed = 0
+
+    def create(self, model, contents, ttl):
+        tokens = model.count_tokens(contents).prompt_token_count
+        if tokens < self.min_tokens:
+            raise FakeApiError(400, f"Cached content is too small: {tokens} tokens, at least {self.min_tokens} required")
+        with self._lock:
+            self.created += 1
+            name = f"cachedContents/fake-{self.created}"
+            self._expires_at[name] = time.monotonic() + ttl * self.ttl_scale
+        return name, model.with_cached_prefix(self, name, contents)
+
+    def refresh(self, name, ttl):
+        with self._lock:
+            if not self._is_live(name):
+                raise FakeApiError(404, f"CachedContent not found: {name}")
+            self._expires_at[name] = time.monotonic() + ttl * self.ttl_scale
+            self.refreshed += 1
+
+    def delete(self, name):
+        with self._lock:
+            self._expires_at.pop(name, None)
+
+    def _is_live(self, name):
+        return self._expires_at.get(name, 0.0) > time.monotonic()
+
+    def is_live(self, name):
+        with self._lock:
+            return self._is_live(name)
+
+
+class FakeWhispererClient:
+    """
+    Stand-in for LLMWhispererClientV2.
+
+    whisper() consumes the stream, waits ocr_latency and returns lines_per_page lines
+    of synthetic layout-preserving text. The asynchronous whisper_status /
+    whisper_retrieve flow is supported for callers that poll instead of waiting.
+    """
+
+    def __init__(self, ocr_latency=0.1, jitter=0.2, error_rate=0.0, error_code=503, lines_per_page=25, seed=0):
+        self.ocr_latency = ocr_latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.lines_per_page = lines_per_page
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._submitted = 0
+        self.calls = 0
+
+    def _draw(self):
+        with self._lock:
+            self.calls += 1
+            return random.Random(self._rng.random())
+
+    def _result_text(self, data):
+        page_rng = random.Random(len(data))
+        return "\n".join(
+            f"語{page_rng.randrange(100000)}    ご{line}    synthetic word {line}"
+            for line in range(self.lines_per_page)
+        )
+
+    def whisper(self, stream=None, wait_for_completion=False, **kwargs):
+        data = stream.read() if stream is not None else b""
+        rng = self._draw()
+        if rng.random() < self.error_rate:
+            raise FakeApiError(self.error_code)
+        if not wait_for_completion:
+            delay = max(0.0, rng.uniform(self.ocr_latency * (1 - self.jitter), self.ocr_latency * (1 + self.jitter)))
+            with self._lock:
+                self._submitted += 1
+                whisper_hash = f"fake-{self._submitted}"
+                self._jobs[whisper_hash] = (time.monotonic() + delay, self._result_text(data))
+            return {"status_code": 202, "whisper_hash": whisper_hash, "extraction": {}}
+        _sleep(rng, self.ocr_latency, self.jitter)
+        return {
+            "status_code": 200,
+            "status": "processed",
+            "extraction": {"result_text": self._result_text(data)},
+        }
+
+    def whisper_status(self, whisper_hash):
+        with self._lock:
+            ready_at, _ = self._jobs[whisper_hash]
+        status = "processed" if time.monotonic() >= ready_at else "processing"
+        return {"status_code": 200, "status": status}
+
+    def whisper_retrieve(self, whisper_hash, encoding="utf-8"):
+        with self._lock:
+            _, text = self._jobs.pop(whisper_hash)
+        return {"status_code": 200, "extraction": {"result_text": text}}
+
+
+# Function to build pipeline resources backed by the fakes
+# model: Optional FakeGenerativeModel (defaults are used otherwise)
+# client: Optional FakeWhispererClient
+# prefix_cache: Optional PrefixCache (e.g. backed by a FakeContextCache)
+# router: Optional ModelRouter over FakeGenerativeModels (see make_fake_router)
+# Returns: PipelineResources with small synthetic example images
+def make_fake_resources(model=None, client=None, prefix_cache=None, router=None):
+    return PipelineResources(
+        model=model or FakeGenerativeModel(),
+        client=client or FakeWhispererClient(),
+        image_example_1=PIL.Image.new("L", (96, 128), "white"),
+        image_example_2=PIL.Image.new("L", (96, 128), "white"),
+        examples_fingerprint="fake-examples",
+        prefix_cache=prefix_cache,
+        router=router,
+    )
+
+
+# Function to build a two-model router over fakes: a cheaper, faster model that rejects some
+# suitable pages and writes short answers for others, and the given model behind it
+# model: The stronger FakeGenerativeModel
+# latency_scale: The cheaper model's latencies as a share of the stronger one's
+# false_reject_rate: Share of the pages the stronger model accepts that the cheaper one rejects
+# short_answer_rate: Share of the cheaper model's flashcard answers that stop early
+# confirm_rejections: Whether the stronger model checks the cheaper one's rejections
+# Returns: ModelRouter with the cheaper model first for both stages
+def make_fake_router(model, latency_scale=0.5, false_reject_rate=0.05, short_answer_rate=0.1, confirm_rejections=True):
+    cheap_model = FakeGenerativeModel(
+        model_name="models/gemini-2.0-flash-lite",
+        suitability_latency=model.suitability_latency * latency_scale,
+        flashcard_latency=model.flashcard_latency * latency_scale,
+        jitter=model.jitter,
+        error_rate=model.error_rate,
+        error_code=model.error_code,
+        suitable_rate=max(0.0, model.suitable_rate - false_reject_rate),
+        cards_per_page=model.cards_per_page,
+        malformed_rate=model.malformed_rate,
+        prompt_latency_per_1k_tokens=model.prompt_latency_per_1k_tokens * latency_scale,
+        verdict_flip_rate=model.verdict_flip_rate,
+        short_answer_rate=short_answer_rate,
+        text_tokens_per_character=model.text_tokens_per_character,
+    )
+    return ModelRouter(
+        {SUITABILITY_STAGE: [cheap_model, model], FLASHCARD_STAGE: [cheap_model, model]},
+        confirm_rejections=confirm_rejections,
+    )
+
+
+# Function to create synthetic page uploads
+# count: Number of pages
+# size: Base (width, height); each page differs slightly so pages are distinct
+# Returns: List of BytesIO objects holding PNG images, like Streamlit's uploader
+def make_synthetic_pages(count, size=(160, 224)):
+    pages = []
+    for page in range(count):
+        image = PIL.Image.new("L", (size[0] + page % 97, size[1] + page // 97), "white")
+        buffer = BytesIO()
+        image.save(buffer, format="PNG")
+        buffer.seek(0)
+        buffer.name = f"page_{page + 1:04d}.png"
+        pages.append(buffer)
+    return pages
+
+
+# Function to build synthetic pages with text-like content, some of them retakes of earlier ones
+# count: Number of pages
+# duplicate_rate: Share of pages that are a re-encoded, re-cropped and darker copy of an earlier page
+# size: Page size in pixels
+# seed: Random seed
+# Returns: List of BytesIO JPEG files, as make_synthetic_pages
+def make_retaken_pages(count, duplicate_rate=0.2, size=(620, 877), seed=0):
+    rng = random.Random(seed)
+    originals = []
+    pages = []
+    for page in range(count):
+        if originals and rng.random() < duplicate_rate:
+            image = rng.choice(originals)
+            width, height = image.size
+            margin = rng.randint(0, width // 40)
+            image = PIL.ImageEnhance.Brightness(
+                image.crop((margin, margin, width - margin, height - margin))
+            ).enhance(rng.uniform(0.8, 1.0))
+            quality = rng.randint(50, 80)
+        else:
+            # Two columns of word-like blocks, so distinct pages share their layout as textbook pages do
+            image = PIL.Image.new("L", size, "white")
+            draw = PIL.ImageDraw.Draw(image)
+            for line in range(rng.randint(24, 30)):
+                top = 60 + line * 26
+                for column_left in (50, size[0] // 2 + 10):
+                    left = column_left
+                    for _ in range(rng.randint(2, 4)):
+                        width = rng.randint(20, 70)
+                        draw.rectangle((left, top, left + width, top + 12), fill=rng.randint(0, 60))
+                        left += width + rng.randint(8, 16)
+            originals.append(image)
+            quality = 85
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG", quality=quality)
+        buffer.seek(0)
+        buffer.name = f"page_{page + 1:04d}.jpg"
+        pages.append(buffer)
+    return pages
@@ -0,0 +1,182 @@
+# Multi-session load test for the shared page scheduler
+#
+# Usage (from the repository root):
+#   python -m benchmarks.load_test                          # 10 sessions, fair scheduler vs per-session pools
+#   python -m benchmarks.load_test --sessions 20 --heavy-pages 500 --modes fair
+#
+# Simulates N Streamlit sessions against the fake backends: session 1 uploads a large
+# book, the others arrive over the arrival window with single pages or small batches.
+# Every session shares one rate limiter (the per-API concurrency caps). In "fair" mode
+# their pages go through one FairScheduler, as in the app; in "per-session" mode each
+# session uses its own page pool and only the API slots are shared. The report shows each
+# session's latency and, for the scheduler, its queueing delay.
+# Importing the required libraries
+import argparse
+import random
+import sys
+import threading
+import time
+
+from app import generate_japanese_flashcards
+from benchmarks.fake_backends import (
+    FakeGenerativeModel,
+    FakeWhispererClient,
+    make_fake_resources,
+    make_synthetic_pages,
+)
+from benchmarks.run_benchmarks import percentile
+from fair_scheduler import FairScheduler, priority_for_pages
+from rate_limiter import GEMINI_API, LLMWHISPERER_API, RateLimitScheduler
+
+
+# Function to build the shared rate limiter: no quota, but the per-API concurrency caps of a deployment
+# args: Parsed command-line arguments
+# Returns: RateLimitScheduler
+def make_capped_limiter(args):
+    settings = {"requests_per_minute": 1e9, "tokens_per_minute": None, "base_delay": 0.01, "max_delay": 0.1}
+    return RateLimitScheduler({
+        GEMINI_API: dict(settings, max_concurrency=args.gemini_concurrency),
+        LLMWHISPERER_API: dict(settings, max_concurrency=args.ocr_concurrency),
+    })
+
+
+# Function to plan the sessions of one run
+# args: Parsed command-line arguments
+# Returns: List of (user id, page count, start delay in seconds); the first session is the heavy one
+def plan_sessions(args):
+    rng = random.Random(args.seed)
+    sessions = [("user-01", args.heavy_pages, 0.0)]
+    for number in range(2, args.sessions + 1):
+        page_count = 1 if rng.random() < args.single_page_share else rng.randint(2, args.light_pages)
+        sessions.append((f"user-{number:02d}", page_count, rng.uniform(0.1, args.arrival_window)))
+    return sessions
+
+
+# Function to run every session concurrently
+# mode: "fair" (shared FairScheduler) or "per-session" (a page pool per session)
+# sessions: Output of plan_sessions
+# args: Parsed command-line arguments
+# Returns: Tuple (list of per-session result dictionaries, scheduler stats or None)
+def run_sessions(mode, sessions, args):
+    resources = make_fake_resources(
+        model=FakeGenerativeModel(
+            suitability_latency=args.suitability_latency,
+            flashcard_latency=args.flashcard_latency,
+            suitable_rate=1.0,
+        ),
+        client=FakeWhispererClient(ocr_latency=args.ocr_latency),
+    )
+    rate_limiter = make_capped_limiter(args)
+    scheduler = FairScheduler(max_workers=args.scheduler_workers) if mode == "fair" else None
+    results = []
+    results_lock = threading.Lock()
+
+    def run_session(user_id, page_count, start_delay):
+        time.sleep(start_delay)
+        pages = make_synthetic_pages(page_count)
+        first_page = []
+        start = time.perf_counter()
+
+        def on_event(event):
+            if event["type"] == "page_done" and not first_page:
+                first_page.append(time.perf_counter() - start)
+
+        generate_japanese_flashcards(
+            pages,
+            resources=resources,
+            max_workers=args.workers,
+            rate_limiter=rate_limiter,
+            on_event=on_event,
+            scheduler=scheduler,
+            user_id=user_id,
+            priority=priority_for_pages(page_count),
+        )
+        with results_lock:
+            results.append({
+                "user": user_id,
+                "pages": page_count,
+                "first_page": first_page[0] if first_page else None,
+                "total": time.perf_counter() - start,
+            })
+
+    threads = [
+        threading.Thread(target=run_session, args=session, name=f"session-{session[0]}")
+        for session in sessions
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    scheduler_stats = None
+    if scheduler is not None:
+        scheduler_stats = scheduler.stats()
+        scheduler.shutdown()
+    return sorted(results, key=lambda result: result["user"]), scheduler_stats
+
+
+# Function to print one run's per-session table and summary
+# mode: Mode name
+# results: Per-session result dictionaries
+# scheduler_stats: FairScheduler.stats() or None
+# Returns: Dictionary of summary numbers for the comparison line
+def print_run(mode, results, scheduler_stats):
+    print(f"\n{mode}")
+    print(f"{'session':<10}{'pages':>7}{'first page s':>14}{'total s':>10}{'mean wait s':>13}{'max wait s':>12}")
+    for result in results:
+        user = (scheduler_stats or {}).get("users", {}).get(result["user"])
+        mean_wait = f"{user['mean_delay']:.2f}" if user else "-"
+        max_wait = f"{user['max_delay']:.2f}" if user else "-"
+        print(
+            f"{result['user']:<10}{result['pages']:>7}{result['first_page']:>14.2f}{result['total']:>10.2f}"
+            f"{mean_wait:>13}{max_wait:>12}"
+        )
+    light = results[1:]
+    summary = {
+        "light_p50": percentile([result["total"] for result in light], 50),
+        "light_p95": percentile([result["total"] for result in light], 95),
+        "heavy_total": results[0]["total"],
+    }
+    line = (
+        f"small sessions: p50 {summary['light_p50']:.2f}s, p95 {summary['light_p95']:.2f}s; "
+        f"large session: {summary['heavy_total']:.2f}s"
+    )
+    if scheduler_stats:
+        line += (
+            f"; queueing delay p95 {scheduler_stats['interactive']['delay_p95']:.2f}s (single page), "
+            f"{scheduler_stats['batch']['delay_p95']:.2f}s (batch)"
+        )
+    print(line)
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate concurrent sessions sharing the API quota.")
+    parser.add_argument("--sessions", type=int, default=10, help="Number of concurrent sessions")
+    parser.add_argument("--heavy-pages", type=int, default=200, help="Pages uploaded by the first session")
+    parser.add_argument("--light-pages", type=int, default=5, help="Largest upload of the other sessions")
+    parser.add_argument("--single-page-share", type=float, default=0.5, help="Share of other sessions uploading one page")
+    parser.add_argument("--arrival-window", type=float, default=2.0, help="Seconds over which the other sessions arrive")
+    parser.add_argument("--modes", nargs="+", default=["per-session", "fair"], choices=["per-session", "fair"])
+    parser.add_argument("--workers", type=int, default=8, help="Pages per session in flight (read-ahead with the scheduler)")
+    parser.add_argument("--scheduler-workers", type=int, default=8, help="Shared scheduler workers")
+    parser.add_argument("--gemini-concurrency", type=int, default=4)
+    parser.add_argument("--ocr-concurrency", type=int, default=2)
+    parser.add_argument("--suitability-latency", type=float, default=0.02)
+    parser.add_argument("--ocr-latency", type=float, default=0.06)
+    parser.add_argument("--flashcard-latency", type=float, default=0.04)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sessions = plan_sessions(args)
+    for mode in args.modes:
+        results, scheduler_stats = run_sessions(mode, sessions, args)
+        print_run(mode, results, scheduler_stats)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,343 @@
+# Offline throughput benchmark for the flashcard pipeline
+#
+# Usage (from the repository root):
+#   python -m benchmarks.run_benchmarks                      # compare against benchmarks/baseline.json
+#   python -m benchmarks.run_benchmarks --update-baseline    # record a new baseline
+#   python -m benchmarks.run_benchmarks --sizes 1 10 --error-rate 0.05
+#   FLASHCARD_STRUCTURED_OUTPUT=1 python -m benchmarks.run_benchmarks --sizes 100 --malformed-rate 0.05   # targeted repairs
+#   python -m benchmarks.run_benchmarks --sizes 100 --prompt-latency-per-1k 0.01 --prefix-cache   # cached few-shot prefix
+#   python -m benchmarks.run_benchmarks --sizes 100 --tiered --cheap-short-rate 0.1   # cheap model first, escalation
+#
+# Runs generate_japanese_flashcards (the "batch" scenario) and the streaming flow that
+# main() renders (the "ui" scenario: generate_japanese_flashcards_stream plus the deck
+# exports) over synthetic page sets, using the fake backends, so no API quota is spent.
+# Importing the required libraries
+import argparse
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+from app import generate_japanese_flashcards, generate_japanese_flashcards_stream
+from benchmarks.fake_backends import (
+    FakeContextCache,
+    FakeGenerativeModel,
+    FakeWhispererClient,
+    make_fake_resources,
+    make_fake_router,
+    make_retaken_pages,
+    make_synthetic_pages,
+)
+from flashcard_deck import FlashcardDeck
+from prefix_cache import PrefixCache
+from pipeline_metrics import plan_outcome
+from rate_limiter import GEMINI_API, LLMWHISPERER_API, RateLimitScheduler
+from token_budget import TokenBudgetPlanner
+
+DEFAULT_SIZES = (1, 10, 100, 1000)
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+STAGES = ("suitability", "ocr", "flashcards", "total")
+
+
+# Function to compute a percentile without numpy
+# values: List of numbers
+# percentile: 0-100
+# Returns: The nearest-rank percentile, or None for an empty list
+def percentile(values, percentile):
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(percentile / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+# Function to read the peak resident set size of this process
+# Returns: Peak RSS in megabytes, or None where the platform does not report it
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+# Function to build a rate limiter that never throttles, so the benchmark measures the pipeline
+# max_concurrency: Concurrency cap per API
+# Returns: RateLimitScheduler with effectively unlimited quotas and fast retries
+def make_unthrottled_limiter(max_concurrency):
+    settings = {
+        "requests_per_minute": 1e9,
+        "tokens_per_minute": None,
+        "max_concurrency": max_concurrency,
+        "base_delay": 0.01,
+        "max_delay": 0.1,
+    }
+    return RateLimitScheduler({GEMINI_API: dict(settings), LLMWHISPERER_API: dict(settings)})
+
+
+# Function to summarise the per-page timings of one run
+# page_results: List of page result dictionaries
+# elapsed: Wall time of the run in seconds
+# Returns: Dictionary of p50/p95 latency per stage, throughput, memory, repaired rows, routed model attempts,
+#          near-duplicate pages and the token plans of the Gemini calls
+def summarise(page_results, elapsed):
+    repairs = [report for page_result in page_results for report in page_result.get("repairs", {}).values()]
+    attempts = [attempt for page_result in page_results for attempt in page_result.get("models") or []]
+    plans = [plan for page_result in page_results for plan in page_result.get("token_plans") or []]
+    summary = {
+        "pages": len(page_results),
+        "elapsed_seconds": elapsed,
+        "pages_per_second": len(page_results) / elapsed if elapsed else None,
+        "errors": sum(1 for page_result in page_results if page_result["error"]),
+        "peak_rss_mb": peak_rss_mb(),
+        "repaired_rows": sum(report["rows"] for report in repairs),
+        "repair_tokens_saved": sum(report["tokens_saved"] for report in repairs),
+        "prefix_cached_calls": sum(
+            page_result["prefix_cache"]["cached_calls"] for page_result in page_results if page_result.get("prefix_cache")
+        ),
+        "prefix_tokens_saved": sum(
+            page_result["prefix_cache"]["tokens_saved"] for page_result in page_results if page_result.get("prefix_cache")
+        ),
+        "model_attempts": {
+            model: sum(1 for attempt in attempts if attempt["model"] == model)
+            for model in sorted({attempt["model"] for attempt in attempts})
+        },
+        "escalations": sum(1 for attempt in attempts if attempt["escalation"]),
+        "cost_usd": sum(attempt["cost"] for attempt in attempts),
+        "duplicates": sum(1 for page_result in page_results if page_result.get("duplicate")),
+        "api_calls": sum(sum(page_result.get("api_calls", {}).values()) for page_result in page_results),
+        "prompt_tokens": sum(
+            usage.get("prompt", 0) for page_result in page_results for usage in page_result["tokens"].values()
+        ),
+        "predicted_tokens": sum(plan["calibrated"] for plan in plans),
+        "reported_tokens": sum(plan["reported"] or 0 for plan in plans),
+        "reduced_calls": sum(1 for plan in plans if plan_outcome(plan) != "full"),
+    }
+    for stage in STAGES:
+        values = [page_result["timings"][stage] for page_result in page_results if stage in page_result["timings"]]
+        summary[f"{stage}_p50"] = percentile(values, 50)
+        summary[f"{stage}_p95"] = percentile(values, 95)
+    return summary
+
+
+# Function to run one scenario over one page set
+# scenario: "batch" or "ui"
+# page_count: Number of synthetic pages
+# args: Parsed command-line arguments (latencies, error rate, workers)
+# Returns: Summary dictionary (see summarise)
+def run_scenario(scenario, page_count, args):
+    model = FakeGenerativeModel(
+        # Named after a priced model, so tiered runs report a cost
+        model_name="models/gemini-2.0-flash",
+        text_tokens_per_character=args.text_tokens_per_character,
+        suitability_latency=args.suitability_latency,
+        flashcard_latency=args.flashcard_latency,
+        error_rate=args.error_rate,
+        cards_per_page=args.cards_per_page,
+        malformed_rate=args.malformed_rate,
+        prompt_latency_per_1k_tokens=args.prompt_latency_per_1k,
+    )
+    router = None
+    if args.tiered:
+        router = make_fake_router(
+            model,
+            latency_scale=args.cheap_latency_scale,
+            false_reject_rate=args.cheap_false_reject_rate,
+            short_answer_rate=args.cheap_short_rate,
+        )
+    resources = make_fake_resources(
+        model=model,
+        client=FakeWhispererClient(ocr_latency=args.ocr_latency, error_rate=args.error_rate),
+        prefix_cache=PrefixCache(FakeContextCache()) if args.prefix_cache else None,
+        router=router,
+    )
+    pages = make_synthetic_pages(page_count, size=tuple(args.page_size))
+    if args.duplicate_rate is not None:
+        pages = make_retaken_pages(page_count, duplicate_rate=args.duplicate_rate)
+    page_results = []
+    options = {
+        "max_workers": args.workers,
+        "resources": resources,
+        "rate_limiter": make_unthrottled_limiter(args.workers),
+        "skip_duplicates": args.skip_duplicates,
+        "token_planner": TokenBudgetPlanner(budget=args.token_budget, suitability_budget=args.suitability_token_budget),
+    }
+
+    start = time.perf_counter()
+    if scenario == "batch":
+        # Collect the page results through the event hook; the return value is what callers get
+        generate_japanese_flashcards(
+            pages,
+            on_event=lambda event: page_results.append(event["result"]) if event["type"] == "page_done" else None,
+            **options
+        )
+    else:
+        deck = FlashcardDeck()
+        for event in generate_japanese_flashcards_stream(pages, deck=deck, **options):
+            if event["type"] == "page_done":
+                page_results.append(event["result"])
+        deck.to_csv()
+        deck.to_tsv()
+    elapsed = time.perf_counter() - start
+    return summarise(page_results, elapsed)
+
+
+# Function to compare a run against the stored baseline
+# results: Dictionary of "scenario/pages" -> summary
+# baseline: Same shape, from a previous run
+# tolerance: Allowed relative slowdown (0.2 = 20%)
+# Returns: List of regression messages (empty if none)
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for name, summary in results.items():
+        reference = baseline.get(name)
+        if not reference:
+            continue
+        if reference.get("pages_per_second") and summary["pages_per_second"] < reference["pages_per_second"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: {summary['pages_per_second']:.1f} pages/s vs baseline {reference['pages_per_second']:.1f}"
+            )
+        if reference.get("total_p95") and summary["total_p95"] and summary["total_p95"] > reference["total_p95"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: p95 page latency {summary['total_p95'] * 1000:.0f} ms vs baseline {reference['total_p95'] * 1000:.0f} ms"
+            )
+    return regressions
+
+
+# Function to print one line per scenario and page count
+# results: Dictionary of "scenario/pages" -> summary
+# Returns: None
+def print_report(results):
+    header = f"{'run':<12}{'pages/s':>9}{'p50 ms':>9}{'p95 ms':>9}" + "".join(
+        f"{stage + ' p95':>17}" for stage in STAGES[:-1]
+    ) + f"{'peak RSS MB':>13}"
+    print(header)
+    for name, summary in results.items():
+        def ms(value):
+            return f"{value * 1000:.0f}" if value is not None else "-"
+        rss = f"{summary['peak_rss_mb']:.0f}" if summary["peak_rss_mb"] is not None else "-"
+        print(
+            f"{name:<12}{summary['pages_per_second']:>9.1f}{ms(summary['total_p50']):>9}{ms(summary['total_p95']):>9}"
+            + "".join(f"{ms(summary[stage + '_p95']):>17}" for stage in STAGES[:-1])
+            + f"{rss:>13}"
+        )
+        if summary.get("repaired_rows"):
+            print(
+                f"{'':<12}{summary['repaired_rows']} malformed row(s) repaired, "
+                f"~{summary['repair_tokens_saved']} tokens saved versus regenerating their pages"
+            )
+        if summary.get("prefix_cached_calls"):
+            print(
+                f"{'':<12}{summary['prefix_cached_calls']} flashcard call(s) read the few-shot prefix from the context cache, "
+                f"~{summary['prefix_tokens_saved']} input tokens not re-sent"
+            )
+        if summary.get("model_attempts"):
+            attempts = sum(summary["model_attempts"].values())
+            print(
+                f"{'':<12}Model answers: "
+                + ", ".join(f"{model} {count}" for model, count in summary["model_attempts"].items())
+                + f"; {summary['escalations']} escalated ({summary['escalations'] / attempts:.0%}), ~${summary['cost_usd']:.4f}"
+            )
+        if summary.get("predicted_tokens"):
+            print(
+                f"{'':<12}Input tokens: {summary['predicted_tokens']} predicted, {summary['reported_tokens']} reported "
+                f"({summary['predicted_tokens'] / max(1, summary['reported_tokens']) - 1:+.1%}); "
+                f"{summary['reduced_calls']} call(s) reduced to fit the budget"
+            )
+        if summary.get("duplicates"):
+            print(f"{'':<12}{summary['duplicates']} near-duplicate page(s) skipped; {summary['api_calls']} API call(s) made")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the flashcard pipeline with fake API backends.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="Page counts to run")
+    parser.add_argument("--scenarios", nargs="+", default=["batch", "ui"], choices=["batch", "ui"])
+    parser.add_argument("--workers", type=int, default=8, help="Pages processed in parallel")
+    parser.add_argument("--suitability-latency", type=float, default=0.02, help="Seconds per suitability call")
+    parser.add_argument("--ocr-latency", type=float, default=0.06, help="Seconds per OCR call")
+    parser.add_argument("--flashcard-latency", type=float, default=0.04, help="Seconds per flashcard call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of API calls failing with a retryable error")
+    parser.add_argument("--cards-per-page", type=int, default=20)
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="Share of flashcard rows written malformed")
+    parser.add_argument(
+        "--prompt-latency-per-1k", type=float, default=0.0,
+        help="Extra seconds per flashcard call for every thousand uncached prompt tokens"
+    )
+    parser.add_argument(
+        "--prefix-cache", action="store_true",
+        help="Register the few-shot prefix with a local stand-in for Gemini's context cache"
+    )
+    parser.add_argument(
+        "--tiered", action="store_true",
+        help="Route each stage through a cheaper, faster fake model first, escalating to the default one"
+    )
+    parser.add_argument("--cheap-latency-scale", type=float, default=0.5, help="The cheaper model's share of the latencies")
+    parser.add_argument(
+        "--cheap-false-reject-rate", type=float, default=0.05,
+        help="Share of suitable pages the cheaper model rejects (each costs a confirming call)"
+    )
+    parser.add_argument(
+        "--cheap-short-rate", type=float, default=0.1,
+        help="Share of the cheaper model's flashcard answers that stop after a fifth of the cards"
+    )
+    parser.add_argument(
+        "--duplicate-rate", type=float,
+        help="Use text-like pages, this share of them retakes of earlier ones, instead of blank pages"
+    )
+    parser.add_argument(
+        "--skip-duplicates", action="store_true",
+        help="Answer near-duplicate pages from the page they repeat instead of calling the APIs"
+    )
+    parser.add_argument(
+        "--page-size", type=int, nargs=2, default=[160, 224], metavar=("WIDTH", "HEIGHT"),
+        help="Size of the blank synthetic pages (large pages exercise the token budget)"
+    )
+    parser.add_argument(
+        "--token-budget", type=int, default=0,
+        help="Input tokens allowed per flashcard call; larger requests are scaled down (0: no budget)"
+    )
+    parser.add_argument(
+        "--suitability-token-budget", type=int, default=0, help="Input tokens allowed per suitability call (0: no budget)"
+    )
+    parser.add_argument(
+        "--text-tokens-per-character", type=float,
+        help="Tokens the fake Gemini bills per kana or kanji, to check the calibration of the estimates"
+    )
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH, help="Baseline JSON file")
+    parser.add_argument("--update-baseline", action="store_true", help="Store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown before failing")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = {}
+    for scenario in args.scenarios:
+        for page_count in args.sizes:
+            results[f"{scenario}/{page_count}"] = run_scenario(scenario, page_count, args)
+    print_report(results)
+
+    if args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline found; run with --update-baseline to record one.")
+        return 0
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = find_regressions(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,206 @@
+# Multi-page document ingestion: PDF and TIFF uploads are rasterised one page at a
+# time, as the pipeline asks for the next page
+# Importing the required libraries
+import os
+import threading
+from io import BytesIO
+
+import PIL.Image
+
+from upload_spool import release_upload
+
+DOCUMENT_EXTENSIONS = (".pdf", ".tif", ".tiff")
+
+# Resolution PDF pages are rendered at; TIFF pages scanned at a higher resolution are
+# scaled down to it. 200 DPI keeps furigana legible for OCR at a moderate upload size.
+DEFAULT_DPI = 200
+MIN_DPI = 72
+MAX_DPI = 600
+
+# Rendered pages are sent as JPEG at this quality (scans compress poorly as PNG)
+PAGE_JPEG_QUALITY = 90
+
+PDF_POINTS_PER_INCH = 72
+
+_PDF_MAGIC = b"%PDF"
+_TIFF_MAGICS = (b"II*\x00", b"MM\x00*")
+
+# PDFium is not thread-safe, even across documents, so every call into it is serialised
+_pdfium_lock = threading.Lock()
+
+
+# Function to tell whether an upload is a PDF or TIFF document rather than a single image
+# uploaded_file: File-like object (its name is used if the first bytes are not conclusive)
+# Returns: "pdf", "tiff" or None
+def document_kind(uploaded_file):
+    uploaded_file.seek(0)
+    magic = uploaded_file.read(4)
+    uploaded_file.seek(0)
+    if magic == _PDF_MAGIC:
+        return "pdf"
+    if magic in _TIFF_MAGICS:
+        return "tiff"
+    name = (getattr(uploaded_file, "name", None) or "").lower()
+    if name.endswith(".pdf"):
+        return "pdf"
+    if name.endswith((".tif", ".tiff")):
+        return "tiff"
+    return None
+
+
+# Function to turn a page range such as "1-5, 8, 12-" into page positions
+# spec: Comma-separated 1-based pages and inclusive ranges ("-3" and "12-" are open-ended);
+#       empty or None selects every page
+# page_count: Number of pages in the document
+# Returns: Sorted list of 0-based page positions; pages past the end are ignored
+# Raises: ValueError if the range is malformed or selects no page
+def parse_page_range(spec, page_count):
+    if not spec or not spec.strip():
+        return list(range(page_count))
+    selected = set()
+    for part in spec.replace(" ", "").split(","):
+        if not part:
+            continue
+        try:
+            if "-" in part:
+                first, last = part.split("-", 1)
+                first = int(first) if first else 1
+                last = int(last) if last else page_count
+            else:
+                first = last = int(part)
+        except ValueError:
+            raise ValueError(f"Invalid page range '{spec}': use pages and ranges such as 1-5, 8, 12-")
+        if first < 1 or last < first:
+            raise ValueError(f"Invalid page range '{part}': pages start at 1 and ranges must go upwards")
+        selected.update(range(first - 1, min(last, page_count)))
+    if not selected:
+        raise ValueError(f"The page range '{spec}' selects none of the {page_count} page(s)")
+    return sorted(selected)
+
+
+# Function to encode a rendered page for the APIs
+# image: PIL Image
+# name: Name given to the returned file
+# Returns: BytesIO holding a JPEG, with .name set like an uploaded file
+def _encode_page(image, name):
+    if image.mode not in ("L", "RGB"):
+        image = image.convert("RGB")
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=PAGE_JPEG_QUALITY)
+    buffer.seek(0)
+    buffer.name = name
+    return buffer
+
+
+class DocumentReader:
+    """
+    Opens a PDF or TIFF once and renders single pages on request.
+
+    Nothing is decoded until render() is called, and each rendered page is
+    encoded and released before the next, so the memory held is the document
+    bytes plus the pages the caller keeps. PDF rendering needs the pypdfium2
+    package (see requirements.txt); TIFF pages are read with Pillow.
+    """
+
+    def __init__(self, uploaded_file, dpi=DEFAULT_DPI):
+        self.dpi = min(MAX_DPI, max(MIN_DPI, dpi))
+        self.kind = document_kind(uploaded_file)
+        self.name = getattr(uploaded_file, "name", None) or "document"
+        if self.kind == "pdf":
+            try:
+                import pypdfium2
+            except ImportError:
+                raise ImportError("PDF uploads require the 'pypdfium2' package (pip install -r requirements.txt).")
+            uploaded_file.seek(0)
+            with _pdfium_lock:
+                self._document = pypdfium2.PdfDocument(uploaded_file)
+                self.page_count = len(self._document)
+        elif self.kind == "tiff":
+            uploaded_file.seek(0)
+            self._document = PIL.Image.open(uploaded_file)
+            self.page_count = getattr(self._document, "n_frames", 1)
+        else:
+            raise ValueError(f"{self.name} is not a PDF or TIFF document")
+
+    # Function to rasterise one page
+    # position: 0-based page position
+    # Returns: BytesIO holding the page as a JPEG, named "<document>#page=<n>"
+    def render(self, position):
+        name = f"{self.name}#page={position + 1}"
+        if self.kind == "pdf":
+            with _pdfium_lock:
+                page = self._document[position]
+                try:
+                    bitmap = page.render(scale=self.dpi / PDF_POINTS_PER_INCH)
+                    image = bitmap.to_pil()
+                    bitmap.close()
+                finally:
+                    page.close()
+            return _encode_page(image, name)
+
+        self._document.seek(position)
+        image = self._document.copy()
+        scan_dpi = self._document.info.get("dpi", (0, 0))[0]
+        if scan_dpi and scan_dpi > self.dpi:
+            scale = self.dpi / float(scan_dpi)
+            image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), PIL.Image.LANCZOS)
+        return _encode_page(image, name)
+
+    # Function to release the decoded document; the file passed in stays open
+    # Returns: None
+    def close(self):
+        if self.kind == "pdf":
+            with _pdfium_lock:
+                self._document.close()
+        # Pillow's close() would also close the caller's file once a TIFF has several frames,
+        # so the image is only dropped
+        self._document = None
+
+
+# Function to list the pages an upload contributes, without rendering any
+# uploaded_file: Image, PDF or TIFF file-like object
+# page_range: Page range applied to documents (see parse_page_range); single images always count once
+# Returns: Number of pages
+def count_upload_pages(uploaded_file, page_range=None):
+    if document_kind(uploaded_file) is None:
+        return 1
+    reader = DocumentReader(uploaded_file)
+    try:
+        return len(parse_page_range(page_range, reader.page_count))
+    finally:
+        reader.close()
+
+
+# Function to count the pages a set of uploads expands to
+# uploaded_files: Image, PDF or TIFF file-like objects
+# page_range: As for count_upload_pages
+# Returns: Total number of pages
+def count_pages(uploaded_files, page_range=None):
+    return sum(count_upload_pages(uploaded_file, page_range) for uploaded_file in uploaded_files)
+
+
+# Function to expand uploads into pages lazily
+# uploaded_files: Iterable of image, PDF or TIFF file-like objects
+# page_range: Page range applied to each document (see parse_page_range); single images are passed through
+# dpi: Resolution documents are rasterised at
+# Yields: One file-like object per page, in upload order; a document page is only rendered when the
+#         consumer asks for it, so the pages held in memory are the ones the consumer keeps
+def expand_uploads(uploaded_files, page_range=None, dpi=DEFAULT_DPI):
+    for uploaded_file in uploaded_files:
+        if document_kind(uploaded_file) is None:
+            yield uploaded_file
+            continue
+        reader = DocumentReader(uploaded_file, dpi=dpi)
+        try:
+            for position in parse_page_range(page_range, reader.page_count):
+                yield reader.render(position)
+        finally:
+            reader.close()
+            release_upload(uploaded_file)
+
+
+# Function to tell whether a path names a PDF or TIFF document
+# path: File path
+# Returns: True for .pdf, .tif and .tiff files
+def is_document_path(path):
+    return os.path.splitext(path)[1].lower() in DOCUMENT_EXTENSIONS
@@ -0,0 +1,277 @@
+# Near-duplicate page detection: perceptual hashes of the uploaded pages, compared by Hamming
+# distance, so a retake or re-crop of a page is answered from the earlier page's result
+# Importing the required libraries
+import json
+import math
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+
+import PIL.Image
+import PIL.ImageOps
+
+# Set FLASHCARD_SKIP_DUPLICATES=1 to skip near-duplicate pages by default. Off by default: a false match
+# answers a page with another page's result, and same-layout textbook pages are the likely case
+SKIP_DUPLICATES = os.getenv("FLASHCARD_SKIP_DUPLICATES", "0") == "1"
+
+DEFAULT_PAGE_INDEX_PATH = ".flashcard_pages.sqlite3"
+# Fingerprints kept on disk; the oldest are dropped beyond this
+DEFAULT_MAX_ENTRIES = 100000
+
+# Side of the difference hash grid (DHASH_SIZE x DHASH_SIZE bits); text pages need a finer grid than
+# photos, as two pages of one textbook share their layout
+DHASH_SIZE = 16
+# The DCT hash uses the PHASH_SIZE x PHASH_SIZE lowest frequencies of a PHASH_SAMPLE-pixel square
+PHASH_SIZE = 8
+PHASH_SAMPLE = 32
+
+# A page is a near-duplicate when both hashes are within these distances (out of 256 and 64 bits)
+MAX_DHASH_DISTANCE = int(os.getenv("FLASHCARD_DUPLICATE_MAX_DHASH_DISTANCE", "20"))
+MAX_PHASH_DISTANCE = int(os.getenv("FLASHCARD_DUPLICATE_MAX_PHASH_DISTANCE", "8"))
+
+# Pages are reduced to this size before hashing; JPEGs are decoded at a fraction of their resolution
+HASH_WORKING_SIZE = 512
+# Pixels darker than this (after autocontrast) count as content when trimming the margins
+CONTENT_THRESHOLD = 160
+
+# dhash: DHASH_SIZE**2-bit difference hash; phash: PHASH_SIZE**2-bit DCT hash
+PageFingerprint = namedtuple("PageFingerprint", ["dhash", "phash"])
+
+_DCT_COSINES = [
+    [math.cos(math.pi * (2 * x + 1) * u / (2 * PHASH_SAMPLE)) for x in range(PHASH_SAMPLE)]
+    for u in range(PHASH_SIZE)
+]
+
+
+# Function to pack booleans into an integer, first one as the highest bit
+def _bits(values):
+    bits = 0
+    for value in values:
+        bits = (bits << 1) | bool(value)
+    return bits
+
+
+# Function to compute the perceptual hashes of a page
+# image: PIL image (any mode; EXIF orientation is applied)
+# Returns: PageFingerprint
+def page_fingerprint(image):
+    image.draft("L", (HASH_WORKING_SIZE, HASH_WORKING_SIZE))  # Only has an effect on unloaded JPEGs
+    gray = PIL.ImageOps.exif_transpose(image).convert("L")
+    gray.thumbnail((HASH_WORKING_SIZE, HASH_WORKING_SIZE))
+    gray = PIL.ImageOps.autocontrast(gray)
+    # Trim the margins, so the same page cropped a little differently hashes the same
+    content_box = gray.point(lambda value: 255 if value < CONTENT_THRESHOLD else 0).getbbox()
+    if content_box is not None:
+        gray = gray.crop(content_box)
+
+    small = list(gray.resize((DHASH_SIZE + 1, DHASH_SIZE), PIL.Image.Resampling.BOX).tobytes())
+    dhash = _bits(
+        small[row * (DHASH_SIZE + 1) + column] > small[row * (DHASH_SIZE + 1) + column + 1]
+        for row in range(DHASH_SIZE)
+        for column in range(DHASH_SIZE)
+    )
+
+    # Separable DCT-II, keeping only the low frequencies
+    sample = list(gray.resize((PHASH_SAMPLE, PHASH_SAMPLE), PIL.Image.Resampling.BOX).tobytes())
+    rows = [
+        [sum(cosines[x] * sample[y * PHASH_SAMPLE + x] for x in range(PHASH_SAMPLE)) for cosines in _DCT_COSINES]
+        for y in range(PHASH_SAMPLE)
+    ]
+    coefficients = [
+        sum(_DCT_COSINES[v][y] * rows[y][u] for y in range(PHASH_SAMPLE))
+        for v in range(PHASH_SIZE)
+        for u in range(PHASH_SIZE)
+    ]
+    # The DC term is the overall brightness, not the layout
+    median = sorted(coefficients[1:])[len(coefficients) // 2 - 1]
+    phash = _bits(coefficient > median for coefficient in coefficients)
+    return PageFingerprint(dhash, phash)
+
+
+# Function to fingerprint an uploaded page without disturbing it
+# uploaded_file: Seekable file-like object
+# Returns: PageFingerprint, or None if the file is not a readable image; the position is reset to the start
+def fingerprint_upload(uploaded_file):
+    try:
+        uploaded_file.seek(0)
+        with PIL.Image.open(uploaded_file) as image:
+            return page_fingerprint(image)
+    except Exception:
+        return None
+    finally:
+        uploaded_file.seek(0)
+
+
+# Function to compare two fingerprints
+# Returns: Tuple (dhash distance, phash distance) in bits
+def hamming_distances(first, second):
+    return (first.dhash ^ second.dhash).bit_count(), (first.phash ^ second.phash).bit_count()
+
+
+# Function to decide whether two fingerprints are of the same page
+# Returns: True if both distances are within MAX_DHASH_DISTANCE and MAX_PHASH_DISTANCE
+def is_near_duplicate(first, second, max_dhash_distance=MAX_DHASH_DISTANCE, max_phash_distance=MAX_PHASH_DISTANCE):
+    dhash_distance, phash_distance = hamming_distances(first, second)
+    return dhash_distance <= max_dhash_distance and phash_distance <= max_phash_distance
+
+
+class PageIndex:
+    """
+    Fingerprints of pages seen so far, each with a JSON-serialisable value,
+    searched by Hamming distance.
+
+    The 256-bit difference hash is split into bands; any fingerprint within the
+    allowed distance shares at least one band exactly with the query
+    (pigeonhole), so find() only compares the fingerprints in the query's band
+    buckets. With a path, entries are stored in SQLite and loaded on start, so
+    pages of earlier runs are found too; without one the index lives for one run.
+    """
+
+    def __init__(self, path=None, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_dhash_distance=MAX_DHASH_DISTANCE, max_phash_distance=MAX_PHASH_DISTANCE):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_dhash_distance = max_dhash_distance
+        self.max_phash_distance = max_phash_distance
+        # Bit ranges of the bands, partitioning the difference hash
+        band_count = min(max_dhash_distance + 1, DHASH_SIZE * DHASH_SIZE)
+        self._band_bounds = [
+            (band * DHASH_SIZE * DHASH_SIZE // band_count, (band + 1) * DHASH_SIZE * DHASH_SIZE // band_count)
+            for band in range(band_count)
+        ]
+        self._band_count = band_count
+        self._lock = threading.Lock()
+        self._entries = {}  # Entry id -> (PageFingerprint, value)
+        self._bands = [{} for _ in range(self._band_count)]
+        self._next_id = 0
+        self._stats = {"lookups": 0, "matches": 0, "comparisons": 0}
+        self._conn = None
+        if path is not None:
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            # One connection shared by all worker threads, serialised by self._lock
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS page_fingerprints (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    dhash TEXT NOT NULL,
+                    phash TEXT NOT NULL,
+                    value TEXT NOT NULL
+                )
+                """
+            )
+            self._conn.commit()
+            for entry_id, dhash, phash, value in self._conn.execute(
+                "SELECT id, dhash, phash, value FROM page_fingerprints ORDER BY id"
+            ):
+                self._insert(entry_id, PageFingerprint(int(dhash, 16), int(phash, 16)), json.loads(value))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _band_keys(self, fingerprint):
+        return [(fingerprint.dhash >> start) & ((1 << (end - start)) - 1) for start, end in self._band_bounds]
+
+    # Must be called with self._lock held (or from __init__)
+    def _insert(self, entry_id, fingerprint, value):
+        self._entries[entry_id] = (fingerprint, value)
+        for band, key in enumerate(self._band_keys(fingerprint)):
+            self._bands[band].setdefault(key, []).append(entry_id)
+        self._next_id = max(self._next_id, entry_id + 1)
+
+    # Must be called with self._lock held
+    def _remove(self, entry_id):
+        fingerprint, _ = self._entries.pop(entry_id)
+        for band, key in enumerate(self._band_keys(fingerprint)):
+            bucket = self._bands[band][key]
+            bucket.remove(entry_id)
+            if not bucket:
+                del self._bands[band][key]
+
+    # Must be called with self._lock held
+    def _find(self, fingerprint):
+        candidates = set()
+        for band, key in enumerate(self._band_keys(fingerprint)):
+            candidates.update(self._bands[band].get(key, ()))
+        self._stats["lookups"] += 1
+        self._stats["comparisons"] += len(candidates)
+        best = None
+        for entry_id in sorted(candidates):
+            stored, value = self._entries[entry_id]
+            dhash_distance, phash_distance = hamming_distances(fingerprint, stored)
+            if dhash_distance > self.max_dhash_distance or phash_distance > self.max_phash_distance:
+                continue
+            if best is None or dhash_distance < best[1]:
+                best = (value, dhash_distance)
+        if best is not None:
+            self._stats["matches"] += 1
+        return best
+
+    # Function to look up the closest near-duplicate of a page
+    # fingerprint: PageFingerprint of the page
+    # Returns: Tuple (stored value, dhash distance), or None if no page is close enough
+    def find(self, fingerprint):
+        with self._lock:
+            return self._find(fingerprint)
+
+    # Function to add a page
+    # fingerprint: PageFingerprint of the page
+    # value: JSON-serialisable value returned by find() for its near-duplicates
+    # Returns: None; the oldest entries are dropped beyond max_entries
+    def add(self, fingerprint, value):
+        with self._lock:
+            self._add(fingerprint, value)
+
+    # Must be called with self._lock held
+    def _add(self, fingerprint, value):
+        entry_id = self._next_id
+        if self._conn is not None:
+            cursor = self._conn.execute(
+                "INSERT INTO page_fingerprints (dhash, phash, value) VALUES (?, ?, ?)",
+                (format(fingerprint.dhash, "x"), format(fingerprint.phash, "x"), json.dumps(value)),
+            )
+            entry_id = cursor.lastrowid
+        self._insert(entry_id, fingerprint, value)
+        while len(self._entries) > self.max_entries:
+            oldest = min(self._entries)
+            self._remove(oldest)
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM page_fingerprints WHERE id = ?", (oldest,))
+        if self._conn is not None:
+            self._conn.commit()
+
+    # Function to find a page's near-duplicate, or add the page if there is none, in one step
+    # fingerprint: PageFingerprint of the page
+    # value: Value stored for the page if it is new
+    # Returns: Tuple (stored value, dhash distance) of the near-duplicate, or None if the page was added
+    def find_or_add(self, fingerprint, value):
+        with self._lock:
+            match = self._find(fingerprint)
+            if match is None:
+                self._add(fingerprint, value)
+            return match
+
+    # Function to report the index state
+    # Returns: Dictionary with the entry count, lookups, matches and fingerprints compared
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), **self._stats}
+
+    # Function to delete every entry
+    # Returns: None
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bands = [{} for _ in range(self._band_count)]
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM page_fingerprints")
+                self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,254 @@
+# Process-wide page scheduler shared by every session, with per-user fairness
+# Importing the required libraries
+import contextvars
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+# Priorities, lowest value served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+
+# Requests with at most this many pages count as interactive
+INTERACTIVE_PAGE_LIMIT = 1
+
+# After this many interactive tasks in a row, one waiting batch task is started, so a
+# stream of interactive requests slows batch work down but cannot stop it
+INTERACTIVE_BURST = 4
+
+# Number of recent queueing delays kept per priority for the percentiles
+DELAY_SAMPLES = 1000
+
+DEFAULT_SCHEDULER_WORKERS = int(os.getenv("FLASHCARD_SCHEDULER_WORKERS", "8"))
+
+# The (user id, priority) of the page being processed, set by the scheduler so the
+# per-API concurrency slots in rate_limiter.py are handed out with the same fairness
+current_request = contextvars.ContextVar("flashcard_request", default=(None, PRIORITY_BATCH))
+
+
+# Function to choose the priority of a request
+# page_count: Number of pages in the request
+# Returns: PRIORITY_INTERACTIVE for single pages, PRIORITY_BATCH otherwise
+def priority_for_pages(page_count):
+    return PRIORITY_INTERACTIVE if page_count <= INTERACTIVE_PAGE_LIMIT else PRIORITY_BATCH
+
+
+# Function to compute a percentile of a list of numbers
+# values: Numbers
+# percentile: 0-100
+# Returns: The nearest-rank percentile, or 0.0 for an empty list
+def _percentile(values, percentile):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(percentile / 100.0 * len(ordered)))]
+
+
+class FairQueue:
+    """
+    Queue that orders items by priority, then round robin across users.
+
+    Interactive items come first, except that after INTERACTIVE_BURST of them in a
+    row a waiting batch item is taken. Within a priority each user keeps their own
+    FIFO and users take turns, so a user with 200 queued items gets the same share
+    as a user with 2. Not thread-safe: callers hold their own lock.
+    """
+
+    def __init__(self):
+        self._queues = {PRIORITY_INTERACTIVE: OrderedDict(), PRIORITY_BATCH: OrderedDict()}
+        self._interactive_streak = 0
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    # Function to add an item at the back of its user's queue
+    # item: Anything; it is returned as is by peek and pop
+    # user_id: Whose turn the item takes (None is a user like any other)
+    # priority: PRIORITY_INTERACTIVE or PRIORITY_BATCH
+    # Returns: None
+    def push(self, item, user_id=None, priority=PRIORITY_BATCH):
+        self._queues[priority].setdefault(user_id, deque()).append(item)
+        self._length += 1
+
+    def _next_priority(self):
+        order = (PRIORITY_INTERACTIVE, PRIORITY_BATCH)
+        if self._interactive_streak >= INTERACTIVE_BURST and self._queues[PRIORITY_BATCH]:
+            order = (PRIORITY_BATCH, PRIORITY_INTERACTIVE)
+        for priority in order:
+            if self._queues[priority]:
+                return priority
+        return None
+
+    # Function to look at the item that pop would return
+    # Returns: The next item, or None if the queue is empty
+    def peek(self):
+        priority = self._next_priority()
+        if priority is None:
+            return None
+        return next(iter(self._queues[priority].values()))[0]
+
+    # Function to take the next item: interactive first, then one item per user in turn
+    # Returns: The next item, or None if the queue is empty
+    def pop(self):
+        priority = self._next_priority()
+        if priority is None:
+            return None
+        queues = self._queues[priority]
+        user_id, queue = next(iter(queues.items()))
+        item = queue.popleft()
+        if queue:
+            queues.move_to_end(user_id)  # This user goes to the back of the line
+        else:
+            del queues[user_id]
+        self._length -= 1
+        self._interactive_streak = self._interactive_streak + 1 if priority == PRIORITY_INTERACTIVE else 0
+        return item
+
+    # Function to drop an item that is no longer waiting (e.g. its caller gave up)
+    # item, user_id, priority: As passed to push
+    # Returns: None
+    def remove(self, item, user_id=None, priority=PRIORITY_BATCH):
+        queue = self._queues[priority].get(user_id)
+        if queue is None or item not in queue:
+            return
+        queue.remove(item)
+        if not queue:
+            del self._queues[priority][user_id]
+        self._length -= 1
+
+    # Function to count the waiting items
+    # priority: PRIORITY_INTERACTIVE or PRIORITY_BATCH
+    # Returns: Tuple (items, users with items)
+    def counts(self, priority):
+        queues = self._queues[priority]
+        return sum(len(queue) for queue in queues.values()), len(queues)
+
+
+class FairScheduler:
+    """
+    One pool of page workers shared by all sessions.
+
+    Pages wait in a FairQueue, so single-page requests go first and users take
+    turns. While a page runs, its user and priority are in current_request, and
+    the shared RateLimitScheduler hands out each API's concurrency slots in the
+    same fair order. Those slots are the global per-API caps; this pool bounds
+    how many pages are in flight in total.
+    """
+
+    def __init__(self, max_workers=DEFAULT_SCHEDULER_WORKERS):
+        self.max_workers = max_workers
+        self._condition = threading.Condition()
+        self._queue = FairQueue()
+        self._running = 0
+        self._shutdown = False
+        self._delays = {priority: deque(maxlen=DELAY_SAMPLES) for priority in (PRIORITY_INTERACTIVE, PRIORITY_BATCH)}
+        self._users = {}
+        self._workers = [
+            threading.Thread(target=self._work, name=f"fair-scheduler-{number}", daemon=True)
+            for number in range(max_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    # Function to queue a task for a user
+    # user_id: Identifies whose share the task counts against (e.g. a session id)
+    # fn: Callable to run; args and kwargs are passed to it
+    # priority: PRIORITY_INTERACTIVE or PRIORITY_BATCH
+    # Returns: concurrent.futures.Future for the task's result; cancelling it drops the task if it has not started
+    def submit(self, user_id, fn, *args, priority=PRIORITY_BATCH, **kwargs):
+        future = Future()
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("The scheduler has been shut down.")
+            self._queue.push((future, fn, args, kwargs, user_id, priority, time.perf_counter()), user_id, priority)
+            self._condition.notify()
+        return future
+
+    def _work(self):
+        while True:
+            with self._condition:
+                task = self._queue.pop()
+                while task is None:
+                    if self._shutdown:
+                        return
+                    self._condition.wait()
+                    task = self._queue.pop()
+                future, fn, args, kwargs, user_id, priority, queued_at = task
+                if not future.set_running_or_notify_cancel():
+                    continue  # Cancelled while it was queued
+                delay = time.perf_counter() - queued_at
+                self._delays[priority].append(delay)
+                user = self._users.setdefault(
+                    user_id, {"started": 0, "completed": 0, "total_delay": 0.0, "max_delay": 0.0}
+                )
+                user["started"] += 1
+                user["total_delay"] += delay
+                user["max_delay"] = max(user["max_delay"], delay)
+                self._running += 1
+            token = current_request.set((user_id, priority))
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finally:
+                current_request.reset(token)
+                with self._condition:
+                    self._running -= 1
+                    self._users[user_id]["completed"] += 1
+
+    # Function to report the queue state and the recent queueing delays
+    # Returns: Dictionary with queued tasks and users per priority, running tasks, p50/p95/max
+    #          queueing delay in seconds per priority, and tasks completed and mean/max delay per user
+    def stats(self):
+        with self._condition:
+            stats = {
+                "running": self._running,
+                "max_workers": self.max_workers,
+                "users": {
+                    user_id: {
+                        "completed": user["completed"],
+                        "mean_delay": user["total_delay"] / user["started"] if user["started"] else 0.0,
+                        "max_delay": user["max_delay"],
+                    }
+                    for user_id, user in self._users.items()
+                },
+            }
+            for priority, name in ((PRIORITY_INTERACTIVE, "interactive"), (PRIORITY_BATCH, "batch")):
+                queued, users = self._queue.counts(priority)
+                delays = list(self._delays[priority])
+                stats[name] = {
+                    "queued": queued,
+                    "users": users,
+                    "delay_p50": _percentile(delays, 50),
+                    "delay_p95": _percentile(delays, 95),
+                    "delay_max": max(delays) if delays else 0.0,
+                }
+            return stats
+
+    # Function to stop the workers once the queued tasks have run
+    # Returns: None
+    def shutdown(self):
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+
+_shared_scheduler = None
+_shared_scheduler_lock = threading.Lock()
+
+
+# Function to get the process-wide scheduler that every session submits its pages to
+# Returns: FairScheduler with FLASHCARD_SCHEDULER_WORKERS workers
+def get_shared_scheduler():
+    global _shared_scheduler
+    with _shared_scheduler_lock:
+        if _shared_scheduler is None:
+            _shared_scheduler = FairScheduler()
+        return _shared_scheduler
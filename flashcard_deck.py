@@ -0,0 +1,385 @@
+# Structured flashcard records: streaming parsers, de-duplicating deck index and deck export
+# Importing the required libraries
+import csv
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import unicodedata
+from collections import namedtuple
+from io import StringIO
+
+# One flashcard, with the columns produced by the flashcard prompts
+Flashcard = namedtuple("Flashcard", ["kanji", "furigana", "english_translation_and_notes"])
+
+FLASHCARD_COLUMNS = ("Kanji", "Furigana", "English_Translation_and_Notes")
+
+# Field names of a card in the JSON answers of the flashcard stage
+FLASHCARD_JSON_FIELDS = tuple(column.lower() for column in FLASHCARD_COLUMNS)
+
+# Separator used when notes from duplicate cards are merged
+NOTES_SEPARATOR = "; "
+
+_KATAKANA_START = 0x30A1  # ァ
+_KATAKANA_END = 0x30F6    # ヶ
+_KATAKANA_TO_HIRAGANA = 0x60
+
+
+# Function to normalise a field for duplicate detection
+# text: Kanji or reading as written by the model
+# Returns: NFKC-normalised, whitespace-free, case-folded text with katakana folded to hiragana,
+#          so "迷う [道に～]" and "迷う［道に~］" or "コーヒー" and "こーひー" compare equal
+def normalize_field(text):
+    text = unicodedata.normalize("NFKC", text or "")
+    folded = []
+    for char in text:
+        code = ord(char)
+        if _KATAKANA_START <= code <= _KATAKANA_END:
+            char = chr(code - _KATAKANA_TO_HIRAGANA)
+        if not char.isspace():
+            folded.append(char)
+    return "".join(folded).casefold()
+
+
+# Function to build the de-duplication key of a card
+# card: Flashcard
+# Returns: Tuple (normalised kanji, normalised reading)
+def flashcard_key(card):
+    return normalize_field(card.kanji), normalize_field(card.furigana)
+
+
+class FlashcardStreamParser:
+    """
+    Incremental parser for the CSV text written by the flashcard prompts.
+
+    feed() accepts arbitrary chunks (e.g. streamed tokens) and returns the cards whose
+    row is complete; a row only counts as complete at a newline outside quotes, so
+    quoted notes containing commas or line breaks are handled. Markdown fences and a
+    header row are skipped. Rows that are not three fields are kept in `rejected`.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._scan_position = 0
+        self._in_quotes = False
+        self.rejected = []
+
+    # Function to parse the next chunk of text
+    # chunk: Text as it arrives
+    # Returns: List of Flashcards completed by this chunk
+    def feed(self, chunk):
+        self._buffer += chunk
+        cards = []
+        row_start = 0
+        position = self._scan_position
+        while position < len(self._buffer):
+            char = self._buffer[position]
+            if char == '"':
+                self._in_quotes = not self._in_quotes
+            elif char == "\n" and not self._in_quotes:
+                card = self._parse_row(self._buffer[row_start:position])
+                if card is not None:
+                    cards.append(card)
+                row_start = position + 1
+            position += 1
+        self._buffer = self._buffer[row_start:]
+        self._scan_position = len(self._buffer)
+        return cards
+
+    # Function to parse whatever is left once the stream has ended
+    # Returns: List with the final card, if the text did not end with a newline
+    def close(self):
+        remaining = self._buffer
+        self._buffer = ""
+        self._scan_position = 0
+        self._in_quotes = False
+        card = self._parse_row(remaining)
+        return [card] if card is not None else []
+
+    def _parse_row(self, row_text):
+        stripped = row_text.strip()
+        if not stripped or stripped.startswith("```"):
+            return None
+        try:
+            fields = next(csv.reader(StringIO(stripped), skipinitialspace=True))
+        except (csv.Error, StopIteration):
+            self.rejected.append(row_text)
+            return None
+        fields = [field.strip() for field in fields]
+        if len(fields) != 3:
+            self.rejected.append(row_text)
+            return None
+        if tuple(fields) == FLASHCARD_COLUMNS:
+            return None  # Header row
+        return Flashcard(*fields)
+
+
+# Function to parse a complete flashcard text in one go
+# flashcards_text: CSV text from the flashcard stage
+# Returns: List of Flashcards
+def parse_flashcards(flashcards_text):
+    parser = FlashcardStreamParser()
+    return parser.feed(flashcards_text or "") + parser.close()
+
+
+# Function to validate one decoded JSON card
+# value: Decoded JSON value
+# Returns: Flashcard, or None unless value is an object with a non-empty kanji and reading and a
+#          string of notes (field names are matched case-insensitively)
+def flashcard_from_json(value):
+    if not isinstance(value, dict):
+        return None
+    fields = {str(name).strip().lower(): field for name, field in value.items()}
+    if not all(isinstance(fields.get(name), str) for name in FLASHCARD_JSON_FIELDS):
+        return None
+    card = Flashcard(*(fields[name].strip() for name in FLASHCARD_JSON_FIELDS))
+    if not card.kanji or not card.furigana:
+        return None
+    return card
+
+
+class FlashcardJsonStreamParser:
+    """
+    Incremental, validating parser for the JSON array of cards written in JSON mode.
+
+    feed() accepts arbitrary chunks and returns the cards whose object has closed;
+    braces inside strings (and escaped quotes) are handled, and the array brackets,
+    commas and Markdown fences around the objects are skipped. Each object is
+    decoded and checked with flashcard_from_json on its own, so one bad row does
+    not lose the others: objects that fail, stray text between objects and an
+    object left open by a truncated answer are kept in `rejected`, ready to be
+    sent back for repair. `objects` counts every object seen.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self.rejected = []
+        self.objects = 0
+
+    # Function to parse the next chunk of text
+    # chunk: Text as it arrives
+    # Returns: List of Flashcards completed by this chunk
+    def feed(self, chunk):
+        cards = []
+        for char in chunk:
+            if self._depth == 0:
+                if char == "{":
+                    self._reject_stray_text()
+                    self._depth = 1
+                    self._buffer = char
+                else:
+                    self._buffer += char
+                continue
+
+            self._buffer += char
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    card = self._parse_object(self._buffer)
+                    if card is not None:
+                        cards.append(card)
+                    self._buffer = ""
+        return cards
+
+    # Function to finish parsing once the stream has ended
+    # Returns: An empty list; an unfinished object (a truncated answer) goes to `rejected`
+    def close(self):
+        if self._depth > 0:
+            self.objects += 1
+            self.rejected.append(self._buffer)
+        else:
+            self._reject_stray_text()
+        self._buffer = ""
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        return []
+
+    def _reject_stray_text(self):
+        stray = self._buffer.replace("```json", "").replace("```", "")
+        if stray.strip(" \t\r\n[],"):
+            self.rejected.append(self._buffer.strip())
+        self._buffer = ""
+
+    def _parse_object(self, object_text):
+        self.objects += 1
+        try:
+            card = flashcard_from_json(json.loads(object_text))
+        except ValueError:
+            card = None
+        if card is None:
+            self.rejected.append(object_text)
+        return card
+
+
+# Function to parse a complete JSON flashcard answer in one go
+# flashcards_text: JSON text from the flashcard stage
+# Returns: Tuple (list of valid Flashcards, list of rejected raw rows, number of objects seen)
+def parse_flashcards_json(flashcards_text):
+    parser = FlashcardJsonStreamParser()
+    cards = parser.feed(flashcards_text or "") + parser.close()
+    return cards, parser.rejected, parser.objects
+
+
+# Function to write flashcards as CSV (or TSV) rows
+# cards: Iterable of Flashcards
+# file: Text file object to write to
+# delimiter: "," for CSV or "\t" for TSV
+# Returns: Number of rows written
+def write_flashcards(cards, file, delimiter=","):
+    writer = csv.writer(file, delimiter=delimiter, quoting=csv.QUOTE_ALL, lineterminator="\n")
+    rows = 0
+    for card in cards:
+        writer.writerow(card)
+        rows += 1
+    return rows
+
+
+class FlashcardDeck:
+    """
+    Hash index of flashcards keyed by normalised (kanji, reading).
+
+    Cards are merged in O(1) as pages arrive: a duplicate keeps the first card's
+    fields and appends any notes that are not already present. Insertion order is
+    preserved, so exports follow page order. All methods are thread-safe.
+    """
+
+    def __init__(self, name="Japanese Flashcards"):
+        self.name = name
+        self._cards = {}
+        self._pages = {}
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    # Function to add one card, merging it into an existing entry if it is a duplicate
+    # card: Flashcard
+    # page_index: Optional page the card came from
+    # Returns: True if the card was new, False if it was merged into an existing one
+    def add(self, card, page_index=None):
+        key = flashcard_key(card)
+        with self._lock:
+            existing = self._cards.get(key)
+            if existing is None:
+                self._cards[key] = card
+                self._pages[key] = [page_index] if page_index is not None else []
+                return True
+
+            self.duplicates += 1
+            if page_index is not None and page_index not in self._pages[key]:
+                self._pages[key].append(page_index)
+            new_notes = card.english_translation_and_notes.strip()
+            if new_notes and normalize_field(new_notes) not in normalize_field(
+                existing.english_translation_and_notes
+            ):
+                merged_notes = NOTES_SEPARATOR.join(
+                    part for part in (existing.english_translation_and_notes, new_notes) if part
+                )
+                self._cards[key] = existing._replace(english_translation_and_notes=merged_notes)
+            return False
+
+    # Function to add several cards
+    # cards: Iterable of Flashcards
+    # page_index: Optional page the cards came from
+    # Returns: Number of cards that were new
+    def add_cards(self, cards, page_index=None):
+        return sum(1 for card in cards if self.add(card, page_index))
+
+    # Function to check whether an equivalent card is already in the deck
+    # card: Flashcard
+    # Returns: True if a card with the same normalised kanji and reading exists
+    def __contains__(self, card):
+        with self._lock:
+            return flashcard_key(card) in self._cards
+
+    def __len__(self):
+        with self._lock:
+            return len(self._cards)
+
+    # Function to snapshot the cards in insertion order
+    # Returns: List of Flashcards
+    def cards(self):
+        with self._lock:
+            return list(self._cards.values())
+
+    # Function to export the deck as CSV (or TSV) text
+    # delimiter: "," for CSV or "\t" for TSV
+    # Returns: String with one quoted row per card
+    def to_csv(self, delimiter=","):
+        output = StringIO()
+        write_flashcards(self.cards(), output, delimiter=delimiter)
+        return output.getvalue()
+
+    # Function to export the deck as tab-separated text (Anki's default import format)
+    # Returns: String with one row per card
+    def to_tsv(self):
+        return self.to_csv(delimiter="\t")
+
+    # Function to export the deck as an Anki package
+    # path: Destination .apkg path
+    # Returns: None; raises ImportError if genanki is not installed
+    def write_apkg(self, path):
+        try:
+            import genanki
+        except ImportError:
+            raise ImportError("Anki .apkg export requires the 'genanki' package (pip install -r requirements.txt).")
+
+        # Stable ids, so re-imports update the same note type and deck instead of duplicating them
+        model_id = _stable_id("Japanese Flashcard Generator model")
+        deck_id = _stable_id(self.name)
+        model = genanki.Model(
+            model_id,
+            "Japanese Flashcard (Kanji/Furigana/English)",
+            fields=[{"name": column} for column in FLASHCARD_COLUMNS],
+            templates=[
+                {
+                    "name": "Recognition",
+                    "qfmt": "<div class=\"kanji\">{{Kanji}}</div>",
+                    "afmt": "{{FrontSide}}<hr id=\"answer\">{{Furigana}}<br>{{English_Translation_and_Notes}}",
+                },
+            ],
+            css=".card { font-size: 24px; text-align: center; } .kanji { font-size: 48px; }",
+        )
+        deck = genanki.Deck(deck_id, self.name)
+        for card in self.cards():
+            deck.add_note(
+                genanki.Note(
+                    model=model,
+                    fields=list(card),
+                    guid=genanki.guid_for(*flashcard_key(card)),
+                )
+            )
+        genanki.Package(deck).write_to_file(path)
+
+    # Function to export the deck as Anki package bytes (e.g. for a download button)
+    # Returns: Bytes of the .apkg file
+    def to_apkg_bytes(self):
+        handle, path = tempfile.mkstemp(suffix=".apkg")
+        os.close(handle)
+        try:
+            self.write_apkg(path)
+            with open(path, "rb") as f:
+                return f.read()
+        finally:
+            os.remove(path)
+
+
+# Function to derive a stable 31-bit id from a name, as Anki expects for models and decks
+# name: Text to hash
+# Returns: Integer id
+def _stable_id(name):
+    return int(hashlib.sha1(name.encode("utf-8")).hexdigest()[:8], 16) & 0x7FFFFFFF
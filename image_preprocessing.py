@@ -0,0 +1,182 @@
+# Image pre-encoding stage that shrinks page photos before they are sent to Gemini and LLMWhisperer
+# Importing the required libraries
+import atexit
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import PIL.Image
+import PIL.ImageOps
+
+# Profile for the image attached to the Gemini calls. The model downsamples large
+# images itself, so a moderate resolution and JPEG quality lose nothing it can see.
+LLM_IMAGE_PROFILE = {
+    "name": "llm",
+    "max_side": 1600,
+    "grayscale": True,
+    "autocontrast_cutoff": 1,
+    "target_bytes": 400 * 1024,
+    "max_quality": 85,
+    "min_quality": 45,
+}
+
+# Profile for the OCR input. Small kana and furigana need more pixels and fewer
+# compression artefacts than the LLM input, so the cap and quality floor are higher.
+OCR_IMAGE_PROFILE = {
+    "name": "ocr",
+    "max_side": 2400,
+    "grayscale": True,
+    "autocontrast_cutoff": 1,
+    "target_bytes": 1024 * 1024,
+    "max_quality": 92,
+    "min_quality": 65,
+}
+
+# Worker processes of the shared pre-encoding pool; empty means one per CPU
+PREPROCESS_WORKERS = int(os.getenv("FLASHCARD_PREPROCESS_WORKERS") or 0) or None
+
+# Quality is lowered in these steps, then the image is downscaled until it is within budget
+QUALITY_STEP = 10
+DOWNSCALE_FACTOR = 0.8
+
+
+# Function to decode an image, applying the cheap JPEG draft mode when possible
+# image_bytes: Encoded image bytes
+# profile: One of the *_IMAGE_PROFILE dictionaries
+# Returns: Tuple (PIL Image with EXIF orientation applied, True if the orientation was changed)
+def decode_image(image_bytes, profile):
+    image = PIL.Image.open(BytesIO(image_bytes))
+    if image.format == "JPEG":
+        # Let libjpeg decode at 1/2, 1/4 or 1/8 scale while keeping at least max_side pixels
+        draft_mode = "L" if profile["grayscale"] else "RGB"
+        image.draft(draft_mode, (profile["max_side"], profile["max_side"]))
+
+    orientation = image.getexif().get(0x0112, 1)
+    image = PIL.ImageOps.exif_transpose(image)
+    return image, orientation not in (None, 1)
+
+
+# Function to cap the resolution and normalise the colours of a decoded image
+# image: PIL Image
+# profile: One of the *_IMAGE_PROFILE dictionaries
+# Returns: A new PIL Image in "L" or "RGB" mode
+def normalise_image(image, profile):
+    if image.mode in ("RGBA", "LA", "P"):
+        # Flatten transparency onto white, which is what a printed page looks like
+        image = image.convert("RGBA")
+        background = PIL.Image.new("RGBA", image.size, "white")
+        image = PIL.Image.alpha_composite(background, image)
+
+    image = image.convert("L" if profile["grayscale"] else "RGB")
+    image.thumbnail((profile["max_side"], profile["max_side"]), PIL.Image.LANCZOS)
+
+    if profile["autocontrast_cutoff"] is not None:
+        image = PIL.ImageOps.autocontrast(image, cutoff=profile["autocontrast_cutoff"])
+    return image
+
+
+# Function to encode an image as JPEG within the profile's byte budget
+# image: Normalised PIL Image
+# profile: One of the *_IMAGE_PROFILE dictionaries
+# Returns: Tuple (encoded bytes, JPEG quality used, (width, height) of the encoded image); the bytes are
+#          over target_bytes only if a single pixel is
+def encode_to_budget(image, profile):
+    while True:
+        quality = profile["max_quality"]
+        while True:
+            buffer = BytesIO()
+            image.save(buffer, format="JPEG", quality=quality, optimize=True)
+            encoded = buffer.getvalue()
+            if len(encoded) <= profile["target_bytes"] or quality <= profile["min_quality"]:
+                break
+            quality = max(profile["min_quality"], quality - QUALITY_STEP)
+
+        if len(encoded) <= profile["target_bytes"] or image.size == (1, 1):
+            return encoded, quality, image.size
+        # Even the lowest allowed quality is too big: trade resolution instead
+        new_size = (
+            max(1, int(image.width * DOWNSCALE_FACTOR)),
+            max(1, int(image.height * DOWNSCALE_FACTOR)),
+        )
+        image = image.resize(new_size, PIL.Image.LANCZOS)
+
+
+# Function to run the full pre-encoding stage for one image and one profile
+# image_bytes: Encoded bytes of the uploaded page
+# profile: One of the *_IMAGE_PROFILE dictionaries
+# Returns: Dictionary with the bytes to upload and a size report
+def preprocess_image_bytes(image_bytes, profile):
+    image, reoriented = decode_image(image_bytes, profile)
+    image = normalise_image(image, profile)
+    encoded, quality, size = encode_to_budget(image, profile)
+
+    # A small, upright original is already cheaper than anything we can produce
+    if len(encoded) >= len(image_bytes) and not reoriented:
+        encoded = image_bytes
+        quality = None
+
+    return {
+        "profile": profile["name"],
+        "bytes": encoded,
+        "original_bytes": len(image_bytes),
+        "encoded_bytes": len(encoded),
+        "bytes_saved": len(image_bytes) - len(encoded),
+        "quality": quality,
+        "size": size,
+    }
+
+
+# Function to prepare both pipeline inputs for one page
+# Runs in a worker process, so it must stay a picklable top-level function
+# image_bytes: Encoded bytes of the uploaded page
+# Returns: Dictionary with "llm" and "ocr" results, or {"error": message} if the image could not be processed
+def preprocess_page(image_bytes):
+    try:
+        return {
+            "llm": preprocess_image_bytes(image_bytes, LLM_IMAGE_PROFILE),
+            "ocr": preprocess_image_bytes(image_bytes, OCR_IMAGE_PROFILE),
+        }
+    except Exception as e:
+        return {"error": str(e)}
+
+
+# Function to describe the savings of a preprocessed page in a status note
+# idx: 1-based position of the image in the upload
+# prepared: A preprocess_page result
+# Returns: Status note string
+def describe_preprocessing(idx, prepared):
+    if "error" in prepared:
+        return f"Image #{idx}: Preprocessing skipped - {prepared['error']}"
+    llm, ocr = prepared["llm"], prepared["ocr"]
+    return (
+        f"Image #{idx}: Preprocessed {llm['original_bytes'] / 1024:.0f} KB upload to "
+        f"{llm['encoded_bytes'] / 1024:.0f} KB for Gemini and {ocr['encoded_bytes'] / 1024:.0f} KB for OCR "
+        f"({(llm['bytes_saved'] + ocr['bytes_saved']) / 1024:.0f} KB saved)."
+    )
+
+
+_shared_executor = None
+_shared_executor_lock = threading.Lock()
+
+
+# Function to shut the shared pool down when the process exits
+# Returns: None
+def _shutdown_shared_executor():
+    global _shared_executor
+    with _shared_executor_lock:
+        executor, _shared_executor = _shared_executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Function to get the process-wide pool that runs preprocess_page for every run, so concurrent
+# runs and sessions share its workers instead of each starting a pool of their own
+# Returns: ProcessPoolExecutor with PREPROCESS_WORKERS processes, created on first use and shut down at exit
+def get_shared_preprocess_executor():
+    global _shared_executor
+    with _shared_executor_lock:
+        if _shared_executor is None:
+            _shared_executor = ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS)
+            atexit.register(_shutdown_shared_executor)
+        return _shared_executor
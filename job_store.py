@@ -0,0 +1,406 @@
+# Background generation jobs that outlive Streamlit reruns and browser refreshes
+# Importing the required libraries
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from flashcard_deck import Flashcard, FlashcardDeck
+from pipeline_metrics import PipelineMetrics, page_status
+from upload_spool import SPILL_THRESHOLD_BYTES, UploadSpool, upload_size
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_INTERRUPTED = "interrupted"  # The server stopped while the job was running
+FINISHED_STATUSES = (JOB_DONE, JOB_FAILED, JOB_INTERRUPTED)
+
+# Events that only matter while a page is being written; once the page is done its
+# "page_done" event carries the final cards, so replays skip them
+STREAMED_EVENT_TYPES = ("cards", "cards_reset")
+
+DEFAULT_JOB_STORE_PATH = ".flashcard_jobs.sqlite3"
+# Jobs mostly wait on their pages, which the shared FairScheduler runs, so many can be in progress at once
+DEFAULT_JOB_WORKERS = 16
+DEFAULT_RETENTION_SECONDS = 24 * 60 * 60
+# Finished jobs stay in memory this long; after that they are reloaded from disk on demand
+IN_MEMORY_SECONDS = 60 * 60
+# Followers waiting for events check this often that the job's worker is still running
+FOLLOW_WAIT_SECONDS = 5.0
+
+
+class Job:
+    """
+    One generation run: its pages, progress events, deck and metrics.
+
+    Events are appended by the worker and read by any number of followers, so a
+    session that reattaches replays the run from the start and then sees new
+    events as they happen. Low-memory jobs keep only the index and status of
+    each finished page, and drop the streamed text of a page once it is done;
+    readers load the page itself from the job store (see JobStore.page_result).
+    """
+
+    def __init__(self, job_id, total_pages, options=None, status=JOB_QUEUED, created_at=None):
+        self.id = job_id
+        self.total_pages = total_pages
+        self.options = options or {}
+        self.status = status
+        self.created_at = created_at or time.time()
+        self.finished_at = None
+        self.error = None
+        self.events = []
+        self.finished_pages = set()
+        self._streamed_positions = {}  # Page index -> positions of its streamed events (low-memory jobs)
+        self.deck = FlashcardDeck()
+        self.metrics = PipelineMetrics()
+        self.condition = threading.Condition()
+        self.worker = None  # Future of the background run, for jobs started by this process
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATUSES
+
+    @property
+    def low_memory(self):
+        return bool(self.options.get("low_memory"))
+
+    # Function to record an event and wake up the followers
+    # event: Event dictionary (see generate_japanese_flashcards_stream); a low-memory job keeps
+    #        only the index and status of a "page_done" event
+    # Returns: None
+    def append_event(self, event):
+        if self.low_memory and event["type"] == "page_done" and "result" in event:
+            event = {"type": "page_done", "index": event["index"], "status": page_status(event["result"])}
+        with self.condition:
+            if self.low_memory and event["type"] in STREAMED_EVENT_TYPES:
+                self._streamed_positions.setdefault(event["index"], []).append(len(self.events))
+            self.events.append(event)
+            if event["type"] == "page_done":
+                self.finished_pages.add(event["index"])
+                # Followers skip the streamed text of finished pages, so it is dropped in place
+                for position in self._streamed_positions.pop(event["index"], []):
+                    self.events[position] = {"type": self.events[position]["type"], "index": event["index"], "text": ""}
+            self.condition.notify_all()
+
+    # Function to change the job status and wake up the followers
+    # status: One of the JOB_* statuses
+    # error: Error message for failed or interrupted jobs
+    # Returns: None
+    def set_status(self, status, error=None):
+        with self.condition:
+            self.status = status
+            self.error = error
+            if status in FINISHED_STATUSES:
+                self.finished_at = time.time()
+            self.condition.notify_all()
+
+    # Function to report the job progress
+    # Returns: Dictionary with the status, pages finished and total pages
+    def progress(self):
+        with self.condition:
+            return {
+                "id": self.id,
+                "status": self.status,
+                "pages_done": len(self.finished_pages),
+                "total_pages": self.total_pages,
+                "error": self.error,
+            }
+
+
+class JobStore:
+    """
+    Process-wide store of generation jobs, run on a bounded pool of background workers.
+
+    Jobs keep running when the session that started them reruns or goes away.
+    Job ids are random and can be kept in the URL, so a refreshed page reattaches to
+    its job. Every finished page is written to SQLite as it completes, so finished
+    and partially finished jobs survive a server restart. Jobs that were running at
+    the restart are reported as interrupted with the pages finished so far.
+
+    In low-memory mode (or when the uploads exceed SPILL_THRESHOLD_BYTES) a job's
+    uploads are spooled to temp files instead of copied in memory, and its
+    flashcards are written to a file next to the database as pages finish.
+    """
+
+    def __init__(
+        self,
+        path=DEFAULT_JOB_STORE_PATH,
+        max_workers=DEFAULT_JOB_WORKERS,
+        retention_seconds=DEFAULT_RETENTION_SECONDS
+        ):
+        self.path = path
+        self.output_directory = path + "-outputs"
+        self.retention_seconds = retention_seconds
+        self._jobs = {}
+        self._jobs_lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="flashcard-job")
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        # One connection shared by all worker threads, serialised by self._db_lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                total_pages INTEGER NOT NULL,
+                options TEXT NOT NULL,
+                flashcards TEXT,
+                notes TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS job_pages (
+                job_id TEXT NOT NULL,
+                page_index INTEGER NOT NULL,
+                result TEXT NOT NULL,
+                PRIMARY KEY (job_id, page_index)
+            )
+            """
+        )
+        # Nothing is running yet in this process, so jobs left "running" were cut off by a restart
+        self._conn.execute(
+            "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE status IN (?, ?)",
+            (JOB_INTERRUPTED, "The server restarted while this job was running.", time.time(), JOB_QUEUED, JOB_RUNNING),
+        )
+        self._conn.commit()
+        self._prune()
+
+    # Function to start a generation job in the background
+    # run: The pipeline function, called as run(pages, on_event=..., deck=..., metrics=..., **options) and
+    #      returning (flashcards, notes) like generate_japanese_flashcards
+    # uploaded_images: Seekable file-like objects, passed to the run as they are unless spooled; the job keeps
+    #                  its own references, so the session may drop them but must not close them
+    # total_pages: Number of pages the run will report, if not one per upload (e.g. PDF documents)
+    # low_memory: If True, spool the uploads to disk and stream the flashcards to a file (run must accept
+    #             output_file); uploads larger than SPILL_THRESHOLD_BYTES in total always are
+    # options: Keyword arguments passed on to run; JSON-serialisable values are also kept with the job, as are
+    #          those of a namedtuple of options (such as app.PipelineConfig)
+    # Returns: The new job id
+    def submit(self, run, uploaded_images, total_pages=None, low_memory=False, **options):
+        low_memory = low_memory or sum(upload_size(uploaded_file) for uploaded_file in uploaded_images) > SPILL_THRESHOLD_BYTES
+        spool = None
+        if low_memory:
+            spool = UploadSpool()
+            for uploaded_file in uploaded_images:
+                spool.add(uploaded_file)
+            pages = spool
+        else:
+            pages = list(uploaded_images)
+            for uploaded_file in pages:
+                uploaded_file.seek(0)
+
+        recorded_options = {}
+        for name, value in options.items():
+            recorded_options.update(value._asdict() if hasattr(value, "_asdict") else {name: value})
+        job = Job(uuid.uuid4().hex, len(pages) if total_pages is None else total_pages, options={
+            name: value for name, value in recorded_options.items()
+            if isinstance(value, (str, int, float, bool, type(None)))
+        })
+        output_path = None
+        if low_memory:
+            os.makedirs(self.output_directory, exist_ok=True)
+            output_path = os.path.join(self.output_directory, f"{job.id}.txt")
+            job.options.update(low_memory=True, output_path=output_path)
+        with self._db_lock:
+            self._conn.execute(
+                "INSERT INTO jobs (job_id, status, total_pages, options, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (job.id, job.status, job.total_pages, json.dumps(job.options), job.created_at, job.created_at),
+            )
+            self._conn.commit()
+        with self._jobs_lock:
+            self._jobs[job.id] = job
+        job.worker = self._executor.submit(self._run_job, job, run, pages, options, spool, output_path)
+        self._prune()
+        return job.id
+
+    def _run_job(self, job, run, pages, options, spool=None, output_path=None):
+        job.set_status(JOB_RUNNING)
+        self._update_job(job.id, status=JOB_RUNNING)
+
+        def on_event(event):
+            if event["type"] == "page_done":
+                self._save_page(job.id, event["result"])
+            job.append_event(event)
+
+        try:
+            if output_path is not None:
+                with open(output_path, "w", encoding="utf-8") as output_file:
+                    flashcards, notes = run(
+                        pages, on_event=on_event, deck=job.deck, metrics=job.metrics, output_file=output_file, **options
+                    )
+            else:
+                flashcards, notes = run(pages, on_event=on_event, deck=job.deck, metrics=job.metrics, **options)
+        except Exception as e:
+            self._update_job(job.id, status=JOB_FAILED, error=str(e))
+            job.set_status(JOB_FAILED, error=str(e))
+            return
+        finally:
+            if spool is not None:
+                spool.cleanup()
+        self._update_job(job.id, status=JOB_DONE, flashcards=flashcards, notes=json.dumps(notes, ensure_ascii=False))
+        job.append_event(self._done_event(flashcards, notes, output_path))
+        job.set_status(JOB_DONE)
+
+    # Function to build a job's final event
+    # flashcards, notes: As returned by the run
+    # output_path: File holding the flashcards of a low-memory job (flashcards is then empty), or None
+    # Returns: "done" event dictionary
+    def _done_event(self, flashcards, notes, output_path=None):
+        event = {"type": "done", "flashcards": flashcards, "notes": notes}
+        if output_path is not None:
+            event["output_path"] = output_path
+        return event
+
+    def _save_page(self, job_id, page_result):
+        with self._db_lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO job_pages (job_id, page_index, result) VALUES (?, ?, ?)",
+                (job_id, page_result["index"], json.dumps(page_result, ensure_ascii=False)),
+            )
+            self._conn.commit()
+
+    def _update_job(self, job_id, **fields):
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._db_lock:
+            self._conn.execute(
+                f"UPDATE jobs SET {assignments} WHERE job_id = ?",
+                (*fields.values(), job_id),
+            )
+            self._conn.commit()
+
+    def _decode_page(self, result_text):
+        page_result = json.loads(result_text)
+        page_result["cards"] = [Flashcard(*card) for card in page_result["cards"]]
+        return page_result
+
+    # Function to read a finished page of a job from disk, for the "page_done" events of low-memory jobs
+    # job_id: Job id
+    # page_index: Index of the page in the run
+    # Returns: Page result dictionary (see process_single_image), or None if the page is not finished
+    def page_result(self, job_id, page_index):
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT result FROM job_pages WHERE job_id = ? AND page_index = ?",
+                (job_id, page_index),
+            ).fetchone()
+        return self._decode_page(row[0]) if row is not None else None
+
+    # Function to rebuild a job that is no longer in memory from its stored pages
+    # job_id: Job id
+    # Returns: Finished Job, or None if the id is unknown
+    def _load_job(self, job_id):
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT status, total_pages, options, flashcards, notes, error, created_at FROM jobs WHERE job_id = ?",
+                (job_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            page_rows = self._conn.execute(
+                "SELECT result FROM job_pages WHERE job_id = ? ORDER BY page_index",
+                (job_id,),
+            ).fetchall()
+        status, total_pages, options, flashcards, notes, error, created_at = row
+        job = Job(job_id, total_pages, options=json.loads(options), status=status, created_at=created_at)
+        job.error = error
+        for (result_text,) in page_rows:
+            page_result = self._decode_page(result_text)
+            job.deck.add_cards(page_result["cards"], page_result["index"])
+            job.metrics.add_page(page_result)
+            job.append_event({"type": "page_done", "index": page_result["index"], "result": page_result})
+        if status == JOB_DONE:
+            job.append_event(self._done_event(flashcards or "", json.loads(notes or "[]"), job.options.get("output_path")))
+        return job
+
+    # Function to find a job, in memory or on disk
+    # job_id: Job id (e.g. from the page URL)
+    # Returns: Job, or None if it is unknown or has expired
+    def get(self, job_id):
+        if not job_id:
+            return None
+        with self._jobs_lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        job = self._load_job(job_id)
+        if job is not None:
+            with self._jobs_lock:
+                job = self._jobs.setdefault(job_id, job)
+        return job
+
+    # Function to follow a job's events: everything so far, then new events until it finishes
+    # job_id: Job id
+    # Yields: Event dictionaries, ending with "done" for a successful job; the streamed
+    #         text of pages that are already finished is skipped
+    # Raises: KeyError for an unknown job, RuntimeError if the job failed or was interrupted
+    def follow(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        position = 0
+        while True:
+            with job.condition:
+                while position >= len(job.events) and not job.finished:
+                    job.condition.wait(timeout=FOLLOW_WAIT_SECONDS)
+                    if not job.finished and job.worker is not None and job.worker.done():
+                        # The worker stopped without finishing the job, so nothing will wake the followers
+                        cause = None if job.worker.cancelled() else job.worker.exception()
+                        error = "The job's worker stopped without finishing it" + (f": {cause!r}" if cause else ".")
+                        self._update_job(job.id, status=JOB_FAILED, error=error)
+                        job.set_status(JOB_FAILED, error=error)
+                new_events = job.events[position:]
+                finished_pages = set(job.finished_pages)
+                finished = job.finished
+            position += len(new_events)
+            for event in new_events:
+                if event["type"] in STREAMED_EVENT_TYPES and event["index"] in finished_pages:
+                    continue
+                yield event
+            if finished and position >= len(job.events):
+                break
+        if job.status != JOB_DONE:
+            raise RuntimeError(job.error or f"Job {job.status}")
+
+    # Function to drop expired jobs from memory and from disk
+    # Returns: None
+    def _prune(self):
+        now = time.time()
+        with self._jobs_lock:
+            for job_id, job in list(self._jobs.items()):
+                if job.finished and job.finished_at is not None and now - job.finished_at > IN_MEMORY_SECONDS:
+                    del self._jobs[job_id]
+        with self._db_lock:
+            expired = [
+                job_id for (job_id,) in self._conn.execute(
+                    "SELECT job_id FROM jobs WHERE updated_at < ? AND status IN (?, ?, ?)",
+                    (now - self.retention_seconds, *FINISHED_STATUSES),
+                ).fetchall()
+            ]
+            for job_id in expired:
+                self._conn.execute("DELETE FROM job_pages WHERE job_id = ?", (job_id,))
+                self._conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+                output_path = os.path.join(self.output_directory, f"{job_id}.txt")
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+            self._conn.commit()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        with self._db_lock:
+            self._conn.close()
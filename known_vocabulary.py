@@ -0,0 +1,206 @@
+# Known-vocabulary filter: skips words the learner already has in their deck
+# Importing the required libraries
+import bisect
+import csv
+import io
+import os
+import re
+import sqlite3
+import tempfile
+import zipfile
+
+from flashcard_deck import Flashcard, normalize_field
+
+# Headwords shorter than this are never matched inside OCR text (single kana such
+# as "は" would match almost every line)
+MIN_MATCH_LENGTH = 2
+
+# Characters per token used for the savings estimate; dense Japanese text is close to
+# one token per character, romaji/English closer to four
+CHARACTERS_PER_TOKEN = 3
+
+# Columns of a layout-preserving OCR line are separated by two or more spaces (or a tab)
+_COLUMN_GAP_PATTERN = re.compile(r"(\t+|\s{2,})")
+# Japanese sentence endings; a column with one is an example sentence, not a vocabulary entry
+_SENTENCE_END_PATTERN = re.compile("[。！？]")
+_ANNOTATION_PATTERN = re.compile(r"[\[(（［【].*?[\])）］】]")
+_ANKI_FIELD_SEPARATOR = "\x1f"
+
+
+# Function to reduce a Kanji column entry to the bare headword used for matching
+# kanji: Kanji column text, e.g. "迷う [道に～]" or "立派[な]"
+# Returns: Normalised headword without bracketed annotations, e.g. "迷う" or "立派"
+def headword_key(kanji):
+    return normalize_field(_ANNOTATION_PATTERN.sub("", kanji or ""))
+
+
+class KnownVocabulary:
+    """
+    Compact lookup structure over a learner's existing deck.
+
+    Exact (kanji, reading) pairs are kept as a sorted array of normalised keys and
+    looked up with bisect. Bare headwords go into a character trie, which the OCR
+    filter walks to tell whether a vocabulary entry starts with a known word.
+    """
+
+    def __init__(self, cards):
+        self._pair_keys = sorted({
+            (headword_key(card.kanji), normalize_field(card.furigana)) for card in cards
+        })
+        self._trie = {}
+        for headword in {headword_key(card.kanji) for card in cards}:
+            if len(headword) < MIN_MATCH_LENGTH:
+                continue
+            node = self._trie
+            for char in headword:
+                node = node.setdefault(char, {})
+            node[None] = headword  # End-of-word marker
+
+    def __len__(self):
+        return len(self._pair_keys)
+
+    # Function to check whether a card is already known
+    # card: Flashcard
+    # Returns: True if the deck has the same headword and reading (or the same headword
+    #          without a reading)
+    def __contains__(self, card):
+        headword = headword_key(card.kanji)
+        for key in ((headword, normalize_field(card.furigana)), (headword, "")):
+            position = bisect.bisect_left(self._pair_keys, key)
+            if position < len(self._pair_keys) and self._pair_keys[position] == key:
+                return True
+        return False
+
+    # Function to check whether a bare headword is known
+    # headword: Normalised headword (see headword_key)
+    # Returns: True if the trie has it as a whole word (headwords under MIN_MATCH_LENGTH never match)
+    def is_known_headword(self, headword):
+        node = self._trie
+        for char in headword:
+            node = node.get(char)
+            if node is None:
+                return False
+        return None in node
+
+    # Function to tell whether a segment of an OCR line is the entry of a known word
+    # segment: Text of one column of a line, without the surrounding whitespace
+    # Returns: True if its first token is a known headword and it is not an example sentence
+    def _is_known_entry(self, segment):
+        if _SENTENCE_END_PATTERN.search(segment):
+            return False  # A sentence that starts with a known word still teaches the rest of it
+        tokens = segment.split()
+        return bool(tokens) and self.is_known_headword(headword_key(tokens[0]))
+
+    # Function to drop the vocabulary entries of known words from the OCR text
+    # ocr_text: OCR text of a page (LLMWhisperer's layout-preserving output)
+    # Returns: Tuple (filtered text, list of removed entries). Each line is split into its
+    #          columns at runs of whitespace; a column is an entry for a known word when its
+    #          first token is a known headword, which is how vocabulary lists are laid out.
+    #          Removed columns are blanked so the others keep their place, and only lines
+    #          left empty are dropped, so unknown words sharing a line with known ones stay.
+    def filter_ocr_text(self, ocr_text):
+        kept_lines = []
+        removed_entries = []
+        for line in (ocr_text or "").splitlines():
+            parts = _COLUMN_GAP_PATTERN.split(line)
+            removed = False
+            for position in range(0, len(parts), 2):  # Even positions are columns, odd ones the gaps
+                segment = parts[position].strip()
+                if segment and self._is_known_entry(segment):
+                    removed_entries.append(segment)
+                    parts[position] = " " * len(parts[position])
+                    removed = True
+            if not removed:
+                kept_lines.append(line)
+            elif "".join(parts).strip():
+                kept_lines.append("".join(parts).rstrip())
+        return "\n".join(kept_lines), removed_entries
+
+    # Function to drop generated cards that are already in the known deck
+    # cards: List of Flashcards
+    # Returns: Tuple (new cards, removed cards)
+    def filter_cards(self, cards):
+        kept = []
+        removed = []
+        for card in cards:
+            (removed if card in self else kept).append(card)
+        return kept, removed
+
+
+# Function to estimate the tokens represented by some text, for reporting savings
+# text: Text that was not sent or not generated
+# Returns: Approximate token count
+def estimate_tokens(text):
+    return (len(text) + CHARACTERS_PER_TOKEN - 1) // CHARACTERS_PER_TOKEN
+
+
+# Function to read cards from a CSV/TSV deck or an Anki "Notes in Plain Text" export
+# text: File contents
+# Returns: List of Flashcards (first column Kanji, second Furigana, third notes if present)
+def read_cards_from_text(text):
+    lines = [line for line in text.splitlines() if line and not line.startswith("#")]
+    if not lines:
+        return []
+    delimiter = "\t" if lines[0].count("\t") >= lines[0].count(",") else ","
+    cards = []
+    for fields in csv.reader(lines, delimiter=delimiter, skipinitialspace=True):
+        fields = [field.strip() for field in fields]
+        if len(fields) < 2 or not fields[0]:
+            continue
+        if fields[0] == "Kanji" and fields[1] == "Furigana":
+            continue  # Header row
+        cards.append(Flashcard(fields[0], fields[1], fields[2] if len(fields) > 2 else ""))
+    return cards
+
+
+# Function to read cards from an Anki package (.apkg)
+# data: Bytes of the .apkg file
+# Returns: List of Flashcards from the first two fields of each note
+def read_cards_from_apkg(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as package:
+        names = package.namelist()
+        collection_name = next(
+            (name for name in ("collection.anki21", "collection.anki2") if name in names), None
+        )
+        if collection_name is None:
+            raise ValueError("Unsupported .apkg: re-export it from Anki with 'Support older Anki versions' ticked.")
+        handle, path = tempfile.mkstemp(suffix=".anki2")
+        try:
+            with os.fdopen(handle, "wb") as f:
+                f.write(package.read(collection_name))
+            connection = sqlite3.connect(path)
+            try:
+                rows = connection.execute("SELECT flds FROM notes").fetchall()
+            finally:
+                connection.close()
+        finally:
+            os.remove(path)
+
+    cards = []
+    for (fields_text,) in rows:
+        fields = [re.sub(r"<[^>]+>", "", field).strip() for field in fields_text.split(_ANKI_FIELD_SEPARATOR)]
+        if len(fields) >= 2 and fields[0]:
+            cards.append(Flashcard(fields[0], fields[1], fields[2] if len(fields) > 2 else ""))
+    return cards
+
+
+# Function to load a learner's existing deck
+# source: Path, bytes or file-like object (e.g. from Streamlit's uploader)
+# filename: Name used to detect the format when source is not a path
+# Returns: KnownVocabulary built from the deck
+def load_known_vocabulary(source, filename=None):
+    if isinstance(source, (str, os.PathLike)):
+        filename = filename or os.fspath(source)
+        with open(source, "rb") as f:
+            data = f.read()
+    elif isinstance(source, bytes):
+        data = source
+    else:
+        filename = filename or getattr(source, "name", "")
+        data = source.read()
+
+    if (filename or "").lower().endswith(".apkg"):
+        cards = read_cards_from_apkg(data)
+    else:
+        cards = read_cards_from_text(data.decode("utf-8-sig"))
+    return KnownVocabulary(cards)
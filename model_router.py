@@ -0,0 +1,165 @@
+# Tiered Gemini models per stage: each page starts on the cheapest model of a stage and is only
+# sent to a stronger one when the answer fails validation or looks unreliable
+# Importing the required libraries
+import json
+import os
+import re
+
+from result_cache import FLASHCARD_STAGE, SUITABILITY_STAGE
+
+# Set FLASHCARD_MODEL_ROUTING=1 to route the calls of each stage through the models listed below;
+# off by default, so every call goes to the single configured model
+MODEL_ROUTING = os.getenv("FLASHCARD_MODEL_ROUTING", "0") == "1"
+
+# Comma-separated model names per stage, cheapest first. Empty (the default) or a single name gives the
+# stage one model and no cascade; list a cheaper model first to opt into it, e.g.
+# "gemini-2.0-flash-lite,gemini-2.0-flash". An empty list uses the configured model.
+SUITABILITY_MODELS = os.getenv("FLASHCARD_SUITABILITY_MODELS", "")
+FLASHCARD_MODELS = os.getenv("FLASHCARD_FLASHCARD_MODELS", "")
+
+# Set FLASHCARD_CONFIRM_REJECTIONS=1 to have a "No" verdict of a cheaper model checked by the next one,
+# so only the strongest model rejects pages (each such rejection costs a second suitability call)
+CONFIRM_REJECTIONS = os.getenv("FLASHCARD_CONFIRM_REJECTIONS", "0") == "1"
+
+# Pages with more Japanese OCR lines than this skip the cheaper flashcard models
+HARD_PAGE_LINES = int(os.getenv("FLASHCARD_HARD_PAGE_LINES", "60"))
+
+# A flashcard answer is escalated when its card count is outside these multiples of the page's
+# Japanese OCR lines; pages with fewer lines than MIN_RATIO_LINES are not checked
+MIN_CARDS_PER_LINE = float(os.getenv("FLASHCARD_MIN_CARDS_PER_LINE", "0.4"))
+MAX_CARDS_PER_LINE = float(os.getenv("FLASHCARD_MAX_CARDS_PER_LINE", "3"))
+MIN_RATIO_LINES = 5
+
+# USD per million (input, output) tokens, for the cost estimate; FLASHCARD_MODEL_PRICES can add or
+# override entries as JSON, e.g. {"gemini-2.5-flash": [0.3, 2.5]}. Unknown models cost 0.
+MODEL_PRICES = {
+    "gemini-2.0-flash-lite": (0.075, 0.30),
+    "gemini-2.0-flash": (0.10, 0.40),
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-pro": (1.25, 10.00),
+}
+MODEL_PRICES.update(
+    {name: tuple(price) for name, price in json.loads(os.getenv("FLASHCARD_MODEL_PRICES") or "{}").items()}
+)
+
+# Why an answer was sent to the next model
+ESCALATE_ERROR = "error"            # The call failed
+ESCALATE_INVALID = "invalid"        # The answer failed validation and the repair did not fix it
+ESCALATE_REJECTED = "rejected"      # A cheaper model judged the page unsuitable
+ESCALATE_CARD_COUNT = "card_count"  # Far fewer or more cards than the page has vocabulary lines
+
+# A line with kana or kanji on it
+_JAPANESE_LINE_PATTERN = re.compile("[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff]")
+
+
+# Function to read a comma-separated list of model names
+# value: String such as "gemini-2.0-flash-lite, gemini-2.0-flash"
+# Returns: Tuple of the names, in order, without blanks
+def parse_model_names(value):
+    return tuple(name.strip() for name in (value or "").split(",") if name.strip())
+
+
+# Function to give a model's name without the "models/" prefix the SDK adds
+# model_name: GenerativeModel.model_name, or a bare name
+# Returns: The bare name, as used in MODEL_PRICES
+def short_model_name(model_name):
+    return model_name.rsplit("/", 1)[-1]
+
+
+# Function to count the lines of OCR text that carry Japanese
+# text: OCR text
+# Returns: Number of lines with kana or kanji on them
+def japanese_line_count(text):
+    return sum(1 for line in (text or "").splitlines() if _JAPANESE_LINE_PATTERN.search(line))
+
+
+# Function to estimate the price of a call
+# model_name: Name of the model that made it
+# usage: read_usage() of the call (or None)
+# Returns: Estimated cost in USD (0.0 for models not in MODEL_PRICES)
+def token_cost(model_name, usage):
+    input_price, output_price = MODEL_PRICES.get(short_model_name(model_name), (0.0, 0.0))
+    usage = usage or {}
+    return (usage.get("prompt", 0) * input_price + usage.get("candidates", 0) * output_price) / 1_000_000
+
+
+class ModelRouter:
+    """
+    The models of each stage, cheapest first, and the checks that decide when
+    an answer is passed up to the next one.
+
+    A page starts on the first model of a stage (dense pages start on the last
+    flashcard model) and moves up when a call fails, when the answer fails
+    validation, or when suitability_signal/flashcard_signal name a reason not to
+    trust it; the last model's answer is always kept. The pipeline does the
+    escalation and records every attempt in the page result.
+    """
+
+    def __init__(self, tiers, confirm_rejections=CONFIRM_REJECTIONS, hard_page_lines=HARD_PAGE_LINES):
+        if not all(tiers.get(stage) for stage in (SUITABILITY_STAGE, FLASHCARD_STAGE)):
+            raise ValueError("Every stage needs at least one model")
+        self.tiers = {stage: list(models) for stage, models in tiers.items()}
+        self.confirm_rejections = confirm_rejections
+        self.hard_page_lines = hard_page_lines
+
+    # Function to list a stage's models
+    # stage: SUITABILITY_STAGE or FLASHCARD_STAGE (single-pass calls use the flashcard models)
+    # Returns: List of GenerativeModels, cheapest first
+    def models(self, stage):
+        return self.tiers[stage]
+
+    # Function to identify a stage's model list, for cache keys
+    # Returns: The model names joined with commas
+    def fingerprint(self, stage):
+        return ",".join(model.model_name for model in self.tiers[stage])
+
+    # Function to choose the first model to try
+    # stage: SUITABILITY_STAGE or FLASHCARD_STAGE
+    # ocr_text: The page's OCR text, for the flashcard stage
+    # Returns: Position in models(stage)
+    def start_tier(self, stage, ocr_text=None):
+        if stage == FLASHCARD_STAGE and japanese_line_count(ocr_text) > self.hard_page_lines:
+            return len(self.tiers[stage]) - 1
+        return 0
+
+    # Function to check a verdict before it is trusted
+    # verdict: Dictionary with "is_suitable"
+    # Returns: ESCALATE_REJECTED for a rejection that is to be confirmed, else None
+    def suitability_signal(self, verdict):
+        if self.confirm_rejections and verdict.get("is_suitable") != "Yes":
+            return ESCALATE_REJECTED
+        return None
+
+    # Function to check a flashcard answer before it is trusted
+    # card_count: Number of valid cards in the answer
+    # ocr_text: The OCR text the cards were written from
+    # Returns: ESCALATE_CARD_COUNT if the count is far off the page's Japanese lines, else None
+    def flashcard_signal(self, card_count, ocr_text):
+        lines = japanese_line_count(ocr_text)
+        if lines < MIN_RATIO_LINES:
+            return None
+        if not MIN_CARDS_PER_LINE * lines <= card_count <= MAX_CARDS_PER_LINE * lines:
+            return ESCALATE_CARD_COUNT
+        return None
+
+
+# Function to build the router from the configured model names
+# make_model: Callable (model name) -> GenerativeModel
+# default_model_name: Model of a stage whose list is empty
+# suitability_models, flashcard_models: Comma-separated model names, cheapest first
+# Returns: ModelRouter; a name used by both stages gets one shared model
+def build_model_router(make_model, default_model_name, suitability_models=SUITABILITY_MODELS,
+                       flashcard_models=FLASHCARD_MODELS):
+    built = {}
+
+    def models_for(names):
+        names = parse_model_names(names) or (default_model_name,)
+        for name in names:
+            if name not in built:
+                built[name] = make_model(name)
+        return [built[name] for name in names]
+
+    return ModelRouter({
+        SUITABILITY_STAGE: models_for(suitability_models),
+        FLASHCARD_STAGE: models_for(flashcard_models),
+    })
@@ -0,0 +1,243 @@
+# Non-blocking LLMWhisperer extraction: pages are submitted without waiting and one
+# poller tracks every outstanding whisper hash until its text can be retrieved
+# Importing the required libraries
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from rate_limiter import LLMWHISPERER_API, get_shared_rate_limiter, is_retryable
+
+# Bounds of the delay between two status checks of the same extraction, in seconds. The floor also
+# delays the first check, which is sent before any extraction time has been observed; extractions
+# take seconds, so checking sooner only spends the LLMWhisperer request quota
+MIN_POLL_INTERVAL = float(os.getenv("LLMWHISPERER_MIN_POLL_INTERVAL", "1.5"))
+MAX_POLL_INTERVAL = float(os.getenv("LLMWHISPERER_MAX_POLL_INTERVAL", "5"))
+# Each status check that finds the extraction still running stretches its interval by this factor
+POLL_BACKOFF = 1.5
+# Weight of the newest extraction in the running estimate of how long extractions take
+EXPECTED_SECONDS_WEIGHT = 0.2
+# The first status check is sent after this share of the expected extraction time, and
+# the checks after it start this share of it apart
+FIRST_CHECK_SHARE = 0.8
+RECHECK_SHARE = 0.1
+# Same default as LLMWhispererClientV2.whisper(wait_timeout=...)
+DEFAULT_POLL_TIMEOUT = float(os.getenv("LLMWHISPERER_POLL_TIMEOUT", "180"))
+# Status checks of one sweep are sent on this many threads, however many extractions are in flight
+STATUS_CHECK_WORKERS = int(os.getenv("LLMWHISPERER_STATUS_CHECK_WORKERS", "4"))
+# Consecutive retryable status check failures tolerated before an extraction is given up
+MAX_STATUS_ERRORS = 5
+
+
+class OcrExtractionError(RuntimeError):
+    """
+    Raised through an extraction's future when LLMWhisperer reports that it failed.
+    """
+
+
+class _Extraction:
+    def __init__(self, client, whisper_hash, future, timeout, rate_limiter):
+        self.client = client
+        self.rate_limiter = rate_limiter
+        self.whisper_hash = whisper_hash
+        self.future = future
+        self.submitted_at = time.monotonic()
+        self.deadline = self.submitted_at + timeout
+        self.next_check = self.submitted_at
+        self.interval = 0.0
+        self.errors = 0
+
+
+class WhisperPoller:
+    """
+    Tracks LLMWhisperer extractions submitted with wait_for_completion=False.
+
+    One thread wakes up when the next extraction is due, sends a status check for
+    every due whisper hash in one sweep (LLMWhisperer has no call that checks several
+    at once) and retrieves the text of the finished ones. The status checks and
+    retrievals go through the LLMWhisperer rate limiter, like the uploads. Poll
+    intervals adapt: the first check waits for most of the recently observed
+    extraction time (at least min_interval), and every check that finds the
+    extraction still running backs off, up to MAX_POLL_INTERVAL.
+
+    Speculative uploads need no thread once they are submitted. A page that waits
+    for its text still blocks its own thread on the returned future, but it no
+    longer sends status requests of its own; polling is shared by all pages.
+    """
+
+    def __init__(
+        self,
+        min_interval=MIN_POLL_INTERVAL,
+        max_interval=MAX_POLL_INTERVAL,
+        timeout=DEFAULT_POLL_TIMEOUT,
+        status_workers=STATUS_CHECK_WORKERS,
+        rate_limiter=None
+        ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        # Used for extractions tracked without a limiter of their own
+        self.rate_limiter = rate_limiter
+        self._condition = threading.Condition()
+        self._extractions = {}
+        self._expected_seconds = None
+        self._stats = {"submitted": 0, "completed": 0, "failed": 0, "cancelled": 0, "status_checks": 0, "peak_in_flight": 0}
+        self._check_pool = ThreadPoolExecutor(max_workers=status_workers, thread_name_prefix="whisper-status")
+        self._thread = threading.Thread(target=self._poll, name="whisper-poller", daemon=True)
+        self._thread.start()
+
+    # Function to start tracking a submitted extraction
+    # client: LLMWhispererClientV2 the extraction was submitted with
+    # whisper_hash: Hash returned by client.whisper(wait_for_completion=False)
+    # rate_limiter: RateLimitScheduler the status checks and the retrieval go through (defaults to the
+    #               poller's, else the process-wide one)
+    # Returns: concurrent.futures.Future resolved with the whisper_retrieve response (plus its
+    #          time.perf_counter() "finished_at"), or with
+    #          OcrExtractionError / TimeoutError / the API error; cancelling it stops the polling
+    def track(self, client, whisper_hash, rate_limiter=None):
+        rate_limiter = rate_limiter or self.rate_limiter or get_shared_rate_limiter()
+        future = Future()
+        extraction = _Extraction(client, whisper_hash, future, self.timeout, rate_limiter)
+        with self._condition:
+            expected = self._expected_seconds or 0.0
+            extraction.next_check += max(self.min_interval, FIRST_CHECK_SHARE * expected)
+            extraction.interval = min(self.max_interval, max(self.min_interval, RECHECK_SHARE * expected))
+            self._extractions[whisper_hash] = extraction
+            self._stats["submitted"] += 1
+            self._stats["peak_in_flight"] = max(self._stats["peak_in_flight"], len(self._extractions))
+            self._condition.notify()
+        return future
+
+    # Function to submit a page to LLMWhisperer without waiting for the extraction
+    # client: LLMWhispererClientV2
+    # submit: Callable sending the page, returning client.whisper(..., wait_for_completion=False)
+    #         (the caller wraps it in its rate limiter and retries)
+    # rate_limiter: As for track
+    # Returns: Future as for track; already resolved if the API answered synchronously
+    def submit(self, client, submit, rate_limiter=None):
+        message = submit()
+        if message.get("whisper_hash") and not message.get("extraction"):
+            return self.track(client, message["whisper_hash"], rate_limiter)
+        future = Future()
+        if message.get("status_code") == 200 and message.get("extraction"):
+            message["finished_at"] = time.perf_counter()
+            future.set_result(message)
+        else:
+            future.set_exception(OcrExtractionError(message.get("message") or f"Unexpected LLMWhisperer response: {message}"))
+        return future
+
+    def _poll(self):
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    for whisper_hash in [h for h, e in self._extractions.items() if e.future.cancelled()]:
+                        del self._extractions[whisper_hash]
+                        self._stats["cancelled"] += 1
+                    due = [e for e in self._extractions.values() if e.next_check <= now]
+                    if due:
+                        break
+                    next_check = min((e.next_check for e in self._extractions.values()), default=None)
+                    self._condition.wait(None if next_check is None else next_check - now)
+            try:
+                self._sweep(due)
+            except Exception as e:
+                # The poller thread serves every extraction of the process, so an unexpected error
+                # fails the extractions of this sweep instead of stopping it
+                self._fail(due, e)
+
+    # Function to check a sweep's due extractions and resolve the futures of the finished ones
+    # due: List of _Extraction whose next check is due
+    def _sweep(self, due):
+        # Each due extraction gets a status request of its own, spread over the status check threads
+        outcomes = list(self._check_pool.map(self._check, due))
+        with self._condition:
+            for extraction, (state, value) in zip(due, outcomes):
+                self._stats["status_checks"] += 1
+                if state == "pending":
+                    continue
+                self._extractions.pop(extraction.whisper_hash, None)
+                if state == "processed":
+                    self._stats["completed"] += 1
+                    elapsed = time.monotonic() - extraction.submitted_at
+                    if self._expected_seconds is None:
+                        self._expected_seconds = elapsed
+                    else:
+                        self._expected_seconds += EXPECTED_SECONDS_WEIGHT * (elapsed - self._expected_seconds)
+                else:
+                    self._stats["failed"] += 1
+        for extraction, (state, value) in zip(due, outcomes):
+            if state == "pending" or not extraction.future.set_running_or_notify_cancel():
+                continue
+            if state == "processed":
+                extraction.future.set_result(value)
+            else:
+                extraction.future.set_exception(value)
+
+    # Function to fail extractions that a sweep could not finish
+    # due: List of _Extraction of the sweep
+    # error: The exception their futures are resolved with
+    def _fail(self, due, error):
+        with self._condition:
+            for extraction in due:
+                if self._extractions.pop(extraction.whisper_hash, None) is not None:
+                    self._stats["failed"] += 1
+        for extraction in due:
+            future = extraction.future
+            if not future.done() and (future.running() or future.set_running_or_notify_cancel()):
+                future.set_exception(error)
+
+    # Function to check one extraction and fetch its text once it is processed
+    # extraction: _Extraction
+    # Returns: Tuple ("pending", None), ("processed", whisper_retrieve response) or ("failed", exception)
+    def _check(self, extraction):
+        # Retryable errors are counted and retried by the next sweep, not by the limiter
+        def call(fn):
+            return extraction.rate_limiter.call(LLMWHISPERER_API, fn, max_retries=0)
+
+        try:
+            status = call(lambda: extraction.client.whisper_status(whisper_hash=extraction.whisper_hash))
+            state = status.get("status", "")
+            if state == "processed":
+                message = call(lambda: extraction.client.whisper_retrieve(whisper_hash=extraction.whisper_hash))
+                message["finished_at"] = time.perf_counter()
+                return "processed", message
+            if "error" in state:
+                return "failed", OcrExtractionError(status.get("message") or state)
+            extraction.errors = 0
+        except Exception as e:
+            extraction.errors += 1
+            if not is_retryable(e) or extraction.errors > MAX_STATUS_ERRORS:
+                return "failed", e
+        now = time.monotonic()
+        if now >= extraction.deadline:
+            return "failed", TimeoutError(f"LLMWhisperer extraction {extraction.whisper_hash} timed out")
+        extraction.next_check = now + extraction.interval
+        extraction.interval = min(self.max_interval, extraction.interval * POLL_BACKOFF)
+        return "pending", None
+
+    # Function to report the poller state
+    # Returns: Dictionary with extractions in flight (now and at peak), submitted/completed/failed/cancelled
+    #          counts, status checks per finished extraction and the expected extraction time in seconds
+    def stats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._extractions)
+            finished = stats["completed"] + stats["failed"]
+            stats["checks_per_extraction"] = stats["status_checks"] / finished if finished else 0.0
+            stats["expected_seconds"] = self._expected_seconds
+            return stats
+
+
+_shared_poller = None
+_shared_poller_lock = threading.Lock()
+
+
+# Function to get the process-wide poller that tracks every extraction of this process
+# Returns: WhisperPoller configured from the LLMWHISPERER_* environment variables
+def get_shared_poller():
+    global _shared_poller
+    with _shared_poller_lock:
+        if _shared_poller is None:
+            _shared_poller = WhisperPoller()
+        return _shared_poller
@@ -0,0 +1,292 @@
+# Dense-page tiling: a page with a lot of vocabulary is cut into overlapping regions
+# along its whitespace, so its flashcards can be written by several smaller calls at once
+# Importing the required libraries
+import math
+import os
+from collections import namedtuple
+
+import PIL.Image
+
+from flashcard_deck import FlashcardDeck
+
+# Pages whose OCR text (after known vocabulary is removed) is shorter than this are not tiled
+TILE_MIN_CHARACTERS = int(os.getenv("FLASHCARD_TILE_MIN_CHARACTERS", "1500"))
+# A dense page gets one tile per this many OCR characters, up to MAX_TILES
+TILE_TARGET_CHARACTERS = int(os.getenv("FLASHCARD_TILE_TARGET_CHARACTERS", "1000"))
+MAX_TILES = int(os.getenv("FLASHCARD_MAX_TILES", "4"))
+
+# Each tile reaches this share of the inked area past its cut on both sides, so a word
+# on a cut is whole in at least one tile; the cards it gets twice are merged
+TILE_OVERLAP = 0.04
+
+# Layout analysis runs on a copy of the page scaled down to this many pixels on its longer side
+ANALYSIS_SIDE = 800
+# Grey level below which a pixel counts as ink
+INK_THRESHOLD = 160
+# A row or column with less than this share of ink counts as whitespace (specks and
+# scanner noise stay under it)
+BLANK_INK_SHARE = 0.005
+# A vertical gutter at least this share of the inked width wide separates two columns of
+# the layout (e.g. a two-column word list); narrower gaps are between words
+MIN_COLUMN_GUTTER_SHARE = 0.02
+# A cut between rows is moved to the middle of the nearest gap between lines if there is
+# one within this share of a band
+SNAP_DISTANCE_SHARE = 0.5
+# Below this many characters a tile's slice of the OCR text is not trusted and the full text is used
+MIN_TILE_TEXT_CHARACTERS = 40
+
+# One region of a page
+# box: (left, top, right, bottom) in page pixels, overlap included
+# columns, rows: The same region as (start, end) shares (0-1) of the page's inked width and height
+Tile = namedtuple("Tile", ["box", "columns", "rows"])
+
+# Layouts reported by plan_tiles
+ROW_LAYOUT = "rows"
+COLUMN_LAYOUT = "columns"
+GRID_LAYOUT = "columns and rows"
+# Columns of vertical text, read right to left; the OCR text of such pages is not sliced
+VERTICAL_LAYOUT = "vertical"
+
+
+# Function to decide how many tiles a page's flashcards are split over
+# ocr_text: The page's OCR text, as it will be sent to the flashcard stage
+# Returns: Number of tiles; 1 means the page is not dense enough to tile
+def tile_count(ocr_text):
+    characters = len((ocr_text or "").strip())
+    if characters < TILE_MIN_CHARACTERS:
+        return 1
+    return max(1, min(MAX_TILES, math.ceil(characters / TILE_TARGET_CHARACTERS)))
+
+
+# Function to build the ink mask layout analysis works on
+# image: PIL Image of the page
+# Returns: Tuple (mode "L" image at analysis resolution, 255 where there is ink, and the factor
+#          from analysis to page pixels)
+def ink_mask(image):
+    scale = max(1.0, max(image.size) / float(ANALYSIS_SIDE))
+    size = (max(1, round(image.width / scale)), max(1, round(image.height / scale)))
+    grey = image.convert("L").resize(size, PIL.Image.BILINEAR)
+    return grey.point(lambda value: 255 if value < INK_THRESHOLD else 0), scale
+
+
+# Function to measure how much ink each column or row of a mask holds
+# mask: Output of ink_mask (or a crop of it)
+# axis: "columns" or "rows"
+# Returns: List of ink shares (0-1)
+def ink_profile(mask, axis):
+    # A box filter down to one pixel high (or wide) averages the ink of every column (or row)
+    size = (mask.width, 1) if axis == "columns" else (1, mask.height)
+    return [value / 255.0 for value in mask.resize(size, PIL.Image.BOX).tobytes()]
+
+
+# Function to find the whitespace runs between the inked parts of a profile
+# profile: Ink shares per column or row
+# Returns: Tuple (first inked index, last inked index, list of (start, end) gutters inside that
+#          extent, end exclusive); (0, len - 1, []) for a blank page
+def find_gutters(profile):
+    inked = [index for index, share in enumerate(profile) if share >= BLANK_INK_SHARE]
+    if not inked:
+        return 0, len(profile) - 1, []
+    first, last = inked[0], inked[-1]
+    gutters = []
+    run_start = None
+    for index in range(first, last + 1):
+        if profile[index] < BLANK_INK_SHARE:
+            if run_start is None:
+                run_start = index
+        elif run_start is not None:
+            gutters.append((run_start, index))
+            run_start = None
+    return first, last, gutters
+
+
+# Function to place the cuts that split a profile into parts holding about the same ink
+# profile: Ink shares per column or row
+# count: Number of parts
+# gutters: (start, end) whitespace runs the cuts may be moved into
+# gutters_only: If True every cut is the middle of a gutter; otherwise a cut moves to a gutter
+#               within SNAP_DISTANCE_SHARE of a part and stays where it is if there is none
+# Returns: Sorted cut positions (profile indices, possibly fractional)
+def place_cuts(profile, count, gutters, gutters_only=False):
+    first, last, _ = find_gutters(profile)
+    total_ink = sum(profile[first:last + 1]) or 1.0
+    snap_distance = SNAP_DISTANCE_SHARE * (last - first + 1) / count
+    centres = [(start + end) / 2.0 for start, end in gutters]
+    cuts = []
+    cumulative = 0.0
+    target_number = 1
+    for index in range(first, last + 1):
+        cumulative += profile[index]
+        while target_number < count and cumulative >= total_ink * target_number / count:
+            free = [centre for centre in centres if centre not in cuts]
+            if not gutters_only:
+                free = [centre for centre in free if abs(centre - index) <= snap_distance]
+            if free:
+                cuts.append(min(free, key=lambda centre: abs(centre - index)))
+            elif not gutters_only:
+                cuts.append(float(index))
+            target_number += 1
+    return sorted(cuts)
+
+
+# Function to turn cuts into overlapping spans
+# first, last: Inked extent (indices) along the axis
+# cuts: Sorted cut positions
+# Returns: List of (start, end) spans in profile indices, each reaching TILE_OVERLAP of the extent past its cuts
+def _spans(first, last, cuts):
+    overlap = TILE_OVERLAP * (last + 1 - first)
+    bounds = [float(first)] + list(cuts) + [float(last + 1)]
+    return [
+        (max(float(first), start - overlap), min(float(last + 1), end + overlap))
+        for start, end in zip(bounds, bounds[1:])
+    ]
+
+
+# Function to share out tiles between the columns of a layout
+# column_ink: Ink held by each column
+# count: Total number of tiles (at least one per column)
+# Returns: Number of row bands per column; the inkiest columns (per band) get the extra bands
+def _bands_per_column(column_ink, count):
+    bands = [1] * len(column_ink)
+    for _ in range(count - len(column_ink)):
+        busiest = max(range(len(bands)), key=lambda column: column_ink[column] / bands[column])
+        bands[busiest] += 1
+    return bands
+
+
+# Function to cut a page into overlapping tiles
+# image: PIL Image of the page
+# count: Number of tiles wanted (see tile_count)
+# Returns: Tuple (layout, list of Tiles in reading order). The page is cut at the gutters between
+#          its columns first, then each column into bands of rows; vertical text is cut between
+#          its lines. A single whole-page tile is returned if count is 1 or the page has too
+#          little ink to cut.
+def plan_tiles(image, count):
+    width, height = image.size
+    whole_page = [Tile((0, 0, width, height), (0.0, 1.0), (0.0, 1.0))]
+    if count <= 1:
+        return ROW_LAYOUT, whole_page
+
+    mask, scale = ink_mask(image)
+    columns = ink_profile(mask, "columns")
+    rows = ink_profile(mask, "rows")
+    column_first, column_last, column_gutters = find_gutters(columns)
+    row_first, row_last, row_gutters = find_gutters(rows)
+    if column_last <= column_first or row_last <= row_first:
+        return ROW_LAYOUT, whole_page
+    column_extent = float(column_last + 1 - column_first)
+    row_extent = float(row_last + 1 - row_first)
+
+    # Function to convert a span of analysis pixels into page pixels; the outer tiles keep
+    # the page margins, so nothing faint at the edge of the ink is cut off
+    def to_page(span, first, last, side):
+        low = 0 if span[0] <= first else int(math.floor(span[0] * scale))
+        high = side if span[1] >= last + 1 else min(side, int(math.ceil(span[1] * scale)))
+        return low, high
+
+    # Vertical text: the gaps between its lines run top to bottom and the rows have almost none
+    if len(column_gutters) > 2 * max(1, len(row_gutters)):
+        cuts = place_cuts(columns, count, column_gutters)
+        tiles = []
+        for span in _spans(column_first, column_last, cuts):
+            left, right = to_page(span, column_first, column_last, width)
+            share = ((span[0] - column_first) / column_extent, (span[1] - column_first) / column_extent)
+            tiles.append(Tile((left, 0, right, height), share, (0.0, 1.0)))
+        # Vertical Japanese text is read from the right-hand column to the left
+        return VERTICAL_LAYOUT, tiles[::-1]
+
+    wide_gutters = [
+        (start, end) for start, end in column_gutters if end - start >= MIN_COLUMN_GUTTER_SHARE * column_extent
+    ]
+    layout_columns = min(count, len(wide_gutters) + 1)
+    column_spans = _spans(column_first, column_last, place_cuts(columns, layout_columns, wide_gutters, gutters_only=True))
+    column_ink = [sum(columns[int(start):int(math.ceil(end))]) for start, end in column_spans]
+    tiles = []
+    for (column_start, column_end), bands in zip(column_spans, _bands_per_column(column_ink, count)):
+        left, right = to_page((column_start, column_end), column_first, column_last, width)
+        column_share = ((column_start - column_first) / column_extent, (column_end - column_first) / column_extent)
+        # Rows are cut where this column has a gap between lines; the other columns' lines need not line up
+        column_rows = ink_profile(mask.crop((int(column_start), 0, int(math.ceil(column_end)), mask.height)), "rows")
+        band_cuts = place_cuts(column_rows, bands, find_gutters(column_rows)[2]) if bands > 1 else []
+        for row_span in _spans(row_first, row_last, band_cuts):
+            top, bottom = to_page(row_span, row_first, row_last, height)
+            row_share = ((row_span[0] - row_first) / row_extent, (row_span[1] - row_first) / row_extent)
+            tiles.append(Tile((left, top, right, bottom), column_share, row_share))
+
+    if len(tiles) <= 1:
+        return ROW_LAYOUT, whole_page
+    if len(column_spans) == 1:
+        return ROW_LAYOUT, tiles
+    return (COLUMN_LAYOUT if len(tiles) == len(column_spans) else GRID_LAYOUT), tiles
+
+
+# Function to find the character positions that are blank on every line of a text
+# lines: Lines of layout-preserving text
+# start, end: Range of character positions to look at
+# Returns: List of (middle, width) of the blank runs (the text's gutters between columns and words)
+def _text_gutters(lines, start, end):
+    gutters = []
+    run_start = None
+    for position in range(start, end + 1):
+        blank = position < end and all(position >= len(line) or line[position] == " " for line in lines)
+        if blank and run_start is None:
+            run_start = position
+        elif not blank and run_start is not None:
+            gutters.append(((run_start + position) / 2.0, position - run_start))
+            run_start = None
+    return gutters
+
+
+# Function to take the part of the OCR text that covers a tile
+# ocr_text: The page's OCR text (LLMWhisperer's layout-preserving output, which keeps the lines in
+#           page order and each word at about its horizontal position)
+# layout: Layout returned by plan_tiles
+# tile: Tile
+# Returns: The lines in the tile's share of the text's height, cut to its share of the width at the
+#          nearest blank column of the text; the full text for vertical text and for slices too
+#          short to be trusted
+def tile_text(ocr_text, layout, tile):
+    if layout == VERTICAL_LAYOUT:
+        return ocr_text
+    lines = (ocr_text or "").replace("\t", " ").splitlines()
+    content = [index for index, line in enumerate(lines) if line.strip()]
+    if not content:
+        return ocr_text
+
+    first, last = content[0], content[-1]
+    line_count = last + 1 - first
+    lines = lines[first + int(math.floor(tile.rows[0] * line_count)):first + int(math.ceil(tile.rows[1] * line_count))]
+
+    if tile.columns != (0.0, 1.0):
+        content_lines = [line for line in lines if line.strip()]
+        indent = min((len(line) - len(line.lstrip()) for line in content_lines), default=0)
+        right = max((len(line.rstrip()) for line in content_lines), default=0)
+        gutters = _text_gutters(content_lines, indent, right)
+        snap_distance = TILE_OVERLAP * 2 * (right - indent)
+
+        # Function to move an edge of the slice into the widest gutter of the text close to it
+        def snap(position):
+            nearby = [gutter for gutter in gutters if abs(gutter[0] - position) <= snap_distance]
+            if not nearby:
+                return int(round(position))
+            return int(round(max(nearby, key=lambda gutter: (gutter[1], -abs(gutter[0] - position)))[0]))
+
+        low = indent if tile.columns[0] <= 0.0 else snap(indent + tile.columns[0] * (right - indent))
+        high = right if tile.columns[1] >= 1.0 else snap(indent + tile.columns[1] * (right - indent))
+        lines = [line[low:high].rstrip() for line in lines]
+
+    sliced = "\n".join(lines)
+    if len(sliced.strip()) < MIN_TILE_TEXT_CHARACTERS:
+        return ocr_text
+    return sliced
+
+
+# Function to merge the cards written for a page's tiles
+# tile_cards: List of Flashcard lists, one per tile, in reading order
+# Returns: Tuple (merged Flashcards in reading order, number of duplicates merged away); a word in
+#          the overlap of two tiles keeps its first card, with any new notes of the second appended
+def merge_tile_cards(tile_cards):
+    deck = FlashcardDeck()
+    for cards in tile_cards:
+        deck.add_cards(cards)
+    return deck.cards(), deck.duplicates
@@ -0,0 +1,482 @@
+# Per-page pipeline metrics: stage timings, token usage and bytes on the wire,
+# with JSON and Prometheus text exports
+# Importing the required libraries
+import json
+import os
+import sys
+import threading
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Key under which decoded example images remember the size of their encoded bytes
+# (PIL.Image.info), so the bytes they add to each request can be counted
+ENCODED_BYTES_INFO_KEY = "encoded_bytes"
+
+# Timings reported per page; "ocr" is how long the page was blocked waiting for OCR and
+# "ocr_request" how long the OCR request itself took (they differ with speculative OCR)
+TIMING_STAGES = ("suitability", "ocr", "ocr_request", "flashcards", "total")
+
+# Histogram buckets for the stage latencies, in seconds
+LATENCY_BUCKETS = (0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+# Labels added to every exported sample, so several deployments can share one Prometheus
+DEFAULT_LABELS = {"deployment": os.getenv("FLASHCARD_DEPLOYMENT", "default")}
+
+METRIC_PREFIX = "flashcard_pipeline"
+
+
+# Function to count the bytes a Gemini request puts on the wire
+# contents: The prompt strings and PIL images passed to generate_content
+# page_bytes: Encoded size of the page image (the SDK re-encodes images, so this is an estimate)
+# page_image: The PIL image of the page, if it is part of contents
+# Returns: Approximate request payload size in bytes (before base64)
+def request_bytes(contents, page_bytes=0, page_image=None):
+    total = 0
+    for part in contents:
+        if isinstance(part, str):
+            total += len(part.encode("utf-8"))
+        elif part is page_image:
+            total += page_bytes
+        else:
+            total += getattr(part, "info", {}).get(ENCODED_BYTES_INFO_KEY, 0)
+    return total
+
+
+# Function to read the token usage reported with a Gemini response
+# response: GenerateContentResponse (resolved)
+# Returns: Dictionary of prompt, candidates and cached token counts, or None if not reported
+def read_usage(response):
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return None
+    return {
+        "prompt": getattr(usage, "prompt_token_count", 0) or 0,
+        "candidates": getattr(usage, "candidates_token_count", 0) or 0,
+        "cached": getattr(usage, "cached_content_token_count", 0) or 0,
+    }
+
+
+# Function to classify a finished page
+# page_result: Dictionary returned by process_single_image
+# Returns: "error", "not_suitable" or "done"
+def page_status(page_result):
+    if page_result["error"]:
+        return "error"
+    if page_result["suitability"] and page_result["suitability"]["is_suitable"] != "Yes":
+        return "not_suitable"
+    return "done"
+
+
+# Function to classify a planned Gemini call
+# plan: Token plan entry of a page result (see token_budget.TokenBudgetPlanner.record)
+# Returns: "over_budget" if even the smallest request was over the budget, "reduced" if examples were
+#          scaled or left out or the page scaled down to fit, else "full"
+def plan_outcome(plan):
+    if plan["over_budget"]:
+        return "over_budget"
+    if any(plan[key] is not None for key in ("examples", "example_side", "page_side")):
+        return "reduced"
+    return "full"
+
+
+# Function to flatten a page result into one metrics row
+# page_result: Dictionary returned by process_single_image
+# Returns: JSON-serialisable dictionary with the page's timings, bytes, tokens, retries, repairs, the
+#          savings of the cached few-shot prefix, the routed model attempts, the token plans of the
+#          Gemini calls and the page it duplicates
+def page_metrics(page_result):
+    timings = page_result.get("timings", {})
+    tokens = page_result.get("tokens", {})
+    return {
+        "page": page_result["index"],
+        "status": page_status(page_result),
+        "error_stage": page_result.get("error_stage"),
+        "seconds": {stage: timings[stage] for stage in TIMING_STAGES if stage in timings},
+        "bytes_uploaded": dict(page_result.get("bytes_uploaded", {})),
+        "tokens": {stage: dict(usage) for stage, usage in tokens.items()},
+        "retries": dict(page_result.get("retries", {})),
+        "repairs": {stage: dict(report) for stage, report in (page_result.get("repairs") or {}).items()},
+        "prefix_cache": dict(page_result.get("prefix_cache") or {}),
+        "models": [dict(attempt) for attempt in page_result.get("models") or []],
+        "token_plans": [dict(plan) for plan in page_result.get("token_plans") or []],
+        "duplicate": dict(page_result["duplicate"]) if page_result.get("duplicate") else None,
+        "cached_stages": list(page_result.get("cached_stages", [])),
+    }
+
+
+# Function to read this process's resident memory
+# Returns: Current RSS in bytes on Linux, the peak RSS so far elsewhere, or None if the platform reports neither
+def current_rss_bytes():
+    try:
+        with open("/proc/self/statm", "rb") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# Function to format a label set in the Prometheus text format
+# labels: Dictionary of label name -> value
+# Returns: String such as '{deployment="prod",stage="ocr"}'
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in sorted(labels.items())
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class PipelineMetrics:
+    """
+    Thread-safe accumulator of page metrics.
+
+    Totals (pages per status, stage latency histograms, bytes, tokens, retries,
+    repairs of malformed answers, savings of the cached few-shot prefix, attempts,
+    escalations, seconds, tokens and cost per stage and model, predicted and
+    reported input tokens of the planned calls, near-duplicate pages and the
+    calls they avoided, cache hits and failures per stage) are kept for every page added, along with
+    the highest process RSS seen when a page finished. The per-page rows are kept
+    too unless keep_pages is False, which bounds the memory of long-lived
+    process-wide instances.
+    """
+
+    def __init__(self, keep_pages=True):
+        self.keep_pages = keep_pages
+        self._lock = threading.Lock()
+        self._pages = []
+        self._status_counts = {}
+        self._latency = {
+            stage: {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0}
+            for stage in TIMING_STAGES
+        }
+        self._bytes = {}
+        self._tokens = {}
+        self._retries = {}
+        self._repairs = {}
+        self._prefix_cache = {}
+        self._models = {}
+        self._token_plans = {}
+        self._duplicates = {}
+        self._cache_hits = {}
+        self._errors = {}
+        self._script_runs = {"count": 0, "cold_start": None, "last": None}
+        self._peak_rss_bytes = None
+
+    # Function to record a finished page
+    # page_result: Dictionary returned by process_single_image
+    # Returns: The page's metrics row (see page_metrics)
+    def add_page(self, page_result):
+        row = page_metrics(page_result)
+        rss = current_rss_bytes()
+        with self._lock:
+            if rss is not None:
+                self._peak_rss_bytes = max(self._peak_rss_bytes or 0, rss)
+            if self.keep_pages:
+                self._pages.append(row)
+            self._status_counts[row["status"]] = self._status_counts.get(row["status"], 0) + 1
+            for stage, seconds in row["seconds"].items():
+                histogram = self._latency[stage]
+                histogram["sum"] += seconds
+                histogram["count"] += 1
+                for position, bound in enumerate(LATENCY_BUCKETS):
+                    if seconds <= bound:
+                        histogram["buckets"][position] += 1
+            for stage, size in row["bytes_uploaded"].items():
+                self._bytes[stage] = self._bytes.get(stage, 0) + size
+            for stage, usage in row["tokens"].items():
+                totals = self._tokens.setdefault(stage, {})
+                for kind, count in usage.items():
+                    totals[kind] = totals.get(kind, 0) + count
+            for stage, count in row["retries"].items():
+                self._retries[stage] = self._retries.get(stage, 0) + count
+            for stage, report in row["repairs"].items():
+                totals = self._repairs.setdefault(stage, {})
+                for kind, count in report.items():
+                    totals[kind] = totals.get(kind, 0) + count
+            for kind, count in row["prefix_cache"].items():
+                if count is not None:
+                    self._prefix_cache[kind] = self._prefix_cache.get(kind, 0) + count
+            for attempt in row["models"]:
+                totals = self._models.setdefault(attempt["stage"], {}).setdefault(attempt["model"], {
+                    "attempts": 0, "escalations": {}, "seconds": 0.0, "prompt": 0, "candidates": 0, "cost": 0.0,
+                })
+                totals["attempts"] += 1
+                totals["seconds"] += attempt["seconds"]
+                totals["prompt"] += attempt["tokens"].get("prompt", 0)
+                totals["candidates"] += attempt["tokens"].get("candidates", 0)
+                totals["cost"] += attempt["cost"]
+                if attempt["escalation"]:
+                    totals["escalations"][attempt["escalation"]] = totals["escalations"].get(attempt["escalation"], 0) + 1
+            for plan in row["token_plans"]:
+                totals = self._token_plans.setdefault(plan["stage"], {
+                    "calls": 0, "full": 0, "reduced": 0, "over_budget": 0, "predicted": 0, "reported": 0,
+                })
+                totals["calls"] += 1
+                totals[plan_outcome(plan)] += 1
+                totals["predicted"] += plan["calibrated"]
+                totals["reported"] += plan["reported"] or 0
+            if row["duplicate"]:
+                # Pages repeating one of the same run, or (with "of" None) one of an earlier run
+                source = "earlier" if row["duplicate"]["of"] is None else "run"
+                totals = self._duplicates.setdefault(source, {"pages": 0, "calls_avoided": 0})
+                totals["pages"] += 1
+                totals["calls_avoided"] += row["duplicate"]["calls_avoided"]
+            for stage in row["cached_stages"]:
+                self._cache_hits[stage] = self._cache_hits.get(stage, 0) + 1
+            if row["error_stage"]:
+                self._errors[row["error_stage"]] = self._errors.get(row["error_stage"], 0) + 1
+        return row
+
+    # Function to record how long a Streamlit script run took to paint the landing page
+    # seconds: Time from the start of the script to the end of the static content
+    # Returns: None; the first run of the process is kept as the cold start
+    def record_script_run(self, seconds):
+        with self._lock:
+            if self._script_runs["cold_start"] is None:
+                self._script_runs["cold_start"] = seconds
+            self._script_runs["last"] = seconds
+            self._script_runs["count"] += 1
+
+    # Function to list the per-page rows in page order
+    # Returns: List of page metrics dictionaries (empty if keep_pages is False)
+    def pages(self):
+        with self._lock:
+            return sorted(self._pages, key=lambda row: row["page"])
+
+    # Function to summarise everything recorded so far
+    # Returns: Dictionary of totals and mean stage latencies
+    def totals(self):
+        with self._lock:
+            return {
+                "pages": sum(self._status_counts.values()),
+                "status": dict(self._status_counts),
+                "mean_seconds": {
+                    stage: histogram["sum"] / histogram["count"]
+                    for stage, histogram in self._latency.items()
+                    if histogram["count"]
+                },
+                "bytes_uploaded": dict(self._bytes),
+                "tokens": {stage: dict(usage) for stage, usage in self._tokens.items()},
+                "retries": dict(self._retries),
+                "repairs": {stage: dict(report) for stage, report in self._repairs.items()},
+                "prefix_cache": dict(self._prefix_cache),
+                "models": {
+                    stage: {
+                        model: {**totals, "escalations": dict(totals["escalations"])}
+                        for model, totals in models.items()
+                    }
+                    for stage, models in self._models.items()
+                },
+                "token_plans": {stage: dict(totals) for stage, totals in self._token_plans.items()},
+                "duplicates": {
+                    "pages": sum(totals["pages"] for totals in self._duplicates.values()),
+                    "calls_avoided": sum(totals["calls_avoided"] for totals in self._duplicates.values()),
+                    "by_source": {source: dict(totals) for source, totals in self._duplicates.items()},
+                },
+                "cache_hits": dict(self._cache_hits),
+                "errors": dict(self._errors),
+                "script_runs": dict(self._script_runs),
+                "peak_rss_mb": self._peak_rss_bytes / (1024 * 1024) if self._peak_rss_bytes is not None else None,
+            }
+
+    # Function to build the table shown in the UI, one row per page
+    # Returns: List of flat dictionaries (seconds, kilobytes, tokens and retries)
+    def summary_rows(self):
+        rows = []
+        for row in self.pages():
+            seconds = row["seconds"]
+            rows.append({
+                "Page": row["page"],
+                "Status": row["status"] if not row["error_stage"] else f"error ({row['error_stage']})",
+                "Suitability s": round(seconds.get("suitability", 0.0), 2),
+                "OCR wait s": round(seconds.get("ocr", 0.0), 2),
+                "Flashcards s": round(seconds.get("flashcards", 0.0), 2),
+                "Total s": round(seconds.get("total", 0.0), 2),
+                "Uploaded KB": round(sum(row["bytes_uploaded"].values()) / 1024, 1),
+                "Prompt tokens": sum(usage.get("prompt", 0) for usage in row["tokens"].values()),
+                "Output tokens": sum(usage.get("candidates", 0) for usage in row["tokens"].values()),
+                "Predicted tokens": sum(plan["calibrated"] for plan in row["token_plans"]),
+                "Reduced calls": sum(plan_outcome(plan) != "full" for plan in row["token_plans"]),
+                "Retries": sum(row["retries"].values()),
+                "Models": " > ".join(attempt["model"] for attempt in row["models"]),
+                "Cost $": round(sum(attempt["cost"] for attempt in row["models"]), 5),
+                "Duplicate of": (
+                    "" if not row["duplicate"] else
+                    "earlier run" if row["duplicate"]["of"] is None else f"page {row['duplicate']['of']}"
+                ),
+                "Cached": ", ".join(row["cached_stages"]),
+            })
+        return rows
+
+    # Function to export the metrics as JSON
+    # Returns: JSON string with the totals and (if kept) the per-page rows
+    def to_json(self):
+        return json.dumps({"totals": self.totals(), "pages": self.pages()}, indent=2, ensure_ascii=False)
+
+    # Function to export the totals in the Prometheus text exposition format
+    # labels: Optional labels added to every sample (defaults to DEFAULT_LABELS)
+    # Returns: String ready to be served from a /metrics endpoint or pushed to a Pushgateway
+    def to_prometheus(self, labels=None):
+        labels = dict(DEFAULT_LABELS if labels is None else labels)
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} {metric_type}")
+            for suffix, sample_labels, value in samples:
+                lines.append(f"{METRIC_PREFIX}_{name}{suffix}{_format_labels({**labels, **sample_labels})} {value}")
+
+        with self._lock:
+            metric(
+                "pages_total", "counter", "Pages processed, by outcome.",
+                [("", {"status": status}, count) for status, count in sorted(self._status_counts.items())],
+            )
+            latency_samples = []
+            for stage, histogram in self._latency.items():
+                if not histogram["count"]:
+                    continue
+                for bound, count in zip(LATENCY_BUCKETS, histogram["buckets"]):
+                    latency_samples.append(("_bucket", {"stage": stage, "le": repr(bound)}, count))
+                latency_samples.append(("_bucket", {"stage": stage, "le": "+Inf"}, histogram["count"]))
+                latency_samples.append(("_sum", {"stage": stage}, histogram["sum"]))
+                latency_samples.append(("_count", {"stage": stage}, histogram["count"]))
+            metric("stage_seconds", "histogram", "Wall time per page and stage.", latency_samples)
+            metric(
+                "uploaded_bytes_total", "counter", "Request payload bytes sent to the APIs, including retries.",
+                [("", {"stage": stage}, size) for stage, size in sorted(self._bytes.items())],
+            )
+            metric(
+                "tokens_total", "counter", "Gemini tokens reported in usage_metadata.",
+                [
+                    ("", {"stage": stage, "kind": kind}, count)
+                    for stage, usage in sorted(self._tokens.items())
+                    for kind, count in sorted(usage.items())
+                ],
+            )
+            metric(
+                "retries_total", "counter", "API call retries.",
+                [("", {"stage": stage}, count) for stage, count in sorted(self._retries.items())],
+            )
+            metric(
+                "repaired_rows_total", "counter", "Malformed answer rows sent back for a targeted repair, and those repaired.",
+                [
+                    ("", {"stage": stage, "outcome": outcome}, report.get(kind, 0))
+                    for stage, report in sorted(self._repairs.items())
+                    for outcome, kind in (("sent", "rows"), ("repaired", "repaired"))
+                ],
+            )
+            metric(
+                "repair_tokens_saved_total", "counter",
+                "Tokens saved by repairing malformed rows instead of regenerating the whole answer.",
+                [("", {"stage": stage}, report.get("tokens_saved", 0)) for stage, report in sorted(self._repairs.items())],
+            )
+            metric(
+                "prefix_cache_calls_total", "counter",
+                "Flashcard calls that read the few-shot prefix from the context cache, and those that sent it inline.",
+                [
+                    ("", {"mode": mode}, self._prefix_cache.get(f"{mode}_calls", 0))
+                    for mode in ("cached", "inline")
+                ],
+            )
+            metric(
+                "prefix_cache_saved_total", "counter",
+                "Input tokens and request bytes not re-sent because the few-shot prefix was cached.",
+                [
+                    ("", {"kind": kind}, self._prefix_cache.get(f"{kind}_saved", 0))
+                    for kind in ("tokens", "bytes")
+                ],
+            )
+            model_samples = [
+                (stage, model, totals) for stage, models in sorted(self._models.items()) for model, totals in sorted(models.items())
+            ]
+            metric(
+                "model_attempts_total", "counter", "Gemini answers per stage and routed model, including escalated ones.",
+                [("", {"stage": stage, "model": model}, totals["attempts"]) for stage, model, totals in model_samples],
+            )
+            metric(
+                "model_escalations_total", "counter", "Answers passed on to a stronger model, by the reason they were not trusted.",
+                [
+                    ("", {"stage": stage, "model": model, "reason": reason}, count)
+                    for stage, model, totals in model_samples
+                    for reason, count in sorted(totals["escalations"].items())
+                ],
+            )
+            metric(
+                "model_seconds_total", "counter", "Wall time of the answers per stage and routed model.",
+                [("", {"stage": stage, "model": model}, totals["seconds"]) for stage, model, totals in model_samples],
+            )
+            metric(
+                "model_cost_usd_total", "counter", "Estimated Gemini cost per stage and routed model (see model_router.MODEL_PRICES).",
+                [("", {"stage": stage, "model": model}, totals["cost"]) for stage, model, totals in model_samples],
+            )
+            metric(
+                "token_plans_total", "counter",
+                "Planned Gemini calls per stage, sent in full, reduced to fit the token budget, or over it even at the smallest request.",
+                [
+                    ("", {"stage": stage, "plan": plan}, totals[plan])
+                    for stage, totals in sorted(self._token_plans.items())
+                    for plan in ("full", "reduced", "over_budget")
+                ],
+            )
+            metric(
+                "token_predicted_total", "counter", "Input tokens predicted by the token planner per stage (after calibration).",
+                [("", {"stage": stage}, totals["predicted"]) for stage, totals in sorted(self._token_plans.items())],
+            )
+            metric(
+                "token_reported_total", "counter", "Input tokens Gemini reported for the planned calls per stage.",
+                [("", {"stage": stage}, totals["reported"]) for stage, totals in sorted(self._token_plans.items())],
+            )
+            metric(
+                "duplicate_pages_total", "counter",
+                "Near-duplicate pages answered from an earlier page of the run or of an earlier run.",
+                [("", {"source": source}, totals["pages"]) for source, totals in sorted(self._duplicates.items())],
+            )
+            metric(
+                "duplicate_calls_avoided_total", "counter", "API calls not made for near-duplicate pages.",
+                [("", {"source": source}, totals["calls_avoided"]) for source, totals in sorted(self._duplicates.items())],
+            )
+            metric(
+                "cache_hits_total", "counter", "Stages answered from the result cache.",
+                [("", {"stage": stage}, count) for stage, count in sorted(self._cache_hits.items())],
+            )
+            metric(
+                "stage_errors_total", "counter", "Pages that failed, by the stage that failed.",
+                [("", {"stage": stage}, count) for stage, count in sorted(self._errors.items())],
+            )
+            if self._peak_rss_bytes is not None:
+                metric(
+                    "peak_rss_bytes", "gauge", "Highest resident memory of the process when a page finished.",
+                    [("", {}, self._peak_rss_bytes)],
+                )
+            if self._script_runs["count"]:
+                metric(
+                    "first_paint_seconds", "gauge",
+                    "Time from the start of a script run to the painted landing page (cold start and latest run).",
+                    [
+                        ("", {"run": "cold_start"}, self._script_runs["cold_start"]),
+                        ("", {"run": "last"}, self._script_runs["last"]),
+                    ],
+                )
+                metric(
+                    "script_runs_total", "counter", "Streamlit script runs, including reruns.",
+                    [("", {}, self._script_runs["count"])],
+                )
+        return "\n".join(lines) + "\n"
+
+
+_shared_metrics = PipelineMetrics(keep_pages=False)
+
+
+# Function to get the process-wide metrics, which count every page processed by this process
+# Returns: PipelineMetrics without per-page rows
+def get_shared_metrics():
+    return _shared_metrics
@@ -0,0 +1,420 @@
+# Process-lifetime resources shared by every flashcard generation run
+# Importing the required libraries
+import atexit
+import base64
+import io
+import json
+import mmap
+import os
+import struct
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from io import BytesIO
+
+import PIL.Image
+import streamlit as st
+from dotenv import find_dotenv, load_dotenv
+
+from pipeline_metrics import ENCODED_BYTES_INFO_KEY
+from model_router import MODEL_ROUTING, build_model_router
+from prefix_cache import PREFIX_CACHE, GeminiContextCacheBackend, PrefixCache
+from result_cache import hash_bytes, hash_strings
+
+GEMINI_MODEL_NAME = "gemini-2.0-flash"
+# GEMINI_MODEL_NAME = "gemini-2.0-flash-thinking-exp-01-21"
+# With FLASHCARD_MODEL_ROUTING=1, the models of each stage are set in model_router.py (FLASHCARD_SUITABILITY_MODELS,
+# FLASHCARD_FLASHCARD_MODELS); GEMINI_MODEL_NAME is used for a stage whose list is empty
+
+EXAMPLE_IMAGE_NAMES = ("flashcard_image_example_1", "flashcard_image_example_2")
+
+# Header of the binary example-image store: magic, then the length of a JSON index
+EXAMPLE_STORE_MAGIC = b"FCEXIMG1"
+_EXAMPLE_STORE_HEADER = struct.Struct("<8sI")
+
+# Everything the pipeline needs besides the uploaded pages
+# model: Configured Gemini GenerativeModel
+# client: LLMWhisperer client used for OCR
+# image_example_1, image_example_2: Decoded few-shot example images (or None)
+# examples_fingerprint: Hash of the example image bytes, used in cache keys
+# prefix_cache: PrefixCache holding the few-shot prefix in Gemini's context cache (None sends it inline)
+# router: ModelRouter with the cheaper and stronger models of each stage (None sends every call to model)
+PipelineResources = namedtuple(
+    "PipelineResources",
+    ["model", "client", "image_example_1", "image_example_2", "examples_fingerprint", "prefix_cache", "router"],
+    defaults=(None, None),
+)
+
+_resources_lock = threading.Lock()
+_resources_cache = {}
+_dotenv_signature = None
+
+
+# Function to load the .env file, but only when it has changed since the last call
+# Returns: None
+def refresh_environment():
+    global _dotenv_signature
+    dotenv_path = find_dotenv(usecwd=True)
+    signature = None
+    if dotenv_path:
+        stat = os.stat(dotenv_path)
+        signature = (dotenv_path, stat.st_mtime_ns, stat.st_size)
+    if signature != _dotenv_signature:
+        # Load environment variables from .env file if running locally
+        load_dotenv(dotenv_path or None, override=True)
+        _dotenv_signature = signature
+
+    # Check if we're running locally by looking for a specific environment variable
+    is_local_dev = os.getenv("IS_LOCAL_DEV", "false").lower() == "true"
+
+    # Only try to access st.secrets if not in local development
+    if not is_local_dev:
+        try:
+            secrets = getattr(st, "secrets", {})
+            if "GOOGLE_GEMINI_API_KEY" in secrets:
+                os.environ["GOOGLE_GEMINI_API_KEY"] = secrets["GOOGLE_GEMINI_API_KEY"]
+
+            if "LLMWHISPERER_BASE_URL_V2" in secrets:
+                os.environ["LLMWHISPERER_BASE_URL_V2"] = secrets["LLMWHISPERER_BASE_URL_V2"]
+
+            if "LLMWHISPERER_API_KEY" in secrets:
+                os.environ["LLMWHISPERER_API_KEY"] = secrets["LLMWHISPERER_API_KEY"]
+        except Exception as e:
+            pass
+
+
+# Function to read the API credentials from the environment
+# Returns: Tuple (gemini_api_key, unstract_api_url, unstract_api_key); raises ValueError if any is missing
+def load_credentials():
+    refresh_environment()
+
+    gemini_api_key = os.getenv("GOOGLE_GEMINI_API_KEY")
+    unstract_api_url = os.getenv("LLMWHISPERER_BASE_URL_V2")
+    unstract_api_key = os.getenv("LLMWHISPERER_API_KEY")
+
+    if not gemini_api_key:
+        raise ValueError("GOOGLE_GEMINI_API_KEY not found in environment.")
+    if not unstract_api_url:
+        raise ValueError("LLMWHISPERER_BASE_URL_V2 not found in environment.")
+    if not unstract_api_key:
+        raise ValueError("LLMWHISPERER_API_KEY not found in environment.")
+
+    return gemini_api_key, unstract_api_url, unstract_api_key
+
+
+# Function to load base64 images from a JSON file
+# filepath: Path to the JSON file containing base64 image strings
+# Returns: Dictionary with image names as keys and base64 strings as values. Empty dictionary returned on error.
+def load_base64_images_from_json(filepath="base64_example_images.json"):
+    try:
+        with open(filepath, 'r') as f:
+            base64_images = json.load(f)
+        return base64_images
+    except FileNotFoundError:
+        print(f"Error: File not found: {filepath}")
+        return {}
+    except json.JSONDecodeError:
+        print(f"Error: Invalid JSON format in {filepath}")
+        return {}
+
+
+# Function to load a base64 image string into a PIL Image object
+# base64_string: Base64 encoded image string
+# Returns: PIL Image object or None on error
+def load_image_from_base64(base64_string):
+    try:
+        image_bytes = base64.b64decode(base64_string)
+        image = PIL.Image.open(BytesIO(image_bytes))
+        return image
+    except Exception as e:
+        print(f"Error loading image from base64: {e}")
+        return None
+
+
+# Function to write example images into the binary store read by load_example_images_from_store
+# image_bytes_by_name: Dictionary of image name -> encoded image bytes (JPEG/PNG)
+# store_path: Destination path (conventionally ending in .bin)
+# Returns: None
+def write_example_image_store(image_bytes_by_name, store_path):
+    index = {}
+    offset = 0
+    for name, image_bytes in image_bytes_by_name.items():
+        index[name] = [offset, len(image_bytes)]
+        offset += len(image_bytes)
+    index_bytes = json.dumps(index).encode("utf-8")
+
+    with open(store_path, "wb") as f:
+        f.write(_EXAMPLE_STORE_HEADER.pack(EXAMPLE_STORE_MAGIC, len(index_bytes)))
+        f.write(index_bytes)
+        for image_bytes in image_bytes_by_name.values():
+            f.write(image_bytes)
+
+
+# Function to convert the base64 JSON example file into the binary store
+# json_path: Path to the JSON file containing base64 image strings
+# store_path: Destination path of the binary store
+# Returns: None
+def convert_base64_json_to_store(json_path, store_path):
+    base64_images = load_base64_images_from_json(json_path)
+    if not base64_images:
+        raise ValueError(f"No example images could be read from {json_path}")
+    write_example_image_store(
+        {name: base64.b64decode(value) for name, value in base64_images.items()},
+        store_path,
+    )
+
+
+class _BufferReader(io.RawIOBase):
+    """
+    Seekable read-only file over a buffer, so PIL can decode an image straight
+    from a slice of the memory-mapped store without copying it out first.
+    """
+
+    def __init__(self, buffer):
+        super().__init__()
+        self._view = memoryview(buffer)
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, target):
+        count = max(0, min(len(target), len(self._view) - self._position))
+        target[:count] = self._view[self._position:self._position + count]
+        self._position += count
+        return count
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._position = offset
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+
+# Function to map the binary store and expose each example image as a view into the mapping
+# store_path: Path to a store written by write_example_image_store
+# Yields: Dictionary of image name -> memoryview of its encoded bytes, valid only inside the with block.
+#         Empty dictionary yielded on error.
+@contextmanager
+def open_example_images_from_store(store_path):
+    try:
+        f = open(store_path, "rb")
+    except FileNotFoundError:
+        print(f"Error: File not found: {store_path}")
+        yield {}
+        return
+
+    with f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError as e:
+            print(f"Error: Invalid example image store {store_path} - {e}")
+            yield {}
+            return
+        with mapped:
+            mapped_view = memoryview(mapped)
+            views = {}
+            try:
+                magic, index_length = _EXAMPLE_STORE_HEADER.unpack_from(mapped, 0)
+                if magic != EXAMPLE_STORE_MAGIC:
+                    raise ValueError("not an example image store")
+                data_start = _EXAMPLE_STORE_HEADER.size + index_length
+                index = json.loads(mapped[_EXAMPLE_STORE_HEADER.size:data_start])
+                for name, (offset, length) in index.items():
+                    if data_start + offset + length > len(mapped):
+                        raise ValueError(f"{name} runs past the end of the file")
+                    views[name] = mapped_view[data_start + offset:data_start + offset + length]
+            except (ValueError, struct.error) as e:
+                print(f"Error: Invalid example image store {store_path} - {e}")
+                for view in views.values():
+                    view.release()
+                views = {}
+            try:
+                yield dict(views)
+            finally:
+                # The mapping can only be closed once every view into it is released
+                for view in views.values():
+                    view.release()
+                mapped_view.release()
+
+
+# Function to read the example images as raw bytes from either supported format
+# example_path: A .bin store or a JSON file of base64 strings
+# Yields: Dictionary of image name -> encoded image bytes or memoryview (may be empty), valid inside the with block
+@contextmanager
+def open_example_image_bytes(example_path):
+    if example_path.endswith(".bin"):
+        with open_example_images_from_store(example_path) as image_bytes_by_name:
+            yield image_bytes_by_name
+        return
+    image_bytes_by_name = {}
+    for name, value in load_base64_images_from_json(example_path).items():
+        try:
+            image_bytes_by_name[name] = base64.b64decode(value)
+        except Exception as e:
+            print(f"Error loading image from base64: {e}")
+    yield image_bytes_by_name
+
+
+# Function to decode the example images used as few-shot prompts
+# example_path: A .bin store or a JSON file of base64 strings
+# Returns: Tuple (image_example_1, image_example_2, examples_fingerprint); images are None if unavailable
+def load_example_images(example_path):
+    with open_example_image_bytes(example_path) as image_bytes_by_name:
+        images = []
+        for name in EXAMPLE_IMAGE_NAMES:
+            image = None
+            if name in image_bytes_by_name:
+                try:
+                    with _BufferReader(image_bytes_by_name[name]) as reader:
+                        image = PIL.Image.open(reader)
+                        # Decode now, while the bytes are mapped, so concurrent workers never race on PIL's lazy loading
+                        image.load()
+                    image.info[ENCODED_BYTES_INFO_KEY] = len(image_bytes_by_name[name])
+                except Exception as e:
+                    print(f"Error loading example image {name}: {e}")
+                    image = None
+            images.append(image)
+
+        examples_fingerprint = ""
+        if all(name in image_bytes_by_name for name in EXAMPLE_IMAGE_NAMES):
+            examples_fingerprint = hash_strings(
+                *(hash_bytes(image_bytes_by_name[name]) for name in EXAMPLE_IMAGE_NAMES)
+            )
+    return images[0], images[1], examples_fingerprint
+
+
+# Function to describe the example file so edits to it invalidate the cached resources
+# example_path: Path of the example file
+# Returns: Tuple identifying the file version (or None if it does not exist)
+def _file_signature(example_path):
+    try:
+        stat = os.stat(example_path)
+    except OSError:
+        return None
+    return (os.path.abspath(example_path), stat.st_mtime_ns, stat.st_size)
+
+
+# Function to build (once per process) the model, OCR client and example images
+# base64_json_path: The example images, as a base64 JSON file or a .bin store
+# Returns: PipelineResources reused until the example file or the credentials change
+def get_pipeline_resources(base64_json_path="base64_example_images.json"):
+    credentials = load_credentials()
+    cache_key = (credentials, base64_json_path, _file_signature(base64_json_path))
+
+    with _resources_lock:
+        cached = _resources_cache.get(base64_json_path)
+        if cached is not None and cached[0] == cache_key:
+            return cached[1]
+        resources = _build_pipeline_resources(credentials, base64_json_path)
+        _resources_cache[base64_json_path] = (cache_key, resources)
+
+    # The replaced resources' prefix is registered under the old credentials or examples; delete it
+    # outside the lock so runs picking up the new resources are not held up by the API calls
+    if cached is not None:
+        _release_pipeline_resources(cached[1])
+    return resources
+
+
+# Function to create the model, OCR client, example images and prefix cache
+# credentials: Tuple (gemini_api_key, unstract_api_url, unstract_api_key) from load_credentials
+# base64_json_path: The example images, as a base64 JSON file or a .bin store
+# Returns: PipelineResources
+def _build_pipeline_resources(credentials, base64_json_path):
+    gemini_api_key, unstract_api_url, unstract_api_key = credentials
+
+    # The SDKs take over a second to import, so they are only loaded once the
+    # first generation needs them, not while the landing page renders
+    import google.generativeai as genai
+    from unstract.llmwhisperer import LLMWhispererClientV2
+
+    # -----------------------------
+    # Configure the Gemini model
+    # -----------------------------
+    genai.configure(api_key=gemini_api_key)
+    model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+
+    # With routing on, each stage starts on its cheapest model and escalates to a stronger one (see model_router.py)
+    router = None
+    if MODEL_ROUTING:
+        router = build_model_router(
+            lambda name: model if name == GEMINI_MODEL_NAME else genai.GenerativeModel(name),
+            GEMINI_MODEL_NAME,
+        )
+
+    # -----------------------------
+    # LLMWhisperer client
+    # -----------------------------
+    client = LLMWhispererClientV2(base_url=unstract_api_url,
+                                  api_key=unstract_api_key,
+                                  logging_level="ERROR")
+
+    # -----------------------------
+    # Prepare example images
+    # -----------------------------
+    image_example_1, image_example_2, examples_fingerprint = load_example_images(base64_json_path)
+
+    # -----------------------------
+    # Few-shot prefix context cache
+    # -----------------------------
+    prefix_cache = PrefixCache(GeminiContextCacheBackend()) if PREFIX_CACHE else None
+
+    resources = PipelineResources(
+        model=model,
+        client=client,
+        image_example_1=image_example_1,
+        image_example_2=image_example_2,
+        examples_fingerprint=examples_fingerprint,
+        prefix_cache=prefix_cache,
+        router=router,
+    )
+    return resources
+
+
+# Function to delete the few-shot prefixes registered by replaced or dropped resources
+# resources: PipelineResources no longer handed out to new runs; runs still using them send the prefix inline
+# Returns: None
+def _release_pipeline_resources(resources):
+    if resources.prefix_cache is not None:
+        resources.prefix_cache.close()
+
+
+# Function to drop the cached resources so the next run rebuilds them; called at exit so
+# registered prefixes do not outlive the process
+# Returns: None; their few-shot prefixes are deleted from Gemini's context cache
+def clear_pipeline_resources():
+    with _resources_lock:
+        dropped = [resources for _, resources in _resources_cache.values()]
+        _resources_cache.clear()
+    for resources in dropped:
+        _release_pipeline_resources(resources)
+
+
+atexit.register(clear_pipeline_resources)
+
+
+# Converting the base64 JSON example file into the binary store from the command line:
+#   python pipeline_resources.py base64_example_images.json example_images.bin
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) != 3:
+        print("Usage: python pipeline_resources.py <base64_json_path> <store_path>")
+        sys.exit(1)
+    convert_base64_json_to_store(sys.argv[1], sys.argv[2])
+    print(f"Wrote {sys.argv[2]}")
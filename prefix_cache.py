@@ -0,0 +1,226 @@
+# Gemini context caching of the flashcard few-shot prefix: the system prompt, the example
+# images and their answers are registered once and every flashcard call references them
+# Importing the required libraries
+import datetime
+import os
+import threading
+import time
+
+# Set FLASHCARD_PREFIX_CACHE=1 to register the few-shot prefix with Gemini's context cache. Off by
+# default: caching needs a versioned model name (e.g. "gemini-2.0-flash-001") and a prefix above the
+# model's minimum cacheable token count, and without them every registration fails
+PREFIX_CACHE = os.getenv("FLASHCARD_PREFIX_CACHE", "0") == "1"
+# How long a registered prefix lives, in seconds
+PREFIX_CACHE_TTL = float(os.getenv("FLASHCARD_PREFIX_CACHE_TTL", "3600"))
+# A prefix used with less than this many seconds left is extended by another TTL, so a
+# busy process never sees it expire while an idle one stops paying for its storage
+PREFIX_CACHE_REFRESH = float(os.getenv("FLASHCARD_PREFIX_CACHE_REFRESH", "600"))
+# After a failed registration (a model without context caching, a prefix under the
+# minimum cacheable size, ...) the prefix is sent inline for this many seconds
+PREFIX_CACHE_RETRY = float(os.getenv("FLASHCARD_PREFIX_CACHE_RETRY", "900"))
+# Weight of the newest call in the running mean of call times
+CALL_SECONDS_WEIGHT = 0.2
+
+
+class GeminiContextCacheBackend:
+    """
+    Registers prefixes with Gemini's context caching API (google.generativeai.caching).
+    """
+
+    # Function to register a prefix
+    # model: The GenerativeModel the prefix is used with
+    # contents: The prefix parts (prompt strings and PIL images)
+    # ttl: Lifetime in seconds
+    # Returns: Tuple (handle passed to refresh/delete, GenerativeModel whose calls start with the prefix)
+    def create(self, model, contents, ttl):
+        import google.generativeai as genai
+        from google.generativeai import caching
+
+        cached_content = caching.CachedContent.create(
+            model=model.model_name,
+            display_name="flashcard-few-shot-prefix",
+            contents=contents,
+            ttl=datetime.timedelta(seconds=ttl),
+        )
+        return cached_content, genai.GenerativeModel.from_cached_content(cached_content)
+
+    # Function to extend a registered prefix
+    # handle: Handle returned by create
+    # ttl: New lifetime in seconds, from now
+    # Returns: None
+    def refresh(self, handle, ttl):
+        handle.update(ttl=datetime.timedelta(seconds=ttl))
+
+    # Function to delete a registered prefix
+    # handle: Handle returned by create
+    # Returns: None
+    def delete(self, handle):
+        handle.delete()
+
+
+class _CachedPrefix:
+    def __init__(self, handle, model, expires_at):
+        self.handle = handle
+        self.model = model
+        self.expires_at = expires_at
+        self.refreshing = False
+
+
+class PrefixCache:
+    """
+    Keeps one registered copy of each few-shot prefix and hands out the model to
+    call with it.
+
+    model_for() registers a prefix the first time it is asked for and extends it
+    when it is close to expiring. The API calls are made outside the lock, by the
+    one caller that found the prefix missing (or due for a refresh); concurrent
+    callers send the prefix inline meanwhile instead of waiting for that round
+    trip. When registration fails, or a call against the cached prefix fails for
+    good, the prefix is sent inline until the retry delay has passed, so caching
+    never fails a page. The backend does the API calls (GeminiContextCacheBackend,
+    or a local stand-in in the benchmarks).
+    """
+
+    def __init__(self, backend, ttl=PREFIX_CACHE_TTL, refresh=PREFIX_CACHE_REFRESH, retry=PREFIX_CACHE_RETRY):
+        self.backend = backend
+        self.ttl = ttl
+        self.refresh = min(refresh, ttl / 2)
+        self.retry = retry
+        # Guards the entries and counters; never held during an API call
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._creating = set()  # Keys whose registration is in flight
+        self._unavailable_until = {}
+        self._closed = False
+        self._call_seconds = {"cached": None, "inline": None}
+        self._stats = {"created": 0, "refreshed": 0, "dropped": 0, "failed": 0, "cached_calls": 0, "inline_calls": 0}
+        self.last_error = None
+
+    # Function to get the model whose calls start with a prefix
+    # model: The GenerativeModel the prefix is used with
+    # key: Identity of the prefix (a hash of the model name, prompts and example images)
+    # contents: The prefix parts, registered if the key is not cached yet
+    # Returns: The cached GenerativeModel, or None if the prefix has to be sent inline (also while
+    #          another caller is registering it)
+    def model_for(self, model, key, contents):
+        with self._lock:
+            if self._closed:
+                return None
+            now = time.monotonic()
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= now:
+                del self._entries[key]
+                self._stats["dropped"] += 1
+                entry = None
+            if entry is None:
+                if self._unavailable_until.get(key, 0.0) > now or key in self._creating:
+                    return None
+                self._creating.add(key)
+            elif entry.expires_at - now < self.refresh and not entry.refreshing:
+                entry.refreshing = True
+            else:
+                return entry.model
+
+        if entry is None:
+            return self._create(model, key, contents)
+
+        try:
+            self.backend.refresh(entry.handle, self.ttl)
+        except Exception as e:
+            # It still works until it expires; the next call tries again
+            with self._lock:
+                entry.refreshing = False
+                self.last_error = str(e)
+        else:
+            with self._lock:
+                entry.refreshing = False
+                entry.expires_at = time.monotonic() + self.ttl
+                self._stats["refreshed"] += 1
+        return entry.model
+
+    # Function to register a prefix; called by the one caller that added key to self._creating
+    # Returns: The cached GenerativeModel, or None if the registration failed
+    def _create(self, model, key, contents):
+        try:
+            handle, cached_model = self.backend.create(model, contents, self.ttl)
+        except Exception as e:
+            with self._lock:
+                self._creating.discard(key)
+                self._unavailable_until[key] = time.monotonic() + self.retry
+                self._stats["failed"] += 1
+                self.last_error = str(e)
+            return None
+        with self._lock:
+            cleared = key not in self._creating
+            if not cleared:
+                self._creating.discard(key)
+                self._entries[key] = _CachedPrefix(handle, cached_model, time.monotonic() + self.ttl)
+                self._stats["created"] += 1
+        if cleared:
+            # clear() ran during the registration: this prefix is not kept either
+            try:
+                self.backend.delete(handle)
+            except Exception:
+                pass
+            return None
+        return cached_model
+
+    # Function to stop using a cached prefix whose call failed (e.g. it expired or was deleted early)
+    # key: Identity of the prefix
+    # error: The exception the call raised
+    # Returns: None; the prefix is sent inline until the retry delay has passed
+    def invalidate(self, key, error):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._stats["dropped"] += 1
+            self._unavailable_until[key] = time.monotonic() + self.retry
+            self.last_error = str(error)
+
+    # Function to record a flashcard call
+    # cached: Whether the call referenced the cached prefix
+    # seconds: How long the call took
+    # Returns: Estimated seconds the cached prefix saved (the running mean of inline calls
+    #          minus this call), or None for inline calls and before any inline call was timed
+    def record_call(self, cached, seconds):
+        mode = "cached" if cached else "inline"
+        with self._lock:
+            self._stats[f"{mode}_calls"] += 1
+            mean = self._call_seconds[mode]
+            self._call_seconds[mode] = seconds if mean is None else mean + CALL_SECONDS_WEIGHT * (seconds - mean)
+            inline_mean = self._call_seconds["inline"]
+        if not cached or inline_mean is None:
+            return None
+        return max(0.0, inline_mean - seconds)
+
+    # Function to report the cache state
+    # Returns: Dictionary with the registered prefixes, registration/refresh/drop/failure counts, cached and
+    #          inline calls with their mean seconds, and the last error (or None)
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["prefixes"] = len(self._entries)
+            stats["mean_cached_seconds"] = self._call_seconds["cached"]
+            stats["mean_inline_seconds"] = self._call_seconds["inline"]
+            stats["last_error"] = self.last_error
+            return stats
+
+    # Function to delete every registered prefix (best effort; they expire on their own anyway)
+    # Returns: None
+    def clear(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+            self._creating.clear()  # Registrations in flight delete their prefix when they finish
+        for entry in entries:
+            try:
+                self.backend.delete(entry.handle)
+            except Exception:
+                pass
+
+    # Function to delete every registered prefix and stop registering new ones, for a cache
+    # that runs still in flight may hold after it was replaced
+    # Returns: None; later calls send the prefix inline
+    def close(self):
+        with self._lock:
+            self._closed = True
+        self.clear()
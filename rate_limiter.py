@@ -0,0 +1,321 @@
+# Shared rate limiting and retry scheduling for the Gemini and LLMWhisperer APIs
+# Importing the required libraries
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+from fair_scheduler import FairQueue, current_request
+
+GEMINI_API = "gemini"
+LLMWHISPERER_API = "llmwhisperer"
+
+# HTTP statuses worth retrying: timeouts, quota (429) and transient server errors
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+THROTTLE_STATUS_CODES = {429, 503}
+
+# Default quotas, overridable per deployment through environment variables
+DEFAULT_LIMITS = {
+    GEMINI_API: {
+        "requests_per_minute": float(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "60")),
+        "tokens_per_minute": float(os.getenv("GEMINI_TOKENS_PER_MINUTE", "1000000")),
+        "max_concurrency": int(os.getenv("GEMINI_MAX_CONCURRENCY", "8")),
+    },
+    LLMWHISPERER_API: {
+        "requests_per_minute": float(os.getenv("LLMWHISPERER_REQUESTS_PER_MINUTE", "30")),
+        "tokens_per_minute": None,
+        "max_concurrency": int(os.getenv("LLMWHISPERER_MAX_CONCURRENCY", "4")),
+    },
+}
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled continuously at rate_per_minute.
+
+    acquire() blocks until the requested amount is available. Requests larger than
+    the bucket capacity are allowed once the bucket is full, so a single oversized
+    call is delayed rather than rejected forever.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate_per_second)
+        self._updated = now
+
+    # Function to take tokens from the bucket, waiting for them if necessary
+    # amount: Number of tokens to take
+    # Returns: Seconds spent waiting
+    def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return waited
+                delay = (amount - self._tokens) / self.rate_per_second
+            time.sleep(delay)
+            waited += delay
+
+    # Function to empty the bucket, e.g. after the server reports the quota is exhausted
+    # Returns: None
+    def drain(self):
+        with self._lock:
+            self._refill()
+            self._tokens = 0.0
+
+
+# Function to find the HTTP-like status code of an API error, whichever SDK raised it
+# error: Exception raised by google.generativeai, llmwhisperer-client or requests
+# Returns: Integer status code, or None if the error does not carry one
+def get_status_code(error):
+    code = getattr(error, "code", None)  # google.api_core exceptions
+    if isinstance(code, int):
+        return int(code)
+    status_code = getattr(error, "status_code", None)
+    if isinstance(status_code, int):
+        return status_code
+    value = getattr(error, "value", None)  # LLMWhispererClientException wraps the response body
+    if isinstance(value, dict) and isinstance(value.get("status_code"), int):
+        return value["status_code"]
+    response = getattr(error, "response", None)
+    if isinstance(getattr(response, "status_code", None), int):
+        return response.status_code
+    return None
+
+
+# Function to decide whether a failed call is worth retrying
+# error: Exception raised by the call
+# Returns: True for quota, timeout, connection and transient server errors
+def is_retryable(error):
+    if get_status_code(error) in RETRYABLE_STATUS_CODES:
+        return True
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    # requests is loaded by the SDKs; if nothing imported it, the error cannot be one of its exceptions
+    requests = sys.modules.get("requests")
+    if requests is not None and isinstance(
+        error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+    ):
+        return True
+    return False
+
+
+# Function to read the server's requested retry delay from an API error
+# error: Exception raised by the call
+# Returns: Delay in seconds, or None if the server did not ask for one
+def get_retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers is not None:
+        retry_after = headers.get("Retry-After")
+        if retry_after is not None:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                pass
+    # Gemini reports the delay as a google.rpc.RetryInfo detail over gRPC
+    for detail in getattr(error, "details", None) or []:
+        retry_delay = getattr(detail, "retry_delay", None)
+        if retry_delay is not None:
+            return retry_delay.seconds + retry_delay.nanos / 1e9
+    match = re.search(r"retry in ([0-9.]+)\s*s", str(error), re.IGNORECASE)
+    if match:
+        return float(match.group(1))
+    return None
+
+
+class ApiLimiter:
+    """
+    Rate limiter, retry scheduler and adaptive concurrency limit for one API.
+
+    Calls wait for a concurrency slot, one request from the requests-per-minute bucket
+    and their estimated tokens from the tokens-per-minute bucket. Retryable failures
+    are retried with exponential backoff and full jitter, or after the server's
+    Retry-After delay. Throttling errors halve the concurrency limit, and successes
+    grow it back by one slot per limit's worth of calls (AIMD), so the limit tracks
+    the error rate. Callers waiting for a slot are served in FairQueue order, by the
+    user and priority of the page they belong to (see fair_scheduler.current_request).
+    """
+
+    def __init__(
+        self,
+        name,
+        requests_per_minute,
+        tokens_per_minute=None,
+        max_concurrency=8,
+        max_retries=5,
+        base_delay=1.0,
+        max_delay=60.0
+        ):
+        self.name = name
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._condition = threading.Condition()
+        self._concurrency_limit = float(max_concurrency)
+        self._in_flight = 0
+        self._waiters = FairQueue()
+        self._error_rate = 0.0
+        self._stats = {
+            "calls": 0,
+            "succeeded": 0,
+            "failed": 0,
+            "retries": 0,
+            "throttled": 0,
+            "wait_seconds": 0.0,
+        }
+
+    def _acquire_slot(self):
+        user_id, priority = current_request.get()
+        ticket = object()
+        with self._condition:
+            self._waiters.push(ticket, user_id, priority)
+            try:
+                # Wait for a free slot and for this caller's turn
+                while self._in_flight >= max(1, int(self._concurrency_limit)) or self._waiters.peek() is not ticket:
+                    self._condition.wait()
+            except BaseException:
+                self._waiters.remove(ticket, user_id, priority)
+                self._condition.notify_all()
+                raise
+            self._waiters.pop()
+            self._in_flight += 1
+            # The next caller in line may fit in a slot that is still free
+            self._condition.notify_all()
+
+    def _release_slot(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def _record_outcome(self, succeeded, throttled=False):
+        with self._condition:
+            # Exponentially weighted error rate over roughly the last 20 calls
+            self._error_rate = 0.95 * self._error_rate + 0.05 * (0.0 if succeeded else 1.0)
+            if throttled:
+                self._stats["throttled"] += 1
+                self._concurrency_limit = max(1.0, self._concurrency_limit / 2)
+            elif succeeded:
+                self._concurrency_limit = min(
+                    float(self.max_concurrency),
+                    self._concurrency_limit + 1.0 / self._concurrency_limit,
+                )
+            self._condition.notify_all()
+
+    def _backoff_delay(self, attempt, error):
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            return min(self.max_delay, retry_after)
+        # Full jitter: uniform in [0, base * 2^attempt], capped
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    # Function to run an API call under the limits, retrying transient failures
+    # fn: Callable making the API request (and raising on failure)
+    # estimated_tokens: Tokens to reserve from the tokens-per-minute bucket
+    # on_retry: Optional callback(attempt, delay, error) called before each retry
+    # max_retries: Retries allowed for this call (defaults to the limiter's); 0 for callers that retry on their own
+    # Returns: Whatever fn returns; the last error is raised once retries are exhausted
+    def call(self, fn, estimated_tokens=0, on_retry=None, max_retries=None):
+        if max_retries is None:
+            max_retries = self.max_retries
+        attempt = 0
+        while True:
+            waited = 0.0
+            self._acquire_slot()
+            try:
+                waited += self.request_bucket.acquire(1)
+                if self.token_bucket is not None and estimated_tokens:
+                    waited += self.token_bucket.acquire(estimated_tokens)
+                with self._condition:
+                    self._stats["calls"] += 1
+                    self._stats["wait_seconds"] += waited
+                result = fn()
+            except Exception as e:
+                retryable = is_retryable(e)
+                throttled = get_status_code(e) in THROTTLE_STATUS_CODES
+                self._record_outcome(succeeded=False, throttled=throttled)
+                if throttled:
+                    # The server says the quota is gone; stop other callers from spending it
+                    self.request_bucket.drain()
+                if not retryable or attempt >= max_retries:
+                    with self._condition:
+                        self._stats["failed"] += 1
+                    raise
+                delay = self._backoff_delay(attempt, e)
+                with self._condition:
+                    self._stats["retries"] += 1
+                if on_retry is not None:
+                    on_retry(attempt + 1, delay, e)
+            else:
+                self._record_outcome(succeeded=True)
+                with self._condition:
+                    self._stats["succeeded"] += 1
+                return result
+            finally:
+                self._release_slot()
+
+            attempt += 1
+            time.sleep(delay)
+
+    # Function to report the limiter state
+    # Returns: Dictionary with queue depth, in-flight calls, the current concurrency limit and counters
+    def stats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            stats.update({
+                "queue_depth": len(self._waiters),
+                "in_flight": self._in_flight,
+                "concurrency_limit": max(1, int(self._concurrency_limit)),
+                "max_concurrency": self.max_concurrency,
+                "error_rate": self._error_rate,
+            })
+            return stats
+
+
+class RateLimitScheduler:
+    """One ApiLimiter per external API, shared by every caller in the process."""
+
+    def __init__(self, limits=None):
+        limits = limits if limits is not None else DEFAULT_LIMITS
+        self.limiters = {name: ApiLimiter(name, **settings) for name, settings in limits.items()}
+
+    # Function to run a call against one API's limits (see ApiLimiter.call)
+    # api: GEMINI_API or LLMWHISPERER_API
+    # Returns: Whatever fn returns
+    def call(self, api, fn, estimated_tokens=0, on_retry=None, max_retries=None):
+        return self.limiters[api].call(fn, estimated_tokens=estimated_tokens, on_retry=on_retry, max_retries=max_retries)
+
+    # Function to report every API's limiter state
+    # Returns: Dictionary of API name -> ApiLimiter.stats()
+    def stats(self):
+        return {name: limiter.stats() for name, limiter in self.limiters.items()}
+
+
+_shared_scheduler = None
+_shared_scheduler_lock = threading.Lock()
+
+
+# Function to get the process-wide scheduler used when callers do not pass their own
+# Returns: RateLimitScheduler built from DEFAULT_LIMITS
+def get_shared_rate_limiter():
+    global _shared_scheduler
+    with _shared_scheduler_lock:
+        if _shared_scheduler is None:
+            _shared_scheduler = RateLimitScheduler()
+        return _shared_scheduler
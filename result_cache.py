@@ -0,0 +1,173 @@
+# Persistent, content-addressed cache for the per-page pipeline stages
+# Importing the required libraries
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+# Stage names used as cache namespaces
+SUITABILITY_STAGE = "suitability"
+OCR_STAGE = "ocr"
+FLASHCARD_STAGE = "flashcards"
+
+DEFAULT_CACHE_PATH = ".flashcard_cache.sqlite3"
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+# Function to hash raw bytes (e.g. the uploaded image)
+# data: Bytes to hash
+# Returns: Hex SHA-256 digest
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+# Function to hash a file-like object in blocks, without holding its contents in memory
+# file_obj: Seekable file-like object
+# Returns: Hex SHA-256 digest (the same as hash_bytes of its contents); the position is reset to the start
+def hash_stream(file_obj, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    file_obj.seek(0)
+    for block in iter(lambda: file_obj.read(block_size), b""):
+        digest.update(block)
+    file_obj.seek(0)
+    return digest.hexdigest()
+
+
+# Function to hash a sequence of strings (e.g. the prompts used by a stage)
+# parts: Strings (or None) to combine into a single fingerprint
+# Returns: Hex SHA-256 digest; the parts are length-prefixed so ("ab", "c") != ("a", "bc")
+def hash_strings(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        encoded = ("" if part is None else str(part)).encode("utf-8")
+        digest.update(str(len(encoded)).encode("ascii") + b":")
+        digest.update(encoded)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    SQLite-backed cache of stage outputs keyed by (stage, key).
+
+    Keys are built by the caller from the image bytes hash, the model name and a hash
+    of the prompts the stage depends on, so editing the flashcard prompts only misses
+    the flashcard stage while the suitability verdict and OCR text are reused.
+    The total stored size is capped at max_bytes; the least recently used entries
+    are evicted first. Hit and miss counters are kept per stage for this process.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._hits = {}
+        self._misses = {}
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        # One connection shared by all worker threads, serialised by self._lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS stage_results (
+                stage TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (stage, key)
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_stage_results_last_access ON stage_results (last_access)"
+        )
+        self._conn.commit()
+
+    # Function to look up a cached stage output
+    # stage: One of the *_STAGE names
+    # key: Cache key for the stage (see hash_strings)
+    # Returns: The cached string, or None on a miss
+    def get(self, stage, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM stage_results WHERE stage = ? AND key = ?",
+                (stage, key),
+            ).fetchone()
+            if row is None:
+                self._misses[stage] = self._misses.get(stage, 0) + 1
+                return None
+            self._conn.execute(
+                "UPDATE stage_results SET last_access = ? WHERE stage = ? AND key = ?",
+                (time.time(), stage, key),
+            )
+            self._conn.commit()
+            self._hits[stage] = self._hits.get(stage, 0) + 1
+            return row[0]
+
+    # Function to store a stage output and evict old entries beyond the size cap
+    # stage: One of the *_STAGE names
+    # key: Cache key for the stage
+    # value: String to store
+    # Returns: None
+    def put(self, stage, key, value):
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO stage_results (stage, key, value, size, last_access) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (stage, key, value, size, time.time()),
+            )
+            self._evict()
+            self._conn.commit()
+
+    # Function to remove least recently used entries until the cache fits in max_bytes
+    # Must be called with self._lock held
+    def _evict(self):
+        (total,) = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM stage_results"
+        ).fetchone()
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            "SELECT stage, key, size FROM stage_results ORDER BY last_access ASC"
+        ).fetchall()
+        for stage, key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._conn.execute(
+                "DELETE FROM stage_results WHERE stage = ? AND key = ?", (stage, key)
+            )
+            total -= size
+
+    # Function to report cache usage
+    # Returns: Dictionary with per-stage hits/misses, entry count and stored bytes
+    def stats(self):
+        with self._lock:
+            entries, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM stage_results"
+            ).fetchone()
+            stages = sorted(set(self._hits) | set(self._misses))
+            return {
+                "hits": {stage: self._hits.get(stage, 0) for stage in stages},
+                "misses": {stage: self._misses.get(stage, 0) for stage in stages},
+                "entries": entries,
+                "bytes": total,
+                "max_bytes": self.max_bytes,
+            }
+
+    # Function to delete every cached entry
+    # Returns: None
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM stage_results")
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
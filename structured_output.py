@@ -0,0 +1,206 @@
+# Schema-constrained answers: the response schemas the Gemini calls are made with, validation
+# of the suitability verdict and the accounting of targeted repairs
+# Importing the required libraries
+import json
+import os
+
+from flashcard_deck import FLASHCARD_JSON_FIELDS, FlashcardJsonStreamParser
+
+# Set FLASHCARD_STRUCTURED_OUTPUT=1 to ask models with JSON mode for schema-constrained answers; by
+# default the answers are read as the free text the prompts ask for
+STRUCTURED_OUTPUT = os.getenv("FLASHCARD_STRUCTURED_OUTPUT", "0") == "1"
+
+SUITABILITY_VERDICTS = ("Yes", "No")
+
+# OpenAPI-style schemas as accepted by GenerationConfig.response_schema
+SUITABILITY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "is_suitable": {"type": "string", "enum": list(SUITABILITY_VERDICTS)},
+        "reason": {"type": "string"},
+    },
+    "required": ["is_suitable", "reason"],
+}
+
+FLASHCARD_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {field: {"type": "string"} for field in FLASHCARD_JSON_FIELDS},
+        "required": list(FLASHCARD_JSON_FIELDS),
+    },
+}
+
+# Single-pass answers carry the verdict and the cards in one object. Gemini writes the properties
+# of a schema in alphabetical order, so the verdict comes before the cards: a truncated answer
+# keeps it, and a streamed answer has it before the first card
+SINGLE_PASS_CARDS_FIELD = "vocabulary"
+SINGLE_PASS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "is_suitable": {"type": "string", "enum": list(SUITABILITY_VERDICTS)},
+        "reason": {"type": "string"},
+        SINGLE_PASS_CARDS_FIELD: FLASHCARD_SCHEMA,
+    },
+    "required": ["is_suitable", "reason", SINGLE_PASS_CARDS_FIELD],
+}
+
+# Rows sent back for repair are cut to this many characters each, so a runaway row cannot make
+# the repair as expensive as the call it replaces
+MAX_REPAIR_ROW_CHARACTERS = 2000
+
+
+class StructuredOutputError(ValueError):
+    """
+    Raised when an answer does not match its schema, even after a repair.
+    """
+
+
+# Function to build the generation config that constrains a call's answer to a schema
+# schema: SUITABILITY_SCHEMA or FLASHCARD_SCHEMA
+# Returns: Dictionary to pass as generate_content(generation_config=...)
+def json_generation_config(schema):
+    return {"response_mime_type": "application/json", "response_schema": schema}
+
+
+# Function to remove the Markdown fences a model may still put around its answer
+# text: Answer text
+# Returns: The text without ```json / ```csv / ```html / ``` fences
+def strip_fences(text):
+    for fence in ("```json", "```csv", "```html", "```"):
+        text = text.replace(fence, "")
+    return text
+
+
+# Function to validate a suitability answer
+# text: Answer text (fences are ignored)
+# Returns: Dictionary with "is_suitable" ("Yes" or "No") and "reason"
+# Raises: StructuredOutputError if the answer is not a JSON object of that form
+def parse_suitability(text):
+    try:
+        verdict = json.loads(strip_fences(text or ""))
+    except ValueError as e:
+        raise StructuredOutputError(f"The suitability answer is not valid JSON ({e})")
+    if not isinstance(verdict, dict) or verdict.get("is_suitable") not in SUITABILITY_VERDICTS:
+        raise StructuredOutputError(f"The suitability answer has no Yes/No verdict: {text!r}")
+    return {"is_suitable": verdict["is_suitable"], "reason": str(verdict.get("reason") or "")}
+
+
+class SinglePassStreamParser:
+    """
+    Incremental parser for single-pass answers: one JSON object with the
+    suitability verdict and the array of cards under SINGLE_PASS_CARDS_FIELD.
+
+    The text inside the card array is handed to a FlashcardJsonStreamParser, so
+    cards come out of feed() as their objects close and malformed ones end up in
+    `rejected`; everything around the array is kept to read the verdict from.
+    `verdict` is set as soon as the card array opens (or at close() if the
+    properties came in another order), and stays None if it cannot be read.
+    """
+
+    def __init__(self):
+        self._cards = FlashcardJsonStreamParser()
+        self._envelope = []
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._string = None
+        self._last_string = None
+        self._in_cards = False
+        self.verdict = None
+
+    @property
+    def rejected(self):
+        return self._cards.rejected
+
+    @property
+    def objects(self):
+        return self._cards.objects
+
+    # Function to parse the next chunk of text
+    # chunk: Text as it arrives
+    # Returns: List of Flashcards completed by this chunk
+    def feed(self, chunk):
+        cards_text = []
+        for char in chunk:
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._string is not None:
+                        self._last_string = "".join(self._string)
+                        self._string = None
+                if self._string is not None:
+                    self._string.append(char)
+            elif char == '"':
+                self._in_string = True
+                # The keys of the outer object are remembered to find the card array
+                if self._depth == 1 and not self._in_cards:
+                    self._string = []
+            elif char in "{[":
+                if char == "[" and self._depth == 1 and not self._in_cards and self._last_string == SINGLE_PASS_CARDS_FIELD:
+                    self._in_cards = True
+                    self._depth += 1
+                    self._envelope.append("[]")
+                    self._read_verdict("}")
+                    continue
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._in_cards and self._depth == 1:
+                    self._in_cards = False
+                    continue
+            (cards_text if self._in_cards else self._envelope).append(char)
+        return self._cards.feed("".join(cards_text)) if cards_text else []
+
+    # Function to finish parsing once the stream has ended
+    # Returns: An empty list; a truncated card goes to `rejected`
+    def close(self):
+        self._cards.close()
+        if self.verdict is None:
+            self._read_verdict("")
+        return []
+
+    def _read_verdict(self, closing):
+        try:
+            self.verdict = parse_suitability("".join(self._envelope) + closing)
+        except StructuredOutputError:
+            pass
+
+
+# Function to parse a complete single-pass answer in one go
+# text: Answer text
+# Returns: Tuple (verdict dictionary or None, list of valid Flashcards, list of rejected raw rows, number of card objects seen)
+def parse_single_pass(text):
+    parser = SinglePassStreamParser()
+    cards = parser.feed(text or "")
+    parser.close()
+    return parser.verdict, cards, parser.rejected, parser.objects
+
+
+# Function to prepare malformed rows for the repair prompt
+# rows: Raw rejected rows
+# Returns: The rows, one per line block, each cut to MAX_REPAIR_ROW_CHARACTERS
+def format_repair_rows(rows):
+    return "\n".join(row.strip()[:MAX_REPAIR_ROW_CHARACTERS] for row in rows)
+
+
+# Function to account for one targeted repair
+# rows: Number of rows (or answers) that failed validation and were sent back
+# repaired: Number of them the repair turned into valid records
+# repair_usage: read_usage() of the repair call (or None)
+# full_usage: read_usage() of the call whose answer was repaired (or None); re-running that call
+#             is what the repair replaces
+# Returns: Dictionary with rows, repaired, the repair's tokens and the tokens saved against a re-run
+def repair_report(rows, repaired, repair_usage, full_usage):
+    repair_tokens = sum((repair_usage or {}).get(kind, 0) for kind in ("prompt", "candidates"))
+    full_tokens = sum((full_usage or {}).get(kind, 0) for kind in ("prompt", "candidates"))
+    return {
+        "rows": rows,
+        "repaired": repaired,
+        "tokens": repair_tokens,
+        "tokens_saved": max(0, full_tokens - repair_tokens),
+    }
@@ -0,0 +1,3 @@
+# The pipeline tests run on the benchmarks' fake backends, which answer in milliseconds; the OCR
+# poll floor is lowered the same way before the app reads it (see benchmarks/__init__.py)
+import benchmarks  # noqa: F401
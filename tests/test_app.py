@@ -0,0 +1,56 @@
+# Tests for the page pipeline, run on the offline fake backends of the benchmarks
+# Importing the required libraries
+import pytest
+
+from app import PipelineConfig, generate_japanese_flashcards, process_pages
+from benchmarks.fake_backends import make_fake_resources, make_synthetic_pages
+from benchmarks.run_benchmarks import make_unthrottled_limiter
+from token_budget import TokenBudgetPlanner
+
+PAGE_COUNT = 6
+
+
+# Function to build the options of a run over fresh fakes, without quotas or token budgets
+# max_workers: Number of pages processed concurrently
+# Returns: Dictionary of PipelineConfig fields
+def run_options(max_workers):
+    return {
+        "max_workers": max_workers,
+        "rate_limiter": make_unthrottled_limiter(max_workers),
+        "token_planner": TokenBudgetPlanner(budget=0, suitability_budget=0),
+    }
+
+
+# Function to leave out of a page result what depends on how long its calls took
+# Returns: The page result without its timings
+def without_timings(page_result):
+    page_result = {key: value for key, value in page_result.items() if key != "timings"}
+    page_result["models"] = [
+        {key: value for key, value in model.items() if key != "seconds"} for model in page_result["models"]
+    ]
+    return page_result
+
+
+@pytest.mark.parametrize("max_workers", [2, 4])
+def test_concurrent_pages_match_the_sequential_run_in_upload_order(max_workers):
+    runs = []
+    for workers in (1, max_workers):
+        pages = enumerate(make_synthetic_pages(PAGE_COUNT), start=1)
+        config = PipelineConfig(**run_options(workers))
+        runs.append([without_timings(page_result) for page_result in process_pages(pages, make_fake_resources(), config)])
+    sequential, concurrent = runs
+    assert [page_result["index"] for page_result in sequential] == list(range(1, PAGE_COUNT + 1))
+    assert any(page_result["cards"] for page_result in sequential)
+    assert concurrent == sequential
+
+
+def test_concurrent_flashcards_and_notes_keep_upload_order():
+    sequential = generate_japanese_flashcards(
+        make_synthetic_pages(PAGE_COUNT), resources=make_fake_resources(), **run_options(1)
+    )
+    concurrent = generate_japanese_flashcards(
+        make_synthetic_pages(PAGE_COUNT), resources=make_fake_resources(), **run_options(4)
+    )
+    assert concurrent == sequential
+    note_pages = [int(note.split(":")[0].split("#")[1]) for note in sequential[1]]
+    assert note_pages == sorted(note_pages) and set(note_pages) == set(range(1, PAGE_COUNT + 1))
@@ -0,0 +1,86 @@
+# Tests for the headless batch mode and its resumable JSONL manifest
+# Importing the required libraries
+import json
+
+import pytest
+
+import app
+import batch_cli
+from batch_cli import collect_image_paths, collect_pages, hash_file, parse_args, read_manifest_index, run_batch
+from benchmarks.fake_backends import make_fake_resources, make_synthetic_pages
+from benchmarks.run_benchmarks import make_unthrottled_limiter
+
+PAGE_COUNT = 3
+
+
+@pytest.fixture
+def pages_directory(tmp_path):
+    directory = tmp_path / "scans"
+    directory.mkdir()
+    for page in make_synthetic_pages(PAGE_COUNT):
+        (directory / page.name).write_bytes(page.getvalue())
+    return directory
+
+
+@pytest.fixture
+def fake_pipeline(monkeypatch):
+    monkeypatch.setattr(batch_cli, "get_pipeline_resources", lambda examples: make_fake_resources())
+    monkeypatch.setattr(app, "get_shared_rate_limiter", lambda: make_unthrottled_limiter(2))
+
+
+# Function to write a manifest record as an earlier run would have
+# Returns: None
+def write_record(manifest, path, status, flashcards=""):
+    record = {"path": str(path), "sha256": hash_file(path), "status": status, "flashcards": flashcards}
+    manifest.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+# Function to read the records of a manifest
+# Returns: List of dictionaries, in the order they were written
+def read_records(manifest_path):
+    with open(manifest_path, encoding="utf-8") as manifest:
+        return [json.loads(line) for line in manifest]
+
+
+def test_inputs_are_collected_in_order_without_duplicates(pages_directory):
+    (pages_directory / "notes.txt").write_text("not a page")
+    first = str(pages_directory / "page_0001.png")
+    paths = collect_image_paths([first, str(pages_directory), str(pages_directory / "*.png")])
+    assert paths[0] == first and len(paths) == PAGE_COUNT
+    assert [sha256 for _, sha256, _ in collect_pages(paths)] == [hash_file(path) for path in paths]
+
+
+def test_the_latest_record_of_a_page_wins_and_torn_lines_are_ignored(tmp_path):
+    manifest_path = tmp_path / "manifest.jsonl"
+    manifest_path.write_text(
+        '{"sha256": "a", "status": "error"}\n{"sha256": "a", "status": "done"}\n{"sha256": "b", "sta',
+        encoding="utf-8",
+    )
+    index = read_manifest_index(str(manifest_path))
+    assert set(index) == {"a"} and index["a"][1] == "done"
+    assert read_manifest_index(str(tmp_path / "missing.jsonl")) == {}
+
+
+def test_resume_skips_the_pages_already_in_the_manifest(pages_directory, tmp_path, fake_pipeline):
+    pages = sorted(pages_directory.iterdir())
+    manifest_path = tmp_path / "manifest.jsonl"
+    with open(manifest_path, "w", encoding="utf-8") as manifest:
+        write_record(manifest, pages[0], "done", "既,き,already done\n")
+        write_record(manifest, pages[1], "error")
+    output_path = tmp_path / "flashcards.csv"
+    args = parse_args([
+        str(pages_directory), "--manifest", str(manifest_path), "--output", str(output_path),
+        "--no-cache", "--workers", "2",
+    ])
+
+    assert run_batch(args) == 0
+    # Only the failed and the new page were sent to the pipeline
+    new_records = read_records(manifest_path)[2:]
+    assert sorted(record["path"] for record in new_records) == [str(pages[1]), str(pages[2])]
+    assert all(record["status"] == "done" for record in new_records)
+    # The finished page's earlier flashcards still open the output
+    assert output_path.read_text(encoding="utf-8").startswith("既,き,already done\n")
+
+    # With every page done, a re-run sends nothing
+    assert run_batch(args) == 0
+    assert len(read_records(manifest_path)) == 4
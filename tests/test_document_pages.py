@@ -0,0 +1,128 @@
+# Tests for the PDF and TIFF ingestion: document detection, page ranges and lazy page rendering
+# Importing the required libraries
+from io import BytesIO
+
+import PIL.Image
+import pytest
+
+from document_pages import (
+    DocumentReader,
+    count_pages,
+    document_kind,
+    expand_uploads,
+    is_document_path,
+    parse_page_range,
+)
+
+
+# Function to build an upload holding a multi-page document made with Pillow
+# format: "TIFF" or "PDF"
+# sizes: Page sizes in pixels
+# name: Upload name
+# Returns: BytesIO with .name set, like Streamlit's uploads
+def document_upload(format, sizes, name, **save_options):
+    pages = [PIL.Image.new("L", size, "white") for size in sizes]
+    buffer = BytesIO()
+    pages[0].save(buffer, format=format, save_all=True, append_images=pages[1:], **save_options)
+    buffer.seek(0)
+    buffer.name = name
+    return buffer
+
+
+# Function to build a single-page image upload
+# Returns: BytesIO holding a PNG
+def image_upload(name="page.png"):
+    buffer = BytesIO()
+    PIL.Image.new("L", (50, 70), "white").save(buffer, format="PNG")
+    buffer.seek(0)
+    buffer.name = name
+    return buffer
+
+
+def test_document_kind_reads_the_magic_bytes_before_the_name():
+    assert document_kind(document_upload("TIFF", [(40, 60)], "scan.png")) == "tiff"
+    assert document_kind(image_upload("scan.pdf")) == "pdf"
+    assert document_kind(image_upload()) is None
+    assert is_document_path("book/Chapter1.PDF") and not is_document_path("page.jpg")
+
+
+@pytest.mark.parametrize("spec, expected", [
+    (None, [0, 1, 2, 3, 4, 5]),
+    ("  ", [0, 1, 2, 3, 4, 5]),
+    ("2", [1]),
+    ("1-2, 5", [0, 1, 4]),
+    ("-2", [0, 1]),
+    ("5-", [4, 5]),
+    ("4-9, 2,", [1, 3, 4, 5]),
+])
+def test_parse_page_range(spec, expected):
+    assert parse_page_range(spec, 6) == expected
+
+
+@pytest.mark.parametrize("spec", ["a-b", "0", "4-2", "7-9"])
+def test_parse_page_range_rejects_malformed_and_empty_ranges(spec):
+    with pytest.raises(ValueError):
+        parse_page_range(spec, 6)
+
+
+def test_tiff_pages_are_counted_and_rendered_as_named_jpegs():
+    tiff = document_upload("TIFF", [(40, 60), (41, 60), (42, 60)], "scan.tiff")
+    assert count_pages([tiff, image_upload()]) == 4
+    assert count_pages([tiff, image_upload()], page_range="2-") == 3
+
+    reader = DocumentReader(tiff)
+    assert (reader.kind, reader.page_count) == ("tiff", 3)
+    page = reader.render(1)
+    reader.close()
+    assert page.name == "scan.tiff#page=2"
+    with PIL.Image.open(page) as image:
+        assert image.format == "JPEG" and image.size == (41, 60)
+
+
+def test_high_resolution_scans_are_scaled_down_to_the_dpi():
+    tiff = document_upload("TIFF", [(600, 900)], "scan.tiff", dpi=(600, 600))
+    with PIL.Image.open(DocumentReader(tiff, dpi=200).render(0)) as image:
+        assert image.size == (200, 300)
+
+
+def test_expand_uploads_renders_document_pages_only_when_asked():
+    image = image_upload()
+    tiff = document_upload("TIFF", [(40, 60), (41, 60), (42, 60)], "scan.tiff")
+    pages = expand_uploads([image, tiff], page_range="1, 3")
+    assert next(pages) is image  # Single images are passed through as they are
+    first = next(pages)
+    assert first.name == "scan.tiff#page=1"
+    assert [page.name for page in pages] == ["scan.tiff#page=3"]
+    # The caller's document is left open for it to reuse
+    assert not tiff.closed
+
+
+def test_a_spooled_document_is_closed_once_its_pages_are_rendered(tmp_path):
+    path = tmp_path / "scan.tiff"
+    path.write_bytes(document_upload("TIFF", [(40, 60), (41, 60)], "scan.tiff").getvalue())
+    spooled = open(path, "rb")
+    spooled.spooled = True
+    assert len(list(expand_uploads([spooled]))) == 2
+    assert spooled.closed
+
+
+def test_pdf_pages_are_rendered_at_the_dpi():
+    pytest.importorskip("pypdfium2")
+    # Pillow writes the pages at 72 DPI, so one pixel is one PDF point
+    pdf = document_upload("PDF", [(72, 144), (144, 72)], "book.pdf", resolution=72.0)
+    reader = DocumentReader(pdf, dpi=144)
+    assert (reader.kind, reader.page_count) == ("pdf", 2)
+    with PIL.Image.open(reader.render(1)) as image:
+        assert image.size == (288, 144)
+    reader.close()
+
+
+def test_pdf_uploads_without_pypdfium2_explain_the_missing_package():
+    try:
+        import pypdfium2  # noqa: F401
+    except ImportError:
+        pass
+    else:
+        pytest.skip("pypdfium2 is installed")
+    with pytest.raises(ImportError, match="pypdfium2"):
+        DocumentReader(document_upload("PDF", [(72, 72)], "book.pdf"))
@@ -0,0 +1,132 @@
+# Tests for the near-duplicate page fingerprints and their index
+# Importing the required libraries
+import random
+from io import BytesIO
+
+import PIL.Image
+import PIL.ImageDraw
+import PIL.ImageEnhance
+import pytest
+
+from duplicate_pages import (
+    MAX_DHASH_DISTANCE,
+    MAX_PHASH_DISTANCE,
+    PageFingerprint,
+    PageIndex,
+    fingerprint_upload,
+    hamming_distances,
+    is_near_duplicate,
+    page_fingerprint,
+)
+
+PAGE_SIZE = (620, 877)
+
+
+# Function to draw a textbook-like page: the same header and two columns of word-like blocks on every
+# page, with only the block widths differing, as on the pages of one vocabulary list
+# seed: Random seed choosing the word widths
+# Returns: PIL image
+def make_page(seed):
+    rng = random.Random(seed)
+    image = PIL.Image.new("L", PAGE_SIZE, "white")
+    draw = PIL.ImageDraw.Draw(image)
+    draw.rectangle((50, 20, PAGE_SIZE[0] - 50, 40), fill=30)
+    for line in range(28):
+        top = 60 + line * 26
+        for column_left in (50, PAGE_SIZE[0] // 2 + 10):
+            left = column_left
+            for _ in range(3):
+                width = rng.randint(20, 70)
+                draw.rectangle((left, top, left + width, top + 12), fill=20)
+                left += width + 12
+    return image
+
+
+# Function to re-encode a page as a JPEG upload
+# Returns: BytesIO positioned at the start
+def to_jpeg(image, quality=85):
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    buffer.seek(0)
+    return buffer
+
+
+# Function to retake a page: cropped a little, darker and saved at a lower quality
+# Returns: BytesIO JPEG
+def retake(image, margin=10, brightness=0.85, quality=55):
+    width, height = image.size
+    cropped = image.crop((margin, margin, width - margin, height - margin))
+    return to_jpeg(PIL.ImageEnhance.Brightness(cropped).enhance(brightness), quality)
+
+
+def test_thresholds_keep_distinct_same_layout_pages_apart():
+    fingerprints = [fingerprint_upload(to_jpeg(make_page(seed))) for seed in range(30)]
+    closest = min(
+        hamming_distances(first, second)[0]
+        for position, first in enumerate(fingerprints)
+        for second in fingerprints[position + 1:]
+    )
+    # Pinned with a margin, so a change to the hashes or the defaults that brings same-layout pages
+    # within reach of each other fails here
+    assert closest > MAX_DHASH_DISTANCE * 1.5
+    assert not any(
+        is_near_duplicate(first, second)
+        for position, first in enumerate(fingerprints)
+        for second in fingerprints[position + 1:]
+    )
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_retakes_are_near_duplicates(seed):
+    page = make_page(seed)
+    original = fingerprint_upload(to_jpeg(page))
+    retaken = fingerprint_upload(retake(page))
+    dhash_distance, phash_distance = hamming_distances(original, retaken)
+    assert dhash_distance <= MAX_DHASH_DISTANCE
+    assert phash_distance <= MAX_PHASH_DISTANCE
+
+
+def test_fingerprint_upload_resets_the_position_and_ignores_non_images():
+    upload = to_jpeg(make_page(0))
+    upload.seek(10)
+    assert fingerprint_upload(upload) == page_fingerprint(PIL.Image.open(to_jpeg(make_page(0))))
+    assert upload.tell() == 0
+    assert fingerprint_upload(BytesIO(b"not an image")) is None
+
+
+def test_page_index_finds_the_closest_match_within_the_distances():
+    index = PageIndex()
+    base = PageFingerprint(dhash=0, phash=0)
+    index.add(base, "original")
+    # Differs in a few bits spread over several bands
+    near = PageFingerprint(dhash=(1 << 255) | (1 << 100) | 1, phash=0b11)
+    far = PageFingerprint(dhash=(1 << (MAX_DHASH_DISTANCE + 1)) - 1, phash=0)
+    assert index.find(near) == ("original", 3)
+    assert index.find(far) is None
+    assert index.find(PageFingerprint(dhash=0, phash=(1 << (MAX_PHASH_DISTANCE + 1)) - 1)) is None
+
+
+def test_page_index_find_or_add():
+    index = PageIndex()
+    fingerprint = PageFingerprint(dhash=12345, phash=678)
+    assert index.find_or_add(fingerprint, 1) is None
+    assert index.find_or_add(fingerprint, 2) == (1, 0)
+    assert len(index) == 1
+
+
+def test_page_index_persists_and_drops_the_oldest_entries(tmp_path):
+    path = str(tmp_path / "pages.sqlite3")
+    index = PageIndex(path=path, max_entries=2)
+    # Each entry sets a different quarter of the difference hash, so no two are near-duplicates
+    fingerprints = [PageFingerprint(dhash=((1 << 64) - 1) << (64 * value), phash=0) for value in range(3)]
+    for value, fingerprint in enumerate(fingerprints):
+        index.add(fingerprint, value)
+    index.close()
+
+    reopened = PageIndex(path=path, max_entries=2)
+    try:
+        assert len(reopened) == 2
+        assert reopened.find(fingerprints[0]) is None
+        assert reopened.find(fingerprints[2]) == (2, 0)
+    finally:
+        reopened.close()
@@ -0,0 +1,69 @@
+# Tests for the priority and per-user ordering of the shared page queue
+# Importing the required libraries
+from fair_scheduler import (
+    INTERACTIVE_BURST,
+    PRIORITY_BATCH,
+    PRIORITY_INTERACTIVE,
+    FairQueue,
+    priority_for_pages,
+)
+
+
+# Function to take every item of a queue
+# Returns: List of items in pop order
+def drain(queue):
+    items = []
+    while len(queue):
+        items.append(queue.pop())
+    return items
+
+
+def test_priority_for_pages():
+    assert priority_for_pages(1) == PRIORITY_INTERACTIVE
+    assert priority_for_pages(2) == PRIORITY_BATCH
+
+
+def test_empty_queue():
+    queue = FairQueue()
+    assert len(queue) == 0
+    assert queue.peek() is None
+    assert queue.pop() is None
+
+
+def test_users_take_turns_within_a_priority():
+    queue = FairQueue()
+    for page in range(4):
+        queue.push(("big", page), user_id="big")
+    queue.push(("small", 0), user_id="small")
+    queue.push(("small", 1), user_id="small")
+    # Each user's items stay in order, and the user with fewer items is not stuck behind the other
+    assert drain(queue) == [("big", 0), ("small", 0), ("big", 1), ("small", 1), ("big", 2), ("big", 3)]
+
+
+def test_interactive_items_go_first_but_batch_items_are_not_starved():
+    queue = FairQueue()
+    queue.push("batch", user_id="a", priority=PRIORITY_BATCH)
+    for item in range(INTERACTIVE_BURST + 2):
+        queue.push(item, user_id="b", priority=PRIORITY_INTERACTIVE)
+    assert queue.peek() == 0
+    order = drain(queue)
+    assert order[:INTERACTIVE_BURST] == list(range(INTERACTIVE_BURST))
+    assert order[INTERACTIVE_BURST] == "batch"
+    assert order[INTERACTIVE_BURST + 1:] == [INTERACTIVE_BURST, INTERACTIVE_BURST + 1]
+
+
+def test_remove_and_counts():
+    queue = FairQueue()
+    queue.push("a1", user_id="a")
+    queue.push("a2", user_id="a")
+    queue.push("b1", user_id="b")
+    queue.push("i1", user_id="a", priority=PRIORITY_INTERACTIVE)
+    assert queue.counts(PRIORITY_BATCH) == (3, 2)
+    assert queue.counts(PRIORITY_INTERACTIVE) == (1, 1)
+
+    queue.remove("b1", user_id="b")
+    queue.remove("missing", user_id="b")  # Ignored
+    queue.remove("i1", user_id="a", priority=PRIORITY_INTERACTIVE)
+    assert len(queue) == 2
+    assert queue.counts(PRIORITY_BATCH) == (2, 1)
+    assert drain(queue) == ["a1", "a2"]
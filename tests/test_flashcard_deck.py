@@ -0,0 +1,114 @@
+# Tests for the flashcard parsers, the de-duplicating deck and its exports
+# Importing the required libraries
+import json
+from io import StringIO
+
+import pytest
+
+from flashcard_deck import (
+    Flashcard,
+    FlashcardDeck,
+    FlashcardJsonStreamParser,
+    FlashcardStreamParser,
+    flashcard_key,
+    normalize_field,
+    parse_flashcards,
+    parse_flashcards_json,
+    write_flashcards,
+)
+
+CARDS = [
+    Flashcard("迷う", "まよう", "to get lost"),
+    Flashcard("道", "みち", "road, way\n(also: method)"),
+    Flashcard("コーヒー", "こーひー", "coffee"),
+]
+
+
+# Function to write cards as the CSV the flashcard prompts ask for
+# Returns: CSV text
+def to_csv(cards):
+    output = StringIO()
+    write_flashcards(cards, output)
+    return output.getvalue()
+
+
+def test_normalize_field_folds_width_katakana_and_spacing():
+    assert normalize_field("迷う [道に～]") == normalize_field("迷う［道に~］")
+    assert normalize_field("コーヒー") == normalize_field("こーひー")
+    assert normalize_field(" ＡＢＣ ") == "abc"
+    assert normalize_field(None) == ""
+
+
+def test_csv_round_trip_keeps_quoted_commas_and_line_breaks():
+    assert parse_flashcards(to_csv(CARDS)) == CARDS
+
+
+def test_parse_flashcards_skips_fences_and_the_header_and_rejects_bad_rows():
+    text = "```csv\nKanji,Furigana,English_Translation_and_Notes\n迷う,まよう,to get lost\nonly two,fields\n```"
+    parser = FlashcardStreamParser()
+    cards = parser.feed(text) + parser.close()
+    assert cards == [CARDS[0]]
+    assert parser.rejected == ["only two,fields"]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 1000])
+def test_csv_stream_parser_gives_the_same_cards_whatever_the_chunks(chunk_size):
+    text = to_csv(CARDS)
+    parser = FlashcardStreamParser()
+    cards = []
+    for position in range(0, len(text), chunk_size):
+        cards += parser.feed(text[position:position + chunk_size])
+    assert cards + parser.close() == CARDS
+
+
+def test_json_parser_validates_each_card_on_its_own():
+    objects = [
+        {"kanji": "迷う", "furigana": "まよう", "english_translation_and_notes": "to get lost"},
+        {"Kanji": "道", "Furigana": "みち", "English_Translation_and_Notes": "road, way\n(also: method)"},
+        {"kanji": "", "furigana": "から", "english_translation_and_notes": "empty kanji"},
+        {"kanji": "括弧", "furigana": "かっこ", "english_translation_and_notes": "brackets {like} \"these\""},
+    ]
+    text = "```json\n" + json.dumps(objects, ensure_ascii=False) + "\n```"
+    cards, rejected, count = parse_flashcards_json(text)
+    assert cards == [CARDS[0], CARDS[1], Flashcard("括弧", "かっこ", 'brackets {like} "these"')]
+    assert rejected == [json.dumps(objects[2], ensure_ascii=False)]
+    assert count == 4
+
+
+def test_json_parser_keeps_a_truncated_object_and_stray_text_for_repair():
+    text = '[{"kanji": "迷う", "furigana": "まよう", "english_translation_and_notes": "x"}, oops, {"kanji": "道", "fur'
+    parser = FlashcardJsonStreamParser()
+    cards = []
+    for char in text:
+        cards += parser.feed(char)
+    parser.close()
+    assert cards == [Flashcard("迷う", "まよう", "x")]
+    assert parser.rejected == [", oops,", '{"kanji": "道", "fur']
+    assert parser.objects == 2
+
+
+def test_deck_merges_duplicates_and_their_notes():
+    deck = FlashcardDeck()
+    assert deck.add_cards(CARDS, page_index=1) == 3
+    assert not deck.add(Flashcard("迷う", "マヨウ", "to hesitate"), page_index=2)
+    assert not deck.add(Flashcard("迷う", "まよう", "TO GET LOST"), page_index=3)
+    assert len(deck) == 3 and deck.duplicates == 2
+    assert Flashcard("コーヒー", "コーヒー", "") in deck
+    assert deck.cards()[0] == Flashcard("迷う", "まよう", "to get lost; to hesitate")
+    assert flashcard_key(deck.cards()[2]) == flashcard_key(CARDS[2])
+
+
+def test_deck_exports_in_insertion_order():
+    deck = FlashcardDeck()
+    deck.add_cards(reversed(CARDS))
+    assert parse_flashcards(deck.to_csv()) == list(reversed(CARDS))
+    rows = deck.to_tsv().split("\n")
+    assert rows[0] == '"コーヒー"\t"こーひー"\t"coffee"'
+
+
+def test_anki_export():
+    pytest.importorskip("genanki")
+    deck = FlashcardDeck()
+    deck.add_cards(CARDS)
+    package = deck.to_apkg_bytes()
+    assert package[:2] == b"PK"  # An .apkg file is a zip archive
@@ -0,0 +1,84 @@
+# Tests for the pre-encoding of page photos into the smaller Gemini and OCR inputs
+# Importing the required libraries
+import os
+from io import BytesIO
+
+import PIL.Image
+import pytest
+
+from image_preprocessing import (
+    LLM_IMAGE_PROFILE,
+    OCR_IMAGE_PROFILE,
+    describe_preprocessing,
+    encode_to_budget,
+    normalise_image,
+    preprocess_image_bytes,
+    preprocess_page,
+)
+
+
+# Function to make an image that compresses badly, like a detailed page photo
+# Returns: PIL Image of random grey pixels
+def noisy_image(size, mode="L"):
+    return PIL.Image.frombytes(mode, size, os.urandom(size[0] * size[1] * len(mode)))
+
+
+# Function to encode an image as an upload would arrive
+# Returns: Encoded bytes
+def encode(image, format="JPEG", **options):
+    buffer = BytesIO()
+    image.save(buffer, format=format, **options)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("target_bytes", [400 * 1024, 100 * 1024, 20 * 1024])
+def test_encode_to_budget_stays_within_the_target_bytes(target_bytes):
+    profile = dict(LLM_IMAGE_PROFILE, target_bytes=target_bytes)
+    encoded, quality, size = encode_to_budget(noisy_image((1600, 1600)), profile)
+    assert len(encoded) <= target_bytes
+    assert profile["min_quality"] <= quality <= profile["max_quality"]
+    # The reported size is the size of the encoded image
+    with PIL.Image.open(BytesIO(encoded)) as image:
+        assert image.size == size
+
+
+def test_encode_to_budget_keeps_the_resolution_when_the_quality_suffices():
+    image = PIL.Image.new("L", (800, 600), "white")
+    encoded, quality, size = encode_to_budget(image, LLM_IMAGE_PROFILE)
+    assert (quality, size) == (LLM_IMAGE_PROFILE["max_quality"], (800, 600))
+
+
+def test_normalise_image_caps_the_side_and_flattens_transparency():
+    image = PIL.Image.new("RGBA", (3200, 1600), (0, 0, 0, 0))
+    normalised = normalise_image(image, LLM_IMAGE_PROFILE)
+    assert normalised.mode == "L"
+    assert normalised.size == (LLM_IMAGE_PROFILE["max_side"], LLM_IMAGE_PROFILE["max_side"] // 2)
+    assert normalised.getpixel((0, 0)) == 255
+
+
+def test_large_photos_are_shrunk_and_rotated_upright():
+    photo = noisy_image((3000, 2000), "RGB")
+    exif = PIL.Image.Exif()
+    exif[0x0112] = 6  # Rotated 90 degrees clockwise
+    result = preprocess_image_bytes(encode(photo, quality=95, exif=exif), OCR_IMAGE_PROFILE)
+    assert result["encoded_bytes"] <= OCR_IMAGE_PROFILE["target_bytes"] < result["original_bytes"]
+    assert result["bytes_saved"] == result["original_bytes"] - result["encoded_bytes"]
+    width, height = result["size"]
+    assert height > width and max(result["size"]) <= OCR_IMAGE_PROFILE["max_side"]
+
+
+def test_a_small_upright_original_is_sent_as_it_is():
+    original = encode(noisy_image((200, 300)), quality=20)
+    result = preprocess_image_bytes(original, LLM_IMAGE_PROFILE)
+    assert result["bytes"] == original
+    assert result["quality"] is None and result["bytes_saved"] == 0
+
+
+def test_preprocess_page_prepares_both_inputs_and_reports_errors():
+    prepared = preprocess_page(encode(noisy_image((1200, 1600))))
+    assert set(prepared) == {"llm", "ocr"}
+    assert "KB for Gemini" in describe_preprocessing(3, prepared)
+
+    failed = preprocess_page(b"not an image")
+    assert set(failed) == {"error"}
+    assert describe_preprocessing(3, failed).startswith("Image #3: Preprocessing skipped")
@@ -0,0 +1,165 @@
+# Tests for the background generation jobs and their persistence across restarts
+# Importing the required libraries
+import threading
+from collections import namedtuple
+from io import BytesIO
+
+import pytest
+
+from flashcard_deck import Flashcard
+from job_store import JOB_DONE, JOB_FAILED, JOB_INTERRUPTED, JobStore
+
+CARD = Flashcard("迷う", "まよう", "to get lost")
+
+
+# Function to build a finished page as the pipeline reports it
+# Returns: Page result dictionary with the fields the job store and its metrics read
+def page_result(index, cards=(CARD,)):
+    return {
+        "index": index,
+        "flashcards": "",
+        "notes": [f"Image #{index}: Flashcards generated successfully."],
+        "cards": list(cards),
+        "suitability": {"is_suitable": "Yes", "reason": ""},
+        "timings": {"total": 0.1},
+        "error": None,
+        "error_stage": None,
+    }
+
+
+# Function standing in for generate_japanese_flashcards: one page per upload, with streamed text
+# Returns: Tuple (flashcards, notes)
+def fake_run(pages, on_event=None, deck=None, metrics=None, **options):
+    notes = []
+    for index, page in enumerate(pages, start=1):
+        on_event({"type": "cards", "index": index, "text": page.read().decode()})
+        result = page_result(index)
+        deck.add_cards(result["cards"], index)
+        notes += result["notes"]
+        on_event({"type": "page_done", "index": index, "result": result})
+    return "cards", notes
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.sqlite3"), max_workers=2)
+    yield store
+    store.close()
+
+
+def test_follow_replays_a_finished_job_without_the_streamed_text(store):
+    job_id = store.submit(fake_run, [BytesIO(b"page 1"), BytesIO(b"page 2")])
+    live_events = list(store.follow(job_id))
+    assert "page_done" in [event["type"] for event in live_events]
+    events = list(store.follow(job_id))
+    job = store.get(job_id)
+    assert job.status == JOB_DONE
+    assert [event["type"] for event in events] == ["page_done", "page_done", "done"]
+    assert events[-1]["flashcards"] == "cards" and len(events[-1]["notes"]) == 2
+    assert job.progress()["pages_done"] == 2
+    assert job.deck.cards() == [CARD]
+
+
+def test_options_are_kept_with_the_job(store):
+    Config = namedtuple("Config", ["speculative_ocr", "cache"])
+    job_id = store.submit(fake_run, [BytesIO(b"page")], max_workers=4, config=Config(True, object()))
+    list(store.follow(job_id))
+    # Only JSON-serialisable values are kept, including the fields of a namedtuple of options
+    assert store.get(job_id).options == {"max_workers": 4, "speculative_ocr": True}
+
+
+def test_failed_jobs_raise_when_followed(store):
+    def failing_run(pages, **kwargs):
+        raise ValueError("no pages")
+
+    job_id = store.submit(failing_run, [BytesIO(b"page")])
+    with pytest.raises(RuntimeError, match="no pages"):
+        list(store.follow(job_id))
+    assert store.get(job_id).status == JOB_FAILED
+    with pytest.raises(KeyError):
+        list(store.follow("unknown"))
+
+
+def test_finished_jobs_survive_a_restart(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    store = JobStore(path)
+    job_id = store.submit(fake_run, [BytesIO(b"page 1"), BytesIO(b"page 2")])
+    list(store.follow(job_id))
+    store.close()
+
+    restarted = JobStore(path)
+    job = restarted.get(job_id)
+    assert job.status == JOB_DONE
+    assert job.deck.cards() == [CARD]
+    assert [event["type"] for event in restarted.follow(job_id)] == ["page_done", "page_done", "done"]
+    restarted.close()
+
+
+def test_running_jobs_are_interrupted_by_a_restart(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    store = JobStore(path)
+    first_page_done = threading.Event()
+    release = threading.Event()
+
+    def slow_run(pages, on_event=None, **kwargs):
+        on_event({"type": "page_done", "index": 1, "result": page_result(1)})
+        first_page_done.set()
+        release.wait(10)
+        return "", []
+
+    job_id = store.submit(slow_run, [BytesIO(b"page 1"), BytesIO(b"page 2")])
+    assert first_page_done.wait(10)
+
+    # A second store on the same database stands in for the restarted server
+    restarted = JobStore(path)
+    job = restarted.get(job_id)
+    assert job.status == JOB_INTERRUPTED
+    assert job.progress()["pages_done"] == 1
+    with pytest.raises(RuntimeError):
+        list(restarted.follow(job_id))
+    restarted.close()
+    release.set()
+    list(store.follow(job_id))
+    store.close()
+
+
+def test_uploads_are_passed_to_the_run_without_a_copy(store):
+    uploads = [BytesIO(b"page 1"), BytesIO(b"page 2")]
+    received = []
+
+    def recording_run(pages, **kwargs):
+        received.extend(pages)
+        return "", []
+
+    list(store.follow(store.submit(recording_run, uploads)))
+    assert all(page is upload for page, upload in zip(received, uploads)) and len(received) == 2
+
+
+def test_low_memory_jobs_keep_only_the_page_status_in_their_events(store):
+    job_id = store.submit(fake_run, [BytesIO(b"page 1"), BytesIO(b"page 2")], low_memory=True)
+    list(store.follow(job_id))
+    job = store.get(job_id)
+    page_events = [event for event in job.events if event["type"] != "done"]
+    # The streamed text of the finished pages is dropped as well
+    assert page_events == [
+        {"type": "cards", "index": 1, "text": ""},
+        {"type": "page_done", "index": 1, "status": "done"},
+        {"type": "cards", "index": 2, "text": ""},
+        {"type": "page_done", "index": 2, "status": "done"},
+    ]
+    page = store.page_result(job_id, 2)
+    assert page["index"] == 2 and page["cards"] == [CARD]
+    assert store.page_result(job_id, 3) is None
+
+
+def test_followers_notice_a_worker_that_stopped_without_finishing(store, monkeypatch):
+    monkeypatch.setattr("job_store.FOLLOW_WAIT_SECONDS", 0.01)
+
+    def dying_run(pages, **kwargs):
+        # Escapes the job's error handling, as a crashing worker would
+        raise SystemExit("worker stopped")
+
+    job_id = store.submit(dying_run, [BytesIO(b"page")])
+    with pytest.raises(RuntimeError, match="worker stopped"):
+        list(store.follow(job_id))
+    assert store.get(job_id).status == JOB_FAILED
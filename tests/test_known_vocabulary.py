@@ -0,0 +1,98 @@
+# Tests for the known-vocabulary filter over OCR text and generated cards
+# Importing the required libraries
+import sqlite3
+import zipfile
+from io import BytesIO
+
+import pytest
+
+from flashcard_deck import Flashcard
+from known_vocabulary import KnownVocabulary, headword_key, load_known_vocabulary, read_cards_from_text
+
+KNOWN = [
+    Flashcard("迷う [道に～]", "まよう", "to get lost"),
+    Flashcard("立派[な]", "りっぱ", "splendid"),
+    Flashcard("は", "は", "topic particle"),
+]
+
+
+@pytest.fixture
+def known():
+    return KnownVocabulary(KNOWN)
+
+
+def test_headword_key_drops_annotations():
+    assert headword_key("迷う [道に～]") == headword_key("迷う")
+    assert headword_key("立派[な]") == headword_key("立派")
+    assert headword_key(None) == ""
+
+
+def test_cards_match_on_headword_and_reading(known):
+    assert len(known) == 3
+    assert Flashcard("迷う", "まよう", "to hesitate") in known
+    assert Flashcard("迷う", "マヨウ", "") in known
+    assert Flashcard("迷う", "めいう", "") not in known
+    kept, removed = known.filter_cards([Flashcard("立派", "りっぱ", ""), Flashcard("道", "みち", "road")])
+    assert kept == [Flashcard("道", "みち", "road")]
+    assert removed == [Flashcard("立派", "りっぱ", "")]
+
+
+def test_headwords_match_whole_words_only(known):
+    assert known.is_known_headword(headword_key("迷う"))
+    assert not known.is_known_headword(headword_key("迷"))
+    assert not known.is_known_headword(headword_key("迷うな"))
+    # Single kana are too short to match inside OCR text
+    assert not known.is_known_headword("は")
+
+
+def test_filter_ocr_text_blanks_known_entries_and_keeps_the_rest_of_the_line(known):
+    ocr_text = "\n".join([
+        "迷う まよう to get lost",
+        "迷う まよう to get lost    道 みち road",
+        "道に迷うと困ります。",
+        "迷うと困ります。",
+    ])
+    filtered, removed = known.filter_ocr_text(ocr_text)
+    lines = filtered.split("\n")
+    # A line left empty is dropped; the unknown entry sharing a line keeps its column
+    assert len(lines) == 3
+    assert lines[0].strip() == "道 みち road"
+    assert lines[0].index("道") == ocr_text.split("\n")[1].index("道")
+    # Example sentences are kept even when they start with a known word
+    assert lines[1:] == ["道に迷うと困ります。", "迷うと困ります。"]
+    assert removed == ["迷う まよう to get lost", "迷う まよう to get lost"]
+
+
+def test_read_cards_from_text_detects_the_delimiter_and_skips_headers():
+    csv_text = "Kanji,Furigana,English\n迷う, まよう, to get lost\n# comment\nonly one field\n"
+    assert read_cards_from_text(csv_text) == [Flashcard("迷う", "まよう", "to get lost")]
+    tsv_text = "道\tみち\n立派\tりっぱ\tsplendid, fine"
+    assert read_cards_from_text(tsv_text) == [Flashcard("道", "みち", ""), Flashcard("立派", "りっぱ", "splendid, fine")]
+
+
+def test_load_known_vocabulary_from_a_path_bytes_and_an_anki_package(tmp_path):
+    path = tmp_path / "deck.csv"
+    path.write_text("迷う,まよう,to get lost\n", encoding="utf-8")
+    assert Flashcard("迷う", "まよう", "") in load_known_vocabulary(str(path))
+    assert Flashcard("迷う", "まよう", "") in load_known_vocabulary("\ufeff迷う,まよう\n".encode("utf-8"), filename="deck.csv")
+
+    collection = tmp_path / "collection.anki2"
+    connection = sqlite3.connect(collection)
+    connection.execute("CREATE TABLE notes (flds TEXT)")
+    connection.execute("INSERT INTO notes VALUES (?)", ("<b>道</b>\x1fみち\x1froad",))
+    connection.commit()
+    connection.close()
+    package = BytesIO()
+    with zipfile.ZipFile(package, "w") as archive:
+        archive.write(collection, "collection.anki2")
+    package.seek(0)
+    package.name = "deck.apkg"
+    assert Flashcard("道", "みち", "") in load_known_vocabulary(package)
+
+
+def test_unsupported_anki_packages_are_rejected():
+    package = BytesIO()
+    with zipfile.ZipFile(package, "w") as archive:
+        archive.writestr("collection.anki21b", b"zstd")
+    with pytest.raises(ValueError):
+        load_known_vocabulary(package.getvalue(), filename="deck.apkg")
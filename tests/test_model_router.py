@@ -0,0 +1,109 @@
+# Tests for the tiered models of each stage and the checks that escalate their answers
+# Importing the required libraries
+import pytest
+
+from app import PipelineConfig, process_pages
+from benchmarks.fake_backends import FakeGenerativeModel, make_fake_resources, make_fake_router, make_synthetic_pages
+from benchmarks.run_benchmarks import make_unthrottled_limiter
+from model_router import (
+    ESCALATE_CARD_COUNT,
+    ESCALATE_REJECTED,
+    MIN_RATIO_LINES,
+    ModelRouter,
+    build_model_router,
+    japanese_line_count,
+    parse_model_names,
+    short_model_name,
+    token_cost,
+)
+from result_cache import FLASHCARD_STAGE, SUITABILITY_STAGE
+from token_budget import TokenBudgetPlanner
+
+
+class NamedModel:
+    def __init__(self, model_name):
+        self.model_name = model_name
+
+
+# Function to make OCR text with a number of Japanese lines
+# Returns: Text with that many vocabulary lines and a line of English
+def japanese_lines(count):
+    return "\n".join([f"語{line}    ご{line}" for line in range(count)] + ["Chapter 3"])
+
+
+def test_model_names_and_prices():
+    assert parse_model_names(" gemini-2.0-flash-lite, ,gemini-2.0-flash ") == ("gemini-2.0-flash-lite", "gemini-2.0-flash")
+    assert parse_model_names(None) == ()
+    assert short_model_name("models/gemini-2.0-flash") == "gemini-2.0-flash"
+    assert token_cost("models/gemini-2.0-flash", {"prompt": 1_000_000, "candidates": 1_000_000}) == pytest.approx(0.5)
+    assert token_cost("unknown-model", {"prompt": 1000}) == 0.0
+    assert token_cost("gemini-2.0-flash", None) == 0.0
+
+
+def test_japanese_line_count_ignores_lines_without_kana_or_kanji():
+    assert japanese_line_count(japanese_lines(3)) == 3
+    assert japanese_line_count("カタカナ\nhiragana\n漢字") == 2
+    assert japanese_line_count(None) == 0
+
+
+def test_every_stage_needs_a_model():
+    with pytest.raises(ValueError):
+        ModelRouter({SUITABILITY_STAGE: [NamedModel("a")], FLASHCARD_STAGE: []})
+
+
+def test_dense_pages_start_on_the_strongest_flashcard_model():
+    models = [NamedModel("lite"), NamedModel("flash")]
+    router = ModelRouter({SUITABILITY_STAGE: models, FLASHCARD_STAGE: models}, hard_page_lines=10)
+    assert router.start_tier(FLASHCARD_STAGE, japanese_lines(10)) == 0
+    assert router.start_tier(FLASHCARD_STAGE, japanese_lines(11)) == 1
+    assert router.start_tier(SUITABILITY_STAGE, japanese_lines(11)) == 0
+    assert router.fingerprint(FLASHCARD_STAGE) == "lite,flash"
+
+
+def test_rejections_are_confirmed_only_when_asked():
+    tiers = {SUITABILITY_STAGE: [NamedModel("a")], FLASHCARD_STAGE: [NamedModel("a")]}
+    assert ModelRouter(tiers, confirm_rejections=True).suitability_signal({"is_suitable": "No"}) == ESCALATE_REJECTED
+    assert ModelRouter(tiers, confirm_rejections=True).suitability_signal({"is_suitable": "Yes"}) is None
+    assert ModelRouter(tiers, confirm_rejections=False).suitability_signal({"is_suitable": "No"}) is None
+
+
+def test_card_counts_far_off_the_page_lines_are_escalated():
+    router = ModelRouter({SUITABILITY_STAGE: [NamedModel("a")], FLASHCARD_STAGE: [NamedModel("a")]})
+    ocr_text = japanese_lines(20)
+    assert router.flashcard_signal(20, ocr_text) is None
+    assert router.flashcard_signal(2, ocr_text) == ESCALATE_CARD_COUNT
+    assert router.flashcard_signal(200, ocr_text) == ESCALATE_CARD_COUNT
+    # Pages with few lines are not checked
+    assert router.flashcard_signal(0, japanese_lines(MIN_RATIO_LINES - 1)) is None
+
+
+def test_build_model_router_shares_the_models_of_both_stages():
+    made = []
+
+    def make_model(name):
+        made.append(name)
+        return NamedModel(name)
+
+    router = build_model_router(make_model, "gemini-2.0-flash", "gemini-2.0-flash-lite,gemini-2.0-flash", "")
+    assert made == ["gemini-2.0-flash-lite", "gemini-2.0-flash"]
+    assert router.models(FLASHCARD_STAGE) == [router.models(SUITABILITY_STAGE)[1]]
+
+
+def test_weak_answers_and_rejections_are_passed_up_to_the_stronger_model():
+    model = FakeGenerativeModel(suitable_rate=1.0)
+    # The cheaper model writes a fifth of the cards and rejects every page
+    router = make_fake_router(model, false_reject_rate=1.0, short_answer_rate=1.0, confirm_rejections=True)
+    config = PipelineConfig(
+        rate_limiter=make_unthrottled_limiter(1), token_planner=TokenBudgetPlanner(budget=0, suitability_budget=0)
+    )
+    pages = enumerate(make_synthetic_pages(2), start=1)
+    for page_result in process_pages(pages, make_fake_resources(model=model, router=router), config):
+        attempts = [(attempt["stage"], attempt["model"], attempt["escalation"]) for attempt in page_result["models"]]
+        assert attempts == [
+            (SUITABILITY_STAGE, "gemini-2.0-flash-lite", ESCALATE_REJECTED),
+            (SUITABILITY_STAGE, "fake-gemini", None),
+            (FLASHCARD_STAGE, "gemini-2.0-flash-lite", ESCALATE_CARD_COUNT),
+            (FLASHCARD_STAGE, "fake-gemini", None),
+        ]
+        assert page_result["suitability"]["is_suitable"] == "Yes"
+        assert len(page_result["cards"]) == model.cards_per_page
@@ -0,0 +1,87 @@
+# Tests for the shared poller tracking LLMWhisperer extractions submitted without waiting
+# Importing the required libraries
+import threading
+
+import pytest
+
+from benchmarks.run_benchmarks import make_unthrottled_limiter
+from ocr_poller import OcrExtractionError, WhisperPoller
+
+
+class ScriptedClient:
+    """Stand-in for LLMWhispererClientV2 answering each hash's status checks from a script."""
+
+    def __init__(self, statuses):
+        # whisper_hash -> statuses returned by successive checks; the last one repeats
+        self.statuses = statuses
+        self.checks = {whisper_hash: 0 for whisper_hash in statuses}
+        self.lock = threading.Lock()
+
+    def whisper_status(self, whisper_hash):
+        with self.lock:
+            script = self.statuses[whisper_hash]
+            status = script[min(self.checks[whisper_hash], len(script) - 1)]
+            self.checks[whisper_hash] += 1
+        return {"status_code": 200, "status": status, "message": f"{whisper_hash} {status}"}
+
+    def whisper_retrieve(self, whisper_hash):
+        return {"status_code": 200, "extraction": {"result_text": f"text of {whisper_hash}"}}
+
+
+@pytest.fixture
+def poller():
+    return WhisperPoller(min_interval=0.01, max_interval=0.02, timeout=5, rate_limiter=make_unthrottled_limiter(4))
+
+
+def test_extractions_are_retrieved_once_processed(poller):
+    client = ScriptedClient({"a": ["processing", "processing", "processed"], "b": ["processed"]})
+    futures = {whisper_hash: poller.track(client, whisper_hash) for whisper_hash in ("a", "b")}
+    for whisper_hash, future in futures.items():
+        message = future.result(timeout=5)
+        assert message["extraction"]["result_text"] == f"text of {whisper_hash}"
+        assert "finished_at" in message
+    assert client.checks == {"a": 3, "b": 1}
+    stats = poller.stats()
+    assert (stats["completed"], stats["failed"], stats["in_flight"]) == (2, 0, 0)
+    assert stats["status_checks"] == 4 and stats["expected_seconds"] is not None
+
+
+def test_failed_and_late_extractions_raise_through_their_futures():
+    poller = WhisperPoller(min_interval=0.01, max_interval=0.02, timeout=0.1, rate_limiter=make_unthrottled_limiter(4))
+    client = ScriptedClient({"failed": ["processing", "error"], "late": ["processing"]})
+    with pytest.raises(OcrExtractionError, match="failed error"):
+        poller.track(client, "failed").result(timeout=5)
+    with pytest.raises(TimeoutError):
+        poller.track(client, "late").result(timeout=5)
+    assert poller.stats()["failed"] == 2
+
+
+def test_submit_resolves_synchronous_answers_without_polling(poller):
+    client = ScriptedClient({})
+    future = poller.submit(client, lambda: {"status_code": 200, "extraction": {"result_text": "at once"}})
+    assert future.result(timeout=1)["extraction"]["result_text"] == "at once"
+    with pytest.raises(OcrExtractionError, match="quota"):
+        poller.submit(client, lambda: {"status_code": 402, "message": "quota"}).result(timeout=1)
+    assert poller.stats()["submitted"] == 0
+
+
+def test_cancelled_extractions_are_no_longer_polled(poller):
+    client = ScriptedClient({"a": ["processing"]})
+    assert poller.track(client, "a").cancel()
+    poller.track(ScriptedClient({"b": ["processed"]}), "b").result(timeout=5)
+    assert client.checks["a"] == 0
+    assert poller.stats()["cancelled"] == 1
+
+
+def test_an_unexpected_error_fails_its_sweep_and_the_poller_carries_on(poller, monkeypatch):
+    def broken_check(extraction):
+        raise AssertionError("broken sweep")
+
+    monkeypatch.setattr(poller, "_check", broken_check)
+    with pytest.raises(AssertionError, match="broken sweep"):
+        poller.track(ScriptedClient({"a": ["processed"]}), "a").result(timeout=5)
+    monkeypatch.undo()
+
+    future = poller.track(ScriptedClient({"b": ["processed"]}), "b")
+    assert future.result(timeout=5)["extraction"]["result_text"] == "text of b"
+    assert poller.stats()["in_flight"] == 0
@@ -0,0 +1,100 @@
+# Tests for cutting dense pages into overlapping tiles and slicing their OCR text
+# Importing the required libraries
+import PIL.Image
+import PIL.ImageDraw
+
+from flashcard_deck import Flashcard
+from page_tiling import (
+    COLUMN_LAYOUT,
+    MAX_TILES,
+    MIN_TILE_TEXT_CHARACTERS,
+    ROW_LAYOUT,
+    TILE_MIN_CHARACTERS,
+    TILE_TARGET_CHARACTERS,
+    VERTICAL_LAYOUT,
+    Tile,
+    merge_tile_cards,
+    plan_tiles,
+    tile_count,
+    tile_text,
+)
+
+PAGE_SIZE = (600, 800)
+
+
+# Function to draw a page of text-like lines
+# columns: (left, right) pixel ranges of the columns of lines
+# Returns: PIL Image with a line of "words" every 30 pixels in each column
+def lined_page(columns):
+    image = PIL.Image.new("L", PAGE_SIZE, "white")
+    draw = PIL.ImageDraw.Draw(image)
+    for left, right in columns:
+        for top in range(40, PAGE_SIZE[1] - 40, 30):
+            draw.rectangle((left, top, right, top + 14), fill="black")
+    return image
+
+
+def test_tile_count_grows_with_the_text_up_to_the_maximum():
+    assert tile_count(None) == 1
+    assert tile_count("x" * (TILE_MIN_CHARACTERS - 1)) == 1
+    assert tile_count("x" * max(TILE_MIN_CHARACTERS, 2 * TILE_TARGET_CHARACTERS)) >= 2
+    assert tile_count("x" * 100 * TILE_TARGET_CHARACTERS) == MAX_TILES
+
+
+def test_a_single_tile_or_a_blank_page_is_the_whole_page():
+    whole_page = [Tile((0, 0) + PAGE_SIZE, (0.0, 1.0), (0.0, 1.0))]
+    assert plan_tiles(lined_page([(40, 560)]), 1) == (ROW_LAYOUT, whole_page)
+    assert plan_tiles(PIL.Image.new("L", PAGE_SIZE, "white"), 3) == (ROW_LAYOUT, whole_page)
+
+
+def test_a_single_column_is_cut_into_overlapping_bands_of_rows():
+    layout, tiles = plan_tiles(lined_page([(40, 560)]), 3)
+    assert layout == ROW_LAYOUT and len(tiles) == 3
+    assert all(tile.box[0] == 0 and tile.box[2] == PAGE_SIZE[0] for tile in tiles)
+    # The bands cover the page from top to bottom and overlap at every cut
+    assert tiles[0].box[1] == 0 and tiles[-1].box[3] == PAGE_SIZE[1]
+    assert all(upper.box[3] > lower.box[1] for upper, lower in zip(tiles, tiles[1:]))
+
+
+def test_a_two_column_list_is_cut_at_its_gutter():
+    layout, tiles = plan_tiles(lined_page([(40, 260), (340, 560)]), 2)
+    assert layout == COLUMN_LAYOUT and len(tiles) == 2
+    left, right = tiles
+    assert left.box[0] == 0 and right.box[2] == PAGE_SIZE[0]
+    # The cut falls in the gutter, so no word of either column is split
+    assert 260 <= right.box[0] and left.box[2] <= 340
+
+
+def test_vertical_text_is_cut_between_its_lines_from_right_to_left():
+    image = PIL.Image.new("L", PAGE_SIZE, "white")
+    draw = PIL.ImageDraw.Draw(image)
+    # Lines of characters set close together from the top of the page down, of uneven lengths
+    for line, left in enumerate(range(40, PAGE_SIZE[0] - 40, 30)):
+        draw.rectangle((left, 40, left + 14, PAGE_SIZE[1] - 40 - 60 * (line % 3)), fill="black")
+    layout, tiles = plan_tiles(image, 2)
+    assert layout == VERTICAL_LAYOUT and len(tiles) == 2
+    assert tiles[0].box[0] > tiles[1].box[0]
+    assert tile_text("縦書き", layout, tiles[0]) == "縦書き"
+
+
+def test_tile_text_takes_the_tile_share_of_the_lines_and_columns():
+    lines = [f"左{row:02d} left word entry      右{row:02d} right word entry" for row in range(20)]
+    ocr_text = "\n".join(lines)
+    top_left = tile_text(ocr_text, COLUMN_LAYOUT, Tile((0, 0, 300, 400), (0.0, 0.5), (0.0, 0.5)))
+    assert top_left.splitlines() == [line.split("      ")[0] for line in lines[:10]]
+    bottom_right = tile_text(ocr_text, COLUMN_LAYOUT, Tile((300, 400, 600, 800), (0.5, 1.0), (0.5, 1.0)))
+    assert [line.strip() for line in bottom_right.splitlines()] == [line.split("      ")[1] for line in lines[10:]]
+
+
+def test_a_slice_too_short_to_trust_falls_back_to_the_full_text():
+    ocr_text = "短い\n" + "x" * (MIN_TILE_TEXT_CHARACTERS * 2)
+    assert tile_text(ocr_text, ROW_LAYOUT, Tile((0, 0, 600, 400), (0.0, 1.0), (0.0, 0.5))) == ocr_text
+
+
+def test_merge_tile_cards_keeps_reading_order_and_merges_the_overlap():
+    first = [Flashcard("迷う", "まよう", "to get lost"), Flashcard("道", "みち", "road")]
+    second = [Flashcard("道", "みち", "way"), Flashcard("立派", "りっぱ", "splendid")]
+    cards, duplicates = merge_tile_cards([first, second])
+    assert [card.kanji for card in cards] == ["迷う", "道", "立派"]
+    assert cards[1].english_translation_and_notes == "road; way"
+    assert duplicates == 1
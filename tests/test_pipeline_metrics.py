@@ -0,0 +1,154 @@
+# Tests for the per-page pipeline metrics and their JSON and Prometheus exports
+# Importing the required libraries
+import json
+from types import SimpleNamespace
+
+import PIL.Image
+import pytest
+
+from pipeline_metrics import (
+    ENCODED_BYTES_INFO_KEY,
+    LATENCY_BUCKETS,
+    PipelineMetrics,
+    page_status,
+    plan_outcome,
+    read_usage,
+    request_bytes,
+)
+
+
+# Function to build a token plan entry like TokenBudgetPlanner.record returns
+# Returns: Dictionary with the fields the metrics read
+def token_plan(stage, calibrated, reported, over_budget=False, examples=None):
+    return {
+        "stage": stage, "over_budget": over_budget, "examples": examples, "example_side": None,
+        "page_side": None, "calibrated": calibrated, "reported": reported,
+    }
+
+
+# Function to build a finished page result like process_single_image returns
+# Returns: Dictionary with the keys the metrics read, overridden by the keyword arguments
+def page_result(index, **fields):
+    result = {
+        "index": index,
+        "error": None,
+        "error_stage": None,
+        "suitability": {"is_suitable": "Yes"},
+        "timings": {"suitability": 0.4, "ocr": 1.5, "flashcards": 3.0, "total": 4.9},
+        "bytes_uploaded": {"suitability": 2048, "flashcards": 4096},
+        "tokens": {"suitability": {"prompt": 300, "candidates": 20}, "flashcards": {"prompt": 900, "candidates": 400}},
+        "retries": {},
+        "repairs": {},
+        "prefix_cache": {},
+        "models": [{
+            "stage": "flashcards", "model": "gemini-2.0-flash", "seconds": 3.0,
+            "tokens": {"prompt": 900, "candidates": 400}, "cost": 0.0003, "escalation": None,
+        }],
+        "token_plans": [token_plan("flashcards", 950, 900)],
+        "duplicate": None,
+        "cached_stages": [],
+    }
+    result.update(fields)
+    return result
+
+
+def test_request_bytes_counts_text_the_page_and_the_encoded_examples():
+    page = PIL.Image.new("L", (10, 10))
+    example = PIL.Image.new("L", (10, 10))
+    example.info[ENCODED_BYTES_INFO_KEY] = 700
+    assert request_bytes(["日本", page, example, PIL.Image.new("L", (1, 1))], page_bytes=5000, page_image=page) == 5706
+
+
+def test_read_usage_defaults_missing_counts_to_zero():
+    usage = SimpleNamespace(prompt_token_count=120, candidates_token_count=None)
+    assert read_usage(SimpleNamespace(usage_metadata=usage)) == {"prompt": 120, "candidates": 0, "cached": 0}
+    assert read_usage(SimpleNamespace()) is None
+
+
+def test_pages_and_plans_are_classified():
+    assert page_status(page_result(1)) == "done"
+    assert page_status(page_result(1, suitability={"is_suitable": "No"})) == "not_suitable"
+    assert page_status(page_result(1, error="Quota exceeded")) == "error"
+    assert plan_outcome(token_plan("flashcards", 1, 1)) == "full"
+    assert plan_outcome(token_plan("flashcards", 1, 1, examples=2)) == "reduced"
+    assert plan_outcome(token_plan("flashcards", 1, 1, over_budget=True, examples=0)) == "over_budget"
+
+
+def test_totals_add_up_every_page():
+    metrics = PipelineMetrics()
+    metrics.add_page(page_result(2, retries={"flashcards": 2}))
+    metrics.add_page(page_result(
+        1,
+        models=[
+            {"stage": "flashcards", "model": "gemini-2.0-flash-lite", "seconds": 1.0, "tokens": {"prompt": 900},
+             "cost": 0.0001, "escalation": "card_count"},
+            {"stage": "flashcards", "model": "gemini-2.0-flash", "seconds": 3.0, "tokens": {"prompt": 900},
+             "cost": 0.0003, "escalation": None},
+        ],
+        token_plans=[token_plan("flashcards", 950, None, over_budget=True)],
+    ))
+    metrics.add_page(page_result(
+        3, timings={"total": 0.01}, bytes_uploaded={}, tokens={}, models=[], token_plans=[],
+        duplicate={"of": 1, "calls_avoided": 3}, cached_stages=["ocr"],
+    ))
+    metrics.add_page(page_result(
+        4, error="Quota exceeded", error_stage="ocr", timings={}, bytes_uploaded={}, tokens={}, models=[], token_plans=[],
+    ))
+
+    totals = metrics.totals()
+    assert totals["pages"] == 4
+    assert totals["status"] == {"done": 3, "error": 1}
+    assert totals["mean_seconds"]["flashcards"] == pytest.approx(3.0)
+    assert totals["bytes_uploaded"] == {"suitability": 4096, "flashcards": 8192}
+    assert totals["tokens"]["flashcards"] == {"prompt": 1800, "candidates": 800}
+    assert totals["retries"] == {"flashcards": 2}
+    assert totals["models"]["flashcards"]["gemini-2.0-flash"]["attempts"] == 2
+    assert totals["models"]["flashcards"]["gemini-2.0-flash-lite"]["escalations"] == {"card_count": 1}
+    assert totals["token_plans"]["flashcards"] == {
+        "calls": 2, "full": 1, "reduced": 0, "over_budget": 1, "predicted": 1900, "reported": 900,
+    }
+    assert totals["duplicates"] == {"pages": 1, "calls_avoided": 3, "by_source": {"run": {"pages": 1, "calls_avoided": 3}}}
+    assert totals["cache_hits"] == {"ocr": 1}
+    assert totals["errors"] == {"ocr": 1}
+    assert [row["page"] for row in metrics.pages()] == [1, 2, 3, 4]
+    assert json.loads(metrics.to_json())["totals"]["pages"] == 4
+
+
+def test_summary_rows_flatten_each_page():
+    metrics = PipelineMetrics()
+    metrics.add_page(page_result(1, retries={"suitability": 1, "flashcards": 2}))
+    metrics.add_page(page_result(2, duplicate={"of": None, "calls_avoided": 3}, cached_stages=["suitability", "ocr"]))
+    metrics.add_page(page_result(3, error="Quota exceeded", error_stage="flashcards"))
+    first, second, third = metrics.summary_rows()
+    assert (first["Uploaded KB"], first["Prompt tokens"], first["Output tokens"]) == (6.0, 1200, 420)
+    assert (first["Retries"], first["Models"], first["Predicted tokens"]) == (3, "gemini-2.0-flash", 950)
+    assert (second["Duplicate of"], second["Cached"]) == ("earlier run", "suitability, ocr")
+    assert third["Status"] == "error (flashcards)"
+
+
+def test_metrics_without_page_rows_still_keep_the_totals():
+    metrics = PipelineMetrics(keep_pages=False)
+    row = metrics.add_page(page_result(1))
+    assert row["page"] == 1
+    assert metrics.pages() == [] and metrics.summary_rows() == []
+    assert metrics.totals()["pages"] == 1
+
+
+def test_prometheus_export_counts_the_histogram_buckets_and_escapes_labels():
+    metrics = PipelineMetrics()
+    metrics.add_page(page_result(1))
+    metrics.record_script_run(2.5)
+    metrics.record_script_run(0.5)
+    lines = metrics.to_prometheus(labels={"deployment": 'shelf "A"\\1'}).splitlines()
+    label = 'deployment="shelf \\"A\\"\\\\1"'
+
+    assert "# TYPE flashcard_pipeline_stage_seconds histogram" in lines
+    assert f'flashcard_pipeline_pages_total{{{label},status="done"}} 1' in lines
+    # Buckets are cumulative: the 3 second flashcard stage is in every bucket from 5 seconds up
+    buckets = [line for line in lines if line.startswith("flashcard_pipeline_stage_seconds_bucket") and '"flashcards"' in line]
+    assert [line.rsplit(" ", 1)[1] for line in buckets] == [
+        "1" if bound >= 3.0 else "0" for bound in LATENCY_BUCKETS
+    ] + ["1"]
+    assert f'flashcard_pipeline_tokens_total{{{label},kind="prompt",stage="flashcards"}} 900' in lines
+    assert f'flashcard_pipeline_first_paint_seconds{{{label},run="cold_start"}} 2.5' in lines
+    assert f"flashcard_pipeline_script_runs_total{{{label}}} 2" in lines
@@ -0,0 +1,175 @@
+# Tests for the registration, refresh and invalidation of cached few-shot prefixes, and their races
+# Importing the required libraries
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from prefix_cache import PrefixCache
+
+PREFIX = ["system prompt", "example answer"]
+
+
+class BlockingBackend:
+    """Context cache backend whose create and refresh calls can be held until the test releases them."""
+
+    def __init__(self, fail_create=False):
+        self.fail_create = fail_create
+        self.release = threading.Event()
+        self.release.set()
+        self.entered = threading.Event()
+        self.lock = threading.Lock()
+        self.created = []
+        self.refreshed = []
+        self.deleted = []
+
+    def create(self, model, contents, ttl):
+        self.entered.set()
+        self.release.wait(10)
+        if self.fail_create:
+            raise RuntimeError("model does not support caching")
+        with self.lock:
+            handle = f"cached-{len(self.created) + 1}"
+            self.created.append(handle)
+        return handle, f"{model} with {handle}"
+
+    def refresh(self, handle, ttl):
+        self.entered.set()
+        self.release.wait(10)
+        with self.lock:
+            self.refreshed.append(handle)
+
+    def delete(self, handle):
+        with self.lock:
+            self.deleted.append(handle)
+
+
+# Function to start a registration that the backend holds until released
+# Returns: Tuple (PrefixCache, backend, future of the registering model_for call)
+def held_registration(executor, **options):
+    backend = BlockingBackend()
+    backend.release.clear()
+    cache = PrefixCache(backend, **options)
+    registering = executor.submit(cache.model_for, "model", "key", PREFIX)
+    assert backend.entered.wait(10)
+    return cache, backend, registering
+
+
+def test_the_prefix_is_registered_once_and_reused():
+    backend = BlockingBackend()
+    cache = PrefixCache(backend)
+    assert cache.model_for("model", "key", PREFIX) == "model with cached-1"
+    assert cache.model_for("model", "key", PREFIX) == "model with cached-1"
+    assert cache.model_for("model", "other", PREFIX) == "model with cached-2"
+    stats = cache.stats()
+    assert (stats["created"], stats["prefixes"]) == (2, 2)
+
+
+def test_concurrent_callers_send_the_prefix_inline_while_it_is_registered():
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        cache, backend, registering = held_registration(executor)
+        # The other pages do not wait for the registration round trip, and do not start one of their own
+        assert [cache.model_for("model", "key", PREFIX) for _ in range(5)] == [None] * 5
+        backend.release.set()
+        assert registering.result(10) == "model with cached-1"
+    assert backend.created == ["cached-1"]
+    assert cache.model_for("model", "key", PREFIX) == "model with cached-1"
+
+
+def test_many_threads_register_a_prefix_only_once():
+    backend = BlockingBackend()
+    cache = PrefixCache(backend)
+    start = threading.Barrier(8)
+
+    def call():
+        start.wait(10)
+        return cache.model_for("model", "key", PREFIX)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        models = list(executor.map(lambda _: call(), range(8)))
+    assert backend.created == ["cached-1"]
+    assert set(models) <= {None, "model with cached-1"} and "model with cached-1" in models
+
+
+def test_a_prefix_registered_during_clear_is_deleted_not_kept():
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        cache, backend, registering = held_registration(executor)
+        cache.clear()
+        backend.release.set()
+        assert registering.result(10) is None
+    assert backend.deleted == ["cached-1"]
+    assert cache.stats()["prefixes"] == 0
+
+
+def test_a_closed_cache_deletes_its_prefixes_and_registers_no_more():
+    backend = BlockingBackend()
+    cache = PrefixCache(backend)
+    cache.model_for("model", "key", PREFIX)
+    cache.close()
+    assert backend.deleted == ["cached-1"]
+    assert cache.model_for("model", "key", PREFIX) is None
+    assert backend.created == ["cached-1"]
+
+
+def test_a_failed_registration_is_retried_only_after_the_delay(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("prefix_cache.time.monotonic", lambda: now[0])
+    backend = BlockingBackend(fail_create=True)
+    cache = PrefixCache(backend, retry=60)
+    assert cache.model_for("model", "key", PREFIX) is None
+    assert cache.stats()["failed"] == 1 and "caching" in cache.last_error
+    now[0] += 30
+    assert cache.model_for("model", "key", PREFIX) is None
+    assert cache.stats()["failed"] == 1
+
+    backend.fail_create = False
+    now[0] += 31
+    assert cache.model_for("model", "key", PREFIX) == "model with cached-1"
+
+
+def test_a_prefix_close_to_expiring_is_refreshed_by_one_caller(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("prefix_cache.time.monotonic", lambda: now[0])
+    backend = BlockingBackend()
+    cache = PrefixCache(backend, ttl=100, refresh=20)
+    cache.model_for("model", "key", PREFIX)
+    now[0] += 90
+    backend.release.clear()
+    backend.entered.clear()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        refreshing = executor.submit(cache.model_for, "model", "key", PREFIX)
+        assert backend.entered.wait(10)
+        # The prefix still works while it is extended, so the other callers use it without waiting
+        assert cache.model_for("model", "key", PREFIX) == "model with cached-1"
+        backend.release.set()
+        assert refreshing.result(10) == "model with cached-1"
+    assert backend.refreshed == ["cached-1"]
+    now[0] += 90
+    assert cache.model_for("model", "key", PREFIX) == "model with cached-1"
+    assert backend.refreshed == ["cached-1", "cached-1"]
+
+    # A prefix that was not used before it expired is dropped and registered again
+    now[0] += 200
+    assert cache.model_for("model", "key", PREFIX) == "model with cached-2"
+    assert cache.stats()["dropped"] == 1
+
+
+def test_an_invalidated_prefix_is_sent_inline_until_the_retry_delay(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("prefix_cache.time.monotonic", lambda: now[0])
+    cache = PrefixCache(BlockingBackend(), retry=60)
+    cache.model_for("model", "key", PREFIX)
+    cache.invalidate("key", RuntimeError("404 CachedContent not found"))
+    assert cache.model_for("model", "key", PREFIX) is None
+    assert cache.stats()["dropped"] == 1 and "404" in cache.last_error
+    now[0] += 61
+    assert cache.model_for("model", "key", PREFIX) == "model with cached-2"
+
+
+def test_record_call_estimates_the_seconds_saved():
+    cache = PrefixCache(BlockingBackend())
+    assert cache.record_call(True, 1.0) is None
+    assert cache.record_call(False, 3.0) is None
+    assert cache.record_call(True, 1.0) == pytest.approx(2.0)
+    stats = cache.stats()
+    assert (stats["cached_calls"], stats["inline_calls"], stats["mean_inline_seconds"]) == (2, 1, 3.0)
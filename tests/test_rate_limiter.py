@@ -0,0 +1,147 @@
+# Tests for the token buckets, the retry policy and the adaptive concurrency limit (AIMD) of the API limiter
+# Importing the required libraries
+import pytest
+
+import rate_limiter
+from rate_limiter import ApiLimiter, TokenBucket, get_retry_after, get_status_code, is_retryable
+
+
+class ApiError(Exception):
+    """Error carrying a status code, like the exceptions of the Gemini SDK."""
+
+    def __init__(self, code, message=""):
+        super().__init__(message or f"HTTP {code}")
+        self.code = code
+
+
+class Clock:
+    """Stand-in for time.monotonic and time.sleep: sleeping moves the clock forward."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limiter.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(rate_limiter.time, "sleep", clock.sleep)
+    return clock
+
+
+def test_token_bucket_waits_for_the_refill(clock):
+    bucket = TokenBucket(rate_per_minute=60, capacity=2)
+    assert bucket.acquire() == 0.0
+    assert bucket.acquire() == 0.0
+    # Empty: the next token arrives after one second
+    assert bucket.acquire() == pytest.approx(1.0)
+    clock.now += 10
+    # The bucket refills up to its capacity, not beyond
+    assert bucket.acquire(2) == 0.0
+    assert bucket.acquire() == pytest.approx(1.0)
+
+
+def test_token_bucket_delays_oversized_requests_and_drains(clock):
+    bucket = TokenBucket(rate_per_minute=60, capacity=5)
+    # More than the capacity is served once the bucket is full instead of waiting forever
+    assert bucket.acquire(50) == 0.0
+    clock.now += 5
+    bucket.drain()
+    assert bucket.acquire() == pytest.approx(1.0)
+
+
+def test_status_codes_and_retryable_errors():
+    assert get_status_code(ApiError(429)) == 429
+    assert get_status_code(Exception()) is None
+    assert is_retryable(ApiError(503))
+    assert is_retryable(ConnectionError())
+    assert not is_retryable(ApiError(400))
+    assert not is_retryable(ValueError())
+
+
+def test_get_retry_after_reads_the_message():
+    assert get_retry_after(ApiError(429, "Quota exceeded, please retry in 2.5s")) == 2.5
+    assert get_retry_after(ApiError(429)) is None
+
+
+def test_call_retries_transient_failures(clock):
+    limiter = ApiLimiter("test", requests_per_minute=6000, max_retries=3, base_delay=0.5)
+    outcomes = [ApiError(500), ApiError(502), "answer"]
+    retries = []
+
+    def call():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    assert limiter.call(call, on_retry=lambda attempt, delay, error: retries.append(attempt)) == "answer"
+    assert retries == [1, 2]
+    stats = limiter.stats()
+    assert (stats["calls"], stats["succeeded"], stats["failed"], stats["retries"]) == (3, 1, 0, 2)
+
+
+def test_call_gives_up_on_permanent_errors_and_after_max_retries(clock):
+    limiter = ApiLimiter("test", requests_per_minute=6000, max_retries=2)
+    calls = []
+
+    def bad_request():
+        calls.append(1)
+        raise ApiError(400)
+
+    with pytest.raises(ApiError):
+        limiter.call(bad_request)
+    assert len(calls) == 1
+
+    def unavailable():
+        calls.append(1)
+        raise ApiError(500)
+
+    with pytest.raises(ApiError):
+        limiter.call(unavailable)
+    assert len(calls) == 1 + 3
+    assert limiter.stats()["failed"] == 2
+
+
+def test_throttling_halves_the_concurrency_limit_and_successes_grow_it_back(clock):
+    # 64 requests a second: the waits after each drain are exact binary fractions for the stand-in clock
+    limiter = ApiLimiter("test", requests_per_minute=64 * 60, max_concurrency=8, max_retries=0)
+
+    def throttled():
+        raise ApiError(429)
+
+    for expected in (4, 2, 1, 1):
+        with pytest.raises(ApiError):
+            limiter.call(throttled)
+        assert limiter.stats()["concurrency_limit"] == expected
+    assert limiter.stats()["throttled"] == 4
+
+    # Additive increase: about one slot per limit's worth of successful calls, capped at max_concurrency
+    limiter.call(lambda: None)
+    assert limiter.stats()["concurrency_limit"] == 2
+    for _ in range(100):
+        limiter.call(lambda: None)
+    assert limiter.stats()["concurrency_limit"] == 8
+
+
+def test_throttling_uses_the_servers_retry_delay(clock):
+    limiter = ApiLimiter("test", requests_per_minute=6000, max_retries=1, max_delay=60.0)
+    outcomes = [ApiError(429, "retry in 3s"), "answer"]
+
+    def call():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    delays = []
+    assert limiter.call(call, on_retry=lambda attempt, delay, error: delays.append(delay)) == "answer"
+    assert delays == [3.0]
@@ -0,0 +1,71 @@
+# Tests for the content-addressed cache of the per-page stages
+# Importing the required libraries
+from io import BytesIO
+
+import pytest
+
+from result_cache import FLASHCARD_STAGE, OCR_STAGE, ResultCache, hash_bytes, hash_stream, hash_strings
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache.sqlite3"))
+    yield cache
+    cache.close()
+
+
+def test_hash_stream_matches_hash_bytes_and_rewinds():
+    data = bytes(range(256)) * 100
+    stream = BytesIO(data)
+    stream.seek(50)
+    assert hash_stream(stream, block_size=1000) == hash_bytes(data)
+    assert stream.tell() == 0
+
+
+def test_hash_strings_separates_its_parts():
+    assert hash_strings("ab", "c") != hash_strings("a", "bc")
+    assert hash_strings(None) == hash_strings("")
+    assert hash_strings(1, "x") == hash_strings("1", "x")
+
+
+def test_get_put_and_stats(cache):
+    assert cache.get(OCR_STAGE, "page") is None
+    cache.put(OCR_STAGE, "page", "テキスト")
+    assert cache.get(OCR_STAGE, "page") == "テキスト"
+    # Stages are namespaces of their own
+    assert cache.get(FLASHCARD_STAGE, "page") is None
+    stats = cache.stats()
+    assert stats["hits"] == {FLASHCARD_STAGE: 0, OCR_STAGE: 1}
+    assert stats["misses"] == {FLASHCARD_STAGE: 1, OCR_STAGE: 1}
+    assert (stats["entries"], stats["bytes"]) == (1, len("テキスト".encode("utf-8")))
+
+    cache.clear()
+    assert cache.get(OCR_STAGE, "page") is None
+
+
+def test_least_recently_used_entries_are_evicted_first(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / "cache.sqlite3"), max_bytes=30)
+    now = [100.0]
+    monkeypatch.setattr("result_cache.time.time", lambda: now[0])
+    for key in ("a", "b", "c"):
+        cache.put(OCR_STAGE, key, "x" * 10)
+        now[0] += 1
+    cache.get(OCR_STAGE, "a")  # "b" is now the least recently used
+    now[0] += 1
+    cache.put(OCR_STAGE, "d", "x" * 10)
+    assert cache.get(OCR_STAGE, "b") is None
+    assert all(cache.get(OCR_STAGE, key) is not None for key in ("a", "c", "d"))
+    # A value larger than the whole cache is not stored
+    cache.put(OCR_STAGE, "huge", "x" * 31)
+    assert cache.get(OCR_STAGE, "huge") is None
+    cache.close()
+
+
+def test_entries_persist_across_instances(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    first = ResultCache(path)
+    first.put(FLASHCARD_STAGE, "key", "cards")
+    first.close()
+    second = ResultCache(path)
+    assert second.get(FLASHCARD_STAGE, "key") == "cards"
+    second.close()
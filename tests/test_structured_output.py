@@ -0,0 +1,123 @@
+# Tests for the validation of schema-constrained answers and the accounting of their repairs
+# Importing the required libraries
+import json
+
+import pytest
+
+from app import PipelineConfig, process_pages
+from benchmarks.fake_backends import FakeGenerativeModel, make_fake_resources, make_synthetic_pages
+from benchmarks.run_benchmarks import make_unthrottled_limiter
+from flashcard_deck import Flashcard
+from result_cache import FLASHCARD_STAGE
+from structured_output import (
+    MAX_REPAIR_ROW_CHARACTERS,
+    SINGLE_PASS_CARDS_FIELD,
+    SinglePassStreamParser,
+    StructuredOutputError,
+    format_repair_rows,
+    parse_single_pass,
+    parse_suitability,
+    repair_report,
+    strip_fences,
+)
+from token_budget import TokenBudgetPlanner
+
+CARDS = [
+    {"kanji": "迷う", "furigana": "まよう", "english_translation_and_notes": "to get lost"},
+    {"kanji": "道", "furigana": "みち", "english_translation_and_notes": "road, way"},
+]
+
+
+# Function to write a single-pass answer the way Gemini orders its properties
+# Returns: JSON text
+def single_pass_answer(is_suitable="Yes", cards=CARDS):
+    return json.dumps(
+        {"is_suitable": is_suitable, "reason": "A vocabulary list.", SINGLE_PASS_CARDS_FIELD: cards},
+        ensure_ascii=False,
+    )
+
+
+def test_strip_fences():
+    assert strip_fences('```json\n{"a": 1}\n```') == '\n{"a": 1}\n'
+
+
+def test_parse_suitability_reads_a_fenced_verdict():
+    verdict = parse_suitability('```json\n{"is_suitable": "No", "reason": "A photo."}\n```')
+    assert verdict == {"is_suitable": "No", "reason": "A photo."}
+    assert parse_suitability('{"is_suitable": "Yes", "reason": null}') == {"is_suitable": "Yes", "reason": ""}
+
+
+@pytest.mark.parametrize("text", [None, "", "Yes, it is suitable.", '{"is_suitable": "Maybe"}', '["Yes"]'])
+def test_parse_suitability_rejects_malformed_verdicts(text):
+    with pytest.raises(StructuredOutputError):
+        parse_suitability(text)
+
+
+def test_parse_single_pass_reads_the_verdict_and_the_cards():
+    verdict, cards, rejected, objects = parse_single_pass(single_pass_answer())
+    assert verdict == {"is_suitable": "Yes", "reason": "A vocabulary list."}
+    assert cards == [Flashcard("迷う", "まよう", "to get lost"), Flashcard("道", "みち", "road, way")]
+    assert rejected == []
+    assert objects == 2
+
+
+def test_parse_single_pass_keeps_malformed_and_truncated_cards_for_repair():
+    answer = single_pass_answer(cards=[CARDS[0], {"kanji": "道"}])
+    verdict, cards, rejected, objects = parse_single_pass(answer)
+    assert verdict["is_suitable"] == "Yes"
+    assert cards == [Flashcard("迷う", "まよう", "to get lost")]
+    assert rejected == ['{"kanji": "道"}']
+
+    # An answer cut off in the middle of a card keeps the verdict and the cards before it
+    truncated = single_pass_answer()[:-30]
+    verdict, cards, rejected, objects = parse_single_pass(truncated)
+    assert verdict["is_suitable"] == "Yes"
+    assert cards == [Flashcard("迷う", "まよう", "to get lost")]
+    assert len(rejected) == 1 and objects == 2
+
+
+def test_parse_single_pass_without_a_verdict():
+    verdict, cards, rejected, objects = parse_single_pass("I cannot read this page.")
+    assert verdict is None
+    assert cards == [] and objects == 0
+
+
+def test_single_pass_stream_parser_matches_the_whole_answer_parse():
+    answer = single_pass_answer()
+    parser = SinglePassStreamParser()
+    streamed = []
+    for position in range(0, len(answer), 7):
+        streamed += parser.feed(answer[position:position + 7])
+        if streamed:
+            # The verdict is read as soon as the card array opens, before the first card is done
+            assert parser.verdict is not None
+    parser.close()
+    assert (parser.verdict, streamed, parser.rejected, parser.objects) == parse_single_pass(answer)
+
+
+def test_format_repair_rows_cuts_runaway_rows():
+    rows = format_repair_rows(["  short  ", "x" * (MAX_REPAIR_ROW_CHARACTERS + 50)]).split("\n")
+    assert rows[0] == "short"
+    assert len(rows[1]) == MAX_REPAIR_ROW_CHARACTERS
+
+
+def test_repair_report_counts_the_tokens_saved_against_a_rerun():
+    report = repair_report(3, 2, {"prompt": 100, "candidates": 50}, {"prompt": 1000, "candidates": 400})
+    assert report == {"rows": 3, "repaired": 2, "tokens": 150, "tokens_saved": 1250}
+    assert repair_report(1, 0, None, None) == {"rows": 1, "repaired": 0, "tokens": 0, "tokens_saved": 0}
+    # A repair dearer than the call it replaces saves nothing, rather than a negative amount
+    assert repair_report(1, 1, {"prompt": 500}, {"prompt": 100})["tokens_saved"] == 0
+
+
+@pytest.mark.parametrize("structured_output", [False, True])
+def test_the_pipeline_reads_free_text_and_repairs_malformed_json_rows(monkeypatch, structured_output):
+    monkeypatch.setattr("app.STRUCTURED_OUTPUT", structured_output)
+    model = FakeGenerativeModel(suitable_rate=1.0, malformed_rate=0.5)
+    config = PipelineConfig(
+        rate_limiter=make_unthrottled_limiter(1), token_planner=TokenBudgetPlanner(budget=0, suitability_budget=0)
+    )
+    pages = enumerate(make_synthetic_pages(2), start=1)
+    for page_result in process_pages(pages, make_fake_resources(model=model), config):
+        assert len(page_result["cards"]) == model.cards_per_page
+        # Free-text answers are never malformed by the fake, so only JSON mode sends rows for repair
+        assert bool(page_result["repairs"].get(FLASHCARD_STAGE, {}).get("rows")) == structured_output
@@ -0,0 +1,110 @@
+# Tests for the token estimates and the planner fitting Gemini calls to their input-token budget
+# Importing the required libraries
+import PIL.Image
+
+from result_cache import FLASHCARD_STAGE, SUITABILITY_STAGE
+from token_budget import (
+    GEMINI_TOKENS_PER_IMAGE_TILE,
+    IMAGE_TILE_SIDE,
+    MAX_CALIBRATION_FACTOR,
+    MIN_CALIBRATION_CALLS,
+    TokenBudgetPlanner,
+    estimate_gemini_tokens,
+    image_tokens,
+    plan_key,
+    scaled_size,
+    text_tokens,
+)
+
+PAGE_SIZE = (2480, 3508)  # A4 at 300 DPI
+EXAMPLES = [((1600, 2200), 500), ((1600, 2200), 500)]
+
+
+def test_image_and_text_tokens():
+    assert image_tokens((300, 300)) == GEMINI_TOKENS_PER_IMAGE_TILE
+    assert image_tokens((IMAGE_TILE_SIDE + 1, IMAGE_TILE_SIDE)) == 2 * GEMINI_TOKENS_PER_IMAGE_TILE
+    assert text_tokens("") == 1
+    assert text_tokens("abcdef") == 3
+    contents = ["abcdef", PIL.Image.new("RGB", (300, 300)), object()]
+    assert estimate_gemini_tokens(contents) == 3 + GEMINI_TOKENS_PER_IMAGE_TILE
+
+
+def test_scaled_size_never_enlarges():
+    assert scaled_size((2000, 1000), 1000) == (1000, 500)
+    assert scaled_size((800, 600), 1000) == (800, 600)
+    assert scaled_size((800, 600), None) == (800, 600)
+
+
+def test_without_a_budget_the_request_is_sent_as_it_is():
+    planner = TokenBudgetPlanner(budget=0, suitability_budget=0)
+    plan = planner.plan(FLASHCARD_STAGE, 1000, EXAMPLES, PAGE_SIZE)
+    assert (plan.examples, plan.example_side, plan.page_side, plan.over_budget) == (None, None, None, False)
+    assert plan.predicted == 1000 + 2 * (image_tokens((1600, 2200)) + 500) + image_tokens(PAGE_SIZE)
+    assert plan_key(plan) == ""
+    assert planner.cache_key(FLASHCARD_STAGE) == ""
+
+
+def test_reductions_scale_the_examples_first_then_the_page_then_drop_examples():
+    planner = TokenBudgetPlanner(budget=10 ** 6, suitability_budget=0, min_page_side=1024)
+    full = planner.plan(FLASHCARD_STAGE, 1000, EXAMPLES, PAGE_SIZE)
+
+    # Just under the full request: the example images are scaled to one tile each
+    planner.budget = full.predicted - 1
+    plan = planner.plan(FLASHCARD_STAGE, 1000, EXAMPLES, PAGE_SIZE)
+    assert (plan.examples, plan.example_side, plan.page_side) == (None, IMAGE_TILE_SIDE, None)
+    assert plan.calibrated <= planner.budget
+
+    # Tighter: the page is scaled down too, but not below min_page_side
+    planner.budget = plan.predicted - 1
+    plan = planner.plan(FLASHCARD_STAGE, 1000, EXAMPLES, PAGE_SIZE)
+    assert plan.example_side == IMAGE_TILE_SIDE and plan.page_side is not None and plan.page_side >= 1024
+
+    # Only the system prompt and a small page fit: the examples are left out
+    planner.budget = 1000 + 1 + image_tokens(scaled_size(PAGE_SIZE, 1024))
+    plan = planner.plan(FLASHCARD_STAGE, 1000, EXAMPLES, PAGE_SIZE)
+    assert (plan.examples, plan.example_side, plan.page_side, plan.over_budget) == (0, None, 1024, False)
+    assert plan_key(plan) == "examples=0,example_side=None,page_side=1024"
+
+    # Nothing fits: the smallest request is sent and marked over budget
+    planner.budget = 10
+    plan = planner.plan(FLASHCARD_STAGE, 1000, EXAMPLES, PAGE_SIZE)
+    assert plan.over_budget and plan.examples == 0
+
+
+def test_suitability_calls_have_their_own_budget():
+    planner = TokenBudgetPlanner(budget=0, suitability_budget=1200, min_page_side=768)
+    plan = planner.plan(SUITABILITY_STAGE, 200, page_size=PAGE_SIZE)
+    assert plan.budget == 1200 and plan.calibrated <= 1200 and plan.page_side is not None
+    assert planner.cache_key(SUITABILITY_STAGE) == "budget=1200,min_page_side=768"
+    assert planner.cache_key(FLASHCARD_STAGE) == ""
+
+
+def test_calibration_scales_predictions_by_the_reported_tokens():
+    planner = TokenBudgetPlanner(budget=0, suitability_budget=0)
+    plan = planner.plan(FLASHCARD_STAGE, 1000)
+    for _ in range(MIN_CALIBRATION_CALLS - 1):
+        planner.record(FLASHCARD_STAGE, plan, {"prompt": 1500})
+    assert planner.calibration_factor(FLASHCARD_STAGE) == 1.0
+    entry = planner.record(FLASHCARD_STAGE, plan, {"prompt": 1500})
+    assert entry["stage"] == FLASHCARD_STAGE and entry["reported"] == 1500
+    assert planner.calibration_factor(FLASHCARD_STAGE) == 1.5
+    assert planner.plan(FLASHCARD_STAGE, 1000).calibrated == 1500
+
+    # Calls without reported usage are counted but do not calibrate
+    planner.record(FLASHCARD_STAGE, plan, None)
+    stats = planner.stats()[FLASHCARD_STAGE]
+    assert (stats["calls"], stats["measured"], stats["factor"]) == (MIN_CALIBRATION_CALLS + 1, MIN_CALIBRATION_CALLS, 1.5)
+
+    # The factor is bounded, so a few odd answers cannot throw the planner off
+    for _ in range(200):
+        planner.record(FLASHCARD_STAGE, plan, {"prompt": 10 ** 6})
+    assert planner.calibration_factor(FLASHCARD_STAGE) == MAX_CALIBRATION_FACTOR
+
+
+def test_example_images_are_scaled_once():
+    planner = TokenBudgetPlanner(budget=0, suitability_budget=0)
+    image = PIL.Image.new("RGB", (1600, 2200))
+    assert planner.example_image(image, None) is image
+    scaled = planner.example_image(image, IMAGE_TILE_SIDE)
+    assert max(scaled.size) == IMAGE_TILE_SIDE
+    assert planner.example_image(image, IMAGE_TILE_SIDE) is scaled
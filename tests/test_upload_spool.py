@@ -0,0 +1,76 @@
+# Tests for the disk spooling of uploads in low-memory mode
+# Importing the required libraries
+import os
+from io import BytesIO
+
+import pytest
+
+from upload_spool import UploadSpool, backing_path, release_upload, upload_size
+
+
+# Function to build an in-memory upload like Streamlit's
+# Returns: BytesIO with .name set
+def upload(data, name):
+    buffer = BytesIO(data)
+    buffer.name = name
+    return buffer
+
+
+@pytest.fixture
+def spool(tmp_path):
+    spool = UploadSpool(directory=str(tmp_path))
+    yield spool
+    spool.cleanup()
+
+
+def test_upload_size_leaves_the_position_at_the_start():
+    page = upload(b"0123456789", "page.jpg")
+    page.read(4)
+    assert upload_size(page) == 10
+    assert page.tell() == 0
+
+
+def test_backing_path_finds_real_files_only(tmp_path):
+    path = tmp_path / "page.jpg"
+    path.write_bytes(b"jpeg")
+    with open(path, "rb") as page_file:
+        assert backing_path(page_file) == str(path)
+    # An in-memory upload named like a file in the working directory is not that file
+    assert backing_path(upload(b"other", str(path))) is None
+    assert backing_path(BytesIO(b"unnamed")) is None
+
+
+def test_spooled_uploads_are_copied_and_reopened_in_order(spool):
+    pages = [upload(b"first page", "a.jpg"), upload(b"second page" * 1000, "dir/b.png")]
+    paths = [spool.add(page) for page in pages]
+    assert [os.path.basename(path) for path in paths] == ["00001-a.jpg", "00002-b.png"]
+    assert len(spool) == 2 and spool.bytes == 10 + 11000
+    # The uploads are left ready to be read again
+    assert all(page.tell() == 0 for page in pages)
+
+    handles = list(spool)
+    assert [handle.read() for handle in handles] == [page.getvalue() for page in pages]
+    assert all(handle.spooled and backing_path(handle) == path for handle, path in zip(handles, paths))
+
+
+def test_release_upload_closes_only_spooled_files(spool):
+    spool.add(upload(b"page", "a.jpg"))
+    spooled = next(iter(spool))
+    release_upload(spooled)
+    assert spooled.closed
+
+    # Streamlit's uploads are reused on reruns, so they stay open
+    original = upload(b"page", "a.jpg")
+    release_upload(original)
+    assert not original.closed
+
+
+def test_cleanup_closes_the_open_handles_and_deletes_the_files(tmp_path):
+    spool = UploadSpool(directory=str(tmp_path))
+    for name in ("a.jpg", "b.jpg"):
+        spool.add(upload(b"page", name))
+    iterator = iter(spool)
+    opened = next(iterator)
+    spool.cleanup()
+    assert opened.closed
+    assert not os.path.exists(spool.directory)
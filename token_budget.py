@@ -0,0 +1,309 @@
+# Token budget of the Gemini calls: the input tokens of each request are estimated before it is
+# sent, and the few-shot examples and the page image are scaled down, or examples left out, until
+# the request fits. Predictions are compared with the usage Gemini reports, to calibrate them.
+# Importing the required libraries
+import math
+import os
+import threading
+from collections import deque, namedtuple
+
+import PIL.Image
+
+from pipeline_metrics import ENCODED_BYTES_INFO_KEY
+from result_cache import SUITABILITY_STAGE
+
+# Input tokens allowed per flashcard (or single-pass) call; 0 (the default) sends every request as it is
+TOKEN_BUDGET = int(os.getenv("FLASHCARD_TOKEN_BUDGET", "0"))
+# Input tokens allowed per suitability call, which only needs a look at the page; 0 (the default) is no budget
+SUITABILITY_TOKEN_BUDGET = int(os.getenv("FLASHCARD_SUITABILITY_TOKEN_BUDGET", "0"))
+# The page image is never scaled below this many pixels on its long side; examples are left out first
+MIN_PAGE_SIDE = int(os.getenv("FLASHCARD_MIN_PAGE_SIDE", "1024"))
+# Set FLASHCARD_COUNT_TOKENS=1 to count the fixed prompt texts with Gemini's count_tokens (once per
+# model and text) instead of estimating them
+COUNT_TOKENS = os.getenv("FLASHCARD_COUNT_TOKENS", "0") == "1"
+
+# Gemini bills an image of up to 384x384 pixels as 258 tokens; larger images are
+# split into 768x768 tiles of 258 tokens each
+GEMINI_TOKENS_PER_IMAGE_TILE = 258
+SMALL_IMAGE_SIDE = 384
+IMAGE_TILE_SIDE = 768
+# Text is estimated at ~3 characters per token, which over-counts English and under-counts
+# dense Japanese only slightly; calibration corrects the rest
+CHARACTERS_PER_TOKEN = 3
+
+# Predictions are scaled by the ratio of reported to predicted tokens of a stage's last
+# CALIBRATION_WINDOW calls, once there are MIN_CALIBRATION_CALLS of them
+CALIBRATION_WINDOW = 200
+MIN_CALIBRATION_CALLS = 10
+MIN_CALIBRATION_FACTOR = 0.5
+MAX_CALIBRATION_FACTOR = 2.0
+
+# The long sides a page is tried at, largest first, when it does not fit whole
+PAGE_SIDE_STEPS = (3072, 2304, 1536, 1280, 1024, 768)
+
+# examples: Few-shot examples kept (0-2); example_side / page_side: long side the example images / the page
+# were scaled to (None if sent as they are); predicted: local estimate of the input tokens; calibrated: the
+# estimate after calibration, compared with budget; over_budget: True if even the smallest request is over it
+TokenPlan = namedtuple(
+    "TokenPlan", ["examples", "example_side", "page_side", "predicted", "calibrated", "budget", "over_budget"]
+)
+
+
+# Function to estimate the tokens of an image
+# size: (width, height) in pixels
+# Returns: Token count
+def image_tokens(size):
+    width, height = size
+    if width <= SMALL_IMAGE_SIDE and height <= SMALL_IMAGE_SIDE:
+        return GEMINI_TOKENS_PER_IMAGE_TILE
+    return GEMINI_TOKENS_PER_IMAGE_TILE * math.ceil(width / IMAGE_TILE_SIDE) * math.ceil(height / IMAGE_TILE_SIDE)
+
+
+# Function to estimate the tokens of a text
+# text: Prompt text
+# Returns: Token count
+def text_tokens(text):
+    return len(text) // CHARACTERS_PER_TOKEN + 1
+
+
+# Function to roughly estimate the input tokens of a Gemini request, for rate limiting
+# contents: The list of prompt strings and PIL images sent to generate_content
+# Returns: Estimated token count
+def estimate_gemini_tokens(contents):
+    tokens = 0
+    for part in contents:
+        if isinstance(part, str):
+            tokens += text_tokens(part)
+        elif hasattr(part, "size"):
+            tokens += image_tokens(part.size)
+    return tokens
+
+
+# Function to give the size of an image scaled down to a long side
+# size: (width, height) in pixels
+# side: Long side to scale to, or None to keep the size
+# Returns: (width, height); images already within side are not enlarged
+def scaled_size(size, side):
+    width, height = size
+    if side is None or max(width, height) <= side:
+        return size
+    scale = side / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+# Function to scale an image down to a long side
+# image: PIL image (decoded if it was opened lazily)
+# side: Long side, or None to return the image itself
+# Returns: The scaled copy, whose encoded size is counted as its share of the original's
+def scale_image(image, side):
+    size = scaled_size(image.size, side)
+    if size == image.size:
+        return image
+    scaled = image.resize(size, PIL.Image.Resampling.LANCZOS, reducing_gap=2.0)
+    encoded_bytes = image.info.get(ENCODED_BYTES_INFO_KEY)
+    if encoded_bytes:
+        scaled.info[ENCODED_BYTES_INFO_KEY] = encoded_bytes * size[0] * size[1] // max(1, image.width * image.height)
+    return scaled
+
+
+# Function to identify a reduced request, for cache keys and prefix variants
+# plan: TokenPlan
+# Returns: "" for a request sent as it is, else a short description such as "examples=1,example_side=768"
+def plan_key(plan):
+    if plan is None or (plan.examples is None and plan.example_side is None and plan.page_side is None):
+        return ""
+    return f"examples={plan.examples},example_side={plan.example_side},page_side={plan.page_side}"
+
+
+class TokenBudgetPlanner:
+    """
+    Plans each Gemini request within its stage's input-token budget.
+
+    A request that does not fit is reduced one step at a time, cheapest loss of
+    quality first: the example images are scaled to one tile each, then the page
+    is scaled down towards min_page_side, then the second and the first example
+    are left out. The first request that fits is sent; if none does, the
+    smallest one is sent and the plan is marked over budget.
+
+    Every call's predicted and reported input tokens are recorded; once a stage
+    has enough calls, its predictions are scaled by their recent ratio. Scaled
+    example images are kept, so each is only resized once per process.
+    """
+
+    def __init__(self, budget=TOKEN_BUDGET, suitability_budget=SUITABILITY_TOKEN_BUDGET, min_page_side=MIN_PAGE_SIDE,
+                 count_tokens=COUNT_TOKENS):
+        self.budget = budget
+        self.suitability_budget = suitability_budget
+        self.min_page_side = min_page_side
+        self.count_tokens = count_tokens
+        self._lock = threading.Lock()
+        self._scaled_examples = {}  # (id of the image, side) -> (image, scaled image)
+        self._counted_texts = {}  # (model name, text) -> token count
+        self._calibration = {}  # Stage -> deque of (predicted, reported)
+        self._stats = {}  # Stage -> totals
+
+    # Function to give a stage's budget
+    # stage: SUITABILITY_STAGE, or any other stage for the flashcard calls
+    # Returns: Input tokens allowed per call (0 for no budget)
+    def budget_for(self, stage):
+        return self.suitability_budget if stage == SUITABILITY_STAGE else self.budget
+
+    # Function to identify a stage's budget settings, for result cache keys
+    # stage: The stage making the call (see budget_for)
+    # Returns: "" when the stage has no budget, else e.g. "budget=8000,min_page_side=1024". The key is
+    #          the configured budget, not the plan: a plan depends on the calibration, which drifts
+    #          between runs, and would otherwise give the same page a new cache key each time it does
+    def cache_key(self, stage):
+        budget = self.budget_for(stage)
+        if not budget:
+            return ""
+        return f"budget={budget},min_page_side={self.min_page_side}"
+
+    # Function to count the tokens of a fixed prompt text
+    # text: Text sent with every page (the system prompt, the example prompts and answers)
+    # model: GenerativeModel to count with when count_tokens is on
+    # Returns: Token count, from count_tokens (kept per model and text) or else estimated
+    def fixed_text_tokens(self, text, model=None):
+        if not self.count_tokens or model is None:
+            return text_tokens(text)
+        key = (model.model_name, text)
+        with self._lock:
+            if key in self._counted_texts:
+                return self._counted_texts[key]
+        try:
+            tokens = model.count_tokens([text]).total_tokens
+        except Exception:
+            return text_tokens(text)  # Counted again on the next call
+        with self._lock:
+            self._counted_texts[key] = tokens
+        return tokens
+
+    # Function to give the factor a stage's predictions are scaled by
+    # Returns: Reported / predicted tokens of the recent calls, or 1.0 before there are enough of them
+    def calibration_factor(self, stage):
+        with self._lock:
+            samples = self._calibration.get(stage)
+            if not samples or len(samples) < MIN_CALIBRATION_CALLS:
+                return 1.0
+            predicted = sum(sample[0] for sample in samples)
+            reported = sum(sample[1] for sample in samples)
+        if not predicted:
+            return 1.0
+        return min(MAX_CALIBRATION_FACTOR, max(MIN_CALIBRATION_FACTOR, reported / predicted))
+
+    # Function to plan a request
+    # stage: The stage making the call (see budget_for)
+    # fixed_tokens: Tokens of the parts always sent (system prompt, the page's own prompt)
+    # examples: List of (image size, tokens of its prompt and answer) per few-shot example, in prompt order
+    # page_size: (width, height) of the page (or tile) image, or None
+    # Returns: TokenPlan
+    def plan(self, stage, fixed_tokens, examples=(), page_size=None):
+        budget = self.budget_for(stage)
+        factor = self.calibration_factor(stage)
+
+        def candidate(example_count, example_side, page_side):
+            predicted = fixed_tokens + sum(
+                image_tokens(scaled_size(size, example_side)) + tokens for size, tokens in examples[:example_count]
+            )
+            if page_size is not None:
+                predicted += image_tokens(scaled_size(page_size, page_side))
+            return TokenPlan(
+                example_count if example_count < len(examples) else None,
+                example_side,
+                page_side,
+                predicted,
+                round(predicted * factor),
+                budget,
+                False,
+            )
+
+        plan = candidate(len(examples), None, None)
+        if not budget or plan.calibrated <= budget:
+            return plan
+        for step in self._reductions(len(examples), page_size):
+            plan = candidate(*step)
+            if plan.calibrated <= budget:
+                return plan
+        return plan._replace(over_budget=True)
+
+    # Function to list the reductions of a request, in the order they are tried
+    # Yields: (examples kept, example side, page side)
+    def _reductions(self, example_count, page_size):
+        example_side = IMAGE_TILE_SIDE if example_count else None
+        yield example_count, example_side, None
+        page_side = None
+        if page_size is not None:
+            long_side = max(page_size)
+            for page_side in (side for side in PAGE_SIDE_STEPS if self.min_page_side <= side < long_side):
+                yield example_count, example_side, page_side
+            if long_side > self.min_page_side and page_side != self.min_page_side:
+                page_side = self.min_page_side
+                yield example_count, example_side, page_side
+        for kept in range(example_count - 1, -1, -1):
+            yield kept, example_side if kept else None, page_side
+
+    # Function to give an example image at a plan's size
+    # image: The decoded example image
+    # side: TokenPlan.example_side
+    # Returns: The image, scaled once per process and side
+    def example_image(self, image, side):
+        if side is None:
+            return image
+        key = (id(image), side)
+        with self._lock:
+            cached = self._scaled_examples.get(key)
+        if cached is not None and cached[0] is image:
+            return cached[1]
+        scaled = scale_image(image, side)
+        with self._lock:
+            self._scaled_examples[key] = (image, scaled)
+        return scaled
+
+    # Function to record how many input tokens a planned call was billed
+    # stage: The stage that made the call
+    # plan: Its TokenPlan
+    # usage: read_usage() of the answer (or None)
+    # Returns: Dictionary for the page result: the plan with the reported prompt tokens (None if not reported)
+    def record(self, stage, plan, usage):
+        reported = (usage or {}).get("prompt")
+        with self._lock:
+            totals = self._stats.setdefault(stage, {
+                "calls": 0, "reduced": 0, "over_budget": 0, "measured": 0, "predicted": 0, "reported": 0,
+                "absolute_error": 0,
+            })
+            totals["calls"] += 1
+            totals["reduced"] += bool(plan_key(plan))
+            totals["over_budget"] += plan.over_budget
+            if reported:
+                self._calibration.setdefault(stage, deque(maxlen=CALIBRATION_WINDOW)).append((plan.predicted, reported))
+                totals["measured"] += 1
+                totals["predicted"] += plan.predicted
+                totals["reported"] += reported
+                totals["absolute_error"] += abs(plan.calibrated - reported)
+        return {"stage": stage, **plan._asdict(), "reported": reported}
+
+    # Function to report the predictions so far, per stage
+    # Returns: Dictionary of stage -> calls, reduced and over-budget calls, the calls with reported usage and their
+    #          predicted and reported tokens, the mean absolute error of the calibrated predictions and the current factor
+    def stats(self):
+        with self._lock:
+            stats = {stage: dict(totals) for stage, totals in self._stats.items()}
+        for stage, totals in stats.items():
+            absolute_error = totals.pop("absolute_error")
+            totals["mean_absolute_error"] = absolute_error / totals["measured"] if totals["measured"] else None
+            totals["factor"] = self.calibration_factor(stage)
+        return stats
+
+
+_shared_planner = None
+_shared_planner_lock = threading.Lock()
+
+
+# Function to get the process-wide planner, whose calibration is shared by every run
+# Returns: TokenBudgetPlanner configured from the FLASHCARD_*TOKEN* environment variables
+def get_shared_token_planner():
+    global _shared_planner
+    with _shared_planner_lock:
+        if _shared_planner is None:
+            _shared_planner = TokenBudgetPlanner()
+        return _shared_planner
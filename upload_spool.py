@@ -0,0 +1,110 @@
+# Disk spooling of uploads, so long runs keep the page bytes in temp files instead of memory
+# Importing the required libraries
+import os
+import shutil
+import tempfile
+import threading
+
+# Where spooled uploads go; empty means the system temp directory
+SPOOL_DIRECTORY = os.getenv("FLASHCARD_SPOOL_DIR") or None
+
+# Uploads larger than this in total are spooled to disk even without low-memory mode
+SPILL_THRESHOLD_BYTES = int(float(os.getenv("FLASHCARD_SPILL_THRESHOLD_MB", "256")) * 1024 * 1024)
+
+COPY_CHUNK_BYTES = 1024 * 1024
+
+
+# Function to find the size of an upload without reading it
+# uploaded_file: Seekable file-like object
+# Returns: Size in bytes; the position is reset to the start
+def upload_size(uploaded_file):
+    uploaded_file.seek(0, os.SEEK_END)
+    size = uploaded_file.tell()
+    uploaded_file.seek(0)
+    return size
+
+
+# Function to find the file on disk behind a file object
+# file_obj: Any file-like object
+# Returns: The path of the regular file it reads, or None for in-memory buffers (a BytesIO with a
+#          .name set, as Streamlit's uploads have, is not mistaken for a file of that name)
+def backing_path(file_obj):
+    name = getattr(file_obj, "name", None)
+    if not isinstance(name, str):
+        return None
+    try:
+        file_stat = os.fstat(file_obj.fileno())
+        path_stat = os.stat(name)
+    except (AttributeError, OSError, ValueError):
+        return None
+    return name if os.path.samestat(file_stat, path_stat) else None
+
+
+# Function to close a page file the spool handed out, once the pipeline is done with it
+# file_obj: Any file-like object; only spooled files are closed (Streamlit's uploads are reused on reruns)
+# Returns: None
+def release_upload(file_obj):
+    if getattr(file_obj, "spooled", False):
+        file_obj.close()
+
+
+class UploadSpool:
+    """
+    Copies uploads into a private temp directory, in chunks, and hands them back
+    as files opened one at a time.
+
+    Iterating opens each file only when the consumer reaches it, so with the
+    pipeline's bounded read-ahead only a few are open at once. The pipeline
+    closes each one with release_upload() when its page (or document) is done,
+    and cleanup() closes any still open before deleting the directory, so no
+    handle outlives the job and Windows can delete the files. A spooled page is
+    a real file, so OCR can stream it from disk and Gemini can upload its bytes
+    without the page ever being decoded.
+    """
+
+    def __init__(self, directory=SPOOL_DIRECTORY):
+        self.directory = tempfile.mkdtemp(prefix="flashcard-spool-", dir=directory)
+        self.paths = []
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._handles = []
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        for path in self.paths:
+            handle = open(path, "rb")
+            handle.spooled = True
+            with self._lock:
+                self._handles = [h for h in self._handles if not h.closed]
+                self._handles.append(handle)
+            yield handle
+
+    # Function to spool one upload
+    # uploaded_file: Seekable file-like object; its name (if any) is kept at the end of the file name
+    # Returns: Path of the spooled copy
+    def add(self, uploaded_file):
+        name = os.path.basename(getattr(uploaded_file, "name", None) or "upload")
+        path = os.path.join(self.directory, f"{len(self.paths) + 1:05d}-{name}")
+        uploaded_file.seek(0)
+        with open(path, "wb") as spooled:
+            shutil.copyfileobj(uploaded_file, spooled, COPY_CHUNK_BYTES)
+            self.bytes += spooled.tell()
+        uploaded_file.seek(0)
+        self.paths.append(path)
+        return path
+
+    # Function to close the spooled files still open
+    # Returns: None
+    def close(self):
+        with self._lock:
+            handles, self._handles = self._handles, []
+        for handle in handles:
+            handle.close()
+
+    # Function to close and delete the spooled files
+    # Returns: None
+    def cleanup(self):
+        self.close()
+        shutil.rmtree(self.directory, ignore_errors=True)